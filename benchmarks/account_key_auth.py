@@ -0,0 +1,100 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Load benchmark for the account endpoints that authenticate with signed key data, the account
+registration endpoint and the account lookup endpoint. Each is measured with clients resending
+the same signed key data, which is served from the verified key data cache, and with freshly
+signed key data for every request, which requires signature verification.
+
+    python -m benchmarks.account_key_auth [--requests 2000] [--concurrency 20]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+from datetime import datetime
+import json
+from pathlib import Path
+import time
+
+import aiohttp
+from bitcoinx import PrivateKey
+
+from esv_reference_server.keys import VerifiableKeyDataDict
+
+from .support import external_url, start_reference_server, summarise_latencies
+
+
+MODULE_DIR = Path(__file__).parent
+
+
+def generate_key_data(private_key: PrivateKey) -> VerifiableKeyDataDict:
+    iso_date_text = datetime.utcnow().isoformat()
+    message_bytes = b"http://server/api/account/metadata" + iso_date_text.encode() + \
+        PrivateKey.from_random().to_bytes()
+    signature_bytes = private_key.sign_message(message_bytes)
+    return {
+        "public_key_hex": private_key.public_key.to_hex(),
+        "message_hex": message_bytes.hex(),
+        "signature_hex": signature_bytes.hex()
+    }
+
+
+async def run_scenario_async(session: aiohttp.ClientSession, method: str, url: str,
+        key_datas: list[VerifiableKeyDataDict], concurrency: int) -> dict[str, float]:
+    latencies = list[float]()
+    next_index = 0
+
+    async def client_async() -> None:
+        nonlocal next_index
+        while next_index < len(key_datas):
+            key_data = key_datas[next_index]
+            next_index += 1
+            start_time = time.perf_counter()
+            async with session.request(method, url, data=json.dumps(key_data)) as response:
+                assert response.status == 200, response.reason
+                await response.read()
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(client_async() for i in range(concurrency)))
+    return summarise_latencies(latencies, time.perf_counter() - start_time)
+
+
+async def main_async(request_count: int, concurrency: int) -> None:
+    private_key = PrivateKey.from_random()
+    # Client side signing is done before any measurement.
+    repeated_key_data = generate_key_data(private_key)
+    repeated_key_datas = [ repeated_key_data ] * request_count
+    unique_key_datas = [ generate_key_data(private_key) for i in range(request_count) ]
+
+    results: dict[str, dict[str, float]] = {}
+    async with aiohttp.ClientSession() as session:
+        register_url = external_url("/api/v1/account/register")
+        account_url = external_url("/api/v1/account")
+        results["register_repeated"] = await run_scenario_async(session, "POST", register_url,
+            repeated_key_datas, concurrency)
+        results["register_unique"] = await run_scenario_async(session, "POST", register_url,
+            unique_key_datas, concurrency)
+        results["account_repeated"] = await run_scenario_async(session, "GET", account_url,
+            repeated_key_datas, concurrency)
+        unique_key_datas = [ generate_key_data(private_key) for i in range(request_count) ]
+        results["account_unique"] = await run_scenario_async(session, "GET", account_url,
+            unique_key_datas, concurrency)
+    print(json.dumps(results, indent=2))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    start_reference_server(MODULE_DIR / "localdata")
+    asyncio.run(main_async(args.requests, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
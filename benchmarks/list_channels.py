@@ -0,0 +1,162 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+The time taken to list the channels of an account with many channels, which is what
+`GET /api/v1/channel/manage/list` does. The repository reads the channels and their tokens in
+two queries, and this is compared to reading the tokens for each channel with a query of its
+own, which is how the channels used to be read. Before the token table was indexed by channel,
+each of those queries also scanned the whole token table, which took minutes for 50,000
+channels. Reading all the channels in pages (the `after` and `limit` query parameters) is also
+measured.
+
+    python -m benchmarks.list_channels [--channels 50000] [--page-size 1000]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Optional
+
+try:
+    # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS has latest brew version of 3.35.5 (as of 2021-06-20).
+    # Windows builds use the official Python 3.10.0 builds and bundled version of 3.35.5.
+    import sqlite3
+
+from electrumsv_database.sqlite import replace_db_context_with_connection
+
+from esv_reference_server.constants import DEFAULT_DATABASE_NAME, MessageBoxTokenFlag
+from esv_reference_server.msg_box.models import MsgBox
+from esv_reference_server.msg_box.repositories import MsgBoxSQLiteRepository
+from esv_reference_server.request_timing import TimedDatabaseContext
+from esv_reference_server import sqlite_db
+from esv_reference_server import utils
+
+
+MODULE_DIR = Path(__file__).parent
+
+
+def populate(channel_count: int, db: Optional[sqlite3.Connection]=None) -> int:
+    """
+    Creates an account with the given number of channels, each with two tokens and two
+    messages. The rows are inserted directly as creating this many channels through the
+    repository one at a time is slow.
+    """
+    assert db is not None
+    account_id, _api_key = sqlite_db.create_account(os.urandom(33), db)
+    now = int(time.time())
+    db.executemany("INSERT INTO msg_box (id, account_id, externalid, publicread, publicwrite, "
+        "locked, sequenced, minagedays, maxagedays, autoprune) "
+        "VALUES (?, ?, ?, 1, 1, 0, 1, 0, 0, 1)",
+        [ (msg_box_id, account_id, utils.create_external_id())
+            for msg_box_id in range(1, channel_count+1) ])
+    flags = MessageBoxTokenFlag.READ_ACCESS | MessageBoxTokenFlag.WRITE_ACCESS
+    db.executemany("INSERT INTO msg_box_api_token (account_id, msg_box_id, token, description, "
+        "flags, validfrom) VALUES (?, ?, ?, ?, ?, ?)",
+        [ (account_id, msg_box_id, utils.create_channel_api_token(), description, flags, now)
+            for msg_box_id in range(1, channel_count+1)
+            for description in ("Owner", "Reader") ])
+    db.executemany("INSERT INTO message (fromtoken, msg_box_id, seq, receivedts, contenttype, "
+        "payload) VALUES (?, ?, ?, ?, 'application/octet-stream', x'00')",
+        [ (msg_box_id * 2 - 1, msg_box_id, seq, now)
+            for msg_box_id in range(1, channel_count+1) for seq in (1, 2) ])
+    return account_id
+
+
+async def list_channels_per_channel_tokens_async(repository: MsgBoxSQLiteRepository,
+        database_context: TimedDatabaseContext, account_id: int) -> list[MsgBox]:
+    """
+    How the channels were read before the tokens were read for all the channels at once.
+    """
+    sql = """
+        SELECT id, account_id, externalid, publicread, publicwrite, locked, sequenced,
+               minagedays, maxagedays, autoprune,
+               (SELECT max(seq) FROM message WHERE msg_box.id = message.msg_box_id) AS seq
+        FROM msg_box
+        WHERE account_id = ?
+    """
+    @replace_db_context_with_connection
+    def read(db: sqlite3.Connection) -> list[MsgBox]:
+        msg_boxes = []
+        for row in db.execute(sql, (account_id,)).fetchall():
+            id, account_id_, externalid, publicread, publicwrite, locked, sequenced, \
+                minagedays, maxagedays, autoprune, head_message_sequence = row
+            msg_boxes.append(MsgBox(id=id, account_id=account_id_, external_id=externalid,
+                public_read=publicread, public_write=publicwrite, locked=locked,
+                sequenced=sequenced, min_age_days=minagedays, max_age_days=maxagedays,
+                autoprune=autoprune, api_tokens=repository._read_msgbox_tokens(db, id),
+                head_message_sequence=head_message_sequence or 0))
+        return msg_boxes
+    return read(database_context)
+
+
+async def list_channels_paged_async(repository: MsgBoxSQLiteRepository, account_id: int,
+        page_size: int) -> list[MsgBox]:
+    msg_boxes: list[MsgBox] = []
+    after_id = 0
+    while True:
+        page = await repository.get_msg_boxes_async(account_id, after_id, page_size)
+        msg_boxes.extend(page)
+        if len(page) < page_size:
+            return msg_boxes
+        after_id = page[-1].id
+
+
+async def main_async(channel_count: int, page_size: int) -> None:
+    data_path = MODULE_DIR / "localdata" / "list_channels"
+    if data_path.exists():
+        shutil.rmtree(data_path)
+    data_path.mkdir(parents=True)
+
+    database_context = TimedDatabaseContext(str(data_path / DEFAULT_DATABASE_NAME))
+    repository = MsgBoxSQLiteRepository(database_context)
+    def setup(db: Optional[sqlite3.Connection]=None) -> int:
+        sqlite_db.setup(db)
+        repository.create_tables(db)
+        return populate(channel_count, db)
+    try:
+        account_id = database_context.run_in_thread(setup)
+
+        results: dict[str, object] = { "channels": channel_count }
+        for name, list_channels in (
+                ("per_channel_token_queries",
+                    lambda: list_channels_per_channel_tokens_async(repository, database_context,
+                        account_id)),
+                ("two_queries", lambda: repository.get_msg_boxes_async(account_id)),
+                (f"pages_of_{page_size}",
+                    lambda: list_channels_paged_async(repository, account_id, page_size))):
+            start_time = time.perf_counter()
+            msg_boxes = await list_channels()
+            elapsed = time.perf_counter() - start_time
+            assert len(msg_boxes) == channel_count
+            assert all(len(msg_box.api_tokens) == 2 and msg_box.head_message_sequence == 2
+                for msg_box in msg_boxes)
+            results[name] = { "seconds": elapsed }
+
+        start_time = time.perf_counter()
+        await repository.get_msg_boxes_async(account_id, channel_count // 2, page_size)
+        results["single_page_seconds"] = time.perf_counter() - start_time
+        print(json.dumps(results, indent=4))
+    finally:
+        database_context.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=50000)
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.channels, args.page_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Load-testing harness for the reference server HTTP and websocket APIs.
+
+The reference server is run in-process against local stand-ins for HeaderSV and the indexer
+(see `benchmarks.standins`). A configurable mix of requests is driven against it by concurrent
+clients for a fixed duration, while websocket subscribers to the channels measure the latency
+of message notification fan-out. The results are written as JSON so that they can be compared
+from release to release.
+
+    python -m benchmarks.load [--duration 10] [--concurrency 32] [--channels 8]
+        [--subscribers 16] [--mix channel_write=40,channel_read=30,...] [--output result.json]
+
+Scenario names for `--mix`:
+
+    channel_write           Write a message to a channel.
+    channel_read            Read the unread messages in a channel.
+    channel_head            Get the maximum sequence in a channel.
+    channel_mark_read       Mark the messages in a channel as read.
+    tip_filter_register     Register a tip filter pushdata hash (proxied to the indexer).
+    headers_tips            Get the header chain tips (proxied to HeaderSV).
+
+Peak RSS is that of the whole benchmark process, which includes the clients and stand-ins.
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import sys
+import time
+from typing import Any, Awaitable, Callable, Optional
+try:
+    import resource
+except ModuleNotFoundError:
+    # Windows does not have this module.
+    resource = None # type: ignore[assignment]
+
+import aiohttp
+
+from esv_reference_server.application_state import ApplicationState
+from esv_reference_server.sqlite_db import create_account
+from esv_reference_server.types import tip_filter_registration_struct
+
+from .standins import HEADER_SV_URL, INDEXER_URL, StandInServices
+from .support import external_url, start_reference_server, summarise_latencies
+
+
+MODULE_DIR = Path(__file__).parent
+
+DEFAULT_MIX = "channel_write=40,channel_read=25,channel_head=10,channel_mark_read=10," \
+    "tip_filter_register=5,headers_tips=10"
+
+
+@dataclasses.dataclass
+class Channel:
+    channel_id: str
+    write_token: str
+    read_token: str
+
+
+@dataclasses.dataclass
+class BenchmarkState:
+    session: aiohttp.ClientSession
+    api_key: str
+    channels: list[Channel]
+    # Latencies in seconds for each scenario.
+    latencies: dict[str, list[float]] = dataclasses.field(default_factory=dict)
+    failures: dict[str, int] = dataclasses.field(default_factory=dict)
+    # (channel id, sequence): time the write was started.
+    write_times: dict[tuple[str, int], float] = dataclasses.field(default_factory=dict)
+    # (channel id, sequence): times notifications were received before the write completed.
+    early_notification_times: dict[tuple[str, int], list[float]] = \
+        dataclasses.field(default_factory=dict)
+    fanout_latencies: list[float] = dataclasses.field(default_factory=list)
+
+
+ScenarioFunction = Callable[[BenchmarkState], Awaitable[bool]]
+
+
+def parse_mix(mix_text: str) -> dict[str, int]:
+    mix = dict[str, int]()
+    for entry_text in mix_text.split(","):
+        name, _separator, weight_text = entry_text.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario '{name}'")
+        mix[name] = int(weight_text) if weight_text else 1
+    return mix
+
+
+def get_peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # MacOS reports this in bytes and Linux in kilobytes.
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+async def _create_channel_async(session: aiohttp.ClientSession, api_key: str) -> Channel:
+    headers = { "Authorization": f"Bearer {api_key}" }
+    request_body = {
+        "public_read": True,
+        "public_write": True,
+        "sequenced": True,
+        "retention": { "min_age_days": 0, "max_age_days": 0, "auto_prune": True },
+    }
+    async with session.post(external_url("/api/v1/channel/manage"), headers=headers,
+            json=request_body) as response:
+        assert response.status == 200, response.reason
+        channel_data = await response.json()
+    channel_id = channel_data["id"]
+    write_token = channel_data["access_tokens"][0]["token"]
+
+    request_body = { "description": "benchmark reader", "can_read": True, "can_write": False }
+    async with session.post(external_url(f"/api/v1/channel/manage/{channel_id}/api-token"),
+            headers=headers, json=request_body) as response:
+        assert response.status == 200, response.reason
+        token_data = await response.json()
+    return Channel(channel_id, write_token, token_data["token"])
+
+
+def _record_fanout(state: BenchmarkState, key: tuple[str, int], received_time: float) -> None:
+    write_time = state.write_times.get(key)
+    if write_time is None:
+        state.early_notification_times.setdefault(key, []).append(received_time)
+    else:
+        state.fanout_latencies.append(received_time - write_time)
+
+
+async def _channel_write_async(state: BenchmarkState) -> bool:
+    channel = random.choice(state.channels)
+    headers = {
+        "Authorization": f"Bearer {channel.write_token}",
+        "Content-Type": "application/json",
+    }
+    start_time = time.perf_counter()
+    async with state.session.post(external_url(f"/api/v1/channel/{channel.channel_id}"),
+            headers=headers, json={ "value": os.urandom(32).hex() }) as response:
+        if response.status != 200:
+            return False
+        message_data = await response.json()
+    key = (channel.channel_id, message_data["sequence"])
+    state.write_times[key] = start_time
+    for received_time in state.early_notification_times.pop(key, []):
+        state.fanout_latencies.append(received_time - start_time)
+    return True
+
+
+async def _channel_read_async(state: BenchmarkState) -> bool:
+    channel = random.choice(state.channels)
+    headers = { "Authorization": f"Bearer {channel.read_token}" }
+    async with state.session.get(external_url(f"/api/v1/channel/{channel.channel_id}"),
+            headers=headers, params={ "unread": "true" }) as response:
+        await response.read()
+        return response.status == 200
+
+
+async def _channel_head_async(state: BenchmarkState) -> bool:
+    channel = random.choice(state.channels)
+    headers = { "Authorization": f"Bearer {channel.read_token}" }
+    async with state.session.head(external_url(f"/api/v1/channel/{channel.channel_id}"),
+            headers=headers) as response:
+        return response.status == 200
+
+
+async def _channel_mark_read_async(state: BenchmarkState) -> bool:
+    channel = random.choice(state.channels)
+    headers = { "Authorization": f"Bearer {channel.read_token}" }
+    async with state.session.head(external_url(f"/api/v1/channel/{channel.channel_id}"),
+            headers=headers) as response:
+        if response.status != 200:
+            return False
+        max_sequence = int(response.headers.get("ETag", "0") or "0")
+    if max_sequence == 0:
+        # Nothing has been written to this channel yet, and there is nothing to mark.
+        return True
+    async with state.session.post(
+            external_url(f"/api/v1/channel/{channel.channel_id}/{max_sequence}"),
+            headers=headers, params={ "older": "true" }, json={ "read": True }) as response:
+        await response.read()
+        return response.status == 200
+
+
+async def _tip_filter_register_async(state: BenchmarkState) -> bool:
+    headers = {
+        "Authorization": f"Bearer {state.api_key}",
+        "Content-Type": "application/octet-stream",
+        "Accept": "application/json",
+    }
+    body = tip_filter_registration_struct.pack(os.urandom(32), 86400)
+    async with state.session.post(external_url("/api/v1/transaction/filter"), headers=headers,
+            data=body) as response:
+        await response.read()
+        return response.status == 200
+
+
+async def _headers_tips_async(state: BenchmarkState) -> bool:
+    async with state.session.get(external_url("/api/v1/headers/tips"),
+            headers={ "Accept": "application/json" }) as response:
+        await response.read()
+        return response.status == 200
+
+
+SCENARIOS: dict[str, ScenarioFunction] = {
+    "channel_write": _channel_write_async,
+    "channel_read": _channel_read_async,
+    "channel_head": _channel_head_async,
+    "channel_mark_read": _channel_mark_read_async,
+    "tip_filter_register": _tip_filter_register_async,
+    "headers_tips": _headers_tips_async,
+}
+
+
+async def _subscriber_async(state: BenchmarkState, channel: Channel,
+        connected_event: asyncio.Event) -> None:
+    url = external_url(f"/api/v1/channel/{channel.channel_id}/notify", "ws")
+    async with state.session.ws_connect(url, params={ "token": channel.read_token }) as websocket:
+        connected_event.set()
+        async for message in websocket:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+            received_time = time.perf_counter()
+            notification = json.loads(message.data)
+            _record_fanout(state, (channel.channel_id, notification["sequence"]), received_time)
+
+
+async def _client_async(state: BenchmarkState, scenario_names: list[str], weights: list[int],
+        end_time: float) -> None:
+    while time.perf_counter() < end_time:
+        scenario_name = random.choices(scenario_names, weights)[0]
+        start_time = time.perf_counter()
+        try:
+            succeeded = await SCENARIOS[scenario_name](state)
+        except aiohttp.ClientError:
+            succeeded = False
+        if succeeded:
+            state.latencies.setdefault(scenario_name, []).append(
+                time.perf_counter() - start_time)
+        else:
+            state.failures[scenario_name] = state.failures.get(scenario_name, 0) + 1
+
+
+async def _wait_for_indexer_async(application_state: ApplicationState) -> None:
+    for i in range(100):
+        if application_state.indexer_is_connected:
+            return
+        await asyncio.sleep(0.1)
+    raise Exception("Reference server did not connect to the indexer stand-in")
+
+
+async def run_benchmark_async(application_state: ApplicationState, duration: float,
+        concurrency: int, channel_count: int, subscriber_count: int, mix: dict[str, int]) \
+            -> dict[str, Any]:
+    await _wait_for_indexer_async(application_state)
+
+    _account_id, api_key = await application_state.database_context.run_in_thread_async(
+        create_account, os.urandom(33))
+    connector = aiohttp.TCPConnector(limit=concurrency + subscriber_count + 1)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        channels = [ await _create_channel_async(session, api_key)
+            for i in range(channel_count) ]
+        state = BenchmarkState(session, api_key, channels)
+
+        subscriber_tasks = list[asyncio.Task[None]]()
+        for subscriber_index in range(subscriber_count):
+            connected_event = asyncio.Event()
+            subscriber_tasks.append(asyncio.create_task(_subscriber_async(state,
+                channels[subscriber_index % len(channels)], connected_event)))
+            await asyncio.wait_for(connected_event.wait(), 10.0)
+
+        scenario_names = list(mix)
+        weights = [ mix[name] for name in scenario_names ]
+        start_time = time.perf_counter()
+        end_time = start_time + duration
+        await asyncio.gather(*(_client_async(state, scenario_names, weights, end_time)
+            for i in range(concurrency)))
+        elapsed = time.perf_counter() - start_time
+        # Allow the last notifications to be delivered.
+        await asyncio.sleep(0.5)
+        for task in subscriber_tasks:
+            task.cancel()
+        await asyncio.gather(*subscriber_tasks, return_exceptions=True)
+
+    all_latencies = [ latency for latencies in state.latencies.values()
+        for latency in latencies ]
+    return {
+        "config": {
+            "duration_seconds": duration,
+            "concurrency": concurrency,
+            "channels": channel_count,
+            "subscribers": subscriber_count,
+            "mix": mix,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "total": summarise_latencies(all_latencies, elapsed),
+        "scenarios": {
+            name: dict(summarise_latencies(state.latencies.get(name, []), elapsed),
+                failures=state.failures.get(name, 0))
+            for name in scenario_names
+        },
+        "websocket_fanout": summarise_latencies(state.fanout_latencies, elapsed),
+        "peak_rss_kb": get_peak_rss_kb(),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--subscribers", type=int, default=16)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--output", type=Path, default=None,
+        help="Write the JSON results to this file as well as standard output")
+    args = parser.parse_args()
+
+    stand_ins = StandInServices()
+    stand_ins.start()
+    application_state = start_reference_server(MODULE_DIR / "localdata", {
+        "EXPOSE_HEADER_SV_APIS": "1",
+        "HEADER_SV_URL": HEADER_SV_URL,
+        "EXPOSE_INDEXER_APIS": "1",
+        "INDEXER_URL": INDEXER_URL,
+    })
+    results = asyncio.run(run_benchmark_async(application_state, args.duration,
+        args.concurrency, args.channels, args.subscribers, args.mix))
+    stand_ins.stop()
+
+    results_text = json.dumps(results, indent=2)
+    print(results_text)
+    if args.output is not None:
+        args.output.write_text(results_text)
+
+
+if __name__ == "__main__":
+    main()
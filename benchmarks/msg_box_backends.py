@@ -0,0 +1,195 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Comparison of the peer channel storage backends, the SQLite database that is the default,
+several sharded SQLite databases (see `PEER_CHANNELS_SQLITE_SHARDS`) and a PostgreSQL database
+(see `PEER_CHANNELS_DATABASE_URL`). The repositories are used directly so that only the storage
+is measured, with concurrent writers spread across many channels, all writing to the same
+channel and reading the messages in a channel.
+
+    python -m benchmarks.msg_box_backends [--writes 2000] [--concurrency 32] [--channels 32]
+        [--shards 4] [--postgres-url postgresql://user@127.0.0.1/scratch]
+
+The PostgreSQL database given is reset, so it should be a scratch database. If no URL is given
+the `PEER_CHANNELS_DATABASE_URL` setting is used, and if there is neither only the SQLite
+backends are measured.
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Optional
+
+try:
+    # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS has latest brew version of 3.35.5 (as of 2021-06-20).
+    # Windows builds use the official Python 3.10.0 builds and bundled version of 3.35.5.
+    import sqlite3
+
+from esv_reference_server.constants import DEFAULT_DATABASE_NAME
+from esv_reference_server.msg_box.models import Message, MsgBox
+from esv_reference_server.msg_box.repositories import MsgBoxRepository, MsgBoxSQLiteRepository
+from esv_reference_server.msg_box.repositories_sharded import MsgBoxShardedSQLiteRepository
+from esv_reference_server.msg_box.view_models import MsgBoxViewModelCreate, RetentionViewModel
+from esv_reference_server.request_timing import TimedDatabaseContext
+from esv_reference_server import sqlite_db
+
+from .support import summarise_latencies
+
+
+MODULE_DIR = Path(__file__).parent
+
+PAYLOAD = os.urandom(256)
+
+
+async def create_channels_async(repository: MsgBoxRepository, account_id: int,
+        channel_count: int) -> list[MsgBox]:
+    view = MsgBoxViewModelCreate(public_read=True, public_write=True, sequenced=False,
+        retention=RetentionViewModel(min_age_days=0, max_age_days=0, auto_prune=True))
+    return [ await repository.create_message_box_async(view, account_id)
+        for i in range(channel_count) ]
+
+
+async def run_writes_async(repository: MsgBoxRepository, channels: list[MsgBox],
+        write_count: int, concurrency: int) -> dict[str, float]:
+    latencies = list[float]()
+    next_index = 0
+
+    async def writer_async() -> None:
+        nonlocal next_index
+        while next_index < write_count:
+            msg_box = channels[next_index % len(channels)]
+            next_index += 1
+            message = Message(msg_box_id=msg_box.id,
+                msg_box_api_token_id=msg_box.api_tokens[0].id,
+                content_type="application/octet-stream", payload=PAYLOAD,
+                received_ts=int(time.time()))
+            start_time = time.perf_counter()
+            await repository.write_message_async(message)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(writer_async() for i in range(concurrency)))
+    return summarise_latencies(latencies, time.perf_counter() - start_time)
+
+
+async def run_reads_async(repository: MsgBoxRepository, channels: list[MsgBox],
+        read_count: int, concurrency: int) -> dict[str, float]:
+    latencies = list[float]()
+    next_index = 0
+
+    async def reader_async() -> None:
+        nonlocal next_index
+        while next_index < read_count:
+            msg_box = channels[next_index % len(channels)]
+            next_index += 1
+            start_time = time.perf_counter()
+            await repository.get_messages_async(msg_box.api_tokens[0].id, False)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(reader_async() for i in range(concurrency)))
+    return summarise_latencies(latencies, time.perf_counter() - start_time)
+
+
+async def measure_backend_async(repository: MsgBoxRepository, account_id: int,
+        write_count: int, concurrency: int, channel_count: int) -> dict[str, dict[str, float]]:
+    channels = await create_channels_async(repository, account_id, channel_count + 1)
+    contended_channel = channels.pop()
+    return {
+        "write_many_channels": await run_writes_async(repository, channels, write_count,
+            concurrency),
+        "write_one_channel": await run_writes_async(repository, [ contended_channel ],
+            write_count, concurrency),
+        "read_messages": await run_reads_async(repository, channels, write_count // 10,
+            concurrency),
+    }
+
+
+async def measure_sqlite_async(write_count: int, concurrency: int, channel_count: int) \
+        -> dict[str, dict[str, float]]:
+    data_path = MODULE_DIR / "localdata" / "msg_box_backends"
+    if data_path.exists():
+        shutil.rmtree(data_path)
+    data_path.mkdir(parents=True)
+
+    database_context = TimedDatabaseContext(str(data_path / DEFAULT_DATABASE_NAME))
+    repository = MsgBoxSQLiteRepository(database_context)
+    def setup(db: Optional[sqlite3.Connection]=None) -> tuple[int, str]:
+        sqlite_db.setup(db)
+        repository.create_tables(db)
+        return sqlite_db.create_account(os.urandom(33), db)
+    try:
+        account_id, _api_key = database_context.run_in_thread(setup)
+        return await measure_backend_async(repository, account_id, write_count, concurrency,
+            channel_count)
+    finally:
+        database_context.close()
+
+
+async def measure_sharded_sqlite_async(shard_count: int, write_count: int, concurrency: int,
+        channel_count: int) -> dict[str, dict[str, float]]:
+    data_path = MODULE_DIR / "localdata" / "msg_box_backends_sharded"
+    if data_path.exists():
+        shutil.rmtree(data_path)
+    data_path.mkdir(parents=True)
+
+    repository = MsgBoxShardedSQLiteRepository(data_path / DEFAULT_DATABASE_NAME, shard_count)
+    await repository.setup_async(create_tables=True, reset_tables=False)
+    try:
+        # The accounts are not in the shard databases, so any account id can be used.
+        return await measure_backend_async(repository, 1, write_count, concurrency,
+            channel_count)
+    finally:
+        await repository.close_async()
+
+
+async def measure_postgres_async(database_url: str, write_count: int, concurrency: int,
+        channel_count: int) -> dict[str, dict[str, float]]:
+    from esv_reference_server.msg_box.repositories_postgres import MsgBoxPostgresRepository
+    repository = MsgBoxPostgresRepository(database_url, concurrency)
+    await repository.setup_async(create_tables=True, reset_tables=True)
+    try:
+        # The accounts are not in the PostgreSQL database, so any account id can be used.
+        return await measure_backend_async(repository, 1, write_count, concurrency,
+            channel_count)
+    finally:
+        await repository.close_async()
+
+
+async def main_async(write_count: int, concurrency: int, channel_count: int, shard_count: int,
+        postgres_url: Optional[str]) -> None:
+    results: dict[str, dict[str, dict[str, float]]] = {}
+    results["sqlite"] = await measure_sqlite_async(write_count, concurrency, channel_count)
+    if shard_count > 0:
+        results["sqlite_sharded"] = await measure_sharded_sqlite_async(shard_count, write_count,
+            concurrency, channel_count)
+    if postgres_url:
+        results["postgres"] = await measure_postgres_async(postgres_url, write_count,
+            concurrency, channel_count)
+    print(json.dumps(results, indent=4))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--channels", type=int, default=32)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--postgres-url", default=os.getenv("PEER_CHANNELS_DATABASE_URL"))
+    args = parser.parse_args()
+    asyncio.run(main_async(args.writes, args.concurrency, args.channels, args.shards,
+        args.postgres_url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+The storage saving and processor cost of compressing peer channel message payloads (see
+`MESSAGE_COMPRESSION`). The payloads are JSON documents like those exchanged by wallets, which
+mostly consist of hex encoded transactions and proofs. For each codec the compression ratio and
+the time taken to compress and decompress a payload is measured, and the same messages are
+written to a SQLite database with and without compression to compare the database size.
+
+    python -m benchmarks.payload_compression [--messages 2000] [--size 4096]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Optional
+
+try:
+    # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS has latest brew version of 3.35.5 (as of 2021-06-20).
+    # Windows builds use the official Python 3.10.0 builds and bundled version of 3.35.5.
+    import sqlite3
+
+from esv_reference_server.constants import DEFAULT_DATABASE_NAME, PayloadEncoding
+from esv_reference_server.msg_box.compression import compress_payload, decompress_payload, \
+    PayloadCompressor, zstandard
+from esv_reference_server.msg_box.models import Message
+from esv_reference_server.msg_box.repositories import MsgBoxSQLiteRepository
+from esv_reference_server.msg_box.view_models import MsgBoxViewModelCreate, RetentionViewModel
+from esv_reference_server.request_timing import TimedDatabaseContext
+from esv_reference_server import sqlite_db
+
+
+MODULE_DIR = Path(__file__).parent
+
+
+def create_payload(size: int) -> bytes:
+    # Hex encoding makes the random transaction data compress to about half its size, while
+    # the repeated keys compress well.
+    entries: list[dict[str, object]] = []
+    while len(json.dumps(entries)) < size:
+        entries.append({
+            "tx_hash": os.urandom(32).hex(),
+            "rawtx": os.urandom(200).hex(),
+            "merkle_proof": { "index": len(entries), "nodes": [ os.urandom(32).hex()
+                for i in range(8) ] },
+            "description": "Payment for invoice",
+        })
+    return json.dumps(entries).encode()
+
+
+def measure_codec(encoding: PayloadEncoding, level: Optional[int], payloads: list[bytes]) \
+        -> dict[str, float]:
+    start_time = time.perf_counter()
+    compressed_payloads = [ compress_payload(encoding, payload, level) for payload in payloads ]
+    compress_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for compressed_payload in compressed_payloads:
+        decompress_payload(encoding, compressed_payload)
+    decompress_seconds = time.perf_counter() - start_time
+
+    original_size = sum(len(payload) for payload in payloads)
+    compressed_size = sum(len(payload) for payload in compressed_payloads)
+    return {
+        "ratio": compressed_size / original_size,
+        "compress_us": compress_seconds / len(payloads) * 1_000_000,
+        "decompress_us": decompress_seconds / len(payloads) * 1_000_000,
+        "compress_mb_per_second": original_size / compress_seconds / 1_000_000,
+    }
+
+
+async def measure_database_size_async(payload_compressor: Optional[PayloadCompressor],
+        payloads: list[bytes]) -> tuple[int, int]:
+    """
+    Returns the size of the database file and the total size of the stored payloads. The
+    database is larger than the payloads by more than the other columns, as rows that do not
+    fill a page leave the rest of it unused.
+    """
+    data_path = MODULE_DIR / "localdata" / "payload_compression"
+    if data_path.exists():
+        shutil.rmtree(data_path)
+    data_path.mkdir(parents=True)
+
+    database_context = TimedDatabaseContext(str(data_path / DEFAULT_DATABASE_NAME))
+    repository = MsgBoxSQLiteRepository(database_context)
+    def setup(db: Optional[sqlite3.Connection]=None) -> tuple[int, str]:
+        sqlite_db.setup(db)
+        repository.create_tables(db)
+        return sqlite_db.create_account(os.urandom(33), db)
+    stored_size = 0
+    try:
+        account_id, _api_key = database_context.run_in_thread(setup)
+        msg_box = await repository.create_message_box_async(MsgBoxViewModelCreate(
+            public_read=True, public_write=True, sequenced=False,
+            retention=RetentionViewModel(min_age_days=0, max_age_days=0, auto_prune=True)),
+            account_id)
+        for payload in payloads:
+            payload_encoding = PayloadEncoding.NONE
+            stored_payload: bytes|bytearray = payload
+            if payload_compressor is not None:
+                payload_encoding, stored_payload = payload_compressor.compress(payload)
+            stored_size += len(stored_payload)
+            await repository.write_message_async(Message(msg_box_id=msg_box.id,
+                msg_box_api_token_id=msg_box.api_tokens[0].id,
+                content_type="application/json", payload=stored_payload,
+                received_ts=int(time.time()), payload_encoding=payload_encoding))
+
+        def checkpoint(db: Optional[sqlite3.Connection]=None) -> None:
+            assert db is not None
+            db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        database_context.run_in_thread(checkpoint)
+    finally:
+        database_context.close()
+    return (data_path / DEFAULT_DATABASE_NAME).stat().st_size, stored_size
+
+
+async def main_async(message_count: int, payload_size: int) -> None:
+    payloads = [ create_payload(payload_size) for i in range(message_count) ]
+    codecs: list[tuple[str, PayloadEncoding, Optional[int]]] = [
+        ("deflate-1", PayloadEncoding.DEFLATE, 1),
+        ("deflate-6", PayloadEncoding.DEFLATE, 6),
+        ("deflate-9", PayloadEncoding.DEFLATE, 9),
+    ]
+    if zstandard is not None:
+        codecs += [
+            ("zstd-1", PayloadEncoding.ZSTD, 1),
+            ("zstd-3", PayloadEncoding.ZSTD, 3),
+            ("zstd-19", PayloadEncoding.ZSTD, 19),
+        ]
+
+    results: dict[str, object] = {
+        "payload_size": sum(len(payload) for payload in payloads) / len(payloads),
+        "codecs": { name: measure_codec(encoding, level, payloads)
+            for name, encoding, level in codecs },
+    }
+    uncompressed_size, uncompressed_payload_size = await measure_database_size_async(None,
+        payloads)
+    compressed_size, compressed_payload_size = await measure_database_size_async(
+        PayloadCompressor(PayloadEncoding.DEFLATE, 0), payloads)
+    results["database_bytes"] = {
+        "uncompressed": uncompressed_size,
+        "deflate": compressed_size,
+        "ratio": compressed_size / uncompressed_size,
+    }
+    results["payload_bytes"] = {
+        "uncompressed": uncompressed_payload_size,
+        "deflate": compressed_payload_size,
+        "ratio": compressed_payload_size / uncompressed_payload_size,
+    }
+    print(json.dumps(results, indent=4))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=4096)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.messages, args.size))
+
+
+if __name__ == "__main__":
+    main()
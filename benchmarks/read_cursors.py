@@ -0,0 +1,177 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+The time taken to write messages to a channel with many tokens, and for each reader to mark
+them all as read. Each token has a read cursor, and only the messages read, unread or deleted
+out of order have a status row. This is compared to the status row each token used to have for
+each message, where every write inserted a row for each token and marking messages as read
+updated a row for each message.
+
+    python -m benchmarks.read_cursors [--tokens 20] [--messages 2000]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+from pathlib import Path
+import shutil
+import time
+from typing import Optional
+
+try:
+    # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS has latest brew version of 3.35.5 (as of 2021-06-20).
+    # Windows builds use the official Python 3.10.0 builds and bundled version of 3.35.5.
+    import sqlite3
+
+from esv_reference_server.constants import DEFAULT_DATABASE_NAME, MessageBoxTokenFlag
+from esv_reference_server.msg_box.models import Message, MsgBox
+from esv_reference_server.msg_box.repositories import MsgBoxSQLiteRepository
+from esv_reference_server.msg_box.view_models import MsgBoxViewModelCreate, RetentionViewModel
+from esv_reference_server.request_timing import TimedDatabaseContext
+
+
+MODULE_DIR = Path(__file__).parent
+
+
+def create_legacy_status_table(db: Optional[sqlite3.Connection]=None) -> None:
+    """
+    The status table as it was before tokens had read cursors.
+    """
+    assert db is not None
+    db.execute("""
+        CREATE TABLE message_status_legacy (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id    BIGINT             NOT NULL,
+            token_id      BIGINT             NOT NULL,
+
+            isread        INTEGER            NOT NULL,
+            isdeleted     INTEGER            NOT NULL
+        )""")
+
+
+def write_message_legacy(message: Message, db: Optional[sqlite3.Connection]=None) -> None:
+    """
+    How a message was written before tokens had read cursors, with a status row for each token.
+    """
+    assert db is not None
+    row = db.execute("""
+        INSERT INTO message (fromtoken, msg_box_id, seq, receivedts, contenttype, payload)
+        SELECT ?1, ?2, COALESCE(MAX(seq) + 1, 1), ?3, ?4, ?5
+        FROM message
+        WHERE msg_box_id = ?2
+        RETURNING id
+    """, (message.msg_box_api_token_id, message.msg_box_id, message.received_ts,
+        message.content_type, message.payload)).fetchone()
+    db.execute("""
+        INSERT INTO message_status_legacy (message_id, token_id, isread, isdeleted)
+        SELECT ?1, id, id = ?2, FALSE
+        FROM msg_box_api_token
+        WHERE validto IS NULL AND msg_box_id = ?3
+    """, (row[0], message.msg_box_api_token_id, message.msg_box_id))
+
+
+def mark_older_read_legacy(msg_box_id: int, token_id: int, sequence: int,
+        db: Optional[sqlite3.Connection]=None) -> None:
+    assert db is not None
+    db.execute("""
+        UPDATE message_status_legacy SET isread = TRUE
+        WHERE message_id IN (SELECT id FROM message WHERE msg_box_id = ? AND seq <= ?)
+            AND token_id = ?
+    """, (msg_box_id, sequence, token_id))
+
+
+async def create_channel_async(repository: MsgBoxSQLiteRepository, token_count: int) \
+        -> tuple[MsgBox, list[int]]:
+    msg_box = await repository.create_message_box_async(MsgBoxViewModelCreate(public_read=True,
+        public_write=True, sequenced=False, retention=RetentionViewModel(min_age_days=0,
+            max_age_days=0, auto_prune=True)), 1)
+    token_ids = [ msg_box.api_tokens[0].id ]
+    for i in range(token_count - 1):
+        token_view = await repository.create_api_token_async(f"Reader {i}",
+            MessageBoxTokenFlag.READ_ACCESS, msg_box.id, 1)
+        assert token_view is not None
+        token_ids.append(token_view.id)
+    return msg_box, token_ids
+
+
+def count_rows(table_name: str, db: Optional[sqlite3.Connection]=None) -> int:
+    assert db is not None
+    count: int = db.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    return count
+
+
+async def main_async(token_count: int, message_count: int) -> None:
+    data_path = MODULE_DIR / "localdata" / "read_cursors"
+    if data_path.exists():
+        shutil.rmtree(data_path)
+    data_path.mkdir(parents=True)
+
+    database_context = TimedDatabaseContext(str(data_path / DEFAULT_DATABASE_NAME))
+    # The accounts are not needed to measure this.
+    repository = MsgBoxSQLiteRepository(database_context, has_accounts_table=False)
+    try:
+        database_context.run_in_thread(repository.create_tables)
+        database_context.run_in_thread(create_legacy_status_table)
+        results: dict[str, object] = { "tokens": token_count, "messages": message_count }
+
+        def create_message(msg_box: MsgBox, token_id: int) -> Message:
+            return Message(msg_box_id=msg_box.id, msg_box_api_token_id=token_id,
+                content_type="application/octet-stream", payload=b"\0" * 100,
+                received_ts=int(time.time()))
+
+        msg_box, token_ids = await create_channel_async(repository, token_count)
+        start_time = time.perf_counter()
+        for i in range(message_count):
+            await database_context.run_in_thread_async(write_message_legacy,
+                create_message(msg_box, token_ids[0]))
+        write_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for token_id in token_ids[1:]:
+            await database_context.run_in_thread_async(mark_older_read_legacy, msg_box.id,
+                token_id, message_count)
+        results["status_row_per_token"] = {
+            "write_seconds": write_seconds,
+            "mark_older_read_seconds": time.perf_counter() - start_time,
+            "status_rows": database_context.run_in_thread(count_rows,
+                "message_status_legacy"),
+        }
+
+        msg_box, token_ids = await create_channel_async(repository, token_count)
+        start_time = time.perf_counter()
+        for i in range(message_count):
+            await repository.write_message_async(create_message(msg_box, token_ids[0]))
+        write_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        for token_id in token_ids[1:]:
+            await repository.mark_messages_async(msg_box.external_id, token_id,
+                message_count, True, True)
+        results["read_cursors"] = {
+            "write_seconds": write_seconds,
+            "mark_older_read_seconds": time.perf_counter() - start_time,
+            "status_rows": database_context.run_in_thread(count_rows,
+                "message_status_exception"),
+        }
+        for token_id in token_ids:
+            message_rows, _max_sequence = await repository.get_messages_async(token_id, True)
+            assert message_rows == []
+        print(json.dumps(results, indent=4))
+    finally:
+        database_context.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main_async(args.tokens, args.messages))
+
+
+if __name__ == "__main__":
+    main()
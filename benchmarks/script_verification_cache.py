@@ -0,0 +1,85 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Benchmark of repeated verification of the same 2-of-2 multisig refund transaction input, as
+happens in payment channel flows when the contract transactions are resubmitted. This compares
+evaluating the script every time with the verified script evaluation cache.
+
+    python -m benchmarks.script_verification_cache [--iterations 200]
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import os
+import time
+from typing import Callable
+
+from bitcoinx import Bitcoin, Ops, P2MultiSig_Output, P2PK_Output, pack_byte, PrivateKey, \
+    Script, SigHash, Tx, TxInput, TxOutput
+
+from esv_reference_server import blockchain
+
+
+FUNDING_VALUE = 100_000
+
+
+def create_refund_transaction() -> tuple[Tx, TxOutput]:
+    client_private_key = PrivateKey.from_random()
+    server_private_key = PrivateKey.from_random()
+    funding_script = P2MultiSig_Output([ client_private_key.public_key,
+        server_private_key.public_key ], 2).to_script()
+    funding_output = TxOutput(FUNDING_VALUE, funding_script)
+
+    # The refund is time locked and gives the funds back to the client.
+    refund_input = TxInput(os.urandom(32), 0, Script(), 0xFFFFFFFE)
+    refund_output = TxOutput(FUNDING_VALUE - 500,
+        P2PK_Output(client_private_key.public_key, Bitcoin).to_script())
+    refund_transaction = Tx(1, [ refund_input ], [ refund_output ], 800_000)
+
+    sig_hash = SigHash(SigHash.ALL | SigHash.FORKID)
+    signature_hash = refund_transaction.signature_hash(0, FUNDING_VALUE, bytes(funding_script),
+        sig_hash)
+    client_signature = client_private_key.sign(signature_hash, None) + pack_byte(sig_hash)
+    server_signature = server_private_key.sign(signature_hash, None) + pack_byte(sig_hash)
+    refund_input.script_sig = Script() << Ops.OP_0 << client_signature << server_signature
+    return refund_transaction, funding_output
+
+
+def run_timed(label: str, iterations: int, func: Callable[[], bool]) -> None:
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        assert func()
+    elapsed = time.perf_counter() - start_time
+    print(f"{label:<24} {elapsed*1000:9.2f} ms total  "
+        f"{elapsed/iterations*1_000_000:9.1f} us per verification")
+
+
+async def run_async(iterations: int, transaction: Tx, utxo: TxOutput) -> None:
+    pool = blockchain.ScriptVerificationPool(2, 10.0, 64)
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        assert await pool.verify_utxo_spend_async(transaction, 0, utxo)
+    elapsed = time.perf_counter() - start_time
+    pool.shutdown()
+    print(f"{'pool, cached':<24} {elapsed*1000:9.2f} ms total  "
+        f"{elapsed/iterations*1_000_000:9.1f} us per verification")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    transaction, utxo = create_refund_transaction()
+    run_timed("uncached", args.iterations,
+        lambda: blockchain._evaluate_utxo_spend(transaction, 0, utxo))
+    run_timed("cached", args.iterations,
+        lambda: blockchain.verify_utxo_spend(transaction, 0, utxo))
+    asyncio.run(run_async(args.iterations, transaction, utxo))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Local stand-ins for the HeaderSV and indexer services the reference server talks to. These do
+the minimum required for the reference server endpoints that proxy to them to succeed, so that
+the benchmarks measure the reference server and not some external service.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import threading
+from typing import Any, Optional
+
+from aiohttp import web
+from bitcoinx import double_sha256, hash_to_hex_str, pack_header
+
+from .support import BENCHMARK_HOST
+
+
+logger = logging.getLogger("benchmarks-standins")
+
+HEADER_SV_PORT = 55770
+INDEXER_PORT = 55772
+
+HEADER_SV_URL = f"http://{BENCHMARK_HOST}:{HEADER_SV_PORT}"
+INDEXER_URL = f"http://{BENCHMARK_HOST}:{INDEXER_PORT}"
+
+# The regtest genesis block header.
+GENESIS_HEADER_BYTES = pack_header(1, bytes(32),
+    bytes.fromhex("3ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a"),
+    1296688602, 0x207fffff, 2)
+
+
+def _get_header_json() -> dict[str, Any]:
+    return {
+        "hash": hash_to_hex_str(double_sha256(GENESIS_HEADER_BYTES)),
+        "version": 1,
+        "prevBlockHash": hash_to_hex_str(bytes(32)),
+        "merkleRoot": hash_to_hex_str(GENESIS_HEADER_BYTES[36:68]),
+        "creationTimestamp": 1296688602,
+        "difficultyTarget": 0x207fffff,
+        "nonce": 2,
+        "transactionCount": 1,
+        "work": 2,
+    }
+
+
+def _get_tip_json() -> dict[str, Any]:
+    return {
+        "header": _get_header_json(),
+        "state": "LONGEST_CHAIN",
+        "chainWork": 2,
+        "height": 0,
+        "confirmations": 1,
+    }
+
+
+async def _header_sv_get_tips(request: web.Request) -> web.Response:
+    return web.json_response([ _get_tip_json() ])
+
+
+async def _header_sv_get_header(request: web.Request) -> web.Response:
+    if request.headers.get("Accept") == "application/octet-stream":
+        return web.Response(body=GENESIS_HEADER_BYTES, content_type="application/octet-stream")
+    return web.json_response(_get_header_json())
+
+
+async def _header_sv_get_headers_by_height(request: web.Request) -> web.Response:
+    if request.headers.get("Accept") == "application/octet-stream":
+        return web.Response(body=GENESIS_HEADER_BYTES, content_type="application/octet-stream")
+    return web.json_response([ _get_header_json() ])
+
+
+async def _indexer_websocket(request: web.Request) -> web.WebSocketResponse:
+    # The reference server treats this being open as the indexer being available.
+    websocket = web.WebSocketResponse()
+    await websocket.prepare(request)
+    async for message in websocket:
+        pass
+    return websocket
+
+
+async def _indexer_ok(request: web.Request) -> web.Response:
+    await request.read()
+    return web.Response()
+
+
+def _get_header_sv_application() -> web.Application:
+    app = web.Application()
+    app.add_routes([
+        web.get("/api/v1/chain/tips", _header_sv_get_tips),
+        web.get("/api/v1/chain/header/byHeight", _header_sv_get_headers_by_height),
+        web.get("/api/v1/chain/header/{hash}", _header_sv_get_header),
+    ])
+    return app
+
+
+def _get_indexer_application() -> web.Application:
+    app = web.Application()
+    app.add_routes([
+        web.get("/ws", _indexer_websocket),
+        web.post("/api/v1/transaction/filter", _indexer_ok),
+        web.post("/api/v1/transaction/filter:delete", _indexer_ok),
+        web.post("/api/v1/output-spend/notifications", _indexer_ok),
+        web.post("/api/v1/output-spend/notifications:unregister", _indexer_ok),
+    ])
+    return app
+
+
+class StandInServices:
+    """
+    Runs the stand-in services in their own thread and event loop, so that they do not compete
+    with either the reference server or the benchmark clients.
+    """
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started_event = threading.Event()
+        self._stop_event: Optional[asyncio.Event] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+        if not self._started_event.wait(10.0):
+            raise Exception("Stand-in services startup timed out")
+
+    def stop(self) -> None:
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        self._thread.join(10.0)
+
+    def _run(self) -> None:
+        asyncio.run(self._run_async())
+
+    async def _run_async(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        runners = list[web.AppRunner]()
+        try:
+            for application, port in ((_get_header_sv_application(), HEADER_SV_PORT),
+                    (_get_indexer_application(), INDEXER_PORT)):
+                runner = web.AppRunner(application, access_log=None)
+                await runner.setup()
+                await web.TCPSite(runner, BENCHMARK_HOST, port).start()
+                runners.append(runner)
+            self._started_event.set()
+            await self._stop_event.wait()
+        finally:
+            for runner in runners:
+                await runner.cleanup()
@@ -0,0 +1,99 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Shared helpers for the benchmarks that run against a reference server. The server is started
+in a background thread of the benchmark process in the same way as the `unittests` fixtures do.
+"""
+
+from __future__ import annotations
+import asyncio
+import logging
+import os
+from pathlib import Path
+import shutil
+import statistics
+import threading
+from typing import Optional
+
+from esv_reference_server.application_state import ApplicationState
+
+from server import main as application_main
+
+
+logger = logging.getLogger("benchmarks")
+
+BENCHMARK_HOST = "127.0.0.1"
+BENCHMARK_EXTERNAL_PORT = 55766
+BENCHMARK_INTERNAL_PORT = 55768
+
+
+def _reference_server_thread() -> None:
+    try:
+        asyncio.run(application_main())
+    except Exception:
+        logger.exception("unexpected exception in reference server thread")
+
+
+def start_reference_server(data_path: Path, environment: Optional[dict[str, str]]=None) \
+        -> ApplicationState:
+    """
+    Start the reference server with a fresh data directory and wait until it is accepting
+    connections. Any entries in `environment` override the defaults used here.
+    """
+    if data_path.exists():
+        shutil.rmtree(data_path)
+    data_path.mkdir(parents=True)
+
+    os.environ.update({
+        "EXTERNAL_HOST": BENCHMARK_HOST,
+        "EXTERNAL_PORT": str(BENCHMARK_EXTERNAL_PORT),
+        "INTERNAL_HOST": BENCHMARK_HOST,
+        "INTERNAL_PORT": str(BENCHMARK_INTERNAL_PORT),
+        "HREF_HOST": BENCHMARK_HOST,
+        "HREF_PORT": str(BENCHMARK_EXTERNAL_PORT),
+        "NETWORK": "regtest",
+        "EXPOSE_HEADER_SV_APIS": "0",
+        "EXPOSE_INDEXER_APIS": "0",
+        "ENABLE_OUTBOUND_DATA_DELIVERY": "0",
+        "SKIP_DOTENV_FILE": "1",
+        "REFERENCE_SERVER_RESET": "0",
+        "REFERENCE_SERVER_DATA_PATH": str(data_path),
+        "MAX_MESSAGE_CONTENT_LENGTH": "65536",
+    })
+    if environment is not None:
+        os.environ.update(environment)
+
+    thread = threading.Thread(target=_reference_server_thread, daemon=True)
+    thread.start()
+    if not ApplicationState.singleton_event.wait(10.0):
+        raise Exception("Reference server startup timed out")
+    # The server logs at debug level and that would distort the measurements.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    assert ApplicationState.singleton_reference is not None
+    application_state = ApplicationState.singleton_reference()
+    assert application_state is not None
+    return application_state
+
+
+def external_url(path: str, scheme: str="http") -> str:
+    return f"{scheme}://{BENCHMARK_HOST}:{BENCHMARK_EXTERNAL_PORT}{path}"
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarise_latencies(latencies: list[float], elapsed: float) -> dict[str, float]:
+    sorted_latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(sorted_latencies, 0.50) * 1000,
+        "p99_ms": percentile(sorted_latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(sorted_latencies) * 1000 if sorted_latencies else 0.0,
+    }
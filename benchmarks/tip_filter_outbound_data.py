@@ -0,0 +1,199 @@
+"""
+Copyright(c) 2022 Bitcoin Association.
+Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+Micro-benchmark for the work done per batch of tip filter matches by
+`indexer_post_tip_filter_matches`: encoding each entry to JSON bytes and recording the entries
+that failed to be delivered as outbound data.
+
+The previous approach is reproduced here for comparison. It encoded each entry to text, encoded
+that text again to bytes and hashed the bytes so that ids returned by `INSERT .. RETURNING` could
+be matched back to the rows they were allocated for.
+
+    python -m benchmarks.tip_filter_outbound_data [--entries 10000] [--rounds 5]
+"""
+
+from __future__ import annotations
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+try:
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    import sqlite3
+import statistics
+import time
+from typing import Callable, NamedTuple, Optional
+
+from electrumsv_database.sqlite import bulk_insert_returning
+
+from esv_reference_server.constants import OutboundDataFlag
+from esv_reference_server import sqlite_db
+from esv_reference_server.types import OutboundDataLogRow, OutboundDataRow, \
+    TipFilterNotificationEntry, TipFilterPushDataMatchesData
+from esv_reference_server.utils import json_dumps_bytes
+
+
+CONTENT_TYPE = "application/json"
+ACCOUNT_COUNT = 100
+
+
+class LegacyOutboundDataRow(NamedTuple):
+    outbound_data_id: Optional[int]
+    account_id: int
+    outbound_data: bytes
+    outbound_data_hash: bytes
+    outbound_data_flags: OutboundDataFlag
+    content_type: str
+    date_created: int
+
+
+class LegacyOutboundDataCreatedRow(NamedTuple):
+    outbound_data_id: int
+    account_id: int
+    outbound_data_hash: bytes
+
+
+def generate_entries(entry_count: int) -> list[TipFilterNotificationEntry]:
+    entries = list[TipFilterNotificationEntry]()
+    for entry_index in range(entry_count):
+        entries.append({
+            "accountId": 1 + entry_index % ACCOUNT_COUNT,
+            "matches": [
+                {
+                    "pushDataHashHex": os.urandom(32).hex(),
+                    "transactionId": os.urandom(32).hex(),
+                    "transactionIndex": match_index,
+                    "flags": 1,
+                } for match_index in range(1 + entry_index % 3)
+            ],
+        })
+    return entries
+
+
+def create_database() -> sqlite3.Connection:
+    db = sqlite3.connect(":memory:", isolation_level=None)
+    sqlite_db.create_tables(db)
+    db.execute("""
+    CREATE TABLE legacy_outbound_data (
+        outbound_data_id        INTEGER     PRIMARY KEY,
+        account_id              INTEGER     NOT NULL,
+        outbound_data           BLOB        NOT NULL,
+        outbound_data_hash      BLOB        NOT NULL,
+        outbound_data_flags     INTEGER     NOT NULL,
+        content_type            TEXT        NOT NULL,
+        date_created            INTEGER     NOT NULL
+    )
+    """)
+    return db
+
+
+def legacy_encode(block_id: str, entries: list[TipFilterNotificationEntry]) \
+        -> tuple[list[LegacyOutboundDataRow], dict[tuple[int, bytes], OutboundDataLogRow]]:
+    date_created = int(time.time())
+    data_rows = list[LegacyOutboundDataRow]()
+    log_rows_by_key = dict[tuple[int, bytes], OutboundDataLogRow]()
+    for entry in entries:
+        json_object: TipFilterPushDataMatchesData = {
+            "blockId": block_id,
+            "matches": entry["matches"],
+        }
+        json_text = json.dumps(json_object)
+        outbound_data_bytes = json_text.encode()
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(outbound_data_bytes)
+        outbound_data_hash = hasher.digest()
+        data_rows.append(LegacyOutboundDataRow(None, entry["accountId"], outbound_data_bytes,
+            outbound_data_hash, OutboundDataFlag.TIP_FILTER_NOTIFICATIONS, CONTENT_TYPE,
+            date_created))
+        log_rows_by_key[(entry["accountId"], outbound_data_hash)] = OutboundDataLogRow(
+            entry["accountId"], None, OutboundDataFlag.TIP_FILTER_NOTIFICATIONS, None, None,
+            date_created)
+    return data_rows, log_rows_by_key
+
+
+def legacy_write(db: sqlite3.Connection, data_rows: list[LegacyOutboundDataRow],
+        log_rows_by_key: dict[tuple[int, bytes], OutboundDataLogRow]) -> None:
+    sql_prefix = "INSERT INTO legacy_outbound_data (outbound_data_id, account_id, " \
+        "outbound_data, outbound_data_hash, outbound_data_flags, content_type, date_created) VALUES"
+    sql_suffix = "RETURNING outbound_data_id, account_id, outbound_data_hash"
+    datas_created = bulk_insert_returning(LegacyOutboundDataCreatedRow, db, sql_prefix,
+        sql_suffix, data_rows)
+    for data_created in datas_created:
+        log_row_key = (data_created.account_id, data_created.outbound_data_hash)
+        log_rows_by_key[log_row_key] = log_rows_by_key[log_row_key] \
+            ._replace(outbound_data_id=data_created.outbound_data_id)
+    sql = "INSERT INTO outbound_data_logs (account_id, outbound_data_id, outbound_data_flags, " \
+        "response_status_code, response_reason, date_created) VALUES (?, ?, ?, ?, ?, ?)"
+    db.executemany(sql, list(log_rows_by_key.values()))
+
+
+def current_encode(block_id: str, entries: list[TipFilterNotificationEntry]) \
+        -> tuple[list[OutboundDataRow], list[OutboundDataLogRow]]:
+    date_created = int(time.time())
+    data_rows = list[OutboundDataRow]()
+    log_rows = list[OutboundDataLogRow]()
+    for entry in entries:
+        json_object: TipFilterPushDataMatchesData = {
+            "blockId": block_id,
+            "matches": entry["matches"],
+        }
+        json_bytes = json_dumps_bytes(json_object)
+        data_rows.append(OutboundDataRow(None, entry["accountId"], json_bytes,
+            OutboundDataFlag.TIP_FILTER_NOTIFICATIONS, CONTENT_TYPE, date_created))
+        log_rows.append(OutboundDataLogRow(entry["accountId"], None,
+            OutboundDataFlag.TIP_FILTER_NOTIFICATIONS, None, None, date_created))
+    return data_rows, log_rows
+
+
+def current_write(db: sqlite3.Connection, data_rows: list[OutboundDataRow],
+        log_rows: list[OutboundDataLogRow]) -> None:
+    sqlite_db.create_outbound_datas_write(data_rows, log_rows, db=db)
+
+
+def run_rounds(label: str, rounds: int, func: Callable[[], object]) -> None:
+    timings = list[float]()
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start_time)
+    print(f"{label:<28} median {statistics.median(timings)*1000:9.2f} ms  "
+        f"min {min(timings)*1000:9.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    block_id = os.urandom(32).hex()
+    entries = generate_entries(args.entries)
+    print(f"Batches of {args.entries} entries, {args.rounds} rounds, "
+        f"encoder={'json' if importlib.util.find_spec('orjson') is None else 'orjson'}")
+
+    run_rounds("legacy encode+hash", args.rounds, lambda: legacy_encode(block_id, entries)[0])
+    run_rounds("current encode", args.rounds, lambda: current_encode(block_id, entries)[0])
+
+    db = create_database()
+    def run_legacy_write() -> None:
+        data_rows, log_rows_by_key = legacy_encode(block_id, entries)
+        db.execute("BEGIN")
+        legacy_write(db, data_rows, log_rows_by_key)
+        db.execute("COMMIT")
+    def run_current_write() -> None:
+        data_rows, log_rows = current_encode(block_id, entries)
+        db.execute("BEGIN")
+        current_write(db, data_rows, log_rows)
+        db.execute("COMMIT")
+
+    run_rounds("legacy encode+hash+write", args.rounds, run_legacy_write)
+    run_rounds("current encode+write", args.rounds, run_current_write)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
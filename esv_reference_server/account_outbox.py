@@ -0,0 +1,323 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+from __future__ import annotations
+import asyncio
+from collections import deque
+import json
+import logging
+import os
+from typing import Any, Coroutine, NamedTuple, Optional
+
+from electrumsv_database.sqlite import DatabaseContext
+
+from .constants import AccountMessageKind
+from . import metrics
+from . import sqlite_db
+from .utils import json_dumps_bytes
+
+
+logger = logging.getLogger("account-outbox")
+
+# The low bits of each message id are the index of the worker process that owns it, so that ids
+# from the outbox of another worker can be recognised.
+MESSAGE_ID_WORKER_BITS = 8
+MAXIMUM_WORKER_PROCESSES = 1 << MESSAGE_ID_WORKER_BITS
+# The number of message ids for an account that are reserved in the database at a time.
+MESSAGE_ID_RESERVATION_SIZE = 1000
+
+
+class AccountOutboxEntry(NamedTuple):
+    message_id: int
+    message_kind: AccountMessageKind
+    message: Any
+
+
+def _pack_message(message_kind: AccountMessageKind, message: Any) -> bytes:
+    if message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE:
+        return json_dumps_bytes(message)
+    assert isinstance(message, bytes)
+    return message
+
+
+def _unpack_message(message_kind: AccountMessageKind, message_data: bytes) -> Any:
+    if message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE:
+        return json.loads(message_data)
+    return message_data
+
+
+class _AccountOutboxState:
+    __slots__ = ("entries", "channel_entries", "last_id", "message_count", "reserved_count",
+        "reservation_task", "acknowledged_id", "dropped_id", "spilled_count", "spill_count")
+
+    def __init__(self, last_id: int, message_count: int, reserved_count: int,
+            acknowledged_id: int, dropped_id: int, spilled_count: int) -> None:
+        # The newest messages, oldest first. All of these are newer than the spilled messages.
+        self.entries: deque[AccountOutboxEntry] = deque()
+        # Channel id: the entry in `entries` for the last notification for that channel.
+        self.channel_entries: dict[str, AccountOutboxEntry] = {}
+        self.last_id = last_id
+        # The counter value of the last message id, and the last one that can be used before
+        # more are reserved.
+        self.message_count = message_count
+        self.reserved_count = reserved_count
+        self.reservation_task: Optional[asyncio.Task[None]] = None
+        self.acknowledged_id = acknowledged_id
+        self.dropped_id = dropped_id
+        # The number of messages in the database, and the number of writes adding to them.
+        self.spilled_count = spilled_count
+        self.spill_count = 0
+
+
+class AccountOutbox:
+    """
+    The messages for each account that asked for them to be kept, so that a client that
+    reconnects to the account websocket can be sent the ones it missed, after the last one it
+    acknowledged, rather than resynchronising everything.
+
+    The newest messages for an account are kept in memory. When there are more than
+    `memory_size` of them the oldest half are written to the database, where there are at most
+    `maximum_size - memory_size` of them. When the oldest are dropped to keep to that, the id of
+    the last dropped message is remembered so that the client can be told that it has missed
+    messages. On exit the messages in memory are written as well, keeping at most
+    `maximum_size`. Waiting peer channel notifications are compacted to the last one for each
+    channel, as it has the latest sequence for the channel.
+
+    The message ids are a counter for each account with the index of the worker process in the
+    low bits, and are far below 2^53 so that clients that read JSON numbers as doubles have
+    them exactly. The counter values are reserved in the database ahead of being used, so that
+    ids are never used twice even if the process exits uncleanly, when only the messages in
+    memory are lost. Each worker process has its own outbox, and a client that reconnects to
+    another worker cannot use the ids from the first one. This is only used on the event loop
+    thread.
+    """
+
+    def __init__(self, database_context: DatabaseContext, worker_index: int, memory_size: int,
+            maximum_size: int) -> None:
+        if memory_size < 2 or maximum_size <= memory_size:
+            raise ValueError("The account outbox memory size must be at least 2 and less than "
+                "the account outbox size")
+        if not 0 <= worker_index < MAXIMUM_WORKER_PROCESSES:
+            raise ValueError(f"The account outbox supports at most {MAXIMUM_WORKER_PROCESSES} "
+                "worker processes")
+        self._database_context = database_context
+        self._worker_index = worker_index
+        self._memory_size = memory_size
+        self._maximum_size = maximum_size
+        self._accounts: dict[int, _AccountOutboxState] = {}
+        # The writes of spilled messages and reserved message ids to the database, which the
+        # message loop does not wait for.
+        self._write_tasks: set[asyncio.Task[None]] = set()
+
+    @classmethod
+    def from_environment(cls, database_context: DatabaseContext, worker_index: int) \
+            -> AccountOutbox:
+        return cls(database_context, worker_index,
+            int(os.getenv("ACCOUNT_OUTBOX_MEMORY_SIZE", "100")),
+            int(os.getenv("ACCOUNT_OUTBOX_SIZE", "10000")))
+
+    def load(self) -> None:
+        """
+        Read the state of the outboxes of this worker process. The tables must exist.
+        """
+        for account_id in sqlite_db.read_account_outbox_account_ids(self._database_context,
+                self._worker_index):
+            self._accounts[account_id] = self._read_state(account_id)
+
+    def _read_state(self, account_id: int) -> _AccountOutboxState:
+        row = sqlite_db.read_account_outbox_state(self._database_context, self._worker_index,
+            account_id)
+        # Any reserved ids that were not used before the process exited are skipped.
+        message_count = max(row.reserved_count,
+            row.last_message_id >> MESSAGE_ID_WORKER_BITS,
+            row.acknowledged_id >> MESSAGE_ID_WORKER_BITS)
+        return _AccountOutboxState(max(row.last_message_id, row.acknowledged_id), message_count,
+            row.reserved_count, row.acknowledged_id, row.dropped_id, row.message_count)
+
+    def is_enabled(self, account_id: int) -> bool:
+        return account_id in self._accounts
+
+    async def enable_async(self, account_id: int) -> None:
+        """
+        Messages are only kept for an account from the first time a client asks for them.
+        """
+        if account_id in self._accounts:
+            return
+        await self._database_context.run_in_thread_async(
+            sqlite_db.create_account_outbox_state_write, self._worker_index, account_id)
+        if account_id not in self._accounts:
+            state = self._accounts[account_id] = self._read_state(account_id)
+            await self._start_reservation(account_id, state)
+
+    def get_last_id(self, account_id: int) -> int:
+        return self._accounts[account_id].last_id
+
+    def get_acknowledged_id(self, account_id: int) -> int:
+        return self._accounts[account_id].acknowledged_id
+
+    def get_dropped_id(self, account_id: int) -> int:
+        return self._accounts[account_id].dropped_id
+
+    def is_own_message_id(self, message_id: int) -> bool:
+        """
+        Whether the message id is from the outbox of this worker process. No message has the id
+        `0`, which is used before any message has been acknowledged.
+        """
+        return message_id == 0 or \
+            message_id & (MAXIMUM_WORKER_PROCESSES - 1) == self._worker_index
+
+    async def add_async(self, account_id: int, message_kind: AccountMessageKind,
+            message: Any) -> Optional[int]:
+        """
+        Returns the id of the message, or `None` if messages are not kept for the account. If
+        the oldest messages need to be written to the database this is started in the
+        background, and they are kept in memory until it is done. More message ids are reserved
+        in the background before they are all used, and this only waits for that if they are.
+        """
+        state = self._accounts.get(account_id)
+        if state is None:
+            return None
+        if state.message_count >= state.reserved_count:
+            await (state.reservation_task or self._start_reservation(account_id, state))
+        state.message_count += 1
+        state.last_id = (state.message_count << MESSAGE_ID_WORKER_BITS) | self._worker_index
+        if state.reserved_count - state.message_count < MESSAGE_ID_RESERVATION_SIZE // 2 and \
+                state.reservation_task is None:
+            self._start_reservation(account_id, state)
+        entry = AccountOutboxEntry(state.last_id, message_kind, message)
+        if message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE:
+            channel_id = message["channel_id"]
+            previous_entry = state.channel_entries.get(channel_id)
+            if previous_entry is not None:
+                state.entries.remove(previous_entry)
+                metrics.ACCOUNT_OUTBOX_MESSAGES.inc("compacted")
+            state.channel_entries[channel_id] = entry
+        state.entries.append(entry)
+
+        # Only one write is in progress for an account at a time. More messages can be added to
+        # memory while it is, and those are written by the next one.
+        if len(state.entries) > self._memory_size and state.spill_count == 0:
+            self._start_spill(account_id, state, len(state.entries) // 2,
+                self._maximum_size - self._memory_size)
+        return entry.message_id
+
+    def _start_reservation(self, account_id: int, state: _AccountOutboxState) \
+            -> asyncio.Task[None]:
+        task = self._start_write_task(self._reserve_message_ids_async(account_id, state,
+            state.reserved_count + MESSAGE_ID_RESERVATION_SIZE))
+        state.reservation_task = task
+        return task
+
+    async def _reserve_message_ids_async(self, account_id: int, state: _AccountOutboxState,
+            reserved_count: int) -> None:
+        try:
+            await self._database_context.run_in_thread_async(
+                sqlite_db.reserve_account_outbox_message_ids_write, self._worker_index,
+                account_id, reserved_count)
+        finally:
+            state.reservation_task = None
+        state.reserved_count = max(state.reserved_count, reserved_count)
+
+    def _start_spill(self, account_id: int, state: _AccountOutboxState, entry_count: int,
+            maximum_count: int) -> asyncio.Task[None]:
+        # The entries stay in memory until they are written, so that they can still be read.
+        entries = [ state.entries[i] for i in range(entry_count) ]
+        state.spill_count += 1
+        return self._start_write_task(self._spill_async(account_id, state, entries,
+            maximum_count))
+
+    def _start_write_task(self, coroutine: Coroutine[Any, Any, None]) -> asyncio.Task[None]:
+        task = asyncio.create_task(coroutine)
+        self._write_tasks.add(task)
+        task.add_done_callback(self._write_tasks.discard)
+        return task
+
+    async def _spill_async(self, account_id: int, state: _AccountOutboxState,
+            entries: list[AccountOutboxEntry], maximum_count: int) -> None:
+        rows = [ (entry.message_id, entry.message_kind,
+            _pack_message(entry.message_kind, entry.message)) for entry in entries ]
+        try:
+            state.spilled_count, state.dropped_id = \
+                await self._database_context.run_in_thread_async(
+                    sqlite_db.create_account_outbox_messages_write, self._worker_index,
+                    account_id, rows, maximum_count)
+        except Exception:
+            # The entries are still in memory, and are written by the next spill.
+            logger.exception("Failed writing %d outbox messages for account %d", len(rows),
+                account_id)
+            return
+        finally:
+            state.spill_count -= 1
+        metrics.ACCOUNT_OUTBOX_MESSAGES.inc("spilled", amount=len(rows))
+        # Acknowledged entries may have been removed while the write was in progress.
+        last_spilled_id = entries[-1].message_id
+        while state.entries and state.entries[0].message_id <= last_spilled_id:
+            self._remove_oldest(state)
+
+    def _remove_oldest(self, state: _AccountOutboxState) -> None:
+        entry = state.entries.popleft()
+        if entry.message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE:
+            channel_id = entry.message["channel_id"]
+            if state.channel_entries.get(channel_id) is entry:
+                del state.channel_entries[channel_id]
+
+    async def acknowledge_async(self, account_id: int, message_id: int) -> None:
+        """
+        The client has the messages up to and including the given one and they can be removed.
+        """
+        state = self._accounts[account_id]
+        if message_id <= state.acknowledged_id:
+            return
+        state.acknowledged_id = min(message_id, state.last_id)
+        while state.entries and state.entries[0].message_id <= state.acknowledged_id:
+            self._remove_oldest(state)
+        if state.spilled_count > 0 or state.spill_count > 0:
+            state.spilled_count, state.dropped_id = \
+                await self._database_context.run_in_thread_async(
+                    sqlite_db.acknowledge_account_outbox_messages_write, self._worker_index,
+                    account_id, state.acknowledged_id, self._maximum_size - self._memory_size)
+
+    def read(self, account_id: int, after_message_id: int, limit: int) \
+            -> list[AccountOutboxEntry]:
+        """
+        Returns up to `limit` of the kept messages after the given message id, oldest first.
+        """
+        state = self._accounts[account_id]
+        entries: list[AccountOutboxEntry] = []
+        if state.spilled_count > 0 or state.spill_count > 0:
+            for message_id, message_kind, message_data in \
+                    sqlite_db.read_account_outbox_messages(self._database_context,
+                        self._worker_index, account_id, after_message_id, limit):
+                entries.append(AccountOutboxEntry(message_id, AccountMessageKind(message_kind),
+                    _unpack_message(AccountMessageKind(message_kind), message_data)))
+            if entries:
+                after_message_id = entries[-1].message_id
+        for entry in state.entries:
+            if len(entries) >= limit:
+                break
+            if entry.message_id > after_message_id:
+                entries.append(entry)
+        return entries
+
+    async def flush_async(self) -> None:
+        """
+        Write the messages in memory and the acknowledged ids to the database, on exit.
+        """
+        # The messages being written are removed from memory when that is done.
+        await self.wait_for_writes_async()
+        for account_id, state in self._accounts.items():
+            await self._database_context.run_in_thread_async(
+                sqlite_db.acknowledge_account_outbox_messages_write, self._worker_index,
+                account_id, state.acknowledged_id, self._maximum_size)
+            if state.entries:
+                await self._start_spill(account_id, state, len(state.entries),
+                    self._maximum_size)
+        logger.debug("Flushed the outboxes of %d accounts", len(self._accounts))
+
+    async def wait_for_writes_async(self) -> None:
+        """
+        Wait for the writes of messages and reserved message ids to the database that are in
+        progress.
+        """
+        while self._write_tasks:
+            await asyncio.wait(self._write_tasks)
@@ -6,10 +6,10 @@ import asyncio, logging, os, struct, threading, time, weakref
 from collections import defaultdict
 from http import HTTPStatus
 from pathlib import Path
+from typing import Any
 
 import aiohttp
 from aiohttp import web
-from electrumsv_database.sqlite import DatabaseContext
 
 try:
     # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
@@ -20,10 +20,22 @@ except ModuleNotFoundError:
     import sqlite3
 
 
-from .constants import ACCOUNT_MESSAGE_NAMES, Network, OutboundDataFlag
+from .account_outbox import AccountOutbox
+from .blockchain import close_script_verification_pool
+from .cache import LRUCache
+from .constants import AccountFlag, AccountMessageKind, ACCOUNT_MESSAGE_NAMES, Network, \
+    NotificationBusMessageKind, OutboundDataFlag
 from .indexer_support import maintain_indexer_connection_async, unregister_unwanted_spent_outputs
 from .keys import create_regtest_server_keys, ServerKeys, get_server_keys
-from .msg_box.repositories import MsgBoxSQLiteRepository
+from . import metrics
+from .msg_box.compression import PayloadCompressor
+from .msg_box.models import MsgBoxAPITokenRow, MsgBoxHead
+from .msg_box.repositories import create_msg_box_repository, MsgBoxSQLiteRepository
+from .notification_bus import NotificationBusClient
+from .notification_queue import NotificationQueue
+from .request_timing import create_upstream_trace_config, SlowRequestRecorder, \
+    TimedDatabaseContext
+from .response_compression import ResponseCompressor
 from . import sqlite_db
 from .types import AccountMessage, AccountWebsocketState, GeneralNotification, \
     HeadersWSClient, MsgBoxWSClient, NotificationJsonData, OutboundDataLogRow, \
@@ -56,7 +68,7 @@ class ApplicationState(object):
 
     def __init__(self, network: Network, datastore_location: Path, internal_host: str,
             internal_port: int, external_host: str, external_port: int, href_host: str,
-            href_port: int) -> None:
+            href_port: int, setup_database: bool=True, worker_index: int=0) -> None:
         self.logger = logging.getLogger('app-state')
 
         assert ApplicationState.singleton_reference is None
@@ -79,12 +91,19 @@ class ApplicationState(object):
             self.server_keys = get_server_keys()
 
         self._exit_event = asyncio.Event()
-        self.aiohttp_session = aiohttp.ClientSession()
+        self.aiohttp_session = aiohttp.ClientSession(
+            trace_configs=[ create_upstream_trace_config() ])
+        self.slow_request_recorder = SlowRequestRecorder.from_environment()
+        self.response_compressor = ResponseCompressor.from_environment()
 
         self._account_websocket_state: dict[str, AccountWebsocketState] = {}
         self._account_websocket_id_by_account_id: dict[int, str] = {}  # account_id: ws_id
         self._account_websocket_state_lock: threading.RLock = threading.RLock()
-        self.account_message_queue: asyncio.Queue[AccountMessage] = asyncio.Queue()
+        # Spent output events are never coalesced as each is for a different output.
+        self.account_message_queue = NotificationQueue[AccountMessage].from_environment(
+            "account_messages", "ACCOUNT_MESSAGE_QUEUE",
+            lambda message: (message.account_id, message.message["channel_id"])
+                if message.message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE else None)
 
         self.headers_ws_clients: dict[str, HeadersWSClient] = {}
         self.headers_ws_clients_lock: threading.RLock = threading.RLock()
@@ -92,23 +111,64 @@ class ApplicationState(object):
         self.msg_box_ws_clients: dict[str, MsgBoxWSClient] = {}
         self.ws_clients_by_messagebox_id: dict[int, set[str]] = {}  # msg_box_id: ws_ids
         self.msg_box_ws_clients_lock: threading.RLock = threading.RLock()
-        self.msgbox_notification_queue: asyncio.Queue[tuple[int, NotificationJsonData]] \
-            = asyncio.Queue()
+        # Notifications for websockets that are still being sent the messages they missed. These
+        # are sent after them, so that none are missed or sent out of order.
+        self._msg_box_ws_catch_up_notifications: dict[str, list[NotificationJsonData]] = {}
+        self.msgbox_notification_queue = NotificationQueue[tuple[int, NotificationJsonData]] \
+            .from_environment("msgbox_notifications", "MESSAGE_BOX_NOTIFICATION_QUEUE",
+                lambda entry: entry[0])
+        # Long-polling message list requests wait on these, and are woken by the same
+        # notifications that are sent to the channel websockets. They are only used on the event
+        # loop thread.
+        self._msg_box_message_waiters: dict[int, set[asyncio.Future[None]]] = {}  # msg_box_id
+        self._msg_box_long_poll_counts: dict[int, int] = {}  # account_id: waiting requests
+        self._msg_box_long_poll_account_limit = int(os.getenv(
+            "MESSAGE_BOX_LONG_POLL_ACCOUNT_LIMIT", "20"))
+        self.msg_box_long_poll_maximum_seconds = float(os.getenv(
+            "MESSAGE_BOX_LONG_POLL_MAXIMUM_SECONDS", "60"))
+        self.msg_box_websocket_subscription_limit = int(os.getenv(
+            "MESSAGE_BOX_WEBSOCKET_SUBSCRIPTION_LIMIT", "100"))
 
         def _setup_database(db: sqlite3.Connection|None=None) -> None:
-            if int(os.getenv('REFERENCE_SERVER_RESET', "0")):
+            if self._reset_database:
                 self.logger.info("Dropping database tables")
-                self.msg_box_repository.drop_tables(db)
+                if isinstance(self.msg_box_repository, MsgBoxSQLiteRepository):
+                    self.msg_box_repository.drop_tables(db)
                 sqlite_db.delete_all_tables(db)
             self.logger.info("Creating any missing database tables")
             sqlite_db.setup(db)
-            self.msg_box_repository.create_tables(db)
-
-        self.database_context = DatabaseContext(str(datastore_location), write_warn_ms=10)
-        self.msg_box_repository = MsgBoxSQLiteRepository(self.database_context)
-        self.database_context.run_in_thread(_setup_database)
+            if isinstance(self.msg_box_repository, MsgBoxSQLiteRepository):
+                self.msg_box_repository.create_tables(db)
+
+        self._reset_database = int(os.getenv('REFERENCE_SERVER_RESET', "0")) != 0
+        self.database_context = TimedDatabaseContext(str(datastore_location), write_warn_ms=10)
+        self.msg_box_repository = create_msg_box_repository(self.database_context,
+            datastore_location)
+        # Only the first worker process sets up the database if there are several of them.
+        self._setup_database_tables = setup_database
+        if setup_database:
+            self.database_context.run_in_thread(_setup_database)
+        self.account_outbox = AccountOutbox.from_environment(self.database_context, worker_index)
+
+        # API key: (account id, account flags). Only valid accounts are cached. Entries are
+        # added and removed on the event loop thread, and removed after the database write that
+        # invalidates them has committed. This ordering means an entry cannot be added back with
+        # the outdated account state read before the change.
+        self._account_api_key_cache = LRUCache[str, tuple[int, AccountFlag]](
+            int(os.getenv("ACCOUNT_API_KEY_CACHE_SIZE", "10000")))
+        # Peer channel token: (token row, channel external id). Only valid tokens are cached.
+        self._msg_box_api_token_cache = LRUCache[str, tuple[MsgBoxAPITokenRow, str]](
+            int(os.getenv("MESSAGE_BOX_API_TOKEN_CACHE_SIZE", "10000")))
+        # Channel external id: latest message. The repository reads for these are coroutines
+        # which may not complete until after a write that changes what they read, so an entry
+        # read before the last change to either cache is not added.
+        self._msg_box_head_cache = LRUCache[str, MsgBoxHead](
+            int(os.getenv("MESSAGE_BOX_HEAD_CACHE_SIZE", "10000")))
+        self._msg_box_cache_changes = 0
 
         self.header_sv_url = os.getenv('HEADER_SV_URL')
+        self.max_message_content_length = int(os.getenv('MAX_MESSAGE_CONTENT_LENGTH', '0'))
+        self.payload_compressor = PayloadCompressor.from_environment()
 
         self._account_notifications_task: asyncio.Task[None]|None = None
         self._message_box_notifications_task: asyncio.Task[None]|None = None
@@ -121,11 +181,40 @@ class ApplicationState(object):
         self.indexer_is_connected = False
         self._output_spend_counts: dict[Outpoint, int] = defaultdict(int)
 
+        # This is only present if this is one of several worker processes.
+        self.notification_bus: NotificationBusClient|None = None
+
     async def setup_async(self, internal_application: web.Application|None,
-            external_application: web.Application) -> None:
+            external_application: web.Application, notification_bus_path: Path|None=None,
+            is_primary_worker: bool=True) -> None:
+        """
+        `notification_bus_path` is provided if this is one of several worker processes, and
+        only the primary worker runs the tasks that should not run more than once.
+        """
         self.internal_application = internal_application
         self.external_application = external_application
 
+        await self.msg_box_repository.setup_async(create_tables=self._setup_database_tables,
+            reset_tables=self._setup_database_tables and self._reset_database)
+        self.account_outbox.load()
+
+        if notification_bus_path is not None:
+            self.notification_bus = NotificationBusClient(notification_bus_path,
+                self._on_notification_bus_message)
+            await self.notification_bus.connect_async()
+
+        metrics.ACCOUNT_MESSAGE_QUEUE_LENGTH.set_function(self.account_message_queue.qsize)
+        metrics.MESSAGE_BOX_NOTIFICATION_QUEUE_LENGTH.set_function(
+            self.msgbox_notification_queue.qsize)
+        metrics.ACCOUNT_WEBSOCKETS.set_function(lambda: len(self._account_websocket_state))
+        metrics.HEADERS_WEBSOCKETS.set_function(lambda: len(self.headers_ws_clients))
+        metrics.MESSAGE_BOX_WEBSOCKETS.set_function(lambda: len(self.msg_box_ws_clients))
+        metrics.MESSAGE_BOX_LONG_POLLS.set_function(
+            lambda: sum(self._msg_box_long_poll_counts.values()))
+        # NOTE(metrics) The database package does not expose the length of the writer queue.
+        write_dispatcher = self.database_context._write_dispatcher
+        metrics.DATABASE_WRITER_QUEUE_LENGTH.set_function(write_dispatcher._writer_queue.qsize)
+
         self._account_notifications_task = asyncio.create_task(
             self._manage_account_notifications_async())
         self._message_box_notifications_task = asyncio.create_task(
@@ -136,7 +225,7 @@ class ApplicationState(object):
         if os.getenv("EXPOSE_INDEXER_APIS", "0") == "1":
             self._indexer_task = asyncio.create_task(maintain_indexer_connection_async(self))
 
-            if os.getenv("ENABLE_OUTBOUND_DATA_DELIVERY", "0") == "1":
+            if is_primary_worker and os.getenv("ENABLE_OUTBOUND_DATA_DELIVERY", "0") == "1":
                 self._outbound_data_delivery_future = self._create_outbound_delivery_task()
 
     async def teardown_async(self) -> None:
@@ -153,9 +242,14 @@ class ApplicationState(object):
         if self._outbound_data_delivery_future is not None:
             self._outbound_data_delivery_future.cancel()
 
+        if self.notification_bus is not None:
+            await self.notification_bus.close_async()
+
         self.logger.info("Closing HTTP sessions")
         await self.aiohttp_session.close()
 
+        close_script_verification_pool()
+
         # In theory this will block additional writes being put in place and empty the existing
         # queue. But the write dispatcher will block this thread, the async thread, while it
         # does this. That means that the tasks above may not get a chance to cleanly exit, and
@@ -163,10 +257,162 @@ class ApplicationState(object):
         # the async thread allowing further tasks to happen.
         # TODO(1.4.0) Clean exit. Async tasks may need to do writes on exit. Look into this.
         self.logger.info("Closing database")
+        await self.account_outbox.flush_async()
+        await self.msg_box_repository.close_async()
         self.database_context.close()
 
+        for gauge in (metrics.ACCOUNT_MESSAGE_QUEUE_LENGTH,
+                metrics.MESSAGE_BOX_NOTIFICATION_QUEUE_LENGTH, metrics.ACCOUNT_WEBSOCKETS,
+                metrics.HEADERS_WEBSOCKETS, metrics.MESSAGE_BOX_WEBSOCKETS,
+                metrics.MESSAGE_BOX_LONG_POLLS, metrics.DATABASE_WRITER_QUEUE_LENGTH):
+            gauge.set_function(None)
+
         ApplicationState.singleton_reference = None
 
+    def get_account_id_for_api_key(self, api_key: str) -> tuple[int|None, AccountFlag]:
+        """
+        Authenticate a master bearer token. This should be used by anything that does so rather
+        than the database function, as it caches the result for valid accounts.
+
+        See `sqlite_db.get_account_id_for_api_key` for details on the returned values.
+        """
+        cached_entry = self._account_api_key_cache.get(api_key)
+        if cached_entry is not None:
+            return cached_entry
+        account_id, account_flags = sqlite_db.get_account_id_for_api_key(self.database_context,
+            api_key)
+        if account_id is not None:
+            self._account_api_key_cache.set(api_key, (account_id, account_flags))
+        return account_id, account_flags
+
+    async def deactivate_account_async(self, account_id: int, flags: AccountFlag) -> None:
+        api_key = await self.database_context.run_in_thread_async(sqlite_db.deactivate_account,
+            account_id, flags)
+        if api_key is not None:
+            self._invalidate_account_api_key(api_key)
+
+    def _invalidate_account_api_key(self, api_key: str) -> None:
+        self._account_api_key_cache.remove(api_key)
+        if self.notification_bus is not None:
+            self.notification_bus.publish(NotificationBusMessageKind.ACCOUNT_API_KEY_INVALIDATED,
+                api_key)
+
+    async def get_msg_box_api_token_async(self, token: str, external_id: str) \
+            -> MsgBoxAPITokenRow|None:
+        """
+        Authenticate a peer channel token for the given channel. This should be used by anything
+        that does so rather than the repository, as it caches the result for valid tokens.
+        """
+        cached_entry = self._msg_box_api_token_cache.get(token)
+        if cached_entry is not None:
+            cached_token_row, token_external_id = cached_entry
+            return cached_token_row if token_external_id == external_id else None
+        changes = self._msg_box_cache_changes
+        token_row = await self.msg_box_repository.get_api_token_async(token)
+        if token_row is None:
+            return None
+        if await self.msg_box_repository.get_api_token_authorization_data_for_msg_box_async(
+                external_id, token_row.id) is None:
+            return None
+        if changes == self._msg_box_cache_changes:
+            self._msg_box_api_token_cache.set(token, (token_row, external_id))
+        return token_row
+
+    async def get_msg_box_max_sequence_async(self, external_id: str, token_id: int) -> int:
+        """
+        The sequence of the latest message in the channel that was not written by the given
+        token, or zero if there is none or the channel is not sequenced. This is what
+        `HEAD /api/v1/channel/{channelid}` returns as the `ETag`, and is cached per channel.
+        """
+        head = self._msg_box_head_cache.get(external_id)
+        if head is None:
+            changes = self._msg_box_cache_changes
+            head = await self.msg_box_repository.get_msg_box_head_async(external_id)
+            if head is None:
+                return 0
+            if changes == self._msg_box_cache_changes:
+                self._msg_box_head_cache.set(external_id, head)
+        return head.get_max_sequence(token_id)
+
+    def add_msg_box_head_message(self, external_id: str, sequence: int, token_id: int) -> None:
+        """
+        Update the cached latest message for the channel after a message is written to it. The
+        other worker processes discard theirs when they receive the message notification.
+        """
+        self._msg_box_cache_changes += 1
+        head = self._msg_box_head_cache.get(external_id)
+        if head is not None:
+            self._msg_box_head_cache.set(external_id, head.add_message(sequence, token_id))
+
+    def invalidate_msg_box_head(self, external_id: str) -> None:
+        """
+        This should be called after messages are deleted from the channel, or the channel is
+        deleted.
+        """
+        self._msg_box_cache_changes += 1
+        self._msg_box_head_cache.remove(external_id)
+        if self.notification_bus is not None:
+            self.notification_bus.publish(NotificationBusMessageKind.MESSAGE_BOX_HEAD_INVALIDATED,
+                external_id)
+
+    def invalidate_msg_box_api_token(self, token: str) -> None:
+        """
+        This should be called after the token is revoked, or its channel is deleted.
+        """
+        self._msg_box_cache_changes += 1
+        self._msg_box_api_token_cache.remove(token)
+        if self.notification_bus is not None:
+            self.notification_bus.publish(
+                NotificationBusMessageKind.MESSAGE_BOX_API_TOKEN_INVALIDATED, token)
+
+    async def publish_message_box_notification_async(self, message_box_id: int,
+            notification: NotificationJsonData) -> None:
+        """
+        Queue a notification for the websockets for the given message box, both those connected
+        to this process and those connected to any other worker processes. This waits if the
+        queue is full and its overflow policy is to block.
+        """
+        await self.msgbox_notification_queue.put_async((message_box_id, notification))
+        if self.notification_bus is not None:
+            self.notification_bus.publish(NotificationBusMessageKind.MESSAGE_BOX_NOTIFICATION,
+                [ message_box_id, notification ])
+
+    async def publish_account_message_async(self, message: AccountMessage) -> None:
+        """
+        Queue a message for the account's websocket, wherever it is connected. Only peer channel
+        messages are supported, as spent output events come from the indexer connection that
+        the account's websocket process registered them with.
+        """
+        assert message.message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE
+        await self.account_message_queue.put_async(message)
+        if self.notification_bus is not None:
+            self.notification_bus.publish(NotificationBusMessageKind.ACCOUNT_MESSAGE,
+                [ message.account_id, message.message_kind, message.message ])
+
+    def _on_notification_bus_message(self, kind: NotificationBusMessageKind, message: Any) \
+            -> None:
+        # The notifications from other workers cannot wait for space in the queues, so these
+        # drop the oldest notification if the overflow policy is to block.
+        if kind == NotificationBusMessageKind.MESSAGE_BOX_NOTIFICATION:
+            message_box_id, notification = message
+            self._msg_box_cache_changes += 1
+            self._msg_box_head_cache.remove(notification["channel_id"])
+            self.msgbox_notification_queue.put_nowait((message_box_id, notification))
+        elif kind == NotificationBusMessageKind.ACCOUNT_MESSAGE:
+            account_id, message_kind, payload = message
+            self.account_message_queue.put_nowait(AccountMessage(account_id,
+                AccountMessageKind(message_kind), payload))
+        elif kind == NotificationBusMessageKind.ACCOUNT_API_KEY_INVALIDATED:
+            self._account_api_key_cache.remove(message)
+        elif kind == NotificationBusMessageKind.MESSAGE_BOX_HEAD_INVALIDATED:
+            self._msg_box_cache_changes += 1
+            self._msg_box_head_cache.remove(message)
+        elif kind == NotificationBusMessageKind.MESSAGE_BOX_API_TOKEN_INVALIDATED:
+            self._msg_box_cache_changes += 1
+            self._msg_box_api_token_cache.remove(message)
+        else:
+            self.logger.error("Unexpected notification bus message kind %s", kind)
+
     async def wait_for_exit_async(self, internal: bool=False, external: bool=False) -> None:
         startup_complete = False
         if internal:
@@ -196,8 +442,10 @@ class ApplicationState(object):
         while True:
             # No point in trying if there is no reference server connected.
             next_check_delay = MAXIMUM_DELAY
+            start_time = time.perf_counter()
             rows = sqlite_db.read_pending_outbound_datas(self.database_context,
                 OutboundDataFlag.NONE, OutboundDataFlag.DISPATCHED_SUCCESSFULLY)
+            metrics.OUTBOUND_DATA_BACKLOG.set(len(rows))
             current_rows = list[OutboundDataPendingRow]()
             if len(rows) > 0:
                 current_time = time.time()
@@ -228,11 +476,10 @@ class ApplicationState(object):
                     }
                     if row.tip_filter_callback_token is not None:
                         headers["Authorization"] = row.tip_filter_callback_token
-                    batch_text = row.outbound_data.decode("utf-8")
                     updated_flags = row.outbound_data_flags
                     try:
                         async with self.aiohttp_session.post(url, headers=headers,
-                                data=batch_text) as response:
+                                data=row.outbound_data) as response:
                             if response.status == HTTPStatus.OK:
                                 self.logger.debug("Posted outbound data for account %d to '%s' "+
                                     "status=%s, reason=%s", row.account_id, url, response.status,
@@ -252,6 +499,7 @@ class ApplicationState(object):
                     except aiohttp.ClientError:
                         self.logger.exception("Errored posting outbound data for account %d to "
                             "'%s'", row.account_id, url)
+                        metrics.BACKGROUND_TASK_ERRORS.inc("outbound_data_delivery")
                         # We should work out what exceptions are normal (e.g. invalid URL) and
                         # just add a flag for those. The rest of the exceptions should be in the
                         # log (or redirected to some sys admin notification mechanism).
@@ -268,6 +516,8 @@ class ApplicationState(object):
                 await self.database_context.run_in_thread_async(
                     sqlite_db.update_outbound_data_flags_write, flag_data_updates)
 
+            metrics.BACKGROUND_TASK_DURATION.observe(time.perf_counter() - start_time,
+                "outbound_data_delivery")
             await asyncio.sleep(next_check_delay)
 
     # Headers Websocket Client Get/Add/Remove & Notify thread
@@ -323,6 +573,7 @@ class ApplicationState(object):
                     continue
                 except Exception:
                     logger.exception("Unexpected exception in header notification task")
+                    metrics.BACKGROUND_TASK_ERRORS.inc("header_notifications")
                     await asyncio.sleep(1)
                     continue
 
@@ -330,6 +581,7 @@ class ApplicationState(object):
                         not len(self.get_account_websockets()):
                     continue
 
+                start_time = time.perf_counter()
                 url_to_fetch = f"{self.header_sv_url}/api/v1/chain/header/{current_best_hash}"
                 request_headers = {'Accept': 'application/octet-stream'}
                 async with await session.get(url_to_fetch, headers=request_headers) as resp:
@@ -356,8 +608,12 @@ class ApplicationState(object):
                             GeneralNotification(message_type="bsvapi.headers.tip", result=result))
                     except ConnectionResetError:
                         self.logger.error("Websocket disconnected")
+
+                metrics.BACKGROUND_TASK_DURATION.observe(time.perf_counter() - start_time,
+                    "header_notifications")
         except Exception:
             self.logger.exception("Unexpected exception in header_notifications_thread")
+            metrics.BACKGROUND_TASK_ERRORS.inc("header_notifications")
         finally:
             self.logger.info("Closing header push notifications thread")
 
@@ -375,32 +631,125 @@ class ApplicationState(object):
         """Creates a two-way mapping for fast lookups"""
         with self.msg_box_ws_clients_lock:
             self.msg_box_ws_clients[ws_client.ws_id] = ws_client
-            if self.ws_clients_by_messagebox_id.get(ws_client.messagebox_id) is None:
-                self.ws_clients_by_messagebox_id[ws_client.messagebox_id] = set()
-            self.ws_clients_by_messagebox_id[ws_client.messagebox_id].add(ws_client.ws_id)
+            for msg_box_internal_id in ws_client.messagebox_ids:
+                self.ws_clients_by_messagebox_id.setdefault(msg_box_internal_id, set()) \
+                    .add(ws_client.ws_id)
 
     def remove_msg_box_ws_client(self, ws_id: str) -> None:
         with self.msg_box_ws_clients_lock:
-            msg_box_internal_id = self.msg_box_ws_clients[ws_id].messagebox_id
-            del self.msg_box_ws_clients[ws_id]
-            self.ws_clients_by_messagebox_id[msg_box_internal_id].remove(ws_id)
-            if len(self.ws_clients_by_messagebox_id[msg_box_internal_id]) == 0:
-                del self.ws_clients_by_messagebox_id[msg_box_internal_id]
+            ws_client = self.msg_box_ws_clients.pop(ws_id)
+            for msg_box_internal_id in ws_client.messagebox_ids:
+                self._remove_ws_client_for_messagebox_id(msg_box_internal_id, ws_id)
+        self._msg_box_ws_catch_up_notifications.pop(ws_id, None)
+
+    def subscribe_msg_box_ws_client(self, ws_id: str, msg_box_internal_id: int) -> None:
+        """
+        Websockets for more than one channel are notified of the messages for each channel they
+        subscribe to, using the same index as those for one channel.
+        """
+        with self.msg_box_ws_clients_lock:
+            self.msg_box_ws_clients[ws_id].messagebox_ids.add(msg_box_internal_id)
+            self.ws_clients_by_messagebox_id.setdefault(msg_box_internal_id, set()).add(ws_id)
+
+    def unsubscribe_msg_box_ws_client(self, ws_id: str, msg_box_internal_id: int) -> None:
+        with self.msg_box_ws_clients_lock:
+            messagebox_ids = self.msg_box_ws_clients[ws_id].messagebox_ids
+            if msg_box_internal_id in messagebox_ids:
+                messagebox_ids.remove(msg_box_internal_id)
+                self._remove_ws_client_for_messagebox_id(msg_box_internal_id, ws_id)
+
+    def _remove_ws_client_for_messagebox_id(self, msg_box_internal_id: int, ws_id: str) -> None:
+        ws_ids = self.ws_clients_by_messagebox_id[msg_box_internal_id]
+        ws_ids.remove(ws_id)
+        if len(ws_ids) == 0:
+            del self.ws_clients_by_messagebox_id[msg_box_internal_id]
+
+    def start_msg_box_ws_catch_up(self, ws_id: str) -> None:
+        """
+        The notifications for the websocket are held from now on, until the caller has sent the
+        messages it missed and takes them with `take_msg_box_ws_catch_up_notifications`.
+        """
+        self._msg_box_ws_catch_up_notifications[ws_id] = []
+
+    def take_msg_box_ws_catch_up_notifications(self, ws_id: str) -> list[NotificationJsonData]:
+        """
+        Returns the notifications held since this was last called. If there are none the
+        websocket is sent any later notifications directly.
+        """
+        notifications = self._msg_box_ws_catch_up_notifications.pop(ws_id)
+        if len(notifications) > 0:
+            self._msg_box_ws_catch_up_notifications[ws_id] = []
+        return notifications
+
+    def start_msg_box_long_poll(self, account_id: int) -> bool:
+        """
+        Returns `False` if the account already has as many long-polling requests waiting as it
+        is allowed, otherwise the caller must call `end_msg_box_long_poll` when it is done.
+        """
+        count = self._msg_box_long_poll_counts.get(account_id, 0)
+        if count >= self._msg_box_long_poll_account_limit:
+            return False
+        self._msg_box_long_poll_counts[account_id] = count + 1
+        return True
+
+    def end_msg_box_long_poll(self, account_id: int) -> None:
+        count = self._msg_box_long_poll_counts[account_id] - 1
+        if count == 0:
+            del self._msg_box_long_poll_counts[account_id]
+        else:
+            self._msg_box_long_poll_counts[account_id] = count
+
+    def add_msg_box_message_waiter(self, msg_box_id: int) -> asyncio.Future[None]:
+        """
+        The returned future is completed when the next message is written to the channel. The
+        caller must remove it with `remove_msg_box_message_waiter` whether it completes or not.
+        """
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._msg_box_message_waiters.setdefault(msg_box_id, set()).add(future)
+        return future
+
+    def remove_msg_box_message_waiter(self, msg_box_id: int, future: asyncio.Future[None]) \
+            -> None:
+        # The waiters are removed when they are woken.
+        waiters = self._msg_box_message_waiters.get(msg_box_id)
+        if waiters is None:
+            return
+        waiters.discard(future)
+        if len(waiters) == 0:
+            del self._msg_box_message_waiters[msg_box_id]
+
+    def _wake_msg_box_message_waiters(self, msg_box_id: int) -> None:
+        for future in self._msg_box_message_waiters.pop(msg_box_id, set()):
+            if not future.done():
+                future.set_result(None)
 
     async def _manage_message_box_notifications_async(self) -> None:
         """Emits any notifications from the queue to all connected websockets"""
         try:
             while not self._exit_event.is_set():
                 msgbox_id, notification_data = await self.msgbox_notification_queue.get()
+                start_time = time.perf_counter()
+                self._wake_msg_box_message_waiters(msgbox_id)
                 clients = self.get_ws_clients_by_messagebox_id(msgbox_id)
                 self.logger.debug("msgbox[%d] %d notifications", msgbox_id, len(clients))
                 for client in clients:
+                    catch_up_notifications = self._msg_box_ws_catch_up_notifications.get(
+                        client.ws_id)
+                    if catch_up_notifications is not None:
+                        catch_up_notifications.append(notification_data)
+                        continue
+                    if client.coalescer is not None:
+                        client.coalescer.add(notification_data)
+                        continue
                     try:
                         await client.websocket.send_json(notification_data)
                     except ConnectionResetError:
                         self.logger.error("Websocket[%s] disconnected", client.ws_id)
+                metrics.BACKGROUND_TASK_DURATION.observe(time.perf_counter() - start_time,
+                    "msgbox_notifications")
         except Exception:
             self.logger.exception("Unexpected exception")
+            metrics.BACKGROUND_TASK_ERRORS.inc("msgbox_notifications")
         finally:
             self.logger.info("Exiting msgbox notifications task")
 
@@ -458,27 +807,66 @@ class ApplicationState(object):
         try:
             while not self._exit_event.is_set():
                 account_id, message_kind, payload = await self.account_message_queue.get()
+                start_time = time.perf_counter()
                 self.logger.debug("Sending web socket messages to account id=%d", account_id)
 
+                # Messages are kept for the client that uses the outbox while it is connected or
+                # not, but not while a client that cannot acknowledge them is sent them.
+                message_id: int|None = None
                 websocket_state = self.get_websocket_state_for_account_id(account_id)
+                if websocket_state is None or websocket_state.uses_outbox:
+                    message_id = await self.account_outbox.add_async(account_id, message_kind,
+                        payload)
+                    websocket_state = self.get_websocket_state_for_account_id(account_id)
                 if websocket_state is None:
-                    self.logger.debug("No websocket, dropped message, message_kind=%s, "
-                        "account_id=%d", message_kind, account_id)
+                    if message_id is None:
+                        self.logger.debug("No websocket, dropped message, message_kind=%s, "
+                            "account_id=%d", message_kind, account_id)
                     continue
 
+                if websocket_state.uses_outbox:
+                    # The websocket is sent the messages it missed first, and this one with them.
+                    if message_id is None or websocket_state.is_replaying or \
+                            message_id <= websocket_state.last_message_id:
+                        continue
+                else:
+                    message_id = None
+                    if message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE and \
+                            websocket_state.coalescer is not None:
+                        websocket_state.coalescer.add(payload)
+                        continue
+
                 try:
-                    if websocket_state.accept_type == "application/json":
-                        # TODO(1.4.0) JSON support. We might consider unpacking this for JSON into
-                        #     some dictionary structure rather than just giving them the hex.
-                        if isinstance(payload, bytes): # spent output notification
-                            payload = payload.hex()
-                        await websocket_state.websocket.send_json(GeneralNotification(
-                            message_type=ACCOUNT_MESSAGE_NAMES[message_kind], result=payload))
-                    else:
-                        await websocket_state.websocket.send_bytes(
-                            pack_account_message_bytes(message_kind, payload))
+                    await self.send_account_message_async(websocket_state, message_kind, payload,
+                        message_id)
                 except ConnectionResetError:
                     self.logger.debug("Dropped message for disconnected websocket, "
                         "message_kind=%s, account_id=%d", message_kind, account_id)
+                metrics.BACKGROUND_TASK_DURATION.observe(time.perf_counter() - start_time,
+                    "account_notifications")
         finally:
             self.logger.info("Exiting account push notifications thread")
+
+    async def send_account_message_async(self, websocket_state: AccountWebsocketState,
+            message_kind: AccountMessageKind, payload: Any, message_id: int|None=None) -> None:
+        """
+        The account outbox id of the message is included if the client asked for the outbox to
+        be used, in the JSON object or before the binary message as an unsigned 64 bit integer.
+        """
+        if websocket_state.accept_type == "application/json":
+            # TODO(1.4.0) JSON support. We might consider unpacking this for JSON into
+            #     some dictionary structure rather than just giving them the hex.
+            if isinstance(payload, bytes): # spent output notification
+                payload = payload.hex()
+            notification = GeneralNotification(message_type=ACCOUNT_MESSAGE_NAMES[message_kind],
+                result=payload)
+            if message_id is not None:
+                notification["id"] = message_id
+            await websocket_state.websocket.send_json(notification)
+        else:
+            message_bytes = pack_account_message_bytes(message_kind, payload)
+            if message_id is not None:
+                message_bytes = struct.pack(">Q", message_id) + message_bytes
+            await websocket_state.websocket.send_bytes(message_bytes)
+        if message_id is not None:
+            websocket_state.last_message_id = max(websocket_state.last_message_id, message_id)
@@ -33,12 +33,25 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-from typing import cast
+from __future__ import annotations
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+from typing import cast, Sequence
 
-from bitcoinx import InterpreterLimits, MinerPolicy, Tx, TxInputContext, TxOutput
+from bitcoinx import hash_to_hex_str, InterpreterLimits, MinerPolicy, pack_le_int32, \
+    pack_le_uint32, pack_varbytes, pack_varint, Tx, TxInputContext, TxOutput
 
+from .cache import LRUCache
 
-def verify_utxo_spend(transaction: Tx, input_index: int, utxo: TxOutput) -> bool:
+
+logger = logging.getLogger("blockchain")
+
+
+def _evaluate_utxo_spend(transaction: Tx, input_index: int, utxo: TxOutput) -> bool:
     # We know the script we are executing so rather than trying to guess what miners actually
     # support, we go with the restrictive policy from the bitcoinx unit tests.
     is_genesis_enabled = True
@@ -51,7 +64,228 @@ def verify_utxo_spend(transaction: Tx, input_index: int, utxo: TxOutput) -> bool
     return cast(bool, context.verify_input(verification_limits))
 
 
+def get_script_verification_key(transaction: Tx, input_index: int, utxo: TxOutput) -> bytes:
+    """
+    Identify the script evaluation of the given input spending the given output.
+
+    The signature hash for any sighash type is computed from a subset of what goes into this key
+    and the evaluation is otherwise only dependent on the script signature of the input and the
+    spent output. The script signatures of the other inputs are excluded as nothing signs them,
+    which means the same key is produced as the other inputs of a transaction get signed.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(pack_le_int32(transaction.version))
+    hasher.update(pack_le_uint32(transaction.locktime))
+    hasher.update(pack_le_uint32(input_index))
+    hasher.update(pack_varint(len(transaction.inputs)))
+    for transaction_input in transaction.inputs:
+        hasher.update(transaction_input.prev_hash)
+        hasher.update(pack_le_uint32(transaction_input.prev_idx))
+        hasher.update(pack_le_uint32(transaction_input.sequence))
+    hasher.update(pack_varbytes(bytes(transaction.inputs[input_index].script_sig)))
+    hasher.update(pack_varint(len(transaction.outputs)))
+    for transaction_output in transaction.outputs:
+        hasher.update(transaction_output.to_bytes())
+    hasher.update(utxo.to_bytes())
+    return hasher.digest()
+
+
+class ScriptVerificationCache(LRUCache[bytes, bool]):
+    """
+    The keys of script evaluations that are known to have succeeded, with the least recently
+    used keys evicted when the maximum number of entries is reached. Like the node's signature
+    cache, failed evaluations are not remembered.
+    """
+
+    def contains(self, key: bytes) -> bool:
+        return self.get(key) is not None
+
+    def add(self, key: bytes) -> None:
+        self.set(key, True)
+
+
+_script_verification_cache: ScriptVerificationCache|None = None
+_script_verification_cache_lock = threading.Lock()
+
+
+def get_script_verification_cache() -> ScriptVerificationCache:
+    global _script_verification_cache
+    with _script_verification_cache_lock:
+        if _script_verification_cache is None:
+            _script_verification_cache = ScriptVerificationCache(
+                int(os.getenv("SCRIPT_VERIFICATION_CACHE_SIZE", "10000")))
+        return _script_verification_cache
+
+
+def _evaluate_and_cache_utxo_spend(transaction: Tx, input_index: int, utxo: TxOutput,
+        cache_key: bytes) -> bool:
+    result = _evaluate_utxo_spend(transaction, input_index, utxo)
+    if result:
+        get_script_verification_cache().add(cache_key)
+    return result
+
+
+def verify_utxo_spend(transaction: Tx, input_index: int, utxo: TxOutput) -> bool:
+    cache_key = get_script_verification_key(transaction, input_index, utxo)
+    if get_script_verification_cache().contains(cache_key):
+        return True
+    return _evaluate_and_cache_utxo_spend(transaction, input_index, utxo, cache_key)
+
+
+class ScriptVerificationQueueFullError(Exception):
+    # There are too many script evaluations either queued or still running.
+    pass
+
+
+class ScriptVerificationPool:
+    """
+    Script evaluation in worker threads so that the event loop is not blocked by it.
+
+    Python threads cannot be interrupted, so an evaluation that exceeds the timeout is reported
+    as failed to the caller but continues to occupy its worker until it completes. It continues
+    to count towards the pending limit until then, which means that a flood of costly scripts
+    results in `ScriptVerificationQueueFullError` rather than an ever growing backlog.
+    """
+
+    def __init__(self, max_workers: int, timeout_seconds: float, max_pending: int) -> None:
+        assert max_workers > 0 and max_pending > 0
+        self._timeout_seconds = timeout_seconds
+        self._max_pending = max_pending
+        self._pending_count = 0
+        self._pending_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+            thread_name_prefix="script-eval")
+
+    @classmethod
+    def from_environment(cls) -> ScriptVerificationPool:
+        default_workers = min(4, os.cpu_count() or 1)
+        max_workers = int(os.getenv("SCRIPT_VERIFICATION_WORKERS", str(default_workers)))
+        timeout_seconds = float(os.getenv("SCRIPT_VERIFICATION_TIMEOUT", "5.0"))
+        max_pending = int(os.getenv("SCRIPT_VERIFICATION_MAX_PENDING", "64"))
+        return cls(max_workers, timeout_seconds, max_pending)
+
+    @property
+    def pending_count(self) -> int:
+        return self._pending_count
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _reserve(self, count: int) -> None:
+        with self._pending_lock:
+            if self._pending_count + count > self._max_pending:
+                raise ScriptVerificationQueueFullError()
+            self._pending_count += count
+
+    def _release(self, future: concurrent.futures.Future[bool]) -> None:
+        with self._pending_lock:
+            self._pending_count -= 1
+
+    def _submit(self, transaction: Tx, input_index: int, utxo: TxOutput, cache_key: bytes) \
+            -> concurrent.futures.Future[bool]:
+        try:
+            future = self._executor.submit(_evaluate_and_cache_utxo_spend, transaction,
+                input_index, utxo, cache_key)
+        except RuntimeError:
+            # The executor has been shut down.
+            with self._pending_lock:
+                self._pending_count -= 1
+            raise
+        # This is called when the evaluation completes, or if it is cancelled before it starts.
+        future.add_done_callback(self._release)
+        return future
+
+    async def _wait_for_result_async(self, future: concurrent.futures.Future[bool],
+            transaction: Tx, input_index: int) -> bool:
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self._timeout_seconds)
+        except asyncio.TimeoutError:
+            logger.error("Script evaluation timed out for input %d of transaction %s",
+                input_index, hash_to_hex_str(transaction.hash()))
+            return False
+
+    async def verify_utxo_spend_async(self, transaction: Tx, input_index: int,
+            utxo: TxOutput) -> bool:
+        """
+        Raises `ScriptVerificationQueueFullError` if the evaluation cannot be queued.
+        Raises any `InterpreterError` the evaluation raises.
+        """
+        cache_key = get_script_verification_key(transaction, input_index, utxo)
+        if get_script_verification_cache().contains(cache_key):
+            return True
+        self._reserve(1)
+        future = self._submit(transaction, input_index, utxo, cache_key)
+        return await self._wait_for_result_async(future, transaction, input_index)
+
+    async def verify_transaction_inputs_async(self, transaction: Tx,
+            utxos: Sequence[TxOutput]) -> list[bool]:
+        """
+        Evaluate every input of the transaction in parallel. `utxos` should have the spent
+        output for each input in the same order as the inputs.
+
+        Raises `ScriptVerificationQueueFullError` if the evaluations cannot all be queued, in
+        which case none of them are.
+        Raises any `InterpreterError` an evaluation raises.
+        """
+        assert len(utxos) == len(transaction.inputs)
+        cache = get_script_verification_cache()
+        results = [ False ] * len(utxos)
+        uncached_entries = list[tuple[int, TxOutput, bytes]]()
+        for input_index, utxo in enumerate(utxos):
+            cache_key = get_script_verification_key(transaction, input_index, utxo)
+            if cache.contains(cache_key):
+                results[input_index] = True
+            else:
+                uncached_entries.append((input_index, utxo, cache_key))
+        if len(uncached_entries) == 0:
+            return results
+
+        self._reserve(len(uncached_entries))
+        futures = list[concurrent.futures.Future[bool]]()
+        try:
+            for input_index, utxo, cache_key in uncached_entries:
+                futures.append(self._submit(transaction, input_index, utxo, cache_key))
+        except RuntimeError:
+            # Give back the reservations for the inputs that were not submitted.
+            with self._pending_lock:
+                self._pending_count -= len(uncached_entries) - len(futures) - 1
+            for future in futures:
+                future.cancel()
+            raise
+        uncached_results = await asyncio.gather(*(
+            self._wait_for_result_async(future, transaction, input_index)
+            for (input_index, _utxo, _cache_key), future in zip(uncached_entries, futures)))
+        for (input_index, _utxo, _cache_key), result in zip(uncached_entries, uncached_results):
+            results[input_index] = result
+        return results
+
+
+_script_verification_pool: ScriptVerificationPool|None = None
+_script_verification_pool_lock = threading.Lock()
+
+
+def get_script_verification_pool() -> ScriptVerificationPool:
+    global _script_verification_pool
+    with _script_verification_pool_lock:
+        if _script_verification_pool is None:
+            _script_verification_pool = ScriptVerificationPool.from_environment()
+        return _script_verification_pool
+
+
+def close_script_verification_pool() -> None:
+    global _script_verification_pool
+    with _script_verification_pool_lock:
+        if _script_verification_pool is not None:
+            _script_verification_pool.shutdown()
+            _script_verification_pool = None
+
+
 async def verify_utxo_spend_async(transaction: Tx, input_index: int, utxo: TxOutput) -> bool:
-    # TODO(temporary-prototype-choice) Should use a worker thread with timeout if it takes too long.
-    return verify_utxo_spend(transaction, input_index, utxo)
+    return await get_script_verification_pool().verify_utxo_spend_async(transaction,
+        input_index, utxo)
+
 
+async def verify_transaction_inputs_async(transaction: Tx, utxos: Sequence[TxOutput]) \
+        -> list[bool]:
+    return await get_script_verification_pool().verify_transaction_inputs_async(transaction,
+        utxos)
@@ -0,0 +1,50 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+from __future__ import annotations
+from collections import OrderedDict
+import threading
+from typing import Generic, Optional, TypeVar
+
+
+KeyType = TypeVar("KeyType")
+ValueType = TypeVar("ValueType")
+
+
+class LRUCache(Generic[KeyType, ValueType]):
+    """
+    A thread-safe mapping with a maximum number of entries, where the least recently used entry
+    is evicted to make room for a new one. A maximum of zero disables the cache.
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries = OrderedDict[KeyType, ValueType]()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: KeyType) -> Optional[ValueType]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: KeyType, value: ValueType) -> None:
+        if self._max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def remove(self, key: KeyType) -> Optional[ValueType]:
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
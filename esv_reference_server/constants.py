@@ -58,14 +58,24 @@ class Network(IntEnum):
 class AccountMessageKind(IntEnum):
     PEER_CHANNEL_MESSAGE = 1
     SPENT_OUTPUT_EVENT = 2
+    OUTBOX_TRUNCATED = 3
 
 
 ACCOUNT_MESSAGE_NAMES: dict[AccountMessageKind, str] = {
     AccountMessageKind.PEER_CHANNEL_MESSAGE: "bsvapi.channels.notification",
     AccountMessageKind.SPENT_OUTPUT_EVENT: "bsvapi.output-spends.notification",
+    AccountMessageKind.OUTBOX_TRUNCATED: "bsvapi.outbox.truncated",
 }
 
 
+class NotificationBusMessageKind(IntEnum):
+    MESSAGE_BOX_NOTIFICATION = 1
+    ACCOUNT_MESSAGE = 2
+    ACCOUNT_API_KEY_INVALIDATED = 3
+    MESSAGE_BOX_HEAD_INVALIDATED = 4
+    MESSAGE_BOX_API_TOKEN_INVALIDATED = 5
+
+
 class IndexerPushdataRegistrationFlag(IntFlag):
     NONE                            = 0
     FINALISED                       = 1 << 0
@@ -93,3 +103,19 @@ class MessageBoxTokenFlag(IntFlag):
     READ_ACCESS                     = 1 << 0
     WRITE_ACCESS                    = 1 << 1
     OWNED_BY_ACCOUNT                = 1 << 2
+
+
+class PayloadEncoding(IntEnum):
+    """
+    How a peer channel message payload is stored, see `msg_box/compression.py`. The names are the
+    codec names used in the `Accept-Payload-Encoding` header and the message `content_encoding`.
+    """
+    NONE = 0
+    DEFLATE = 1
+    ZSTD = 2
+
+
+PAYLOAD_ENCODING_NAMES: dict[PayloadEncoding, str] = {
+    PayloadEncoding.DEFLATE: "deflate",
+    PayloadEncoding.ZSTD: "zstd",
+}
@@ -12,10 +12,11 @@ from typing import Any, Dict, Optional, TYPE_CHECKING
 
 from aiohttp import web
 
-from .keys import VerifiableKeyDataDict, verify_key_data
+from .keys import VerifiableKeyDataDict, verify_key_data_async
+from .request_timing import json_response, timed_json_loads
 from .constants import AccountFlag, EXTERNAL_SERVER_HOST, EXTERNAL_SERVER_PORT
-from .sqlite_db import create_account, get_account_id_for_api_key, \
-    get_account_id_for_public_key_bytes, get_account_metadata_for_account_id
+from .sqlite_db import create_account, get_account_id_for_public_key_bytes, \
+    get_account_metadata_for_account_id
 
 
 if TYPE_CHECKING:
@@ -41,14 +42,14 @@ async def get_account(request: web.Request) -> web.Response:
             raise web.HTTPBadRequest(reason="Invalid API key")
 
         api_key = auth_string[7:]
-        account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+        account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     else:
         if not request.body_exists:
             raise web.HTTPBadRequest(reason="Body required")
 
-        key_data: VerifiableKeyDataDict = await request.json()
+        key_data: VerifiableKeyDataDict = await request.json(loads=timed_json_loads)
         try:
-            if not verify_key_data(key_data):
+            if not await verify_key_data_async(key_data):
                 # We do not reveal if the account exists or the key data was invalid.
                 raise web.HTTPUnauthorized()
         except (KeyError, TypeError, ValueError):
@@ -68,7 +69,7 @@ async def get_account(request: web.Request) -> web.Response:
         "public_key_hex": metadata.public_key_bytes.hex(),
         "api_key": metadata.api_key,
     }
-    return web.json_response(data)
+    return json_response(data)
 
 
 async def post_account_registration(request: web.Request) -> web.Response:
@@ -88,10 +89,10 @@ async def post_account_registration(request: web.Request) -> web.Response:
 
     app_state: ApplicationState = request.app['app_state']
 
-    key_data: VerifiableKeyDataDict = await request.json()
+    key_data: VerifiableKeyDataDict = await request.json(loads=timed_json_loads)
     # TODO(technical debt) This should expect a dated signed message.
     try:
-        if not verify_key_data(key_data):
+        if not await verify_key_data_async(key_data):
             # We do not reveal if the account exists or the key data was invalid.
             raise web.HTTPUnauthorized()
     except (KeyError, TypeError, ValueError):
@@ -110,7 +111,7 @@ async def post_account_registration(request: web.Request) -> web.Response:
         metadata = get_account_metadata_for_account_id(app_state.database_context, account_id)
         api_key = metadata.api_key
 
-    return web.json_response({
+    return json_response({
         "public_key_hex": key_data["public_key_hex"],
         "api_key": api_key,
     })
@@ -186,5 +187,5 @@ async def get_endpoints_data(request: web.Request) -> web.Response:
                 }
             }
         ])
-    return web.json_response(data=data)
+    return json_response(data=data)
 
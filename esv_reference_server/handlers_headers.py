@@ -11,6 +11,7 @@ from bitcoinx import pack_header, double_sha256, hash_to_hex_str, \
     hex_str_to_hash
 
 from esv_reference_server.errors import Error, APIErrors
+from esv_reference_server.request_timing import json_response, timed_json_loads
 from esv_reference_server.types import HeadersWSClient, HeaderSVTip
 
 if typing.TYPE_CHECKING:
@@ -47,9 +48,9 @@ async def get_header(request: web.Request) -> web.Response:
             if response.status != 200:
                 return web.Response(reason=response.reason, status=response.status)
 
-            result = await response.json()
+            result = await response.json(loads=timed_json_loads)
         response_headers = {'User-Agent': 'ESV-Ref-Server'}
-        return web.json_response(result, status=200, reason='OK', headers=response_headers)
+        return json_response(result, status=200, reason='OK', headers=response_headers)
     except aiohttp.ClientConnectorError:
         logger.error("Unavailable HeaderSV service request %s", request.rel_url.path)
         raise web.HTTPServiceUnavailable()
@@ -81,9 +82,9 @@ async def get_headers_by_height(request: web.Request) -> web.Response:
         # else: application/json
         request_headers = {'Accept': 'application/json'}
         async with client_session.get(url_to_fetch, headers=request_headers) as response:
-            result = await response.json()
+            result = await response.json(loads=timed_json_loads)
         response_headers = {'User-Agent': 'ESV-Ref-Server'}
-        return web.json_response(result, status=200, reason='OK', headers=response_headers)
+        return json_response(result, status=200, reason='OK', headers=response_headers)
     except aiohttp.ClientConnectorError:
         logger.error("Unavailable HeaderSV service request %s", request.rel_url.path)
         raise web.HTTPServiceUnavailable()
@@ -119,7 +120,7 @@ async def get_chain_tips(request: web.Request) -> web.Response:
         url_to_fetch = f"{app_state.header_sv_url}/api/v1/chain/tips"
         request_headers = {'Accept': 'application/json'}
         async with client_session.get(url_to_fetch, headers=request_headers) as response:
-            result: List[HeaderSVTip] = await response.json()
+            result: List[HeaderSVTip] = await response.json(loads=timed_json_loads)
         response_headers = {'User-Agent': 'ESV-Ref-Server'}
 
         if longest_chain == '1':
@@ -132,7 +133,7 @@ async def get_chain_tips(request: web.Request) -> web.Response:
             headers_array = _convert_json_tips_to_binary(result)
             return web.Response(body=headers_array, status=200, reason='OK',
                 headers=response_headers, content_type=accept_type)
-        return web.json_response(result, status=200, reason='OK', headers=response_headers)
+        return json_response(result, status=200, reason='OK', headers=response_headers)
 
     except aiohttp.ClientConnectorError:
         logger.error("Unavailable HeaderSV service request %s", request.rel_url.path)
@@ -20,9 +20,10 @@ from bitcoinx import hash_to_hex_str, hex_str_to_hash
 from .constants import IndexerPushdataRegistrationFlag
 from . import sqlite_db
 from .errors import APIErrors
+from .request_timing import json_response, timed_json_loads
 from .sqlite_db import create_indexer_filtering_registrations_pushdatas, \
     DatabaseStateModifiedError, delete_indexer_filtering_registrations_pushdatas, \
-    get_account_id_for_api_key, read_indexer_filtering_registrations_pushdatas, \
+    read_indexer_filtering_registrations_pushdatas, \
     update_indexer_filtering_registrations_pushdatas_flags
 from .types import Outpoint, outpoint_struct, tip_filter_list_struct, \
     tip_filter_registration_struct, TipFilterRegistrationEntry
@@ -85,7 +86,7 @@ async def mirrored_indexer_call_async(request: web.Request, *,
         if accept_type == "application/octet-stream":
             return web.Response(body=body_bytes)
         else:
-            return web.json_response(body=body_bytes)
+            return json_response(body=body_bytes)
 
 
 async def indexer_get_indexer_settings(request: web.Request) -> web.Response:
@@ -95,7 +96,7 @@ async def indexer_get_indexer_settings(request: web.Request) -> web.Response:
     if auth_string is None or not auth_string.startswith("Bearer "):
         raise web.HTTPUnauthorized()
     api_key = auth_string[7:]
-    account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+    account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized()
 
@@ -112,7 +113,7 @@ async def indexer_get_indexer_settings(request: web.Request) -> web.Response:
         "tipFilterCallbackUrl": rows[0].tip_filter_callback_url if len(rows) == 1 else None,
         "tipFilterCallbackToken": rows[0].tip_filter_callback_token if len(rows) == 1 else None,
     }
-    return web.json_response(data=settings_object)
+    return json_response(data=settings_object)
 
 
 async def indexer_post_indexer_settings(request: web.Request) -> web.Response:
@@ -131,7 +132,7 @@ async def indexer_post_indexer_settings(request: web.Request) -> web.Response:
         raise web.HTTPUnauthorized()
 
     api_key = auth_string[7:]
-    account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+    account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized()
 
@@ -145,7 +146,7 @@ async def indexer_post_indexer_settings(request: web.Request) -> web.Response:
         raise web.HTTPBadRequest(reason="Invalid 'Accept', expected 'application/json', "
             f"got '{accept_type}'")
 
-    settings_update_object = await request.json()
+    settings_update_object = await request.json(loads=timed_json_loads)
     if not isinstance(settings_update_object, dict):
         raise web.HTTPBadRequest(reason="Invalid settings update object in body")
 
@@ -190,7 +191,7 @@ async def indexer_post_indexer_settings(request: web.Request) -> web.Response:
     settings_object = await app_state.database_context.run_in_thread_async(
         sqlite_db.update_account_indexer_settings_write, account_id, settings_update_object)
 
-    return web.json_response(data=settings_object)
+    return json_response(data=settings_object)
 
 
 async def indexer_post_restoration_search(request: web.Request) -> web.Response:
@@ -215,7 +216,7 @@ async def indexer_get_transaction_filter(request: web.Request) -> web.Response:
     if auth_string is None or not auth_string.startswith("Bearer "):
         raise web.HTTPUnauthorized()
     api_key = auth_string[7:]
-    account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+    account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized()
 
@@ -236,7 +237,7 @@ async def indexer_get_transaction_filter(request: web.Request) -> web.Response:
     elif accept_type == 'application/json':
         json_object: list[list[Any]] = [ [ hash_to_hex_str(data.pushdata_hash), data.date_created,
             data.duration_seconds ] for data in list_datas ]
-        return web.json_response(data=json.dumps(json_object))
+        return json_response(data=json.dumps(json_object))
     else:
         raise web.HTTPBadRequest(reason="unknown request body content type")
 
@@ -265,7 +266,7 @@ async def indexer_post_transaction_filter(request: web.Request) -> web.Response:
     if auth_string is None or not auth_string.startswith("Bearer "):
         raise web.HTTPUnauthorized()
     api_key = auth_string[7:]
-    account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+    account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized()
 
@@ -351,7 +352,7 @@ async def indexer_post_transaction_filter_delete(request: web.Request) -> web.Re
     if auth_string is None or not auth_string.startswith("Bearer "):
         raise web.HTTPUnauthorized()
     api_key = auth_string[7:]
-    account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+    account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized()
 
@@ -523,7 +524,7 @@ async def indexer_post_output_spend_notifications(request: web.Request) -> web.R
     if auth_string is None or not auth_string.startswith("Bearer "):
         raise web.HTTPUnauthorized()
     api_key = auth_string[7:]
-    account_id, account_flags = get_account_id_for_api_key(app_state.database_context, api_key)
+    account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized()
 
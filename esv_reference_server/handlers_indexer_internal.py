@@ -4,9 +4,7 @@
 # The goal of this file is to allow non-public applications to have access to a secure API.
 
 import dataclasses
-import hashlib
 from http import HTTPStatus
-import json
 import logging
 import time
 from typing import Optional
@@ -19,6 +17,7 @@ from .constants import OutboundDataFlag
 from . import sqlite_db
 from .types import OutboundDataLogRow, OutboundDataRow, TipFilterPushDataMatchesData, \
     TipFilterNotificationBatch
+from .utils import json_dumps_bytes
 
 
 logger = logging.getLogger("handlers-indexer-internal")
@@ -31,7 +30,7 @@ class EntryResult:
     outbound_data_id: Optional[int]
     outbound_data_flags: OutboundDataFlag
 
-    json_text: Optional[str]
+    json_bytes: bytes
     content_type: Optional[str]
     response_status_code: Optional[int]
     response_reason: Optional[str]
@@ -67,13 +66,14 @@ async def indexer_post_tip_filter_matches(request: web.Request) -> web.Response:
             "blockId": batch["blockId"],
             "matches": entry["matches"],
         }
-        json_text = json.dumps(json_object)
+        # This is encoded once and the same bytes are both posted and stored on failure.
+        json_bytes = json_dumps_bytes(json_object)
 
         if url is None:
             logger.error("Skipping tip filter match for account %d with no callback URL",
                 account_id)
             flags |= OutboundDataFlag.DISPATCH_NO_CALLBACK
-            entry_results.append(EntryResult(account_id, None, flags, json_text, content_type,
+            entry_results.append(EntryResult(account_id, None, flags, json_bytes, content_type,
                 None, None))
             continue
 
@@ -83,25 +83,25 @@ async def indexer_post_tip_filter_matches(request: web.Request) -> web.Response:
         if metadata.tip_filter_callback_token is not None:
             headers["Authorization"] = metadata.tip_filter_callback_token
         try:
-            async with session.post(url, headers=headers, data=json_text) as response:
+            async with session.post(url, headers=headers, data=json_bytes) as response:
                 if response.status == HTTPStatus.OK:
                     logger.debug("Posted message to peer channel status=%s, reason=%s",
                         response.status, response.reason)
                 else:
                     logger.error("Failed to post peer channel response status=%s, reason=%s",
                         response.status, response.reason)
-                entry_results.append(EntryResult(account_id, None, flags, json_text, content_type,
+                entry_results.append(EntryResult(account_id, None, flags, json_bytes, content_type,
                     response.status, response.reason))
         except aiohttp.ClientError:
             logger.exception("Failed to post peer channel response")
             flags |= OutboundDataFlag.DISPATCH_EXCEPTION
-            entry_results.append(EntryResult(account_id, None, flags, json_text, content_type,
+            entry_results.append(EntryResult(account_id, None, flags, json_bytes, content_type,
                 None, None))
 
     date_created = int(time.time())
     failure_data_creation_rows = list[OutboundDataRow]()
     success_log_creation_rows = list[OutboundDataLogRow]()
-    log_creation_rows_by_key = dict[tuple[int, bytes], OutboundDataLogRow]()
+    failure_log_creation_rows = list[OutboundDataLogRow]()
     for result in entry_results:
         log_row = OutboundDataLogRow(result.account_id, None, result.outbound_data_flags,
             result.response_status_code, result.response_reason, date_created)
@@ -109,23 +109,17 @@ async def indexer_post_tip_filter_matches(request: web.Request) -> web.Response:
         if result.response_status_code == HTTPStatus.OK:
             success_log_creation_rows.append(log_row)
         else:
-            assert result.json_text is not None
-            outbound_data_bytes = result.json_text.encode()
-            # We use the hash to match allocated id to what row it was allocated for.
-            hasher = hashlib.blake2b(digest_size=20)
-            hasher.update(outbound_data_bytes)
-            outbound_data_hash = hasher.digest()
-            data_creation_row = OutboundDataRow(None, result.account_id, outbound_data_bytes,
-                outbound_data_hash, OutboundDataFlag.TIP_FILTER_NOTIFICATIONS,
-                content_type, date_created)
+            data_creation_row = OutboundDataRow(None, result.account_id, result.json_bytes,
+                OutboundDataFlag.TIP_FILTER_NOTIFICATIONS, content_type, date_created)
+            # The log row for a given data row is matched by position when ids are allocated.
             failure_data_creation_rows.append(data_creation_row)
-            log_creation_rows_by_key[(result.account_id, outbound_data_hash)] = log_row
+            failure_log_creation_rows.append(log_row)
 
     if len(failure_data_creation_rows) > 0:
         logger.debug("Recording %d peer channel broadcast failures",
             len(failure_data_creation_rows))
         app_state.database_context.run_in_thread(sqlite_db.create_outbound_datas_write,
-            failure_data_creation_rows, log_creation_rows_by_key)
+            failure_data_creation_rows, failure_log_creation_rows)
 
     if len(success_log_creation_rows):
         app_state.database_context.run_in_thread(
@@ -11,13 +11,14 @@
 #
 
 from __future__ import annotations
-import asyncio, logging
+import asyncio, logging, time
 from typing import cast, TYPE_CHECKING
 
 import aiohttp
 from aiohttp.web import WSMsgType
 
 from .constants import AccountMessageKind
+from . import metrics
 from .types import AccountMessage, Outpoint, outpoint_struct, output_spend_struct, OutputSpend
 
 if TYPE_CHECKING:
@@ -96,6 +97,7 @@ async def maintain_indexer_connection_async(application_state: ApplicationState)
                 # We retry these and log them as they are in theory unexpected and the user might
                 # shut down the indexer and restart it after fixing it.
                 logger.exception("Unexpected exception in indexer web socket management")
+                metrics.BACKGROUND_TASK_ERRORS.inc("indexer_connection")
                 message_to_ignore = None # Allow repeated messages.
             else:
                 message_to_ignore = None # Allow repeated messages.
@@ -125,19 +127,22 @@ async def manage_indexer_websocket(application_state: ApplicationState,
                 message_bytes = cast(bytes, message.data)
                 # NOTE At this time spent outputs are the only data format so there is no
                 #     envelope format used to differentiate packet sizes yet.
+                start_time = time.perf_counter()
                 spent_output = OutputSpend(*output_spend_struct.unpack(message_bytes))
                 logger.debug("Spent output notification from indexer of %r", spent_output)
                 outpoint = Outpoint(spent_output.out_tx_hash, spent_output.out_index)
                 logger.debug("Spent output notification outpoint=%r", outpoint)
-                for websocket_state in application_state.get_account_websockets().values():
+                for websocket_state in list(application_state.get_account_websockets().values()):
                     logger.debug("Websocket account_id=%d, registrations=%r",
                         websocket_state.account_id, websocket_state.spent_output_registrations)
                     if outpoint in websocket_state.spent_output_registrations:
                         logger.debug("Broadcasting spent output notification to account %d",
                             websocket_state.account_id)
-                        application_state.account_message_queue.put_nowait(AccountMessage(
+                        await application_state.account_message_queue.put_async(AccountMessage(
                             websocket_state.account_id, AccountMessageKind.SPENT_OUTPUT_EVENT,
                             message_bytes))
+                metrics.BACKGROUND_TASK_DURATION.observe(time.perf_counter() - start_time,
+                    "indexer_connection")
             else:
                 logger.error("Unhandled websocket message type %s", message.type)
                 break
@@ -1,10 +1,13 @@
+import asyncio
 import logging
 import os
 import sys
+import threading
 from typing import cast, NamedTuple, TypedDict
 
-from bitcoinx import PrivateKey, PublicKey, sha256
+from bitcoinx import pack_varbytes, PrivateKey, PublicKey, sha256
 
+from .cache import LRUCache
 from .constants import REGTEST_IDENTITY_PRIVATE_KEY, REGTEST_IDENTITY_PUBLIC_KEY
 
 
@@ -41,16 +44,67 @@ class VerifiableKeyDataDict(TypedDict):
     message_hex: str
 
 
-def verify_key_data(key_data: VerifiableKeyDataDict) -> bool:
+_verified_key_data_cache: LRUCache[bytes, bool]|None = None
+_verified_key_data_cache_lock = threading.Lock()
+
+
+def get_verified_key_data_cache() -> LRUCache[bytes, bool]:
     """
-    Raises `KeyError` if one of the expected fields is not present.
-    Raises `TypeError` if an expected field is not a string (from `bytes.fromhex`).
-    Raises `ValueError` if an expected field is not valid hexadecimal (from `bytes.fromhex`,
-        `bitcoinx.from_hex`).
-    Raises `ValueError` if the public key is invalid (from `bitcoinx.from_hex`).
+    The digests of the key data that has been successfully verified. Clients may resend the same
+    signed key data repeatedly and there is no point in doing the signature verification again.
+    """
+    global _verified_key_data_cache
+    with _verified_key_data_cache_lock:
+        if _verified_key_data_cache is None:
+            _verified_key_data_cache = LRUCache(
+                int(os.getenv("KEY_DATA_VERIFICATION_CACHE_SIZE", "10000")))
+        return _verified_key_data_cache
+
+
+def _get_key_data_digest(key_data: VerifiableKeyDataDict) -> tuple[bytes, bytes, bytes, bytes]:
+    """
+    Returns the digest of the key data and the decoded fields it was computed from.
+
+    Raises `KeyError`, `TypeError` and `ValueError` for invalid key data like `verify_key_data`.
     """
     assert isinstance(key_data, dict)
-    public_key = PublicKey.from_hex(key_data["public_key_hex"])
+    public_key_bytes = bytes.fromhex(key_data["public_key_hex"])
     signature_bytes = bytes.fromhex(key_data["signature_hex"])
     message_bytes = bytes.fromhex(key_data["message_hex"])
-    return cast(bool, public_key.verify_message(signature_bytes, message_bytes))
+    digest = sha256(pack_varbytes(public_key_bytes) + pack_varbytes(signature_bytes) +
+        pack_varbytes(message_bytes))
+    return digest, public_key_bytes, signature_bytes, message_bytes
+
+
+def _verify_and_cache_key_data(digest: bytes, public_key_bytes: bytes, signature_bytes: bytes,
+        message_bytes: bytes) -> bool:
+    public_key = PublicKey.from_bytes(public_key_bytes)
+    result = cast(bool, public_key.verify_message(signature_bytes, message_bytes))
+    if result:
+        get_verified_key_data_cache().set(digest, True)
+    return result
+
+
+def verify_key_data(key_data: VerifiableKeyDataDict) -> bool:
+    """
+    Raises `KeyError` if one of the expected fields is not present.
+    Raises `TypeError` if an expected field is not a string (from `bytes.fromhex`).
+    Raises `ValueError` if an expected field is not valid hexadecimal (from `bytes.fromhex`).
+    Raises `ValueError` if the public key is invalid (from `bitcoinx.PublicKey.from_bytes`).
+    """
+    digest, public_key_bytes, signature_bytes, message_bytes = _get_key_data_digest(key_data)
+    if get_verified_key_data_cache().get(digest) is not None:
+        return True
+    return _verify_and_cache_key_data(digest, public_key_bytes, signature_bytes, message_bytes)
+
+
+async def verify_key_data_async(key_data: VerifiableKeyDataDict) -> bool:
+    """
+    The same as `verify_key_data` except that signature verification for key data that has not
+    already been verified is done in a worker thread rather than blocking the event loop.
+    """
+    digest, public_key_bytes, signature_bytes, message_bytes = _get_key_data_digest(key_data)
+    if get_verified_key_data_cache().get(digest) is not None:
+        return True
+    return await asyncio.get_running_loop().run_in_executor(None, _verify_and_cache_key_data,
+        digest, public_key_bytes, signature_bytes, message_bytes)
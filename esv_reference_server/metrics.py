@@ -0,0 +1,344 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# Operational metrics exposed in the Prometheus text exposition format. These are always
+# collected, as recording a value is a lock and a few arithmetic operations, and are served on
+# the internal server at `/metrics` if `EXPOSE_METRICS_API` is set.
+#
+# - https://prometheus.io/docs/instrumenting/exposition_formats/
+
+from __future__ import annotations
+from abc import ABC, abstractmethod
+import bisect
+import functools
+import threading
+import time
+from typing import Any, Awaitable, Callable, Coroutine, Iterator, Optional, TypeVar
+from types import TracebackType
+
+from aiohttp import web
+
+from .request_timing import time_database_call
+from .utils import get_route_name
+
+
+T1 = TypeVar("T1")
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: LabelValues,
+        extra_label: str="") -> str:
+    entries = [ f"{name}=\"{_escape_label_value(value)}\""
+        for name, value in zip(label_names, label_values) ]
+    if extra_label:
+        entries.append(extra_label)
+    return "{"+ ",".join(entries) +"}" if entries else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    metric_type = ""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]=()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def render_samples(self) -> Iterator[str]:
+        ...
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        yield from self.render_samples()
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]=()) -> None:
+        super().__init__(name, help_text, label_names)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float=1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self._values.get(label_values, 0)
+
+    def render_samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_format_labels(self.label_names, label_values)} " \
+                f"{_format_value(value)}"
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. Unlabelled gauges can instead be given a function that
+    is called to obtain the current value when the metrics are rendered, which is the cheapest
+    way to report things like queue lengths.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]=()) -> None:
+        super().__init__(name, help_text, label_names)
+        self._values: dict[LabelValues, float] = {}
+        self._value_function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, *label_values: str) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values: str, amount: float=1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values: str, amount: float=1) -> None:
+        self.inc(*label_values, amount=-amount)
+
+    def get(self, *label_values: str) -> float:
+        if self._value_function is not None:
+            return self._value_function()
+        return self._values.get(label_values, 0)
+
+    def set_function(self, value_function: Optional[Callable[[], float]]) -> None:
+        assert not self.label_names
+        self._value_function = value_function
+
+    def render_samples(self) -> Iterator[str]:
+        if self._value_function is not None:
+            yield f"{self.name} {_format_value(self._value_function())}"
+            return
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}{_format_labels(self.label_names, label_values)} " \
+                f"{_format_value(value)}"
+
+
+class _HistogramTimer:
+    def __init__(self, histogram: Histogram, label_values: LabelValues) -> None:
+        self._histogram = histogram
+        self._label_values = label_values
+        self._start_time = 0.0
+
+    def __enter__(self) -> None:
+        self._start_time = time.perf_counter()
+
+    def __exit__(self, exc_type: Optional[type[BaseException]],
+            exc_value: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        self._histogram.observe(time.perf_counter() - self._start_time, *self._label_values)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...]=(),
+            buckets: tuple[float, ...]=DEFAULT_DURATION_BUCKETS) -> None:
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+        # Label values: (per-bucket counts with the last being +Inf, sum of observed values)
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][bucket_index] += 1
+            entry[1][0] += value
+
+    def time(self, *label_values: str) -> _HistogramTimer:
+        return _HistogramTimer(self, label_values)
+
+    def get_count(self, *label_values: str) -> int:
+        entry = self._values.get(label_values)
+        return 0 if entry is None else sum(entry[0])
+
+    def render_samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [ (label_values, list(counts), total[0])
+                for label_values, (counts, total) in self._values.items() ]
+        for label_values, counts, total in values:
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative_count += count
+                bucket_label = f"le=\"{_format_value(upper_bound)}\""
+                yield f"{self.name}_bucket" \
+                    f"{_format_labels(self.label_names, label_values, bucket_label)} " \
+                    f"{cumulative_count}"
+            labels_text = _format_labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels_text} {_format_value(total)}"
+            yield f"{self.name}_count{labels_text} {cumulative_count}"
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        assert metric.name not in self._metrics, f"Duplicate metric {metric.name}"
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = list[str]()
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) +"\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _counter(name: str, help_text: str, label_names: tuple[str, ...]=()) -> Counter:
+    metric = Counter(name, help_text, label_names)
+    REGISTRY.register(metric)
+    return metric
+
+
+def _gauge(name: str, help_text: str, label_names: tuple[str, ...]=()) -> Gauge:
+    metric = Gauge(name, help_text, label_names)
+    REGISTRY.register(metric)
+    return metric
+
+
+def _histogram(name: str, help_text: str, label_names: tuple[str, ...]=()) -> Histogram:
+    metric = Histogram(name, help_text, label_names)
+    REGISTRY.register(metric)
+    return metric
+
+
+HTTP_REQUEST_DURATION = _histogram("esv_http_request_duration_seconds",
+    "Time taken to handle HTTP requests, or the lifetime of websocket connections",
+    ("route", "method", "status"))
+HTTP_REQUESTS_IN_PROGRESS = _gauge("esv_http_requests_in_progress",
+    "HTTP requests currently being handled, including open websocket connections",
+    ("route", "method"))
+HTTP_RESPONSES_COMPRESSED = _counter("esv_http_responses_compressed_total",
+    "HTTP responses compressed for the client, see `response_compression.py`",
+    ("route", "encoding"))
+HTTP_RESPONSE_COMPRESSION_SAVED_BYTES = _counter("esv_http_response_compression_saved_bytes_total",
+    "Bytes not sent in HTTP responses because they were compressed", ("route", "encoding"))
+
+DATABASE_CALL_DURATION = _histogram("esv_database_call_duration_seconds",
+    "Time taken by database functions and repository methods", ("function",))
+DATABASE_CALL_ERRORS = _counter("esv_database_call_errors_total",
+    "Database functions and repository methods that raised an exception", ("function",))
+DATABASE_WRITER_QUEUE_LENGTH = _gauge("esv_database_writer_queue_length",
+    "Database writes waiting for the writer thread")
+
+BACKGROUND_TASK_DURATION = _histogram("esv_background_task_duration_seconds",
+    "Time taken by each unit of work done by a background task", ("task",))
+BACKGROUND_TASK_ERRORS = _counter("esv_background_task_errors_total",
+    "Unexpected errors encountered by background tasks", ("task",))
+
+ACCOUNT_MESSAGE_QUEUE_LENGTH = _gauge("esv_account_message_queue_length",
+    "Account notifications waiting to be sent to account websockets")
+MESSAGE_BOX_NOTIFICATION_QUEUE_LENGTH = _gauge("esv_msgbox_notification_queue_length",
+    "Peer channel notifications waiting to be sent to channel websockets")
+NOTIFICATION_QUEUE_HIGH_WATER_MARK = _gauge("esv_notification_queue_high_water_mark",
+    "The most notifications that have been waiting in the queue at once", ("queue",))
+NOTIFICATION_QUEUE_OVERFLOWS = _counter("esv_notification_queue_overflows_total",
+    "Notifications dropped or replaced by a newer one (coalesced) because the queue was full",
+    ("queue", "outcome"))
+ACCOUNT_OUTBOX_MESSAGES = _counter("esv_account_outbox_messages_total",
+    "Account outbox messages written to the database (spilled), dropped because the outbox was "
+    "full or replaced by a newer notification for the same channel (compacted)", ("outcome",))
+ACCOUNT_WEBSOCKETS = _gauge("esv_account_websockets",
+    "Connected general purpose account websockets")
+HEADERS_WEBSOCKETS = _gauge("esv_headers_websockets", "Connected header websockets")
+MESSAGE_BOX_WEBSOCKETS = _gauge("esv_msgbox_websockets", "Connected peer channel websockets")
+MESSAGE_BOX_LONG_POLLS = _gauge("esv_msgbox_long_polls",
+    "Peer channel message list requests waiting for a new message (the `wait` query parameter)")
+MESSAGE_BOX_MESSAGE_LIST_READS = _counter("esv_msgbox_message_list_reads_total",
+    "Peer channel message list requests, by whether the client's copy was current "
+    "(not_modified), out of date (modified) or not given (unconditional)", ("result",))
+OUTBOUND_DATA_BACKLOG = _gauge("esv_outbound_data_backlog",
+    "Outbound data not yet delivered, as of the last delivery attempt")
+
+
+def instrument_database_call(func: Callable[..., T1]) -> Callable[..., T1]:
+    """
+    Record the duration of the decorated database function or repository method, and whether
+    it raised an exception. This is applied directly to the function, so that the name used
+    as the label is the function name and not that of any other decorator's wrapper.
+    """
+    function_name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapped_call(*args: Any, **kwargs: Any) -> T1:
+        start_time = time.perf_counter()
+        try:
+            with time_database_call():
+                return func(*args, **kwargs)
+        except Exception:
+            DATABASE_CALL_ERRORS.inc(function_name)
+            raise
+        finally:
+            DATABASE_CALL_DURATION.observe(time.perf_counter() - start_time, function_name)
+    return wrapped_call
+
+
+def instrument_database_call_async(func: Callable[..., Coroutine[Any, Any, T1]]) \
+        -> Callable[..., Coroutine[Any, Any, T1]]:
+    """
+    This is `instrument_database_call` for repository methods that are coroutines.
+    """
+    function_name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapped_call(*args: Any, **kwargs: Any) -> T1:
+        start_time = time.perf_counter()
+        try:
+            with time_database_call():
+                return await func(*args, **kwargs)
+        except Exception:
+            DATABASE_CALL_ERRORS.inc(function_name)
+            raise
+        finally:
+            DATABASE_CALL_DURATION.observe(time.perf_counter() - start_time, function_name)
+    return wrapped_call
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    route_name = get_route_name(request)
+    HTTP_REQUESTS_IN_PROGRESS.inc(route_name, request.method)
+    start_time = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        HTTP_REQUESTS_IN_PROGRESS.dec(route_name, request.method)
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - start_time, route_name,
+            request.method, str(status))
+
+
+async def get_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=REGISTRY.render().encode("utf-8"),
+        headers={ "Content-Type": "text/plain; version=0.0.4; charset=utf-8" })
@@ -0,0 +1,138 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# Message payloads larger than the `MESSAGE_PAYLOAD_BLOB_THRESHOLD` setting are stored in files
+# named by the SHA-256 hash of their content, rather than in the `message` table. This keeps the
+# table pages small for the queries that scan the messages in a channel, and identical payloads
+# are only stored once. The message row keeps the hash in its `payload_hash` column.
+#
+# A payload is first written to a temporary file, either as it is received or from memory, and
+# that is only moved into place under its hash by the database writer thread when it inserts the
+# message row that refers to it. Payload files are deleted when no message row refers to them
+# any more, and as the reference check and the deletion are also done in the writer thread, a
+# file cannot be deleted after a new row that refers to it is inserted.
+
+from __future__ import annotations
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import time
+from typing import Iterator
+import uuid
+
+
+class PayloadBlobWriter:
+    """
+    A payload being written to a temporary file in the store. The file operations block, so
+    they should not be done on the event loop.
+    """
+
+    payload_hash: str
+
+    def __init__(self, store: PayloadBlobStore, temporary_path: Path) -> None:
+        self._store = store
+        self._temporary_path = temporary_path
+        self._file = open(temporary_path, "wb")
+        self._hasher = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes|bytearray|memoryview) -> None:
+        self._file.write(data)
+        self._hasher.update(data)
+        self.size += len(data)
+
+    def finish(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self.payload_hash = self._hasher.hexdigest()
+
+    def commit(self) -> None:
+        """
+        This must be called in the writer thread, after inserting the row that refers to it.
+        """
+        file_path = self._store._get_path(self.payload_hash)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        # An existing file for the same payload is replaced, which does not affect any reads of
+        # it that are in progress.
+        os.replace(self._temporary_path, file_path)
+
+    def discard(self) -> None:
+        self._file.close()
+        self._temporary_path.unlink(missing_ok=True)
+
+
+class PayloadBlobStore:
+    def __init__(self, root_path: Path, threshold: int) -> None:
+        """
+        Payloads with more than `threshold` bytes are stored as blobs.
+        """
+        self._root_path = root_path
+        self._temporary_path = root_path / "incoming"
+        self.threshold = threshold
+        self._temporary_path.mkdir(parents=True, exist_ok=True)
+
+    def _get_path(self, payload_hash: str) -> Path:
+        # Two levels of directories keep the number of files in each directory down.
+        return self._root_path / payload_hash[:2] / payload_hash[2:4] / payload_hash
+
+    def should_store(self, payload_length: int) -> bool:
+        return payload_length > self.threshold
+
+    def create_writer(self) -> PayloadBlobWriter:
+        return PayloadBlobWriter(self, self._temporary_path / f"{uuid.uuid4().hex}.tmp")
+
+    def write(self, payload: bytes|bytearray) -> PayloadBlobWriter:
+        writer = self.create_writer()
+        try:
+            writer.write(payload)
+            writer.finish()
+        except Exception:
+            writer.discard()
+            raise
+        return writer
+
+    def read(self, payload_hash: str) -> mmap.mmap:
+        """
+        The payload is memory-mapped rather than read, so that it is only paged in as it is
+        encoded into the response.
+        """
+        with open(self._get_path(payload_hash), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self, payload_hash: str) -> None:
+        try:
+            self._get_path(payload_hash).unlink()
+        except FileNotFoundError:
+            pass
+
+    def iter_hashes(self, minimum_age_seconds: float) -> Iterator[str]:
+        """
+        The hashes of all the stored payloads that were written at least the given time ago.
+        Temporary files left by interrupted writes that are that old are deleted.
+        """
+        oldest_time = time.time() - minimum_age_seconds
+        for file_path in self._temporary_path.iterdir():
+            if self._is_older_than(file_path, oldest_time):
+                file_path.unlink(missing_ok=True)
+        for file_path in self._root_path.glob("??/??/*"):
+            if self._is_older_than(file_path, oldest_time):
+                yield file_path.name
+
+    def _is_older_than(self, file_path: Path, oldest_time: float) -> bool:
+        try:
+            return file_path.stat().st_mtime <= oldest_time
+        except FileNotFoundError:
+            return False
+
+
+def get_payload_blob_store_path(database_path: Path) -> Path:
+    return database_path.with_name(f"{database_path.stem}_payloads")
+
+
+def create_payload_blob_store(database_path: Path) -> PayloadBlobStore|None:
+    threshold = int(os.getenv("MESSAGE_PAYLOAD_BLOB_THRESHOLD", "0"))
+    if threshold <= 0:
+        return None
+    return PayloadBlobStore(get_payload_blob_store_path(database_path), threshold)
@@ -0,0 +1,107 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# Peer channel message payloads can be compressed before they are stored, selected with the
+# `MESSAGE_COMPRESSION` setting. Whether each payload is compressed depends on its content type
+# and size, and the codec used is recorded with the message so that the setting can be changed
+# without affecting existing messages. Payloads are decompressed when they are returned, unless
+# the client names the codec in the `Accept-Payload-Encoding` header, in which case the
+# compressed payload is returned as is along with the codec used.
+#
+# The standard `Accept-Encoding` header is not used for this, as it applies to the encoding of
+# the whole response, and most HTTP clients send it by default.
+
+from __future__ import annotations
+import mmap
+import os
+from typing import cast, Optional
+import zlib
+
+try:
+    # Optional: only needed if `MESSAGE_COMPRESSION` is `zstd`.
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+from ..constants import PAYLOAD_ENCODING_NAMES, PayloadEncoding
+
+
+# These are the content types accepted for messages that are usually worth compressing. Binary
+# payloads, like transactions, generally do not compress.
+COMPRESSIBLE_CONTENT_TYPES = { "application/json" }
+
+PAYLOAD_ENCODINGS_BY_NAME = { name: encoding
+    for encoding, name in PAYLOAD_ENCODING_NAMES.items() }
+
+
+class PayloadCompressor:
+    def __init__(self, encoding: PayloadEncoding, minimum_size: int,
+            level: Optional[int]=None) -> None:
+        """
+        Payloads of a compressible content type with at least `minimum_size` bytes are
+        compressed with the given codec. `level` is the codec's own compression level, or its
+        default if not given.
+        """
+        if encoding == PayloadEncoding.ZSTD and zstandard is None:
+            raise ValueError("zstd compression requires the 'zstandard' package")
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.level = level
+
+    @classmethod
+    def from_environment(cls) -> PayloadCompressor:
+        encoding_name = os.getenv("MESSAGE_COMPRESSION", "none").lower()
+        if encoding_name == "none":
+            encoding = PayloadEncoding.NONE
+        elif encoding_name in PAYLOAD_ENCODINGS_BY_NAME:
+            encoding = PAYLOAD_ENCODINGS_BY_NAME[encoding_name]
+        else:
+            raise ValueError(f"Unknown MESSAGE_COMPRESSION codec '{encoding_name}'")
+        level_text = os.getenv("MESSAGE_COMPRESSION_LEVEL")
+        return cls(encoding, int(os.getenv("MESSAGE_COMPRESSION_MINIMUM_SIZE", "256")),
+            int(level_text) if level_text else None)
+
+    def should_compress(self, content_type: str, payload_length: int) -> bool:
+        return self.encoding != PayloadEncoding.NONE and payload_length >= self.minimum_size \
+            and content_type in COMPRESSIBLE_CONTENT_TYPES
+
+    def compress(self, payload: bytes|bytearray) -> tuple[PayloadEncoding, bytes|bytearray]:
+        """
+        The payload is only stored compressed if that makes it smaller.
+        """
+        compressed_payload = compress_payload(self.encoding, payload, self.level)
+        if len(compressed_payload) < len(payload):
+            return self.encoding, compressed_payload
+        return PayloadEncoding.NONE, payload
+
+
+def compress_payload(encoding: PayloadEncoding, payload: bytes|bytearray,
+        level: Optional[int]=None) -> bytes:
+    if encoding == PayloadEncoding.DEFLATE:
+        return zlib.compress(payload, -1 if level is None else level)
+    elif encoding == PayloadEncoding.ZSTD:
+        compressor = zstandard.ZstdCompressor() if level is None else \
+            zstandard.ZstdCompressor(level=level)
+        return cast(bytes, compressor.compress(payload))
+    raise NotImplementedError(f"Unexpected payload encoding {encoding!r}")
+
+
+def decompress_payload(encoding: PayloadEncoding, payload: bytes|bytearray|mmap.mmap) -> bytes:
+    if encoding == PayloadEncoding.DEFLATE:
+        return zlib.decompress(payload)
+    elif encoding == PayloadEncoding.ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd decompression requires the 'zstandard' package")
+        return cast(bytes, zstandard.ZstdDecompressor().decompress(payload))
+    raise NotImplementedError(f"Unexpected payload encoding {encoding!r}")
+
+
+def parse_accepted_payload_encodings(header_value: Optional[str]) -> set[PayloadEncoding]:
+    """
+    The `Accept-Payload-Encoding` header is a comma-separated list of codec names.
+    """
+    if not header_value:
+        return set()
+    return { PAYLOAD_ENCODINGS_BY_NAME[name] for name in
+        (entry.strip().lower() for entry in header_value.split(","))
+        if name in PAYLOAD_ENCODINGS_BY_NAME }
@@ -5,6 +5,7 @@ Distributed under the Open BSV software license, see the accompanying file LICEN
 
 from __future__ import annotations
 
+import asyncio
 import base64
 import time
 from dataclasses import asdict
@@ -12,7 +13,6 @@ from datetime import timedelta, datetime, timezone
 from http import HTTPStatus
 from json import JSONDecodeError
 import logging
-import os
 from typing import cast, TYPE_CHECKING, Optional, Union
 import uuid
 
@@ -20,15 +20,20 @@ import aiohttp
 from aiohttp import web
 from aiohttp.web_ws import WebSocketResponse
 
-from ..constants import AccountMessageKind, MessageBoxTokenFlag
+from ..constants import AccountMessageKind, MessageBoxTokenFlag, PAYLOAD_ENCODING_NAMES, \
+    PayloadEncoding
 from ..errors import APIErrors
-from .. import sqlite_db
+from .. import metrics
+from ..request_timing import json_response, timed_json_loads
 from ..types import AccountMessage, MsgBoxWSClient, NotificationJsonData
 from ..utils import _try_read_bearer_token
 
+from .blob_store import PayloadBlobStore, PayloadBlobWriter
+from .compression import decompress_payload, parse_accepted_payload_encodings
+from ..notification_coalescing import NotificationCoalescer, parse_coalescing_window
 from .models import Message, MsgBox, MsgBoxAPITokenRow
-from .repositories import MsgBoxSQLiteRepository, PeerChannelMessageWriteError
-from .types import MessageTextResponse
+from .repositories import MsgBoxRepository, PeerChannelMessageWriteError
+from .types import MessageRow, MessageTextResponse
 from .view_models import MsgBoxViewModelGet, \
     MsgBoxViewModelCreate, MsgBoxViewModelAmend, RetentionViewModel
 
@@ -38,11 +43,15 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger('handlers-peer-channels')
 
+# The most channels that can be requested in one page of the channel list.
+MAXIMUM_CHANNEL_LIST_LIMIT = 10000
 
-def _auth_for_channel_token(request: web.Request,
-        handler_name: str, token: str, external_id: str,
-        msg_box_repository: MsgBoxSQLiteRepository) -> tuple[int, MsgBoxAPITokenRow]:
-    token_row = msg_box_repository.get_api_token(token)
+
+async def _auth_for_channel_token_async(request: web.Request,
+        handler_name: str, token: str, external_id: str) -> tuple[int, MsgBoxAPITokenRow]:
+    app_state: ApplicationState = request.app['app_state']
+    # This is `None` if the token is not valid, or is not for the given channel.
+    token_row = await app_state.get_msg_box_api_token_async(token, external_id)
     if token_row is None:
         raise web.HTTPUnauthorized()
 
@@ -66,13 +75,7 @@ def _auth_for_channel_token(request: web.Request,
         #  then can the data be safely deleted by the server.
         #  In contrast to `mark_message_read_or_unread`, calling `delete` is an irreversible action.
         raise web.HTTPUnauthorized()
-    # NOTE(rt12) Removed logging of the provided token. That is not a good practice.
-    logger.debug("Checking per-channel API token authentication")
-    internal_message_box_id = msg_box_repository.get_api_token_authorization_data_for_msg_box(
-        external_id, token_row.id)
-    if internal_message_box_id is None:
-        raise web.HTTPUnauthorized()
-    return internal_message_box_id, token_row
+    return token_row.msg_box_id, token_row
 
 
 def _msg_box_get_view(request: web.Request, msg_box: MsgBox) -> MsgBoxViewModelGet:
@@ -90,38 +93,63 @@ def _msg_box_get_view(request: web.Request, msg_box: MsgBox) -> MsgBoxViewModelG
 # ----- CHANNEL MANAGEMENT APIs ----- #
 async def list_channels(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
+    # Optional keyset pagination: `limit` channels are returned that follow the channel with the
+    # external id `after`, and the `Link` header gives the URL of the next page if there may be one.
+    limit: Optional[int] = None
+    limit_text = request.query.get('limit')
+    if limit_text is not None:
+        try:
+            limit = int(limit_text)
+        except ValueError:
+            raise web.HTTPBadRequest(reason="Invalid 'limit' value")
+        if not 1 <= limit <= MAXIMUM_CHANNEL_LIST_LIMIT:
+            raise web.HTTPBadRequest(reason=f"The 'limit' value must be between 1 and "
+                f"{MAXIMUM_CHANNEL_LIST_LIMIT}")
+
+    after_id = 0
+    after_external_id = request.query.get('after')
+    if after_external_id is not None:
+        after_msg_box = await msg_box_repository.get_msg_box_async(account_id,
+            after_external_id)
+        if after_msg_box is None:
+            raise web.HTTPBadRequest(reason="Unknown 'after' channel")
+        after_id = after_msg_box.id
+
     logger.info("Get list of message boxes for accountid: %s", account_id)
 
-    msg_boxes: list[MsgBox] = msg_box_repository.get_msg_boxes(account_id)
+    msg_boxes: list[MsgBox] = await msg_box_repository.get_msg_boxes_async(account_id,
+        after_id, limit)
     result = []
     for msg_box in msg_boxes:
         msg_box_view_get = _msg_box_get_view(request, msg_box)
         result.append(asdict(msg_box_view_get))
     logger.info("Returning %d channels for account_id: %s", len(msg_boxes), account_id)
-    return web.json_response(result)
+    response = json_response(result)
+    if limit is not None and len(msg_boxes) == limit:
+        next_url = request.rel_url.update_query(after=msg_boxes[-1].external_id, limit=limit)
+        response.headers['Link'] = f"<{next_url}>; rel=\"next\""
+    return response
 
 
 async def get_single_channel_details(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
@@ -130,25 +158,24 @@ async def get_single_channel_details(request: web.Request) -> web.Response:
     external_id = request.match_info['channelid']
 
     logger.info("Get message box by external_id %s for account(id) %s", external_id, account_id)
-    msg_box: Optional[MsgBox] = msg_box_repository.get_msg_box(account_id, external_id)
+    msg_box: Optional[MsgBox] = await msg_box_repository.get_msg_box_async(account_id, external_id)
     if not msg_box:
         raise web.HTTPNotFound
     msg_box_view_get = _msg_box_get_view(request, msg_box)
     logger.info("Returning message box by external_id: %s", external_id)
-    return web.json_response(asdict(msg_box_view_get))
+    return json_response(asdict(msg_box_view_get))
 
 
 async def update_single_channel_properties(request: web.Request) -> web.Response:
     try:
         app_state: ApplicationState = request.app['app_state']
-        msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+        msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
         api_key = _try_read_bearer_token(request)
         if not api_key:
             raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-        account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-            app_state.database_context, api_key)
+        account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
         if account_id is None:
             raise web.HTTPUnauthorized
 
@@ -156,19 +183,19 @@ async def update_single_channel_properties(request: web.Request) -> web.Response
         # Todo - check the account_id against the channel_id to ensure this user
         #  has the required read/write permissions
         external_id = request.match_info['channelid']
-        body = await request.json()
+        body = await request.json(loads=timed_json_loads)
         _msg_box_view_amend = MsgBoxViewModelAmend(public_read=body['public_read'],
             public_write=body['public_write'], locked=body['locked'])
 
         logger.info("Updating message box by external_id %s for account(id) %s.", external_id,
             account_id)
         assert _msg_box_view_amend is not None
-        msg_box_view_amend = msg_box_repository.update_msg_box(
+        msg_box_view_amend = await msg_box_repository.update_msg_box_async(
             _msg_box_view_amend, external_id)
         if not msg_box_view_amend:
             raise web.HTTPNotFound()
         logger.info("Message box with external_id: %s was updated", external_id)
-        return web.json_response(data=asdict(msg_box_view_amend))
+        return json_response(data=asdict(msg_box_view_amend))
     except JSONDecodeError:
         logger.exception("bad request body, invalid JSON")
         raise web.HTTPBadRequest(reason="bad request body, invalid JSON")
@@ -176,14 +203,13 @@ async def update_single_channel_properties(request: web.Request) -> web.Response
 
 async def delete_channel(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
@@ -195,7 +221,11 @@ async def delete_channel(request: web.Request) -> web.Response:
 
     logger.info("Deleting message box by external_id %s for account(id) %s", external_id,
         account_id)
-    msg_box_repository.delete_msg_box(external_id)
+    token_dicts = await msg_box_repository.get_api_tokens_async(external_id)
+    await msg_box_repository.delete_msg_box_async(external_id)
+    app_state.invalidate_msg_box_head(external_id)
+    for token_dict in token_dicts or []:
+        app_state.invalidate_msg_box_api_token(token_dict["token"])
 
     logger.info("Channel Deleted")
     raise web.HTTPNoContent()
@@ -204,15 +234,14 @@ async def delete_channel(request: web.Request) -> web.Response:
 async def create_new_channel(request: web.Request) -> web.Response:
     try:
         app_state: ApplicationState = request.app['app_state']
-        msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+        msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
         logger.debug(request.headers)
         api_key = _try_read_bearer_token(request)
         if not api_key:
             raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-        account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-            app_state.database_context, api_key)
+        account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
         if account_id is None:
             raise web.HTTPUnauthorized
 
@@ -221,20 +250,20 @@ async def create_new_channel(request: web.Request) -> web.Response:
         #  has the required read/write permissions
 
         logger.info("Creating new message box for account_id: %s", account_id)
-        body = await request.json()
+        body = await request.json(loads=timed_json_loads)
         retention_view_model = RetentionViewModel(**body['retention'])
         if not retention_view_model.is_valid():
             raise web.HTTPBadRequest(reason=f"{APIErrors.RETENTION_INVALID_MIN_MAX}: "
                                             "Invalid retention minimum or maximum.")
 
         msg_box_view_create = MsgBoxViewModelCreate.from_request(body)
-        msg_box: MsgBox = msg_box_repository.create_message_box(msg_box_view_create,
+        msg_box: MsgBox = await msg_box_repository.create_message_box_async(msg_box_view_create,
             account_id)
 
         msg_box_view_get = _msg_box_get_view(request, msg_box)
         logger.info("New message box for account_id %s was created external_id: %s",
             account_id, msg_box_view_get.id)
-        return web.json_response(asdict(msg_box_view_get))
+        return json_response(asdict(msg_box_view_get))
     except JSONDecodeError:
         logger.exception("bad request body, invalid JSON")
         raise web.HTTPBadRequest(reason="bad request body, invalid JSON")
@@ -242,14 +271,13 @@ async def create_new_channel(request: web.Request) -> web.Response:
 
 async def revoke_selected_token(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
@@ -257,21 +285,23 @@ async def revoke_selected_token(request: web.Request) -> web.Response:
     # Todo - check the account_id against the channel_id to ensure this user
     #  has the required read/write permissions
     _external_id = request.match_info.get('channelid')
-    token_id = request.match_info['tokenid']
-    msg_box_repository.delete_api_token(int(token_id))
+    token_id = int(request.match_info['tokenid'])
+    token_view = await msg_box_repository.get_api_token_by_id_async(token_id)
+    await msg_box_repository.delete_api_token_async(token_id)
+    if token_view is not None:
+        app_state.invalidate_msg_box_api_token(token_view.token)
     raise web.HTTPNoContent()
 
 
 async def get_token_details(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
@@ -281,22 +311,21 @@ async def get_token_details(request: web.Request) -> web.Response:
     _external_id = request.match_info['channelid']
     token_id = request.match_info['tokenid']
 
-    api_token_view_model_get = msg_box_repository.get_api_token_by_id(int(token_id))
+    api_token_view_model_get = await msg_box_repository.get_api_token_by_id_async(int(token_id))
     if not api_token_view_model_get:
         raise web.HTTPNotFound
-    return web.json_response(asdict(api_token_view_model_get))
+    return json_response(asdict(api_token_view_model_get))
 
 
 async def get_list_of_tokens(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
@@ -306,34 +335,34 @@ async def get_list_of_tokens(request: web.Request) -> web.Response:
     external_id = request.match_info['channelid']
     token = request.query.get('token')
 
-    list_api_token_view_model_get = msg_box_repository.get_api_tokens(external_id, token)
+    list_api_token_view_model_get = await msg_box_repository.get_api_tokens_async(external_id,
+        token)
     if not list_api_token_view_model_get:
         raise web.HTTPNotFound
-    return web.json_response(list_api_token_view_model_get)
+    return json_response(list_api_token_view_model_get)
 
 
 async def create_new_token_for_channel(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     api_key = _try_read_bearer_token(request)
     if not api_key:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-        app_state.database_context, api_key)
+    account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
     if account_id is None:
         raise web.HTTPUnauthorized
 
     external_id = request.match_info['channelid']
 
-    msg_box = msg_box_repository.get_msg_box(account_id, external_id)
+    msg_box = await msg_box_repository.get_msg_box_async(account_id, external_id)
     if msg_box is None:
         raise web.HTTPNotFound
 
     flags = MessageBoxTokenFlag.NONE
     try:
-        body = await request.json()
+        body = await request.json(loads=timed_json_loads)
     except JSONDecodeError:
         logger.exception("failed getting json from request")
         raise web.HTTPBadRequest(reason="bad request body, invalid JSON")
@@ -352,18 +381,120 @@ async def create_new_token_for_channel(request: web.Request) -> web.Response:
     if bool(body["can_write"]):
         flags |= MessageBoxTokenFlag.WRITE_ACCESS
 
-    api_token_view_model_get = msg_box_repository.create_api_token(description, flags,
+    api_token_view_model_get = await msg_box_repository.create_api_token_async(description, flags,
         msg_box.id, account_id)
     if api_token_view_model_get is None:
         raise web.HTTPNotFound()
 
-    return web.json_response(asdict(api_token_view_model_get))
+    return json_response(asdict(api_token_view_model_get))
+
+
+# This is the most that is read from the request body at a time.
+PAYLOAD_CHUNK_SIZE = 64 * 1024
+# Payloads larger than this are compressed and decompressed in a worker thread, rather than
+# blocking the event loop.
+PAYLOAD_EXECUTOR_SIZE = PAYLOAD_CHUNK_SIZE
+# The number of missed messages read at a time for a reconnecting channel websocket.
+MISSED_NOTIFICATIONS_PAGE_SIZE = 100
+
+
+def _payload_too_large(external_id: str, maximum_length: int, actual_length: int) \
+        -> web.HTTPRequestEntityTooLarge:
+    logger.info("Payload too large to write message to channel %s (payload size: %d bytes, "
+        "max allowed size: %d bytes).", external_id, actual_length, maximum_length)
+    return web.HTTPRequestEntityTooLarge(reason=f"{APIErrors.PAYLOAD_TOO_LARGE}: "
+                                                "Payload is too large.",
+                                         max_size=maximum_length,
+                                         actual_size=actual_length)
+
+
+async def _read_message_payload_async(request: web.Request, external_id: str,
+        maximum_length: int, blob_store: Optional[PayloadBlobStore]) \
+        -> tuple[Optional[bytearray], Optional[PayloadBlobWriter]]:
+    """
+    The body is read as it arrives and the size limit is enforced as it is read, so that
+    chunked uploads without a `Content-Length` header are also limited. Payloads that are to be
+    stored as files are written to one as they are received, and the others are read into a
+    buffer that grows as they arrive, so that a large declared `Content-Length` does not
+    allocate memory for a body that has not been sent. Either the payload or the file is
+    returned.
+    """
+    content_length = request.content_length
+    if content_length == 0:
+        raise web.HTTPBadRequest(reason="Payload is empty")
+    if content_length is not None and content_length > maximum_length:
+        raise _payload_too_large(external_id, maximum_length, content_length)
+
+    loop = asyncio.get_running_loop()
+    payload_file: Optional[PayloadBlobWriter] = None
+    buffer = bytearray()
+    received_length = 0
+    try:
+        async for chunk in request.content.iter_chunked(PAYLOAD_CHUNK_SIZE):
+            chunk_end = received_length + len(chunk)
+            if chunk_end > maximum_length:
+                raise _payload_too_large(external_id, maximum_length, chunk_end)
+
+            if payload_file is None and blob_store is not None and \
+                    blob_store.should_store(content_length or chunk_end):
+                payload_file = await loop.run_in_executor(None, blob_store.create_writer)
+                if received_length > 0:
+                    await loop.run_in_executor(None, payload_file.write,
+                        memoryview(buffer)[:received_length])
+                buffer = bytearray()
+
+            if payload_file is not None:
+                await loop.run_in_executor(None, payload_file.write, chunk)
+            else:
+                buffer += chunk
+            received_length = chunk_end
+
+        if received_length == 0:
+            raise web.HTTPBadRequest(reason="Payload is empty")
+        if payload_file is not None:
+            await loop.run_in_executor(None, payload_file.finish)
+            return None, payload_file
+    except BaseException:
+        if payload_file is not None:
+            payload_file.discard()
+        raise
+    # The connection handling guarantees that no more than the `Content-Length` is read.
+    return buffer, None
+
+
+async def _create_message_text_response_async(message_row: MessageRow,
+        accepted_encodings: set[PayloadEncoding]) -> MessageTextResponse:
+    """
+    Compressed payloads are returned as they are stored if the client accepts the codec they
+    are compressed with, and are otherwise decompressed.
+    """
+    payload_bytes = message_row.payload_bytes
+    content_encoding: Optional[str] = None
+    if message_row.payload_encoding != PayloadEncoding.NONE:
+        if message_row.payload_encoding in accepted_encodings:
+            content_encoding = PAYLOAD_ENCODING_NAMES[message_row.payload_encoding]
+        elif len(payload_bytes) > PAYLOAD_EXECUTOR_SIZE:
+            payload_bytes = await asyncio.get_running_loop().run_in_executor(None,
+                decompress_payload, message_row.payload_encoding, payload_bytes)
+        else:
+            payload_bytes = decompress_payload(message_row.payload_encoding, payload_bytes)
+
+    message_text_response: MessageTextResponse = {
+        "sequence": message_row.sequence,
+        "received": datetime.fromtimestamp(message_row.date_received, tz=timezone.utc)
+            .isoformat().replace("+00:00", "Z"),
+        "content_type": message_row.content_type,
+        "payload": base64.b64encode(payload_bytes).decode(),
+    }
+    if content_encoding is not None:
+        message_text_response["content_encoding"] = content_encoding
+    return message_text_response
 
 
 # ----- MESSAGE MANAGEMENT APIs ----- #
 async def write_message(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     external_id = request.match_info.get('channelid')
     if not external_id:
@@ -376,23 +507,21 @@ async def write_message(request: web.Request) -> web.Response:
 
     api_key = auth_string[7:]
     # First check the account master api key.
-    # account_id, account_flags = sqlite_db.get_account_id_for_api_key(app_state.database_context,
-    #     api_key)
+    # account_id, account_flags = app_state.get_account_id_for_api_key(api_key)
     # if account_id is None:
     if True:
         # This will raise an unauthorised response exception if the token is invalid for the
         # given message box represented by `external_id`.
-        internal_message_box_id, api_token_row =_auth_for_channel_token(request,
-            'write_message', api_key, external_id, msg_box_repository)
-        messagebox_row = msg_box_repository.get_message_box_by_id(internal_message_box_id)
+        internal_message_box_id, api_token_row = await _auth_for_channel_token_async(request,
+            'write_message', api_key, external_id)
+        messagebox_row = await msg_box_repository.get_message_box_by_id_async(
+            internal_message_box_id)
         assert messagebox_row is not None
     # else:
-    #     msg_box = msg_box_repository.get_msg_box(account_id, external_id)
+    #     msg_box = await msg_box_repository.get_msg_box_async(account_id, external_id)
     #     if msg_box is None:
     #         raise web.HTTPNotFound(reason="peer channel not found")
 
-    MAX_MESSAGE_CONTENT_LENGTH = int(os.getenv('MAX_MESSAGE_CONTENT_LENGTH', '0'))
-
     # https://docs.aiohttp.org/en/stable/web_reference.html -> see "content_type
     # Return value is 'application/octet-stream' if no Content-Type header present in HTTP headers
     # according to RFC 2616. So this check may be unreliable in that if content type is not set,
@@ -401,31 +530,37 @@ async def write_message(request: web.Request) -> web.Response:
         raise web.HTTPBadRequest(reason=f"{APIErrors.MISSING_HEADER}: content-type header must be "
             f"either 'application/octet-stream' or 'application/json'")
 
-    content_length = request.content_length if request.content_length else 0
-
-    if content_length == 0:
-        raise web.HTTPBadRequest(reason="Payload is empty")
-
-    if content_length > MAX_MESSAGE_CONTENT_LENGTH:
-        logger.info("Payload too large to write message to channel %s (payload size: %d bytes, "
-            "max allowed size: %d bytes).", external_id, content_length, MAX_MESSAGE_CONTENT_LENGTH)
-        raise web.HTTPRequestEntityTooLarge(reason=f"{APIErrors.PAYLOAD_TOO_LARGE}: "
-                                                   "Payload is too large.",
-                                            max_size=MAX_MESSAGE_CONTENT_LENGTH,
-                                            actual_size=content_length)
-
-    payload_bytes = await request.read()
+    # Payloads that are to be compressed are read into memory, and are only stored in a file
+    # after compression if they are still large enough, see `write_message_async`.
+    blob_store: Optional[PayloadBlobStore] = None
+    if not app_state.payload_compressor.should_compress(request.content_type,
+            request.content_length or app_state.max_message_content_length):
+        blob_store = msg_box_repository.get_payload_blob_store(messagebox_row.id)
+    payload_bytes, payload_file = await _read_message_payload_async(request, external_id,
+        app_state.max_message_content_length, blob_store)
+
+    payload_encoding = PayloadEncoding.NONE
+    payload: Optional[bytes|bytearray] = payload_bytes
+    if payload_bytes is not None and app_state.payload_compressor.should_compress(
+            request.content_type, len(payload_bytes)):
+        if len(payload_bytes) > PAYLOAD_EXECUTOR_SIZE:
+            payload_encoding, payload = await asyncio.get_running_loop().run_in_executor(None,
+                app_state.payload_compressor.compress, payload_bytes)
+        else:
+            payload_encoding, payload = app_state.payload_compressor.compress(payload_bytes)
 
     # Write message to database
     message = Message(
         msg_box_id=messagebox_row.id,
         msg_box_api_token_id=api_token_row.id,
         content_type=request.content_type,
-        payload=payload_bytes,
-        received_ts=int(time.time())
+        payload=payload,
+        received_ts=int(time.time()),
+        payload_file=payload_file,
+        payload_encoding=payload_encoding,
     )
     try:
-        message_row = msg_box_repository.write_message(message)
+        message_row = await msg_box_repository.write_message_async(message)
     except PeerChannelMessageWriteError as exc:
         if exc.code == APIErrors.CHANNEL_LOCKED:
             raise web.HTTPBadRequest(reason=f"{APIErrors.CHANNEL_LOCKED}: "
@@ -443,6 +578,8 @@ async def write_message(request: web.Request) -> web.Response:
 
     logger.info("Message %s from api_token_id: %s written to channel %s", message_row.message_id,
         api_token_row.id, external_id)
+    app_state.add_msg_box_head_message(messagebox_row.external_id, message_row.sequence,
+        api_token_row.id)
 
     # Send push notification. This goes out to all websockets for all api tokens.
     # TODO(technical-debt) Do not send to the holder of the token who sent the message.
@@ -452,29 +589,47 @@ async def write_message(request: web.Request) -> web.Response:
             .isoformat().replace("+00:00", "Z"),
         content_type=message_row.content_type,
         channel_id=messagebox_row.external_id)
-    app_state.msgbox_notification_queue.put_nowait((messagebox_row.id, payload_json))
+    await app_state.publish_message_box_notification_async(messagebox_row.id, payload_json)
 
     # Websocket of the account who owns the message box. We do not send the notification to them
     # if they are the sender. This differs from the per-message-box web socket although that
     # should possibly match this behaviour.
     if api_token_row.flags & MessageBoxTokenFlag.OWNED_BY_ACCOUNT == 0:
-        app_state.account_message_queue.put_nowait(AccountMessage(messagebox_row.account_id,
+        await app_state.publish_account_message_async(AccountMessage(messagebox_row.account_id,
             AccountMessageKind.PEER_CHANNEL_MESSAGE, payload_json))
 
-    message_text = base64.b64encode(message_row.payload_bytes).decode()
-    message_text_response: MessageTextResponse = {
-        "sequence": message_row.sequence,
-        "received": datetime.fromtimestamp(message_row.date_received, tz=timezone.utc)
-            .isoformat().replace("+00:00", "Z"),
-        "content_type": message_row.content_type,
-        "payload": message_text,
-    }
-    return web.json_response(message_text_response)
+    return json_response(await _create_message_text_response_async(message_row,
+        parse_accepted_payload_encodings(request.headers.get("Accept-Payload-Encoding"))))
+
+
+def _get_messages_entity_tag(max_sequence: int|None, status_changes: int) -> str:
+    """
+    The messages returned for a token change when a message is written, and when the token is
+    used to mark or delete messages. Only sequenced channels have an entity tag. It is sent as a
+    weak `ETag`, as the same messages can be returned with different payload encodings.
+    """
+    return "" if max_sequence is None else f"{max_sequence}-{status_changes}"
+
+
+def _entity_tag_matches(if_none_match: str, entity_tag: str) -> bool:
+    """
+    Clients may give the entity tag quoted or not, and marked as weak or not, in the
+    `If-None-Match` header.
+    """
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value == "*":
+            return True
+        if value.startswith("W/"):
+            value = value[2:]
+        if value.strip('"') == entity_tag:
+            return True
+    return False
 
 
 async def get_messages(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
     accept_type = request.headers.get('Accept', 'application/json')
     if accept_type not in ('application/json', "*/*"):
         raise web.HTTPBadRequest(reason=f"Unsupported 'accept' header mime type '{accept_type}'.")
@@ -493,16 +648,15 @@ async def get_messages(request: web.Request) -> web.Response:
     if msg_box_api_token is None:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
-    _auth_for_channel_token(request, 'get_messages', msg_box_api_token, external_id,
-        msg_box_repository)
+    _internal_message_box_id, msg_box_api_token_obj = await _auth_for_channel_token_async(
+        request, 'get_messages', msg_box_api_token, external_id)
 
     if request.method == 'HEAD':
         logger.debug("Head called for msg_box: %s", external_id)
 
-        max_sequence1 = msg_box_repository.get_max_sequence(msg_box_api_token, external_id)
-        # NOTE(rt12) `None` is never returned..
-        # if max_sequence is None:
-        #     raise web.HTTPNotFound()
+        # This is answered from the cached latest message of the channel once it is known.
+        max_sequence1 = await app_state.get_msg_box_max_sequence_async(external_id,
+            msg_box_api_token_obj.id)
 
         logger.debug("Head max sequence of msg_box: %s is %s", external_id, max_sequence1)
         response_headers = {
@@ -513,46 +667,109 @@ async def get_messages(request: web.Request) -> web.Response:
         return web.Response(headers=response_headers)
 
     assert request.method == 'GET'
-
-    msg_box_api_token_obj = msg_box_repository.get_api_token(msg_box_api_token)
-    if not msg_box_api_token:
-        raise web.HTTPNotFound(reason=f"{APIErrors.PEER_CHANNEL_TOKEN_NOT_FOUND}: "
-                                      "Peer channel token not found.")
-
-    assert msg_box_api_token_obj is not None
     logger.info("Get messages for channel_id: %s", external_id)
-    message_rows_and_sequence = msg_box_repository.get_messages(msg_box_api_token_obj.id,
-        onlyunread)
-    if message_rows_and_sequence is None:
-        raise web.HTTPNotFound(
-            reason=f"{APIErrors.MESSAGES_NOT_FOUND}: Messages not found or not sequenced.")
 
-    message_rows, max_sequence2 = message_rows_and_sequence
-    logger.info("Returning %d messages for channel: %s", len(message_rows), external_id)
+    # Long-polling clients wait for new messages rather than repeating their request.
+    wait_seconds = 0.0
+    wait_text = request.query.get('wait')
+    if wait_text is not None:
+        try:
+            wait_seconds = float(wait_text)
+        except ValueError:
+            wait_seconds = -1.0
+        if not 0 <= wait_seconds:
+            raise web.HTTPBadRequest(reason="The 'wait' query parameter must be a number of "
+                "seconds")
+        wait_seconds = min(wait_seconds, app_state.msg_box_long_poll_maximum_seconds)
+
+    if wait_seconds == 0:
+        return await _get_messages_async(request, msg_box_api_token_obj, onlyunread, 0)
+    account_id = msg_box_api_token_obj.account_id
+    if not app_state.start_msg_box_long_poll(account_id):
+        raise web.HTTPTooManyRequests(reason="Too many requests are waiting for messages for "
+            "the account of this channel")
+    try:
+        return await _get_messages_async(request, msg_box_api_token_obj, onlyunread,
+            wait_seconds)
+    finally:
+        app_state.end_msg_box_long_poll(account_id)
+
+
+async def _get_messages_async(request: web.Request, token_row: MsgBoxAPITokenRow,
+        onlyunread: bool, wait_seconds: float) -> web.Response:
+    """
+    If `wait_seconds` is given, the response is delayed until a message is written to the
+    channel or that time passes, for as long as the client already has the messages (the
+    `If-None-Match` header) or there are none.
+
+    Marking or deleting messages with the token also changes what is returned to it, so unlike
+    the latest sequence that `HEAD` gives as the `ETag`, the `ETag` of the messages includes the
+    number of times that has been done.
+    """
+    app_state: ApplicationState = request.app['app_state']
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
+    if_none_match = request.headers.get("If-None-Match")
+    end_time = time.monotonic() + wait_seconds
+    while True:
+        # The waiter is added before anything is read, so that a message written after it was
+        # read is not missed.
+        waiter: asyncio.Future[None]|None = None
+        if wait_seconds > 0:
+            waiter = app_state.add_msg_box_message_waiter(token_row.msg_box_id)
+        try:
+            # This is read before the messages, so that it never describes messages newer than
+            # the ones returned.
+            messages_version = await msg_box_repository.get_messages_version_async(token_row.id)
+            max_sequence, status_changes = messages_version if messages_version is not None \
+                else (None, 0)
+            entity_tag = _get_messages_entity_tag(max_sequence, status_changes)
+            not_modified = if_none_match is not None and entity_tag != "" and \
+                _entity_tag_matches(if_none_match, entity_tag)
+            message_rows: list[MessageRow] = []
+            if not not_modified:
+                message_rows, _max_sequence = await msg_box_repository.get_messages_async(
+                    token_row.id, onlyunread)
+
+            remaining_seconds = end_time - time.monotonic()
+            if waiter is not None and remaining_seconds > 0 and \
+                    (not_modified or len(message_rows) == 0):
+                try:
+                    await asyncio.wait_for(waiter, remaining_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+        finally:
+            if waiter is not None:
+                app_state.remove_msg_box_message_waiter(token_row.msg_box_id, waiter)
+        break
 
     response_headers = {
         'User-Agent': 'ElectrumSV-server',
         'Access-Control-Expose-Headers': 'authorization,etag',
-        'ETag': "" if max_sequence2 is None else str(max_sequence2),
+        'ETag': f'W/"{entity_tag}"' if entity_tag else "",
     }
+    if if_none_match is None:
+        metrics.MESSAGE_BOX_MESSAGE_LIST_READS.inc("unconditional")
+    elif not_modified:
+        metrics.MESSAGE_BOX_MESSAGE_LIST_READS.inc("not_modified")
+        return web.Response(status=HTTPStatus.NOT_MODIFIED, headers=response_headers)
+    else:
+        metrics.MESSAGE_BOX_MESSAGE_LIST_READS.inc("modified")
+
+    logger.info("Returning %d messages for channel id: %s", len(message_rows),
+        token_row.msg_box_id)
 
-    message_list: list[MessageTextResponse] = []
-    for message_row in message_rows:
-        message_text = base64.b64encode(message_row.payload_bytes).decode()
-        message_list.append({
-            "sequence": message_row.sequence,
-            "received": datetime.fromtimestamp(message_row.date_received, tz=timezone.utc)
-                .isoformat().replace("+00:00", "Z"),
-            "content_type": message_row.content_type,
-            "payload": message_text,
-        })
-    return web.json_response(message_list, headers=response_headers)
+    accepted_encodings = parse_accepted_payload_encodings(
+        request.headers.get("Accept-Payload-Encoding"))
+    message_list = [ await _create_message_text_response_async(message_row, accepted_encodings)
+        for message_row in message_rows ]
+    return json_response(message_list, headers=response_headers)
 
 
 
 async def mark_message_read_or_unread(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
 
     external_id = request.match_info.get('channelid')
     if not external_id:
@@ -572,13 +789,13 @@ async def mark_message_read_or_unread(request: web.Request) -> web.Response:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
     try:
-        _auth_for_channel_token(request,
-            'mark_message_read_or_unread', msg_box_api_token, external_id, msg_box_repository)
+        _internal_message_box_id, msg_box_api_token_obj = await _auth_for_channel_token_async(
+            request, 'mark_message_read_or_unread', msg_box_api_token, external_id)
     except web.HTTPException as e:
         raise e
 
     try:
-        body = await request.json()
+        body = await request.json(loads=timed_json_loads)
     except JSONDecodeError:
         logger.exception("bad request body, invalid JSON")
         raise web.HTTPBadRequest(reason="bad request body, invalid JSON")
@@ -587,20 +804,18 @@ async def mark_message_read_or_unread(request: web.Request) -> web.Response:
 
     logger.info("Flagging message sequence %s from msg_box %s (older=%s, read=%s)",
         sequence, external_id, older, set_read_to)
-    msg_box_api_token_obj = msg_box_repository.get_api_token(msg_box_api_token)
-    assert msg_box_api_token_obj is not None
-    if not msg_box_repository.sequence_exists(msg_box_api_token_obj.id, int(sequence)):
+    if not await msg_box_repository.sequence_exists_async(msg_box_api_token_obj.id, int(sequence)):
         raise web.HTTPNotFound(reason=f"{APIErrors.SEQUENCE_NUMBER_NOT_FOUND}: "
                                       "Sequence number not found.")
 
-    msg_box_repository.mark_messages(
+    await msg_box_repository.mark_messages_async(
         external_id, msg_box_api_token_obj.id, int(sequence), older, set_read_to)
     raise web.HTTPOk()
 
 
 async def delete_message(request: web.Request) -> web.Response:
     app_state: ApplicationState = request.app['app_state']
-    msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+    msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
     accept_type = request.headers.get('Accept', 'application/json')
 
     auth_string = request.headers.get('Authorization', None)
@@ -623,22 +838,23 @@ async def delete_message(request: web.Request) -> web.Response:
         raise web.HTTPBadRequest(reason="No 'Bearer' authentication.")
 
     try:
-        internal_message_box_id, channel_token = _auth_for_channel_token(request, 'delete_message',
-            msg_box_api_token, external_id, msg_box_repository)
+        internal_message_box_id, channel_token = await _auth_for_channel_token_async(request,
+            'delete_message', msg_box_api_token, external_id)
     except web.HTTPException as e:
         raise e
 
     logger.info("Deleting message sequence: %s in msg_box: %s", sequence, external_id)
-    if not msg_box_repository.sequence_exists(channel_token.id, int(sequence)):
+    if not await msg_box_repository.sequence_exists_async(channel_token.id, int(sequence)):
         raise web.HTTPNotFound(reason=f"{APIErrors.SEQUENCE_NUMBER_NOT_FOUND}: "
                                       "Sequence number not found.")
 
-    message_metadata = msg_box_repository.get_message_metadata(external_id, int(sequence))
+    message_metadata = await msg_box_repository.get_message_metadata_async(external_id,
+        int(sequence))
     if not message_metadata:
         raise web.HTTPNotFound(reason=f"{APIErrors.MESSAGE_METADATA_NOT_FOUND}: "
                                       "Message metadata not found.")
 
-    msg_box = msg_box_repository.get_message_box_by_id(internal_message_box_id)
+    msg_box = await msg_box_repository.get_message_box_by_id_async(internal_message_box_id)
     if not msg_box:
         # this should never happen
         raise web.HTTPNotFound(reason=f"{APIErrors.MESSAGE_BOX_NOT_FOUND}: "
@@ -650,11 +866,13 @@ async def delete_message(request: web.Request) -> web.Response:
         raise web.HTTPBadRequest(reason=f"{APIErrors.RETENTION_NOT_YET_EXPIRED}: "
                                         "Retention period has not yet expired.")
 
-    token_data = msg_box_repository.get_api_token(msg_box_api_token)
-    assert token_data is not None
-    count_deleted = msg_box_repository.delete_message(message_metadata.id, token_data.id)
+    count_deleted = await msg_box_repository.delete_message_async(message_metadata.id,
+        channel_token.id)
     logger.info("Deleted %s messages for sequence: %s in msg_box: %s", count_deleted, sequence,
         external_id)
+    if count_deleted > 0:
+        # The message may now be deleted by every token that received it.
+        app_state.invalidate_msg_box_head(external_id)
     raise web.HTTPOk()
 
 
@@ -665,7 +883,7 @@ class MsgBoxWebSocket(web.View):
         """The communication for this is one-way - for message box notifications only.
         Client messages will be ignored"""
         app_state: 'ApplicationState' = self.request.app['app_state']
-        msg_box_repository: MsgBoxSQLiteRepository = app_state.msg_box_repository
+        msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
         ws_id = str(uuid.uuid4())
 
         external_message_box_id = self.request.match_info.get('channelid')
@@ -681,34 +899,108 @@ class MsgBoxWebSocket(web.View):
                                             "(requires master bearer token).")
 
         try:
-            internal_message_box_id, channel_token = _auth_for_channel_token(self.request,
-                'MsgBoxWebSocket', channel_api_key, external_message_box_id, msg_box_repository)
+            internal_message_box_id, channel_token = await _auth_for_channel_token_async(
+                self.request, 'MsgBoxWebSocket', channel_api_key, external_message_box_id)
         except web.HTTPException:
             raise web.HTTPUnauthorized(reason=f"{APIErrors.INVALID_BEARER_TOKEN}: "
                                               f"Unauthorized - invalid Bearer Token")
 
+        # A reconnecting client is sent the notifications for the messages after the last one it
+        # was notified of, before any new ones.
+        since_sequence: Optional[int] = None
+        since_text = self.request.query.get('since')
+        if since_text is not None:
+            if not since_text.isdigit():
+                raise web.HTTPBadRequest(reason="The 'since' query parameter must be a message "
+                    "sequence number")
+            since_sequence = int(since_text)
+        include_payloads = self.request.query.get('payloads', "false") == "true"
+        coalescing_window_seconds = parse_coalescing_window(self.request)
+
         ws = web.WebSocketResponse(heartbeat=30)
         await ws.prepare(self.request)
         client = MsgBoxWSClient(
             ws_id=ws_id, websocket=ws,
-            messagebox_id=internal_message_box_id,
+            messagebox_ids={ internal_message_box_id },
+            coalescer=NotificationCoalescer(coalescing_window_seconds, ws.send_json)
+                if coalescing_window_seconds is not None else None,
         )
+        if since_sequence is not None:
+            app_state.start_msg_box_ws_catch_up(ws_id)
         app_state.add_msg_box_ws_client(client)
         self.logger.debug('%s connected. host=%s. channel_id=%s',
             client.ws_id, self.request.host, external_message_box_id)
 
         try:
+            if since_sequence is not None:
+                await self._send_missed_notifications_async(client, channel_token,
+                    external_message_box_id, since_sequence, include_payloads)
             await self._handle_new_connection(client)
             return ws
         except Exception:
             return web.Response(reason="Internal server error", status=500)
         finally:
+            if client.coalescer is not None:
+                client.coalescer.close()
             if not ws.closed:
                 await ws.close()
 
             self.logger.debug("removing msg box websocket id: %s", ws_id)
             app_state.remove_msg_box_ws_client(ws_id)
 
+    async def _send_missed_notifications_async(self, client: MsgBoxWSClient,
+            channel_token: MsgBoxAPITokenRow, external_id: str, since_sequence: int,
+            include_payloads: bool) -> None:
+        """
+        The notifications for new messages are held while the missed messages are read and
+        sent. Those held notifications that were not for one of the missed messages are sent
+        after them.
+        """
+        app_state: ApplicationState = self.request.app['app_state']
+        msg_box_repository: MsgBoxRepository = app_state.msg_box_repository
+        accepted_encodings = parse_accepted_payload_encodings(
+            self.request.headers.get("Accept-Payload-Encoding"))
+
+        self.logger.debug("%s sending missed notifications after sequence %d", client.ws_id,
+            since_sequence)
+        # The missed messages are read a page at a time, and the payloads are only read if the
+        # client asked for them.
+        last_sequence = since_sequence
+        while True:
+            if include_payloads:
+                message_rows, _max_sequence = await msg_box_repository.get_messages_async(
+                    channel_token.id, False, last_sequence, MISSED_NOTIFICATIONS_PAGE_SIZE)
+                if len(message_rows) == 0:
+                    break
+                for message_row in message_rows:
+                    await client.websocket.send_json({
+                        **await _create_message_text_response_async(message_row,
+                            accepted_encodings),
+                        "channel_id": external_id })
+                    last_sequence = message_row.sequence
+            else:
+                notification_rows = await msg_box_repository.get_message_notifications_async(
+                    channel_token.id, last_sequence, MISSED_NOTIFICATIONS_PAGE_SIZE)
+                if len(notification_rows) == 0:
+                    break
+                for notification_row in notification_rows:
+                    await client.websocket.send_json(NotificationJsonData(
+                        sequence=notification_row.sequence,
+                        received=datetime.fromtimestamp(notification_row.date_received,
+                            tz=timezone.utc).isoformat().replace("+00:00", "Z"),
+                        content_type=notification_row.content_type,
+                        channel_id=external_id))
+                    last_sequence = notification_row.sequence
+
+        while True:
+            notifications = app_state.take_msg_box_ws_catch_up_notifications(client.ws_id)
+            if len(notifications) == 0:
+                break
+            for notification in notifications:
+                if notification["sequence"] > last_sequence:
+                    await client.websocket.send_json(notification)
+                    last_sequence = notification["sequence"]
+
     async def _handle_new_connection(self, client: MsgBoxWSClient) -> None:
         # self.msg_box_ws_clients = self.request.app['msg_box_ws_clients']
         async for msg in client.websocket:
@@ -722,3 +1014,101 @@ class MsgBoxWebSocket(web.View):
                 # without a traceback. see aiohttp.ws_client.py:receive for details.
                 self.logger.error('ws connection closed with exception %s',
                     client.websocket.exception())
+
+
+class MsgBoxMultiChannelWebSocket(web.View):
+    """
+    One websocket for the notifications of many channels. The client sends control messages to
+    subscribe with the token for each channel, or to unsubscribe:
+
+        {"action": "subscribe", "channel_id": "<channel id>", "token": "<channel token>"}
+        {"action": "unsubscribe", "channel_id": "<channel id>"}
+
+    Each is answered with a message with the action "subscribed", "unsubscribed" or "error" and
+    the channel id. The number of channels a websocket can be subscribed to at once is limited
+    by `MESSAGE_BOX_WEBSOCKET_SUBSCRIPTION_LIMIT`. The notifications are the same as those for
+    the channel websockets, and include the id of the channel they are for.
+    """
+    logger = logging.getLogger("message-box-multi-channel-websocket")
+
+    async def get(self) -> Union[WebSocketResponse, web.Response]:
+        app_state: 'ApplicationState' = self.request.app['app_state']
+        ws_id = str(uuid.uuid4())
+        coalescing_window_seconds = parse_coalescing_window(self.request)
+
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(self.request)
+        client = MsgBoxWSClient(ws_id=ws_id, websocket=ws, messagebox_ids=set(),
+            coalescer=NotificationCoalescer(coalescing_window_seconds, ws.send_json)
+                if coalescing_window_seconds is not None else None)
+        app_state.add_msg_box_ws_client(client)
+        self.logger.debug('%s connected. host=%s', client.ws_id, self.request.host)
+
+        try:
+            await self._handle_new_connection(client)
+            return ws
+        except Exception:
+            return web.Response(reason="Internal server error", status=500)
+        finally:
+            if client.coalescer is not None:
+                client.coalescer.close()
+            if not ws.closed:
+                await ws.close()
+
+            self.logger.debug("removing msg box websocket id: %s", ws_id)
+            app_state.remove_msg_box_ws_client(ws_id)
+
+    async def _handle_new_connection(self, client: MsgBoxWSClient) -> None:
+        app_state: ApplicationState = self.request.app['app_state']
+        # Channel external id: internal id.
+        subscriptions: dict[str, int] = {}
+        async for msg in client.websocket:
+            if msg.type == aiohttp.WSMsgType.text:
+                try:
+                    control_message = msg.json(loads=timed_json_loads)
+                    action = control_message["action"]
+                    external_id = control_message["channel_id"]
+                    token = control_message["token"] if action == "subscribe" else ""
+                except (JSONDecodeError, KeyError, TypeError):
+                    await client.websocket.send_json({ "action": "error",
+                        "reason": "Invalid control message" })
+                    continue
+
+                if action == "subscribe":
+                    # This is checked before the token, so that each subscription attempt past the
+                    # limit does not query the database.
+                    if external_id not in subscriptions and \
+                            len(subscriptions) >= app_state.msg_box_websocket_subscription_limit:
+                        await client.websocket.send_json({ "action": "error",
+                            "channel_id": external_id,
+                            "reason": "Too many channel subscriptions for this websocket" })
+                        continue
+                    try:
+                        internal_message_box_id, _channel_token = \
+                            await _auth_for_channel_token_async(self.request,
+                                'MsgBoxMultiChannelWebSocket', token, external_id)
+                    except web.HTTPException:
+                        await client.websocket.send_json({ "action": "error",
+                            "channel_id": external_id,
+                            "reason": f"{APIErrors.INVALID_BEARER_TOKEN}: "
+                                "Unauthorized - invalid Bearer Token" })
+                        continue
+                    subscriptions[external_id] = internal_message_box_id
+                    app_state.subscribe_msg_box_ws_client(client.ws_id, internal_message_box_id)
+                    await client.websocket.send_json({ "action": "subscribed",
+                        "channel_id": external_id })
+                elif action == "unsubscribe":
+                    if external_id in subscriptions:
+                        app_state.unsubscribe_msg_box_ws_client(client.ws_id,
+                            subscriptions.pop(external_id))
+                    await client.websocket.send_json({ "action": "unsubscribed",
+                        "channel_id": external_id })
+                else:
+                    await client.websocket.send_json({ "action": "error",
+                        "channel_id": external_id, "reason": f"Unknown action '{action}'" })
+
+            elif msg.type == aiohttp.WSMsgType.error:
+                # 'client.websocket.exception()' merely returns ClientWebSocketResponse._exception
+                # without a traceback. see aiohttp.ws_client.py:receive for details.
+                self.logger.error('ws connection closed with exception %s',
+                    client.websocket.exception())
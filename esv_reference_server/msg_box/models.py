@@ -3,9 +3,11 @@ Copyright(c) 2021 Bitcoin Association.
 Distributed under the Open BSV software license, see the accompanying file LICENSE
 """
 from datetime import datetime
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
-from ..constants import MessageBoxTokenFlag
+from ..constants import MessageBoxTokenFlag, PayloadEncoding
+
+from .blob_store import PayloadBlobWriter
 
 
 class MsgBoxAPITokenRow(NamedTuple):
@@ -50,8 +52,12 @@ class Message(NamedTuple):
     msg_box_id: int
     msg_box_api_token_id: int
     content_type: str
-    payload: bytes
+    # This is `None` if the payload was streamed into `payload_file` as it was received.
+    payload: bytes|bytearray|None
     received_ts: int  # time.time()
+    payload_file: Optional[PayloadBlobWriter] = None
+    # The payload is compressed with this codec if it is not `NONE`, see `compression.py`.
+    payload_encoding: PayloadEncoding = PayloadEncoding.NONE
 
 
 class MessageMetadata(NamedTuple):
@@ -60,3 +66,34 @@ class MessageMetadata(NamedTuple):
     msg_box_api_token_id: int
     content_type: str
     received_ts: datetime
+
+
+class MsgBoxHead(NamedTuple):
+    """
+    The latest message in a channel that is not deleted by every token that received it, which
+    gives the `ETag` of the channel's messages. A token is not given the sequence of its own
+    messages, so the latest message written by any other token is also remembered.
+    """
+    sequenced: bool
+    sequence: int
+    from_token_id: int|None
+    other_writers_sequence: int
+
+    def get_max_sequence(self, token_id: int) -> int:
+        if not self.sequenced:
+            return 0
+        if token_id == self.from_token_id:
+            return self.other_writers_sequence
+        return self.sequence
+
+    def add_message(self, sequence: int, token_id: int) -> "MsgBoxHead":
+        if sequence > self.sequence:
+            if token_id == self.from_token_id:
+                return self._replace(sequence=sequence)
+            # The previous latest message was not written by this token.
+            return self._replace(sequence=sequence, from_token_id=token_id,
+                other_writers_sequence=self.sequence)
+        if token_id != self.from_token_id:
+            return self._replace(other_writers_sequence=max(self.other_writers_sequence,
+                sequence))
+        return self
@@ -4,9 +4,14 @@ Distributed under the Open BSV software license, see the accompanying file LICEN
 """
 from __future__ import annotations
 
+from abc import ABC, abstractmethod
+import asyncio
 import time
 from dataclasses import asdict
 import logging
+import mmap
+import os
+from pathlib import Path
 
 try:
     # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
@@ -21,37 +26,277 @@ from datetime import datetime, timezone
 from electrumsv_database.sqlite import DatabaseContext, replace_db_context_with_connection
 
 from .. import utils
-from ..constants import MessageBoxTokenFlag
+from ..constants import MessageBoxTokenFlag, PayloadEncoding
 from ..errors import APIErrors
+from ..metrics import instrument_database_call, instrument_database_call_async
 
 from . import models, view_models
-from .models import MsgBox, MsgBoxAPITokenRow, MessageMetadata, Message
-from .types import MessageRow
+from .blob_store import create_payload_blob_store, PayloadBlobStore
+from .models import MsgBox, MsgBoxAPITokenRow, MsgBoxHead, MessageMetadata, Message
+from .types import MessageNotificationRow, MessageRow
 from .view_models import APITokenViewModelGet, MsgBoxViewModelAmend
 
 
+# Payload files that are not referenced by any message are only deleted on startup if they are
+# at least this old, so that payloads being written by other worker processes are left alone.
+UNREFERENCED_PAYLOAD_MINIMUM_AGE_SECONDS = 60 * 60
+
+MESSAGE_COLUMNS_SQL = "message.id, message.fromtoken, message.msg_box_id, message.seq, " \
+    "message.receivedts, message.contenttype, message.payload, message.payload_encoding, " \
+    "message.payload_hash"
+
+TOKEN_COLUMNS_SQL = "msg_box_api_token.id, msg_box_api_token.account_id, " \
+    "msg_box_api_token.msg_box_id, msg_box_api_token.token, msg_box_api_token.description, " \
+    "msg_box_api_token.flags, msg_box_api_token.validfrom, msg_box_api_token.validto"
+
+# Whether any token still has the message in the outer query, rather than having deleted it.
+MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL = """
+    EXISTS(
+        SELECT 1
+        FROM msg_box_api_token AS reader
+        LEFT JOIN message_status_exception
+            ON message_status_exception.token_id = reader.id
+            AND message_status_exception.seq = message.seq
+        WHERE reader.msg_box_id = message.msg_box_id
+            AND message.seq >= reader.first_seq
+            AND (reader.last_seq IS NULL OR message.seq <= reader.last_seq)
+            AND message_status_exception.isdeleted IS NOT TRUE
+    )
+"""
+
+# The highest sequence there can be, for tokens that have not been revoked.
+MAXIMUM_SEQUENCE = (1 << 63) - 1
+
+
 class PeerChannelMessageWriteError(Exception):
 
     def __init__(self, code: APIErrors):
         self.code = code
 
 
-class MsgBoxSQLiteRepository:
+def _token_row_from_row(row: tuple[Any, ...]) -> MsgBoxAPITokenRow:
+    id, account_id, msg_box_id, token, description, flags_int, validfrom, validto = row
+    return MsgBoxAPITokenRow(id=id, account_id=account_id, msg_box_id=msg_box_id, token=token,
+        description=description, flags=MessageBoxTokenFlag(flags_int), validfrom=validfrom,
+        validto=validto)
+
+
+class MsgBoxRepository(ABC):
+    """
+    The storage for peer channels. Each channel write must be serialised with the other writes
+    to that channel, so that sequence numbers are allocated without gaps and the locked and
+    sequenced checks see the latest state, but writes to different channels may proceed at the
+    same time if the backend allows it.
+    """
+
+    @abstractmethod
+    async def setup_async(self, create_tables: bool, reset_tables: bool) -> None:
+        ...
+
+    @abstractmethod
+    async def close_async(self) -> None:
+        ...
+
+    @abstractmethod
+    async def update_msg_box_async(self, msg_box_view_amend: MsgBoxViewModelAmend,
+            external_id: str) -> Optional[view_models.MsgBoxViewModelAmend]:
+        ...
+
+    @abstractmethod
+    async def create_message_box_async(self,
+            msg_box_view_create: view_models.MsgBoxViewModelCreate, account_id: int) -> MsgBox:
+        ...
+
+    @abstractmethod
+    async def get_msgbox_tokens_async(self, msgbox_id: int) -> list[MsgBoxAPITokenRow]:
+        ...
+
+    @abstractmethod
+    async def get_message_box_by_id_async(self, message_box_id: int) -> Optional[MsgBox]:
+        ...
+
+    @abstractmethod
+    async def get_msg_box_async(self, account_id: int, externalid: str) -> Optional[MsgBox]:
+        ...
+
+    @abstractmethod
+    async def get_msg_boxes_async(self, account_id: int, after_id: int=0,
+            limit: Optional[int]=None) -> list[MsgBox]:
+        """
+        The account's channels in order of id, starting after the channel with id `after_id`.
+        """
+        ...
+
+    @abstractmethod
+    async def delete_msg_box_async(self, external_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def create_api_token_async(self, description: str, flags: MessageBoxTokenFlag,
+            msg_box_id: int, account_id: int) -> APITokenViewModelGet|None:
+        ...
+
+    @abstractmethod
+    async def get_api_token_by_id_async(self, token_id: int) -> APITokenViewModelGet|None:
+        ...
+
+    @abstractmethod
+    async def get_api_token_async(self, token: str) -> MsgBoxAPITokenRow|None:
+        ...
+
+    @abstractmethod
+    async def get_api_tokens_async(self, external_id: str, token: Optional[str]=None) \
+            -> Optional[list[dict[str, Any]]]:
+        ...
+
+    @abstractmethod
+    async def delete_api_token_async(self, token_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def get_api_token_authorization_data_for_msg_box_async(self, externalid: str,
+            token_id: int) -> Optional[int]:
+        ...
+
+    def get_payload_blob_store(self, msg_box_id: int) -> Optional[PayloadBlobStore]:
+        """
+        Large payloads written to the given channel are stored in this if there is one, and may
+        be streamed into it as they are received, see `Message.payload_file`.
+        """
+        return None
+
+    @abstractmethod
+    async def write_message_async(self, message: Message) -> MessageRow:
+        """
+        Raises `PeerChannelMessageWriteError` if the channel is locked, or is sequenced and the
+        writer has unread messages.
+        """
+
+    @abstractmethod
+    async def get_msg_box_head_async(self, external_id: str) -> Optional[MsgBoxHead]:
+        """
+        Returns `None` if there is no channel with the given external id.
+        """
+
+    @abstractmethod
+    async def get_messages_async(self, api_token_id: int, onlyunread: bool,
+            after_sequence: int=0, limit: Optional[int]=None) \
+                -> tuple[list[MessageRow], int | None]:
+        """
+        Only the messages with a sequence after `after_sequence` are returned, up to `limit` of
+        them if it is given, which are read with a range scan of the channel's messages. The
+        latest sequence is for all the messages.
+        """
+
+    @abstractmethod
+    async def get_message_notifications_async(self, api_token_id: int, after_sequence: int,
+            limit: int) -> list[MessageNotificationRow]:
+        """
+        The metadata of up to `limit` of the messages for the token with a sequence after
+        `after_sequence`, in order. The payloads are not read.
+        """
+
+    @abstractmethod
+    async def get_messages_version_async(self, api_token_id: int) \
+            -> tuple[int | None, int] | None:
+        """
+        The latest message sequence that `get_messages_async` would return for the token, and
+        the number of times messages have been marked or deleted with the token. The messages
+        returned for the token only change if one of these does. Returns `None` if there is no
+        such token.
+        """
+
+    @abstractmethod
+    async def sequence_exists_async(self, token_id: int, sequence: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def mark_messages_async(self, external_id: str, token_id: int, sequence: int,
+            mark_older: bool, set_read_to: bool) -> None:
+        ...
+
+    @abstractmethod
+    async def get_message_metadata_async(self, external_id: str, sequence: int) \
+            -> Optional[MessageMetadata]:
+        ...
+
+    @abstractmethod
+    async def delete_message_async(self, message_id: int, token_id: int) -> int:
+        ...
+
 
-    def __init__(self, database_context: DatabaseContext) -> None:
+class MsgBoxSQLiteRepository(MsgBoxRepository):
+    """
+    Reads are done inline on the event loop and writes are done in the database writer thread,
+    which is the only writer for the whole SQLite database.
+    """
+
+    def __init__(self, database_context: DatabaseContext, has_accounts_table: bool=True,
+            blob_store: Optional[PayloadBlobStore]=None) -> None:
+        """
+        `has_accounts_table` is `False` if this database does not also contain the accounts, so
+        the account ids cannot be foreign keys. Large payloads are stored in `blob_store` if one
+        is given, rather than in the `message` table.
+        """
         self.logger = logging.getLogger("msg-box-sqlite-db")
         self._database_context = database_context
+        self._has_accounts_table = has_accounts_table
+        self._blob_store = blob_store
+
+    async def setup_async(self, create_tables: bool, reset_tables: bool) -> None:
+        # The tables are created and dropped along with the rest of the SQLite database, in
+        # the same writer thread call, see `create_tables` and `drop_tables`.
+        if self._blob_store is not None and create_tables:
+            # The payload files of the dropped tables are all unreferenced.
+            minimum_age_seconds = 0 if reset_tables else UNREFERENCED_PAYLOAD_MINIMUM_AGE_SECONDS
+            await self._database_context.run_in_thread_async(
+                self._delete_unreferenced_payload_files, minimum_age_seconds)
+
+    async def close_async(self) -> None:
+        # The database context is owned by the application state.
+        pass
 
     def create_tables(self, db: Optional[sqlite3.Connection]=None) -> None:
         assert db is not None and isinstance(db, sqlite3.Connection)
         self.create_message_box_table(db)
         self.create_messages_table(db)
         self.create_message_box_api_tokens_table(db)
-        self.create_message_status_table(db)
+        self.create_message_status_exception_table(db)
+
+        # Databases created before payloads could be stored as files or compressed lack these.
+        column_names = { row[1] for row in db.execute("PRAGMA table_info(message)").fetchall() }
+        if "payload_hash" not in column_names:
+            db.execute("ALTER TABLE message ADD COLUMN payload_hash TEXT")
+        if "payload_encoding" not in column_names:
+            db.execute("ALTER TABLE message ADD COLUMN payload_encoding INTEGER NOT NULL "
+                "DEFAULT 0")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_message_payload_hash ON message (payload_hash) "
+            "WHERE payload_hash IS NOT NULL")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_msg_box_account_id ON msg_box (account_id, id)")
+
+        # Databases created before tokens had read cursors have a status row for each token for
+        # each message instead.
+        column_names = { row[1]
+            for row in db.execute("PRAGMA table_info(msg_box_api_token)").fetchall() }
+        if "read_seq" not in column_names:
+            db.execute("ALTER TABLE msg_box_api_token ADD COLUMN first_seq BIGINT NOT NULL "
+                "DEFAULT 1")
+            db.execute("ALTER TABLE msg_box_api_token ADD COLUMN last_seq BIGINT")
+            db.execute("ALTER TABLE msg_box_api_token ADD COLUMN read_seq BIGINT NOT NULL "
+                "DEFAULT 0")
+        if "status_changes" not in column_names:
+            db.execute("ALTER TABLE msg_box_api_token ADD COLUMN status_changes BIGINT NOT NULL "
+                "DEFAULT 0")
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'message_status'").fetchone() is not None:
+            self._migrate_message_status_rows(db)
+        db.execute("CREATE INDEX IF NOT EXISTS idx_msg_box_api_token_msg_box_id "
+            "ON msg_box_api_token (msg_box_id)")
 
     def drop_tables(self, db: Optional[sqlite3.Connection]=None) -> None:
         assert db is not None and isinstance(db, sqlite3.Connection)
         db.execute("DROP TABLE IF EXISTS message_status")
+        db.execute("DROP TABLE IF EXISTS message_status_exception")
         db.execute("DROP TABLE IF EXISTS msg_box_api_token")
         db.execute("DROP TABLE IF EXISTS message")
         db.execute("DROP TABLE IF EXISTS msg_box")
@@ -59,7 +304,9 @@ class MsgBoxSQLiteRepository:
     def create_message_box_table(self, db: sqlite3.Connection) -> None:
         """Modelled very closely on Peer Channels reference implementation:
         https://github.com/electrumsv/spvchannels-reference"""
-        sql = """
+        account_foreign_key_sql = ",\n                FOREIGN KEY(account_id) REFERENCES " \
+            "accounts(account_id)" if self._has_accounts_table else ""
+        sql = f"""
             CREATE TABLE IF NOT EXISTS msg_box (
                 id            INTEGER PRIMARY KEY AUTOINCREMENT,
                 account_id    BIGINT             NOT NULL,
@@ -72,8 +319,7 @@ class MsgBoxSQLiteRepository:
                 maxagedays    INTEGER,
                 autoprune     INTEGER,
 
-                UNIQUE (externalid),
-                FOREIGN KEY(account_id) REFERENCES accounts(account_id)
+                UNIQUE (externalid){account_foreign_key_sql}
 
         )"""
         db.execute(sql)
@@ -92,6 +338,10 @@ class MsgBoxSQLiteRepository:
                 receivedts    INTEGER            NOT NULL,
                 contenttype   VARCHAR(64)        NOT NULL,
                 payload       BLOB,
+                -- The SHA-256 hash of the payload if it is stored as a file, see `blob_store.py`.
+                payload_hash  TEXT,
+                -- The `PayloadEncoding` the payload is compressed with, see `compression.py`.
+                payload_encoding INTEGER         NOT NULL DEFAULT 0,
 
                 UNIQUE (msg_box_id, seq),
                 FOREIGN KEY (fromtoken) REFERENCES msg_box_api_token (id),
@@ -99,28 +349,84 @@ class MsgBoxSQLiteRepository:
             )"""
         db.execute(sql)
 
-    def create_message_status_table(self, db: sqlite3.Connection) -> None:
-        """Modelled very closely on Peer Channels reference implementation:
-        https://github.com/electrumsv/spvchannels-reference"""
+    def create_message_status_exception_table(self, db: sqlite3.Connection) -> None:
+        """
+        Each token has the range of message sequences it receives, from the first message
+        written after it was created to the last message written before it was revoked. A
+        message in that range is read by the token if its sequence is not above the token's
+        `read_seq`, and not deleted. Only the messages that are read, unread or deleted out of
+        that order have a row here. A `NULL` `isread` value means `read_seq` decides.
+        """
         sql = """
-            CREATE TABLE IF NOT EXISTS message_status (
-                id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id    BIGINT             NOT NULL,
+            CREATE TABLE IF NOT EXISTS message_status_exception (
                 token_id      BIGINT             NOT NULL,
+                seq           BIGINT             NOT NULL,
 
-                isread        INTEGER            NOT NULL,
+                isread        INTEGER,
                 isdeleted     INTEGER            NOT NULL,
 
-                FOREIGN KEY (message_id) REFERENCES message (id),
+                PRIMARY KEY (token_id, seq),
                 FOREIGN KEY (token_id) REFERENCES msg_box_api_token (id)
-        )"""
+            ) WITHOUT ROWID"""
         db.execute(sql)
 
+    def _migrate_message_status_rows(self, db: sqlite3.Connection) -> None:
+        """
+        Replace the status rows each token had for each message with the token's sequence range
+        and read cursor, and exception rows for the messages that do not fit them. The range of
+        a token's status rows is contiguous, as a token had one for each message written from
+        when it was created until it was revoked.
+        """
+        self.logger.info("Migrating message status rows to token read cursors")
+        db.execute("""
+            UPDATE msg_box_api_token
+            SET first_seq = COALESCE(
+                    (SELECT MIN(message.seq) FROM message_status
+                     INNER JOIN message ON message.id = message_status.message_id
+                     WHERE message_status.token_id = msg_box_api_token.id),
+                    (SELECT COALESCE(MAX(message.seq), 0) + 1 FROM message
+                     WHERE message.msg_box_id = msg_box_api_token.msg_box_id)),
+                last_seq = CASE WHEN validto IS NULL THEN NULL ELSE COALESCE(
+                    (SELECT MAX(message.seq) FROM message_status
+                     INNER JOIN message ON message.id = message_status.message_id
+                     WHERE message_status.token_id = msg_box_api_token.id),
+                    (SELECT COALESCE(MAX(message.seq), 0) FROM message
+                     WHERE message.msg_box_id = msg_box_api_token.msg_box_id)) END
+        """)
+        # The cursor is just before the first unread message that is not deleted.
+        db.execute("""
+            UPDATE msg_box_api_token
+            SET read_seq = COALESCE(
+                (SELECT MIN(message.seq) - 1 FROM message_status
+                 INNER JOIN message ON message.id = message_status.message_id
+                 WHERE message_status.token_id = msg_box_api_token.id
+                    AND NOT message_status.isread AND NOT message_status.isdeleted),
+                (SELECT MAX(message.seq) FROM message_status
+                 INNER JOIN message ON message.id = message_status.message_id
+                 WHERE message_status.token_id = msg_box_api_token.id),
+                first_seq - 1)
+        """)
+        db.execute("""
+            INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+            SELECT message_status.token_id, message.seq,
+                CASE WHEN message.seq > msg_box_api_token.read_seq AND message_status.isread
+                    THEN TRUE ELSE NULL END,
+                message_status.isdeleted
+            FROM message_status
+            INNER JOIN message ON message.id = message_status.message_id
+            INNER JOIN msg_box_api_token ON msg_box_api_token.id = message_status.token_id
+            WHERE message_status.isdeleted
+                OR (message.seq > msg_box_api_token.read_seq AND message_status.isread)
+        """)
+        db.execute("DROP TABLE message_status")
+
     def create_message_box_api_tokens_table(self, db: sqlite3.Connection) -> None:
         """Modelled very closely on Peer Channels reference implementation:
         https://github.com/electrumsv/spvchannels-reference"""
 
-        sql = """CREATE TABLE IF NOT EXISTS msg_box_api_token (
+        account_foreign_key_sql = "FOREIGN KEY (account_id) REFERENCES accounts (account_id)," \
+            if self._has_accounts_table else ""
+        sql = f"""CREATE TABLE IF NOT EXISTS msg_box_api_token (
               id                    INTEGER PRIMARY KEY AUTOINCREMENT,
               account_id            BIGINT             NOT NULL,
               msg_box_id            BIGINT             NOT NULL,
@@ -130,14 +436,21 @@ class MsgBoxSQLiteRepository:
               flags                 INTEGER,
               validfrom             INTEGER            NOT NULL,
               validto               INTEGER,
+              -- The read cursor, see `create_message_status_exception_table`.
+              first_seq             BIGINT             NOT NULL DEFAULT 1,
+              last_seq              BIGINT,
+              read_seq              BIGINT             NOT NULL DEFAULT 0,
+              -- Incremented when messages are marked or deleted with the token.
+              status_changes        BIGINT             NOT NULL DEFAULT 0,
 
               UNIQUE (token),
-              FOREIGN KEY (account_id) REFERENCES accounts (account_id),
+              {account_foreign_key_sql}
               FOREIGN KEY (msg_box_id) REFERENCES msg_box (id)
         )"""
         db.execute(sql)
 
-    def update_msg_box(self, msg_box_view_amend: MsgBoxViewModelAmend,
+    @instrument_database_call_async
+    async def update_msg_box_async(self, msg_box_view_amend: MsgBoxViewModelAmend,
             external_id: str) -> Optional[view_models.MsgBoxViewModelAmend]:
         def write(db: Optional[sqlite3.Connection]=None) -> int:
             assert db is not None and isinstance(db, sqlite3.Connection)
@@ -151,13 +464,14 @@ class MsgBoxSQLiteRepository:
                 msg_box_view_amend.public_write, msg_box_view_amend.locked, external_id))
             return len(cursor.fetchall())
 
-        if not self._database_context.run_in_thread(write):
+        if not await self._database_context.run_in_thread_async(write):
             return None
 
         return msg_box_view_amend
 
-    def create_message_box(self, msg_box_view_create: view_models.MsgBoxViewModelCreate,
-            account_id: int) -> MsgBox:
+    @instrument_database_call_async
+    async def create_message_box_async(self,
+            msg_box_view_create: view_models.MsgBoxViewModelCreate, account_id: int) -> MsgBox:
         msg_box_row = models.MsgBoxRow(
             account_id=account_id,
             locked=False,
@@ -205,34 +519,23 @@ class MsgBoxSQLiteRepository:
                 public_read=publicread, public_write=publicwrite, locked=locked,
                 sequenced=sequenced, min_age_days=minagedays, max_age_days=maxagedays,
                 autoprune=autoprune, api_tokens=[token_row], head_message_sequence=0)
-        return self._database_context.run_in_thread(write)
+        return await self._database_context.run_in_thread_async(write)
+
+    def _read_msgbox_tokens(self, db: sqlite3.Connection, msgbox_id: int) \
+            -> list[MsgBoxAPITokenRow]:
+        sql = f"SELECT {TOKEN_COLUMNS_SQL} FROM msg_box_api_token WHERE msg_box_id = ?"
+        rows = db.execute(sql, (msgbox_id,)).fetchall()
+        return [ _token_row_from_row(row) for row in rows ]
 
-    def get_msgbox_tokens(self, msgbox_id: int) -> list[MsgBoxAPITokenRow]:
-        sql = "SELECT * FROM msg_box_api_token WHERE msg_box_id = ?"
+    @instrument_database_call_async
+    async def get_msgbox_tokens_async(self, msgbox_id: int) -> list[MsgBoxAPITokenRow]:
         @replace_db_context_with_connection
         def read(db: sqlite3.Connection) -> list[MsgBoxAPITokenRow]:
-            rows = db.execute(sql, (msgbox_id,)).fetchall()
-            channel_tokens = []
-
-            id: int
-            account_id: int
-            msg_box_externalid: str
-            token: str
-            description: str
-            flags_int: int
-            validfrom: int
-            validto: int|None
-            for row in rows:
-                id, account_id, msg_box_externalid, token, \
-                    description, flags_int, validfrom, validto = row
-                msg_api_token = MsgBoxAPITokenRow(id=id, account_id=account_id,
-                    msg_box_id=msgbox_id, token=token, description=description,
-                    flags=MessageBoxTokenFlag(flags_int), validfrom=validfrom, validto=validto)
-                channel_tokens.append(msg_api_token)
-            return channel_tokens
+            return self._read_msgbox_tokens(db, msgbox_id)
         return read(self._database_context)
 
-    def get_message_box_by_id(self, message_box_id: int) -> Optional[MsgBox]:
+    @instrument_database_call_async
+    async def get_message_box_by_id_async(self, message_box_id: int) -> Optional[MsgBox]:
         sql = """
             SELECT id, account_id, externalid, publicread, publicwrite, locked, sequenced,
                    minagedays, maxagedays, autoprune,
@@ -249,7 +552,7 @@ class MsgBoxSQLiteRepository:
 
             id, account_id, externalid, publicread, publicwrite, locked, \
                 sequenced, minagedays, maxagedays, autoprune, head_message_sequence = row
-            msg_box_api_tokens = self.get_msgbox_tokens(id)
+            msg_box_api_tokens = self._read_msgbox_tokens(db, id)
             head_message_sequence = head_message_sequence if head_message_sequence else 0
 
             return MsgBox(id=id, account_id=account_id, external_id=externalid,
@@ -260,7 +563,8 @@ class MsgBoxSQLiteRepository:
 
         return read(self._database_context)
 
-    def get_msg_box(self, account_id: int, externalid: str) -> Optional[MsgBox]:
+    @instrument_database_call_async
+    async def get_msg_box_async(self, account_id: int, externalid: str) -> Optional[MsgBox]:
         sql = """
             SELECT id, account_id, externalid, publicread, publicwrite, locked, sequenced,
                    minagedays, maxagedays, autoprune,
@@ -277,7 +581,7 @@ class MsgBoxSQLiteRepository:
 
             id, account_id, externalid, publicread, publicwrite, locked, \
                 sequenced, minagedays, maxagedays, autoprune, head_message_sequence = rows[0]
-            msg_box_api_tokens = self.get_msgbox_tokens(id)
+            msg_box_api_tokens = self._read_msgbox_tokens(db, id)
             head_message_sequence = head_message_sequence if head_message_sequence else 0
 
             return MsgBox(id=id, account_id=account_id, external_id=externalid,
@@ -288,38 +592,61 @@ class MsgBoxSQLiteRepository:
 
         return read(self._database_context)
 
-    def get_msg_boxes(self, account_id: int) -> list[MsgBox]:
-        sql = """
+    @instrument_database_call_async
+    async def get_msg_boxes_async(self, account_id: int, after_id: int=0,
+            limit: Optional[int]=None) -> list[MsgBox]:
+        # The tokens for all the channels are read in one query, rather than one query for each
+        # channel. The head sequence subquery is a single lookup in the `(msg_box_id, seq)`
+        # index for each channel.
+        msg_box_sql = """
             SELECT id, account_id, externalid, publicread, publicwrite, locked, sequenced,
                    minagedays, maxagedays, autoprune,
                    (SELECT max(seq) FROM message WHERE msg_box.id = message.msg_box_id) AS seq
             FROM msg_box
-            WHERE account_id = @account_id;
+            WHERE account_id = ?1 AND id > ?2
+            ORDER BY id
+            LIMIT ?3
+        """
+        token_sql = f"""
+            SELECT {TOKEN_COLUMNS_SQL} FROM msg_box_api_token
+            WHERE msg_box_id IN (
+                SELECT id FROM msg_box WHERE account_id = ?1 AND id > ?2 ORDER BY id LIMIT ?3)
         """
         @replace_db_context_with_connection
         def read(db: sqlite3.Connection) -> list[MsgBox]:
             nonlocal account_id
-            rows = db.execute(sql, (account_id,)).fetchall()
+            # A negative limit is no limit in SQLite.
+            params = (account_id, after_id, -1 if limit is None else limit)
+            rows = db.execute(msg_box_sql, params).fetchall()
+            if not rows:
+                return []
+
+            tokens_by_msg_box_id: dict[int, list[MsgBoxAPITokenRow]] = {}
+            for token_row in db.execute(token_sql, params).fetchall():
+                msg_box_api_token = _token_row_from_row(token_row)
+                tokens_by_msg_box_id.setdefault(msg_box_api_token.msg_box_id, []).append(
+                    msg_box_api_token)
 
             msg_boxes = []
             for row in rows:
                 id, account_id, externalid, publicread, publicwrite, \
                     locked, sequenced, minagedays, maxagedays, autoprune, \
                     head_message_sequence = row
-                msg_box_api_tokens = self.get_msgbox_tokens(id)
                 head_message_sequence = head_message_sequence if head_message_sequence else 0
 
                 msg_box = MsgBox(id=id, account_id=account_id, external_id=externalid,
                     public_read=publicread, public_write=publicwrite, locked=locked,
                     sequenced=sequenced, min_age_days=minagedays, max_age_days=maxagedays,
-                    autoprune=autoprune, api_tokens=msg_box_api_tokens,
+                    autoprune=autoprune, api_tokens=tokens_by_msg_box_id.get(id, []),
                     head_message_sequence=head_message_sequence)
 
                 msg_boxes.append(msg_box)
             return msg_boxes
         return read(self._database_context)
 
-    def delete_msg_box(self, external_id: str) -> bool:
+    @instrument_database_call_async
+    async def delete_msg_box_async(self, external_id: str) -> bool:
+        payload_hashes: list[str] = []
         def write(db: Optional[sqlite3.Connection]=None) -> bool:
             assert db is not None and isinstance(db, sqlite3.Connection)
             selectChannelByExternalId = "SELECT id FROM msg_box WHERE externalid = @msg_box_id;"
@@ -328,14 +655,17 @@ class MsgBoxSQLiteRepository:
                 return False
 
             msg_box_id = result[0]
+            payload_hashes[:] = self._read_payload_hashes(db,
+                "SELECT DISTINCT payload_hash FROM message "
+                "WHERE msg_box_id = ? AND payload_hash IS NOT NULL", (msg_box_id,))
             # Peer Channels C# Reference evicts tokens from the cache and runs this query first:
             #   selectAPITokens = "SELECT * FROM msg_box_api_token WHERE msg_box_id = @msg_box_id;"
             #   apiTokens = cur.execute(selectChannelByExternalId).fetchall()
             # We are not using a cache (at the present moment) so this is skipped.
 
             statements = [
-                """DELETE FROM message_status WHERE message_id IN (
-                    SELECT id FROM message WHERE message.msg_box_id = @msg_box_id)""",
+                """DELETE FROM message_status_exception WHERE token_id IN (
+                    SELECT id FROM msg_box_api_token WHERE msg_box_id = @msg_box_id)""",
                 "DELETE FROM message WHERE msg_box_id = @msg_box_id",
                 "DELETE FROM msg_box_api_token WHERE msg_box_id = @msg_box_id",
                 "DELETE FROM msg_box WHERE id = @msg_box_id",
@@ -343,22 +673,82 @@ class MsgBoxSQLiteRepository:
             for sql in statements:
                 db.execute(sql, (msg_box_id,))
             return True
-        return self._database_context.run_in_thread(write)
+        was_deleted = await self._database_context.run_in_thread_async(write)
+        await self._delete_payload_files_after_commit_async(payload_hashes)
+        return was_deleted
+
+    def _read_payload_hashes(self, db: sqlite3.Connection, sql: str, params: tuple[Any, ...]) \
+            -> list[str]:
+        if self._blob_store is None:
+            return []
+        return [ row[0] for row in db.execute(sql, params).fetchall() ]
+
+    async def _delete_payload_files_after_commit_async(self, payload_hashes: list[str]) \
+            -> None:
+        """
+        The payload files are only deleted after the transaction that removed the references to
+        them has committed, as if it were rolled back the rows would refer to deleted files. If
+        this fails the files are deleted by the check for unreferenced files on startup.
+        """
+        if payload_hashes:
+            await self._database_context.run_in_thread_async(
+                self._delete_payload_files_if_unreferenced, payload_hashes)
+
+    def _delete_payload_files_if_unreferenced(self, payload_hashes: list[str],
+            db: Optional[sqlite3.Connection]=None) -> None:
+        """
+        This must be called in the writer thread, see `blob_store.py`.
+        """
+        assert db is not None and isinstance(db, sqlite3.Connection)
+        if self._blob_store is None:
+            return
+        sql = "SELECT 1 FROM message WHERE payload_hash = ? LIMIT 1"
+        for payload_hash in payload_hashes:
+            if db.execute(sql, (payload_hash,)).fetchone() is None:
+                self._blob_store.delete(payload_hash)
+
+    def _delete_unreferenced_payload_files(self, minimum_age_seconds: float,
+            db: Optional[sqlite3.Connection]=None) -> None:
+        assert db is not None and isinstance(db, sqlite3.Connection)
+        assert self._blob_store is not None
+        payload_hashes = list(self._blob_store.iter_hashes(minimum_age_seconds))
+        self._delete_payload_files_if_unreferenced(payload_hashes, db)
+        self.logger.debug("Checked %d payload files for references", len(payload_hashes))
+
+    def _read_message_row(self, row: tuple[Any, ...]) -> Optional[MessageRow]:
+        message_id, fromtoken, msg_box_id, seq, receivedts, contenttype, payload, \
+            payload_encoding, payload_hash = row
+        message_row = MessageRow(message_id, fromtoken, msg_box_id, seq, receivedts, contenttype,
+            payload, PayloadEncoding(payload_encoding))
+        if payload_hash is not None:
+            assert self._blob_store is not None
+            try:
+                message_row.payload_bytes = self._blob_store.read(payload_hash)
+            except FileNotFoundError:
+                # The message was deleted by every token after it was read.
+                return None
+        return message_row
 
-    def create_api_token(self, description: str, flags: MessageBoxTokenFlag,
+    @instrument_database_call_async
+    async def create_api_token_async(self, description: str, flags: MessageBoxTokenFlag,
             msg_box_id: int, account_id: int) -> APITokenViewModelGet|None:
         token = utils.create_channel_api_token()
         def write(db: sqlite3.Connection|None=None) -> tuple[int, str, str, int]|None:
             assert db is not None and isinstance(db, sqlite3.Connection)
+            # The token receives the messages written after it is created.
             sql = """
                 INSERT INTO msg_box_api_token
-                    (account_id, msg_box_id, token, description, flags, validfrom)
-                VALUES(@account_id, @msg_box_id, @token, @description, @flags, @validfrom)
+                    (account_id, msg_box_id, token, description, flags, validfrom, first_seq,
+                    read_seq)
+                SELECT @account_id, @msg_box_id, @token, @description, @flags, @validfrom,
+                    COALESCE(MAX(seq), 0) + 1, COALESCE(MAX(seq), 0)
+                FROM message
+                WHERE msg_box_id = @msg_box_id
                 RETURNING id, token, description, flags;
             """
             params = (account_id, msg_box_id, token, description, flags, int(time.time()))
             return cast(tuple[int, str, str, int]|None, db.execute(sql, params).fetchone())
-        row = self._database_context.run_in_thread(write)
+        row = await self._database_context.run_in_thread_async(write)
         if row is not None:
             id, token, description, flags_int = row
             return APITokenViewModelGet(id=id, token=token, description=description,
@@ -366,7 +756,8 @@ class MsgBoxSQLiteRepository:
                 can_write=flags_int & MessageBoxTokenFlag.WRITE_ACCESS != 0)
         return None
 
-    def get_api_token_by_id(self, token_id: int) -> APITokenViewModelGet|None:
+    @instrument_database_call_async
+    async def get_api_token_by_id_async(self, token_id: int) -> APITokenViewModelGet|None:
         sql = "SELECT id, token, description, flags FROM msg_box_api_token " \
             "WHERE id = @token_id and (validto IS NULL OR validto >= @validto);"
         params = (token_id, int(time.time()))
@@ -381,7 +772,8 @@ class MsgBoxSQLiteRepository:
             return None
         return read(self._database_context)
 
-    def get_api_token(self, token: str) -> MsgBoxAPITokenRow|None:
+    @instrument_database_call_async
+    async def get_api_token_async(self, token: str) -> MsgBoxAPITokenRow|None:
         sql = """
             SELECT id, account_id, msg_box_id, token, description, flags, validfrom, validto
             FROM msg_box_api_token
@@ -398,7 +790,8 @@ class MsgBoxSQLiteRepository:
             return None
         return read(self._database_context)
 
-    def get_api_tokens(self, external_id: str, token: Optional[str]=None) \
+    @instrument_database_call_async
+    async def get_api_tokens_async(self, external_id: str, token: Optional[str]=None) \
             -> Optional[list[dict[str, Any]]]:
         sql = """
         SELECT MBAT.id, MBAT.token, MBAT.description, MBAT.flags
@@ -425,16 +818,25 @@ class MsgBoxSQLiteRepository:
             return None
         return read(self._database_context)
 
-    def delete_api_token(self, token_id: int) -> None:
-        sql = """UPDATE msg_box_api_token SET validto = @validto WHERE id = @tokenId;"""
+    @instrument_database_call_async
+    async def delete_api_token_async(self, token_id: int) -> None:
+        # The token does not receive the messages written after it is revoked.
+        sql = """
+            UPDATE msg_box_api_token
+            SET validto = @validto,
+                last_seq = COALESCE(last_seq, (SELECT COALESCE(MAX(seq), 0) FROM message
+                    WHERE message.msg_box_id = msg_box_api_token.msg_box_id))
+            WHERE id = @tokenId;
+        """
         params = (int(time.time()), token_id)
         def write(db: Optional[sqlite3.Connection]=None) -> None:
             assert db is not None and isinstance(db, sqlite3.Connection)
             db.execute(sql, params)
-        self._database_context.run_in_thread(write)
+        await self._database_context.run_in_thread_async(write)
 
-    def get_api_token_authorization_data_for_msg_box(self, externalid: str, token_id: int) \
-            -> Optional[int]:
+    @instrument_database_call_async
+    async def get_api_token_authorization_data_for_msg_box_async(self, externalid: str,
+            token_id: int) -> Optional[int]:
         """
         If the given message box api token with id `token_id` is linked to the message box
         with externalid `externalid` then we return the internal message box id `id`.
@@ -448,13 +850,28 @@ class MsgBoxSQLiteRepository:
         params = (externalid, token_id)
         @replace_db_context_with_connection
         def read(db: sqlite3.Connection) -> Optional[int]:
-            rows = db.execute(sql, params).fetchall()
-            assert len(rows) == 1
-            return cast(int, rows[0][0])
+            row = db.execute(sql, params).fetchone()
+            return cast(int, row[0]) if row is not None else None
         return read(self._database_context)
 
-    def write_message(self, message: Message) -> MessageRow:
+    def get_payload_blob_store(self, msg_box_id: int) -> Optional[PayloadBlobStore]:
+        return self._blob_store
+
+    @instrument_database_call_async
+    async def write_message_async(self, message: Message) -> MessageRow:
         """Returns an error code and error reason"""
+        payload = message.payload
+        payload_file = message.payload_file
+        if payload_file is None and self._blob_store is not None:
+            assert payload is not None
+            if self._blob_store.should_store(len(payload)):
+                # The file is written outside the writer thread so that it does not hold up
+                # writes for other channels.
+                payload_file = await asyncio.get_running_loop().run_in_executor(None,
+                    self._blob_store.write, payload)
+                payload = None
+        payload_hash = payload_file.payload_hash if payload_file is not None else None
+
         def write(db: Optional[sqlite3.Connection]=None) -> MessageRow:
             assert db is not None and isinstance(db, sqlite3.Connection)
             # Translating this query from postgres -> SQLite
@@ -479,140 +896,272 @@ class MsgBoxSQLiteRepository:
                         raise PeerChannelMessageWriteError(code=APIErrors.SEQUENCING_FAILURE)
 
             sql = """
-                INSERT INTO message (fromtoken, msg_box_id, seq, receivedts, contenttype, payload)
+                INSERT INTO message (fromtoken, msg_box_id, seq, receivedts, contenttype, payload,
+                    payload_hash, payload_encoding)
                 SELECT @fromtoken,
                        @msg_box_id,
                        COALESCE(MAX(seq) + 1, 1) AS seq,
                        @receivedts,
                        @contenttype,
-                       @payload
+                       @payload,
+                       @payload_hash,
+                       @payload_encoding
                 FROM message
                 WHERE msg_box_id = @msg_box_id
-                RETURNING * ;
+                RETURNING id, fromtoken, msg_box_id, seq, receivedts, contenttype;
             """
             params2 = (message.msg_box_api_token_id, message.msg_box_id, message.received_ts,
-                message.content_type, message.payload)
+                message.content_type, payload, payload_hash, message.payload_encoding)
             rows = db.execute(sql, params2).fetchall()
             if len(rows) == 0:
                 raise PeerChannelMessageWriteError(code=APIErrors.DATABASE_WRITE_FAILURE)
 
-            message_row = MessageRow(*rows[0])
+            message_id, fromtoken, msg_box_id, seq, receivedts, contenttype = rows[0]
+            if payload_file is not None:
+                assert self._blob_store is not None
+                payload_file.commit()
+                payload_bytes: bytes|bytearray|mmap.mmap = \
+                    self._blob_store.read(payload_file.payload_hash)
+            else:
+                assert payload is not None
+                payload_bytes = payload
+            message_row = MessageRow(message_id, fromtoken, msg_box_id, seq, receivedts,
+                contenttype, payload_bytes, message.payload_encoding)
             self.logger.debug("Wrote message sequence: %s for msg_box_id: %s",
                 message_row.sequence, message_row.message_box_id)
 
+            # Every other token has the message unread as it is after their read cursors. The
+            # writer has read it, which only needs an exception row if it has unread messages.
             sql = """
-                INSERT INTO message_status
-                    (message_id, token_id, isread, isdeleted)
-                SELECT @messageid, msg_box_api_token.id,
-                       CASE
-                            WHEN msg_box_api_token.id = @fromtoken
-                            THEN TRUE
-                            ELSE FALSE
-                        END AS isread,
-                        FALSE AS isdeleted
-                FROM msg_box_api_token
-                WHERE validto IS NULL AND msg_box_id = @msg_box_id
+                UPDATE msg_box_api_token SET read_seq = @seq
+                WHERE id = @fromtoken AND msg_box_id = @msg_box_id AND read_seq = @seq - 1
             """
-            params3 = (message_row.message_id, message_row.from_token_id,
+            params3 = (message_row.sequence, message_row.from_token_id,
                 message_row.message_box_id)
-            db.execute(sql, params3)
+            if db.execute(sql, params3).rowcount == 0:
+                sql = """
+                    INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+                    SELECT id, @seq, TRUE, FALSE
+                    FROM msg_box_api_token
+                    WHERE id = @fromtoken AND msg_box_id = @msg_box_id
+                """
+                db.execute(sql, params3)
             return message_row
-        return self._database_context.run_in_thread(write)
 
+        try:
+            return await self._database_context.run_in_thread_async(write)
+        except BaseException:
+            # The file is left in place if it was moved there before the failure, and will be
+            # deleted on a later startup if it is not referenced, see `setup_async`.
+            if payload_file is not None:
+                payload_file.discard()
+            raise
+
+    @instrument_database_call
     def get_unread_messages_count(self, db: sqlite3.Connection, msg_box_api_token_id: int) -> int:
+        # The messages after the read cursor that are not read or deleted, and the messages up to
+        # the read cursor that are marked unread. Each is a range lookup in an index.
         sql = """
-            SELECT Count(*)
-            FROM message_status
-            WHERE message_status.token_id = @tokenid
-              AND message_status.isread = FALSE
-              AND message_status.isdeleted = FALSE
+            SELECT
+                (SELECT COUNT(*)
+                 FROM message
+                 LEFT JOIN message_status_exception
+                    ON message_status_exception.token_id = msg_box_api_token.id
+                    AND message_status_exception.seq = message.seq
+                 WHERE message.msg_box_id = msg_box_api_token.msg_box_id
+                    AND message.seq > msg_box_api_token.read_seq
+                    AND message.seq <= COALESCE(msg_box_api_token.last_seq, @maximum_sequence)
+                    AND message_status_exception.isread IS NOT TRUE
+                    AND message_status_exception.isdeleted IS NOT TRUE) +
+                (SELECT COUNT(*)
+                 FROM message_status_exception
+                 WHERE message_status_exception.token_id = msg_box_api_token.id
+                    AND message_status_exception.seq <= msg_box_api_token.read_seq
+                    AND message_status_exception.isread = FALSE
+                    AND message_status_exception.isdeleted = FALSE)
+            FROM msg_box_api_token
+            WHERE msg_box_api_token.id = @tokenid
         """
-        rows = db.execute(sql, (msg_box_api_token_id, )).fetchall()
+        rows = db.execute(sql, (MAXIMUM_SEQUENCE, msg_box_api_token_id)).fetchall()
         count = 0
         if len(rows) != 0:
             count = rows[0][0]
         return count
 
-    def get_max_sequence(self, api_key: str, external_id: str) -> int:
-        sql = """
-            SELECT MAX(message.seq) AS max_sequence
+    @instrument_database_call_async
+    async def get_msg_box_head_async(self, external_id: str) -> Optional[MsgBoxHead]:
+        head_sql = f"""
+            SELECT message.seq, message.fromtoken
             FROM message
-            INNER JOIN msg_box ON msg_box.id = message.msg_box_id
-            WHERE msg_box.externalid = @external_id
-                AND msg_box.sequenced = true
-                AND EXISTS(
-                    SELECT 'x'
-                    FROM msg_box_api_token
-                    WHERE msg_box_api_token.token = @token
-                        AND (msg_box_api_token.validto IS NULL
-                        OR msg_box_api_token.validto >= @validto)
-                        AND NOT msg_box_api_token.id = message.fromtoken
-                )
-                AND EXISTS(
-                    SELECT 'x'
-                    FROM message_status
-                    WHERE message_status.message_id = message.id AND NOT message_status.isdeleted
-                );
+            WHERE message.msg_box_id = @msg_box_id
+                AND {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL}
+            ORDER BY message.seq DESC
+            LIMIT 1
+        """
+        other_writers_sql = f"""
+            SELECT MAX(message.seq)
+            FROM message
+            WHERE message.msg_box_id = @msg_box_id
+                AND message.fromtoken != @fromtoken
+                AND {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL}
         """
-        params = (external_id, api_key, int(time.time()))
         @replace_db_context_with_connection
-        def read(db: sqlite3.Connection) -> int:
-            rows = db.execute(sql, params).fetchall()
-            seq = 0
-            if len(rows) != 0:
-                seq = rows[0][0]
-            return seq if seq is not None else 0
+        def read(db: sqlite3.Connection) -> Optional[MsgBoxHead]:
+            row = db.execute("SELECT id, sequenced FROM msg_box WHERE externalid = ?",
+                (external_id,)).fetchone()
+            if row is None:
+                return None
+            msg_box_id, sequenced = row
+            if not sequenced:
+                return MsgBoxHead(False, 0, None, 0)
+            row = db.execute(head_sql, (msg_box_id,)).fetchone()
+            if row is None:
+                return MsgBoxHead(True, 0, None, 0)
+            sequence, from_token_id = row
+            other_writers_sequence = db.execute(other_writers_sql,
+                (msg_box_id, from_token_id)).fetchone()[0]
+            return MsgBoxHead(True, sequence, from_token_id, other_writers_sequence or 0)
         return read(self._database_context)
 
-    def get_messages(self, api_token_id: int, onlyunread: bool) -> tuple[list[MessageRow],
-            int | None]:
+    @instrument_database_call_async
+    async def get_messages_async(self, api_token_id: int, onlyunread: bool,
+            after_sequence: int=0, limit: Optional[int]=None) \
+                -> tuple[list[MessageRow], int | None]:
         @replace_db_context_with_connection
         def read(db: sqlite3.Connection) -> tuple[list[MessageRow], int | None]:
             sql = """
-                SELECT msg_box.sequenced
+                SELECT msg_box.sequenced, msg_box.id, msg_box_api_token.first_seq,
+                    COALESCE(msg_box_api_token.last_seq, @maximum_sequence),
+                    msg_box_api_token.read_seq,
+                    (SELECT MIN(seq) FROM message_status_exception
+                     WHERE token_id = msg_box_api_token.id
+                        AND seq <= msg_box_api_token.read_seq
+                        AND isread = FALSE AND isdeleted = FALSE)
                 FROM msg_box
                 INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = msg_box.id
                 WHERE msg_box_api_token.id = @tokenid
             """
-            rows = db.execute(sql, (api_token_id,)).fetchall()
+            rows = db.execute(sql, (MAXIMUM_SEQUENCE, api_token_id)).fetchall()
             if len(rows) == 0:
                 return [], None
 
-            sequenced = rows[0][0]
+            sequenced, msg_box_id, first_sequence, last_sequence, read_sequence, \
+                first_unread_exception_sequence = rows[0]
+            max_sequence: int | None = None
             if sequenced:
-                sql = """
-                    SELECT MAX(message.seq) AS max_sequence
-                    FROM message
-                    INNER JOIN message_status ON message_status.message_id = message.id
-                    WHERE message_status.token_id = @tokenid AND NOT message_status.isdeleted;
-                """
-                sequence_row = db.execute(sql, (api_token_id,)).fetchone()
-                max_sequence = sequence_row[0] if sequence_row is not None else 0
-            else:
-                max_sequence = None
-
-            sql = """
-                SELECT message.*
+                max_sequence = self._read_max_sequence(db, api_token_id, msg_box_id,
+                    first_sequence, last_sequence)
+
+            # Unread messages are either after the read cursor or marked unread, so the messages
+            # before both of these do not need to be looked at.
+            from_sequence = first_sequence
+            if onlyunread:
+                from_sequence = read_sequence + 1
+                if first_unread_exception_sequence is not None:
+                    from_sequence = min(from_sequence, first_unread_exception_sequence)
+            from_sequence = max(from_sequence, after_sequence + 1)
+
+            sql = f"""
+                SELECT {MESSAGE_COLUMNS_SQL}
                 FROM message
-                INNER JOIN message_status ON message_status.message_id = message.id
-                INNER JOIN msg_box_api_token ON message_status.token_id = msg_box_api_token.id
-                WHERE msg_box_api_token.id = @tokenid
-                    AND message_status.isdeleted = false
-                    AND (message_status.isread = false OR @onlyunread = false)
-                ORDER BY message.seq;
+                LEFT JOIN message_status_exception
+                    ON message_status_exception.token_id = @tokenid
+                    AND message_status_exception.seq = message.seq
+                WHERE message.msg_box_id = @msg_box_id
+                    AND message.seq BETWEEN @from_seq AND @last_seq
+                    AND message_status_exception.isdeleted IS NOT TRUE
+                    AND (@onlyunread = false
+                        OR (message.seq > @read_seq
+                            AND message_status_exception.isread IS NOT TRUE)
+                        OR message_status_exception.isread = false)
+                ORDER BY message.seq
+                LIMIT @limit;
             """
-            messages = [ MessageRow(*row) for row in
-                db.execute(sql, (api_token_id, onlyunread)).fetchall() ]
+            messages: list[MessageRow] = []
+            for row in db.execute(sql, (api_token_id, msg_box_id, from_sequence, last_sequence,
+                    onlyunread, read_sequence, -1 if limit is None else limit)).fetchall():
+                message_row = self._read_message_row(row)
+                if message_row is not None:
+                    messages.append(message_row)
             return messages, max_sequence
         return read(self._database_context)
 
-    def sequence_exists(self, token_id: int, sequence: int) -> bool:
+    @instrument_database_call_async
+    async def get_message_notifications_async(self, api_token_id: int, after_sequence: int,
+            limit: int) -> list[MessageNotificationRow]:
+        sql = """
+            SELECT message.seq, message.receivedts, message.contenttype
+            FROM msg_box_api_token
+            INNER JOIN message ON message.msg_box_id = msg_box_api_token.msg_box_id
+            LEFT JOIN message_status_exception
+                ON message_status_exception.token_id = msg_box_api_token.id
+                AND message_status_exception.seq = message.seq
+            WHERE msg_box_api_token.id = @tokenid
+                AND message.seq BETWEEN MAX(msg_box_api_token.first_seq, @after_seq + 1)
+                    AND COALESCE(msg_box_api_token.last_seq, @maximum_seq)
+                AND message_status_exception.isdeleted IS NOT TRUE
+            ORDER BY message.seq
+            LIMIT @limit
+        """
+        @replace_db_context_with_connection
+        def read(db: sqlite3.Connection) -> list[MessageNotificationRow]:
+            return [ MessageNotificationRow(*row) for row in db.execute(sql,
+                (api_token_id, after_sequence, MAXIMUM_SEQUENCE, limit)).fetchall() ]
+        return read(self._database_context)
+
+    def _read_max_sequence(self, db: sqlite3.Connection, api_token_id: int, msg_box_id: int,
+            first_sequence: int, last_sequence: int) -> int | None:
+        sql = """
+            SELECT message.seq
+            FROM message
+            LEFT JOIN message_status_exception
+                ON message_status_exception.token_id = @tokenid
+                AND message_status_exception.seq = message.seq
+            WHERE message.msg_box_id = @msg_box_id
+                AND message.seq BETWEEN @first_seq AND @last_seq
+                AND message_status_exception.isdeleted IS NOT TRUE
+            ORDER BY message.seq DESC
+            LIMIT 1
+        """
+        row = db.execute(sql, (api_token_id, msg_box_id, first_sequence,
+            last_sequence)).fetchone()
+        return cast(int, row[0]) if row is not None else None
+
+    @instrument_database_call_async
+    async def get_messages_version_async(self, api_token_id: int) \
+            -> tuple[int | None, int] | None:
+        sql = """
+            SELECT msg_box.sequenced, msg_box.id, msg_box_api_token.first_seq,
+                COALESCE(msg_box_api_token.last_seq, @maximum_seq),
+                msg_box_api_token.status_changes
+            FROM msg_box
+            INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = msg_box.id
+            WHERE msg_box_api_token.id = @tokenid
+        """
+        @replace_db_context_with_connection
+        def read(db: sqlite3.Connection) -> tuple[int | None, int] | None:
+            row = db.execute(sql, (MAXIMUM_SEQUENCE, api_token_id)).fetchone()
+            if row is None:
+                return None
+            sequenced, msg_box_id, first_sequence, last_sequence, status_changes = row
+            max_sequence: int | None = None
+            if sequenced:
+                max_sequence = self._read_max_sequence(db, api_token_id, msg_box_id,
+                    first_sequence, last_sequence)
+            return max_sequence, status_changes
+        return read(self._database_context)
+
+    @instrument_database_call_async
+    async def sequence_exists_async(self, token_id: int, sequence: int) -> bool:
         sql = """
             SELECT COUNT(message.seq) AS seq_count
             FROM message
-            INNER JOIN message_status ON message_status.message_id = message.id
-            WHERE message_status.token_id = @token_id
-              AND message.seq = @seq;
+            INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = message.msg_box_id
+            WHERE msg_box_api_token.id = @token_id
+              AND message.seq = @seq
+              AND message.seq >= msg_box_api_token.first_seq
+              AND (msg_box_api_token.last_seq IS NULL
+                OR message.seq <= msg_box_api_token.last_seq);
         """
         params = (token_id, sequence)
         @replace_db_context_with_connection
@@ -624,35 +1173,79 @@ class MsgBoxSQLiteRepository:
             return False
         return read(self._database_context)
 
-    def mark_messages(self, external_id: str, token_id: int, sequence: int, mark_older: bool,
-            set_read_to: bool) -> None:
-        sql = """
-            UPDATE message_status SET isread = @isread
-            WHERE message_status.message_id IN (
-                SELECT message.id
-                FROM message
-                INNER JOIN msg_box ON message.msg_box_id = msg_box.id
-                WHERE msg_box.externalid = @external_id
-                AND (message.seq = @seq OR (message.seq < @seq AND @mark_older = true))
-            )
-            AND message_status.token_id = @token_id
-        """
+    @instrument_database_call_async
+    async def mark_messages_async(self, external_id: str, token_id: int, sequence: int,
+            mark_older: bool, set_read_to: bool) -> None:
         def write(db: Optional[sqlite3.Connection]=None) -> None:
             assert db is not None and isinstance(db, sqlite3.Connection)
-            params = (set_read_to, external_id, sequence, mark_older, token_id)
-            db.execute(sql, params)
-        self._database_context.run_in_thread(write)
-
-    def get_message_metadata(self, external_id: str, sequence: int) -> Optional[MessageMetadata]:
-        sql = """
+            sql = """
+                SELECT msg_box_api_token.msg_box_id, msg_box_api_token.first_seq,
+                    msg_box_api_token.read_seq
+                FROM msg_box_api_token
+                INNER JOIN msg_box ON msg_box.id = msg_box_api_token.msg_box_id
+                WHERE msg_box_api_token.id = @token_id AND msg_box.externalid = @external_id
+            """
+            row = db.execute(sql, (token_id, external_id)).fetchone()
+            if row is None:
+                return
+            msg_box_id, first_sequence, read_sequence = row
+            db.execute("UPDATE msg_box_api_token SET status_changes = status_changes + 1 "
+                "WHERE id = @token_id", (token_id,))
+
+            if mark_older and set_read_to:
+                # Everything up to the sequence is read, so the read cursor is moved up to it
+                # if it is not already past it.
+                db.execute("UPDATE msg_box_api_token SET read_seq = MAX(read_seq, @seq) "
+                    "WHERE id = @token_id", (sequence, token_id))
+                db.execute("UPDATE message_status_exception SET isread = NULL "
+                    "WHERE token_id = @token_id AND seq <= @seq", (token_id, sequence))
+            elif mark_older:
+                # Everything up to the sequence is unread, so the read cursor is moved back to
+                # before the first message. Messages that were read and are after the sequence
+                # now need exception rows to stay read, but marking older messages unread is
+                # expected to be rare.
+                if sequence < read_sequence:
+                    db.execute("""
+                        INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+                        SELECT @token_id, seq, TRUE, FALSE
+                        FROM message
+                        WHERE msg_box_id = @msg_box_id AND seq > @seq AND seq <= @read_seq
+                        ON CONFLICT (token_id, seq) DO UPDATE SET isread = COALESCE(isread, TRUE)
+                    """, (token_id, msg_box_id, sequence, read_sequence))
+                db.execute("UPDATE msg_box_api_token SET read_seq = @read_seq WHERE id = @token_id",
+                    (first_sequence - 1, token_id))
+                db.execute("UPDATE message_status_exception SET isread = NULL "
+                    "WHERE token_id = @token_id AND seq <= @seq", (token_id, sequence))
+            elif set_read_to and sequence == read_sequence + 1:
+                # Messages read in order move the read cursor.
+                db.execute("UPDATE msg_box_api_token SET read_seq = @seq WHERE id = @token_id",
+                    (sequence, token_id))
+                db.execute("UPDATE message_status_exception SET isread = NULL "
+                    "WHERE token_id = @token_id AND seq = @seq", (token_id, sequence))
+            else:
+                # The exception is not needed if the read cursor already gives this state.
+                isread = None if set_read_to == (sequence <= read_sequence) else set_read_to
+                db.execute("""
+                    INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+                    VALUES (@token_id, @seq, @isread, FALSE)
+                    ON CONFLICT (token_id, seq) DO UPDATE SET isread = excluded.isread
+                """, (token_id, sequence, isread))
+
+            db.execute("DELETE FROM message_status_exception WHERE token_id = @token_id "
+                "AND isread IS NULL AND isdeleted = FALSE", (token_id,))
+        await self._database_context.run_in_thread_async(write)
+
+    @instrument_database_call_async
+    async def get_message_metadata_async(self, external_id: str, sequence: int) \
+            -> Optional[MessageMetadata]:
+        sql = f"""
             SELECT message.id, message.fromtoken, message.msg_box_id,
                 message.seq, message.receivedts, message.contenttype
             FROM message
-            INNER JOIN message_status ON message_status.message_id = message.id
             INNER JOIN msg_box ON message.msg_box_id = msg_box.id
             WHERE msg_box.externalid = @external_id
               AND message.seq = @seq
-              AND message_status.isdeleted = false;
+              AND {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL};
         """
         params = (external_id, sequence)
         @replace_db_context_with_connection
@@ -670,12 +1263,59 @@ class MsgBoxSQLiteRepository:
             return None
         return read(self._database_context)
 
-    def delete_message(self, message_id: int, token_id: int) -> int:
-        sql = "UPDATE message_status SET isdeleted = true " \
-              "WHERE token_id = @token_id AND message_id = @message_id " \
-              "RETURNING id;"
+    @instrument_database_call_async
+    async def delete_message_async(self, message_id: int, token_id: int) -> int:
+        # Only tokens that received the message can delete it.
+        sql = """
+            INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+            SELECT msg_box_api_token.id, message.seq, NULL, TRUE
+            FROM message
+            INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = message.msg_box_id
+            WHERE message.id = @message_id AND msg_box_api_token.id = @token_id
+                AND message.seq >= msg_box_api_token.first_seq
+                AND (msg_box_api_token.last_seq IS NULL
+                    OR message.seq <= msg_box_api_token.last_seq)
+            ON CONFLICT (token_id, seq) DO UPDATE SET isdeleted = TRUE
+            RETURNING token_id;
+        """
+        payload_hashes: list[str] = []
         def write(db: Optional[sqlite3.Connection]=None) -> int:
             assert db is not None and isinstance(db, sqlite3.Connection)
-            rows = db.execute(sql, (token_id, message_id,)).fetchall()
+            rows = db.execute(sql, (message_id, token_id)).fetchall()
+            if len(rows) > 0:
+                db.execute("UPDATE msg_box_api_token SET status_changes = status_changes + 1 "
+                    "WHERE id = @token_id", (token_id,))
+                # Once every token has deleted the message its payload file is no longer needed.
+                payload_hashes[:] = self._read_payload_hashes(db, f"""
+                    SELECT payload_hash FROM message
+                    WHERE id = @message_id AND payload_hash IS NOT NULL
+                      AND NOT {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL}
+                """, (message_id,))
+                if payload_hashes:
+                    db.execute("UPDATE message SET payload_hash = NULL WHERE id = ?",
+                        (message_id,))
             return len(rows)
-        return self._database_context.run_in_thread(write)
+        deleted_count = await self._database_context.run_in_thread_async(write)
+        await self._delete_payload_files_after_commit_async(payload_hashes)
+        return deleted_count
+
+
+def create_msg_box_repository(database_context: DatabaseContext, datastore_location: Path) \
+        -> MsgBoxRepository:
+    """
+    The peer channels are stored in the SQLite database with everything else, unless a
+    PostgreSQL database is given in the `PEER_CHANNELS_DATABASE_URL` setting or they are to be
+    split across several SQLite databases with the `PEER_CHANNELS_SQLITE_SHARDS` setting.
+    """
+    database_url = os.getenv("PEER_CHANNELS_DATABASE_URL")
+    if database_url:
+        # This requires the optional `asyncpg` package.
+        from .repositories_postgres import MsgBoxPostgresRepository
+        return MsgBoxPostgresRepository(database_url,
+            int(os.getenv("PEER_CHANNELS_DATABASE_POOL_SIZE", "10")))
+    shard_count = int(os.getenv("PEER_CHANNELS_SQLITE_SHARDS", "0"))
+    if shard_count > 0:
+        from .repositories_sharded import MsgBoxShardedSQLiteRepository
+        return MsgBoxShardedSQLiteRepository(datastore_location, shard_count)
+    return MsgBoxSQLiteRepository(database_context,
+        blob_store=create_payload_blob_store(datastore_location))
@@ -0,0 +1,819 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# The peer channel storage on PostgreSQL, selected with the `PEER_CHANNELS_DATABASE_URL` setting.
+# This is a translation of the SQLite repository back to the PostgreSQL queries of the Peer
+# Channels reference implementation (https://github.com/electrumsv/spvchannels-reference). Each
+# message write locks the row of the channel it is written to with `FOR UPDATE`, so writes to
+# the same channel are serialised and writes to different channels are done concurrently on
+# different pooled connections.
+#
+# The accounts remain in the SQLite database, so the account ids are not foreign keys here.
+
+from __future__ import annotations
+from dataclasses import asdict
+from datetime import datetime, timezone
+import logging
+import time
+from typing import Any, Optional
+
+import asyncpg
+
+from .. import utils
+from ..constants import MessageBoxTokenFlag, PayloadEncoding
+from ..errors import APIErrors
+from ..metrics import instrument_database_call_async
+
+from . import view_models
+from .models import MsgBox, MsgBoxAPITokenRow, MsgBoxHead, MessageMetadata, Message
+from .repositories import MAXIMUM_SEQUENCE, MsgBoxRepository, PeerChannelMessageWriteError
+from .types import MessageNotificationRow, MessageRow
+from .view_models import APITokenViewModelGet, MsgBoxViewModelAmend
+
+
+CREATE_TABLE_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS msg_box (
+        id            BIGSERIAL          PRIMARY KEY,
+        account_id    BIGINT             NOT NULL,
+        externalid    VARCHAR(1024)      NOT NULL,
+        publicread    BOOLEAN,
+        publicwrite   BOOLEAN,
+        locked        BOOLEAN,
+        sequenced     BOOLEAN,
+        minagedays    INTEGER,
+        maxagedays    INTEGER,
+        autoprune     BOOLEAN,
+
+        UNIQUE (externalid)
+    )""",
+    # This replaced an index on only `account_id`, so that channels are listed in id order.
+    "DROP INDEX IF EXISTS msg_box_account_id_idx",
+    "CREATE INDEX IF NOT EXISTS msg_box_account_id_id_idx ON msg_box (account_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS msg_box_api_token (
+        id            BIGSERIAL          PRIMARY KEY,
+        account_id    BIGINT             NOT NULL,
+        msg_box_id    BIGINT             NOT NULL,
+
+        token         VARCHAR(1024),
+        description   VARCHAR(1024),
+        flags         INTEGER,
+        validfrom     BIGINT             NOT NULL,
+        validto       BIGINT,
+        -- The read cursor, see `MsgBoxSQLiteRepository.create_message_status_exception_table`.
+        first_seq     BIGINT             NOT NULL DEFAULT 1,
+        last_seq      BIGINT,
+        read_seq      BIGINT             NOT NULL DEFAULT 0,
+        -- Incremented when messages are marked or deleted with the token.
+        status_changes BIGINT            NOT NULL DEFAULT 0,
+
+        UNIQUE (token),
+        FOREIGN KEY (msg_box_id) REFERENCES msg_box (id)
+    )""",
+    # Tables created before tokens had read cursors lack these, see `MIGRATION_STATEMENTS`.
+    "ALTER TABLE msg_box_api_token ADD COLUMN IF NOT EXISTS first_seq BIGINT NOT NULL DEFAULT 1",
+    "ALTER TABLE msg_box_api_token ADD COLUMN IF NOT EXISTS last_seq BIGINT",
+    "ALTER TABLE msg_box_api_token ADD COLUMN IF NOT EXISTS read_seq BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE msg_box_api_token ADD COLUMN IF NOT EXISTS status_changes BIGINT NOT NULL "
+        "DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS msg_box_api_token_msg_box_id_idx ON msg_box_api_token "
+        "(msg_box_id)",
+    """
+    CREATE TABLE IF NOT EXISTS message (
+        id            BIGSERIAL          PRIMARY KEY,
+        fromtoken     BIGINT             NOT NULL,
+        msg_box_id    BIGINT             NOT NULL,
+
+        seq           BIGINT             NOT NULL,
+        receivedts    BIGINT             NOT NULL,
+        contenttype   VARCHAR(64)        NOT NULL,
+        payload       BYTEA,
+        payload_encoding SMALLINT        NOT NULL DEFAULT 0,
+
+        UNIQUE (msg_box_id, seq),
+        FOREIGN KEY (fromtoken) REFERENCES msg_box_api_token (id),
+        FOREIGN KEY (msg_box_id) REFERENCES msg_box (id)
+    )""",
+    # Tables created before payloads could be compressed lack this.
+    "ALTER TABLE message ADD COLUMN IF NOT EXISTS payload_encoding SMALLINT NOT NULL DEFAULT 0",
+    """
+    CREATE TABLE IF NOT EXISTS message_status_exception (
+        token_id      BIGINT             NOT NULL,
+        seq           BIGINT             NOT NULL,
+
+        isread        BOOLEAN,
+        isdeleted     BOOLEAN            NOT NULL,
+
+        PRIMARY KEY (token_id, seq),
+        FOREIGN KEY (token_id) REFERENCES msg_box_api_token (id)
+    )""",
+]
+
+# Databases created before tokens had read cursors have a status row for each token for each
+# message in `message_status` instead. These replace them with the read cursors and exception
+# rows, see `MsgBoxSQLiteRepository._migrate_message_status_rows`.
+MIGRATION_STATEMENTS = [
+    """
+    UPDATE msg_box_api_token
+    SET first_seq = COALESCE(
+            (SELECT MIN(message.seq) FROM message_status
+             INNER JOIN message ON message.id = message_status.message_id
+             WHERE message_status.token_id = msg_box_api_token.id),
+            (SELECT COALESCE(MAX(message.seq), 0) + 1 FROM message
+             WHERE message.msg_box_id = msg_box_api_token.msg_box_id)),
+        last_seq = CASE WHEN validto IS NULL THEN NULL ELSE COALESCE(
+            (SELECT MAX(message.seq) FROM message_status
+             INNER JOIN message ON message.id = message_status.message_id
+             WHERE message_status.token_id = msg_box_api_token.id),
+            (SELECT COALESCE(MAX(message.seq), 0) FROM message
+             WHERE message.msg_box_id = msg_box_api_token.msg_box_id)) END
+    """,
+    """
+    UPDATE msg_box_api_token
+    SET read_seq = COALESCE(
+        (SELECT MIN(message.seq) - 1 FROM message_status
+         INNER JOIN message ON message.id = message_status.message_id
+         WHERE message_status.token_id = msg_box_api_token.id
+            AND NOT message_status.isread AND NOT message_status.isdeleted),
+        (SELECT MAX(message.seq) FROM message_status
+         INNER JOIN message ON message.id = message_status.message_id
+         WHERE message_status.token_id = msg_box_api_token.id),
+        first_seq - 1)
+    """,
+    """
+    INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+    SELECT message_status.token_id, message.seq,
+        CASE WHEN message.seq > msg_box_api_token.read_seq AND message_status.isread
+            THEN TRUE ELSE NULL END,
+        message_status.isdeleted
+    FROM message_status
+    INNER JOIN message ON message.id = message_status.message_id
+    INNER JOIN msg_box_api_token ON msg_box_api_token.id = message_status.token_id
+    WHERE message_status.isdeleted
+        OR (message.seq > msg_box_api_token.read_seq AND message_status.isread)
+    """,
+    "DROP TABLE message_status",
+]
+
+# Whether any token still has the message in the outer query, rather than having deleted it.
+MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL = """
+    EXISTS(
+        SELECT 1
+        FROM msg_box_api_token AS reader
+        LEFT JOIN message_status_exception
+            ON message_status_exception.token_id = reader.id
+            AND message_status_exception.seq = message.seq
+        WHERE reader.msg_box_id = message.msg_box_id
+            AND message.seq >= reader.first_seq
+            AND (reader.last_seq IS NULL OR message.seq <= reader.last_seq)
+            AND message_status_exception.isdeleted IS NOT TRUE
+    )
+"""
+
+# The messages after the read cursor that are not read or deleted, and the messages up to the
+# read cursor that are marked unread.
+UNREAD_MESSAGE_COUNT_SQL = """
+    SELECT
+        (SELECT COUNT(*)
+         FROM message
+         LEFT JOIN message_status_exception
+            ON message_status_exception.token_id = msg_box_api_token.id
+            AND message_status_exception.seq = message.seq
+         WHERE message.msg_box_id = msg_box_api_token.msg_box_id
+            AND message.seq > msg_box_api_token.read_seq
+            AND (msg_box_api_token.last_seq IS NULL
+                OR message.seq <= msg_box_api_token.last_seq)
+            AND message_status_exception.isread IS NOT TRUE
+            AND message_status_exception.isdeleted IS NOT TRUE) +
+        (SELECT COUNT(*)
+         FROM message_status_exception
+         WHERE message_status_exception.token_id = msg_box_api_token.id
+            AND message_status_exception.seq <= msg_box_api_token.read_seq
+            AND message_status_exception.isread = FALSE
+            AND message_status_exception.isdeleted = FALSE)
+    FROM msg_box_api_token
+    WHERE msg_box_api_token.id = $1
+"""
+
+# The latest message in the token's sequence range that it has not deleted.
+MAX_SEQUENCE_SQL = """
+    SELECT message.seq
+    FROM message
+    LEFT JOIN message_status_exception
+        ON message_status_exception.token_id = $1
+        AND message_status_exception.seq = message.seq
+    WHERE message.msg_box_id = $2
+        AND message.seq BETWEEN $3 AND $4
+        AND message_status_exception.isdeleted IS NOT TRUE
+    ORDER BY message.seq DESC
+    LIMIT 1
+"""
+
+MSG_BOX_COLUMNS_SQL = """
+    msg_box.id, msg_box.account_id, msg_box.externalid, msg_box.publicread, msg_box.publicwrite,
+    msg_box.locked, msg_box.sequenced, msg_box.minagedays, msg_box.maxagedays, msg_box.autoprune,
+    (SELECT max(seq) FROM message WHERE msg_box.id = message.msg_box_id) AS seq
+"""
+
+
+def _msg_box_from_record(record: asyncpg.Record, api_tokens: list[MsgBoxAPITokenRow]) -> MsgBox:
+    id, account_id, externalid, publicread, publicwrite, locked, sequenced, minagedays, \
+        maxagedays, autoprune, head_message_sequence = record
+    return MsgBox(id=id, account_id=account_id, external_id=externalid,
+        public_read=publicread, public_write=publicwrite, locked=locked,
+        sequenced=sequenced, min_age_days=minagedays, max_age_days=maxagedays,
+        autoprune=autoprune, api_tokens=api_tokens,
+        head_message_sequence=head_message_sequence if head_message_sequence else 0)
+
+
+def _message_row_from_record(record: asyncpg.Record) -> MessageRow:
+    id, fromtoken, msg_box_id, seq, receivedts, contenttype, payload, payload_encoding = record
+    return MessageRow(id, fromtoken, msg_box_id, seq, receivedts, contenttype, payload,
+        PayloadEncoding(payload_encoding))
+
+
+def _token_row_from_record(record: asyncpg.Record) -> MsgBoxAPITokenRow:
+    id, account_id, msg_box_id, token, description, flags_int, validfrom, validto = record
+    return MsgBoxAPITokenRow(id=id, account_id=account_id, msg_box_id=msg_box_id, token=token,
+        description=description, flags=MessageBoxTokenFlag(flags_int), validfrom=validfrom,
+        validto=validto)
+
+
+def _token_view_from_record(record: asyncpg.Record) -> APITokenViewModelGet:
+    id, token, description, flags_int = record
+    return APITokenViewModelGet(id=id, token=token, description=description,
+        can_read=flags_int & MessageBoxTokenFlag.READ_ACCESS != 0,
+        can_write=flags_int & MessageBoxTokenFlag.WRITE_ACCESS != 0)
+
+
+class MsgBoxPostgresRepository(MsgBoxRepository):
+
+    def __init__(self, database_url: str, pool_size: int) -> None:
+        self.logger = logging.getLogger("msg-box-postgres-db")
+        self._database_url = database_url
+        self._pool_size = pool_size
+        self._pool: Optional[asyncpg.Pool] = None
+
+    @property
+    def pool(self) -> asyncpg.Pool:
+        assert self._pool is not None, "the repository has not been set up"
+        return self._pool
+
+    async def setup_async(self, create_tables: bool, reset_tables: bool) -> None:
+        self._pool = await asyncpg.create_pool(self._database_url, min_size=1,
+            max_size=self._pool_size)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if reset_tables:
+                    self.logger.info("Dropping peer channel database tables")
+                    await self.drop_tables_async(conn)
+                if create_tables:
+                    self.logger.info("Creating any missing peer channel database tables")
+                    for sql in CREATE_TABLE_STATEMENTS:
+                        await conn.execute(sql)
+                    if await conn.fetchval("SELECT to_regclass('message_status')") is not None:
+                        self.logger.info("Migrating message status rows to token read cursors")
+                        for sql in MIGRATION_STATEMENTS:
+                            await conn.execute(sql)
+
+    async def close_async(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def drop_tables_async(self, conn: asyncpg.Connection) -> None:
+        await conn.execute("DROP TABLE IF EXISTS message_status")
+        await conn.execute("DROP TABLE IF EXISTS message_status_exception")
+        await conn.execute("DROP TABLE IF EXISTS message")
+        await conn.execute("DROP TABLE IF EXISTS msg_box_api_token")
+        await conn.execute("DROP TABLE IF EXISTS msg_box")
+
+    async def _read_msgbox_tokens_async(self, conn: asyncpg.Connection, msgbox_id: int) \
+            -> list[MsgBoxAPITokenRow]:
+        sql = """
+            SELECT id, account_id, msg_box_id, token, description, flags, validfrom, validto
+            FROM msg_box_api_token WHERE msg_box_id = $1
+        """
+        return [ _token_row_from_record(record) for record in await conn.fetch(sql, msgbox_id) ]
+
+    @instrument_database_call_async
+    async def update_msg_box_async(self, msg_box_view_amend: MsgBoxViewModelAmend,
+            external_id: str) -> Optional[view_models.MsgBoxViewModelAmend]:
+        sql = """
+            UPDATE msg_box
+            SET publicread = $1, publicwrite = $2, locked = $3
+            WHERE externalid = $4
+        """
+        result = await self.pool.execute(sql, msg_box_view_amend.public_read,
+            msg_box_view_amend.public_write, msg_box_view_amend.locked, external_id)
+        if result == "UPDATE 0":
+            return None
+        return msg_box_view_amend
+
+    @instrument_database_call_async
+    async def create_message_box_async(self,
+            msg_box_view_create: view_models.MsgBoxViewModelCreate, account_id: int) -> MsgBox:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                sql = """
+                    INSERT INTO msg_box (account_id, externalid, publicread, publicwrite, locked,
+                        sequenced, minagedays, maxagedays, autoprune)
+                    VALUES ($1, $2, $3, $4, FALSE, $5, $6, $7, $8)
+                    RETURNING id, account_id, externalid, publicread, publicwrite, locked,
+                        sequenced, minagedays, maxagedays, autoprune, 0
+                """
+                msg_box_record = await conn.fetchrow(sql, account_id, utils.create_external_id(),
+                    msg_box_view_create.public_read, msg_box_view_create.public_write,
+                    msg_box_view_create.sequenced, msg_box_view_create.retention.min_age_days,
+                    msg_box_view_create.retention.max_age_days,
+                    msg_box_view_create.retention.auto_prune)
+
+                sql = """
+                    INSERT INTO msg_box_api_token (account_id, msg_box_id, token, description,
+                        flags, validfrom)
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                    RETURNING id, account_id, msg_box_id, token, description, flags, validfrom,
+                        validto
+                """
+                token_record = await conn.fetchrow(sql, account_id, msg_box_record[0],
+                    utils.create_channel_api_token(), "Owner",
+                    MessageBoxTokenFlag.READ_ACCESS | MessageBoxTokenFlag.WRITE_ACCESS |
+                        MessageBoxTokenFlag.OWNED_BY_ACCOUNT,
+                    int(time.time()))
+        return _msg_box_from_record(msg_box_record, [ _token_row_from_record(token_record) ])
+
+    @instrument_database_call_async
+    async def get_msgbox_tokens_async(self, msgbox_id: int) -> list[MsgBoxAPITokenRow]:
+        async with self.pool.acquire() as conn:
+            return await self._read_msgbox_tokens_async(conn, msgbox_id)
+
+    @instrument_database_call_async
+    async def get_message_box_by_id_async(self, message_box_id: int) -> Optional[MsgBox]:
+        sql = f"SELECT {MSG_BOX_COLUMNS_SQL} FROM msg_box WHERE id = $1"
+        async with self.pool.acquire() as conn:
+            record = await conn.fetchrow(sql, message_box_id)
+            if record is None:
+                return None
+            return _msg_box_from_record(record,
+                await self._read_msgbox_tokens_async(conn, record[0]))
+
+    @instrument_database_call_async
+    async def get_msg_box_async(self, account_id: int, externalid: str) -> Optional[MsgBox]:
+        sql = f"SELECT {MSG_BOX_COLUMNS_SQL} FROM msg_box " \
+            "WHERE account_id = $1 AND externalid = $2"
+        async with self.pool.acquire() as conn:
+            record = await conn.fetchrow(sql, account_id, externalid)
+            if record is None:
+                return None
+            return _msg_box_from_record(record,
+                await self._read_msgbox_tokens_async(conn, record[0]))
+
+    @instrument_database_call_async
+    async def get_msg_boxes_async(self, account_id: int, after_id: int=0,
+            limit: Optional[int]=None) -> list[MsgBox]:
+        # The tokens for all the channels are read in one query, rather than one query for each
+        # channel. A `NULL` limit is no limit.
+        msg_box_sql = f"SELECT {MSG_BOX_COLUMNS_SQL} FROM msg_box " \
+            "WHERE account_id = $1 AND id > $2 ORDER BY id LIMIT $3"
+        token_sql = """
+            SELECT id, account_id, msg_box_id, token, description, flags, validfrom, validto
+            FROM msg_box_api_token WHERE msg_box_id = ANY($1::BIGINT[])
+        """
+        async with self.pool.acquire() as conn:
+            records = await conn.fetch(msg_box_sql, account_id, after_id, limit)
+            if not records:
+                return []
+            tokens_by_msg_box_id: dict[int, list[MsgBoxAPITokenRow]] = {}
+            for token_record in await conn.fetch(token_sql, [ record[0] for record in records ]):
+                token_row = _token_row_from_record(token_record)
+                tokens_by_msg_box_id.setdefault(token_row.msg_box_id, []).append(token_row)
+            return [ _msg_box_from_record(record, tokens_by_msg_box_id.get(record[0], []))
+                for record in records ]
+
+    @instrument_database_call_async
+    async def delete_msg_box_async(self, external_id: str) -> bool:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                msg_box_id = await conn.fetchval(
+                    "SELECT id FROM msg_box WHERE externalid = $1 FOR UPDATE", external_id)
+                if msg_box_id is None:
+                    return False
+
+                statements = [
+                    """DELETE FROM message_status_exception WHERE token_id IN (
+                        SELECT id FROM msg_box_api_token WHERE msg_box_id = $1)""",
+                    "DELETE FROM message WHERE msg_box_id = $1",
+                    "DELETE FROM msg_box_api_token WHERE msg_box_id = $1",
+                    "DELETE FROM msg_box WHERE id = $1",
+                ]
+                for sql in statements:
+                    await conn.execute(sql, msg_box_id)
+        return True
+
+    @instrument_database_call_async
+    async def create_api_token_async(self, description: str, flags: MessageBoxTokenFlag,
+            msg_box_id: int, account_id: int) -> APITokenViewModelGet|None:
+        # The token receives the messages written after it is created. The channel is locked so
+        # that no message is written while the token is being created.
+        sql = """
+            INSERT INTO msg_box_api_token
+                (account_id, msg_box_id, token, description, flags, validfrom, first_seq,
+                read_seq)
+            SELECT $1, $2, $3, $4, $5, $6, COALESCE(MAX(seq), 0) + 1, COALESCE(MAX(seq), 0)
+            FROM message
+            WHERE msg_box_id = $2
+            RETURNING id, token, description, flags
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT 1 FROM msg_box WHERE id = $1 FOR UPDATE", msg_box_id)
+                record = await conn.fetchrow(sql, account_id, msg_box_id,
+                    utils.create_channel_api_token(), description, flags, int(time.time()))
+        if record is None:
+            return None
+        return _token_view_from_record(record)
+
+    @instrument_database_call_async
+    async def get_api_token_by_id_async(self, token_id: int) -> APITokenViewModelGet|None:
+        sql = "SELECT id, token, description, flags FROM msg_box_api_token " \
+            "WHERE id = $1 AND (validto IS NULL OR validto >= $2)"
+        record = await self.pool.fetchrow(sql, token_id, int(time.time()))
+        if record is None:
+            return None
+        return _token_view_from_record(record)
+
+    @instrument_database_call_async
+    async def get_api_token_async(self, token: str) -> MsgBoxAPITokenRow|None:
+        sql = """
+            SELECT id, account_id, msg_box_id, token, description, flags, validfrom, validto
+            FROM msg_box_api_token
+            WHERE token = $1 AND (validto IS NULL OR validto >= $2)
+        """
+        record = await self.pool.fetchrow(sql, token, int(time.time()))
+        if record is None:
+            return None
+        return _token_row_from_record(record)
+
+    @instrument_database_call_async
+    async def get_api_tokens_async(self, external_id: str, token: Optional[str]=None) \
+            -> Optional[list[dict[str, Any]]]:
+        sql = """
+            SELECT MBAT.id, MBAT.token, MBAT.description, MBAT.flags
+            FROM msg_box_api_token MBAT
+            INNER JOIN msg_box MB ON MBAT.msg_box_id = MB.id
+            WHERE MB.externalid = $1
+              AND (MBAT.validto IS NULL OR MBAT.validto >= $2)
+              AND ($3::VARCHAR IS NULL OR MBAT.token = $3)
+        """
+        records = await self.pool.fetch(sql, external_id, int(time.time()), token)
+        if len(records) == 0:
+            return None
+        return [ asdict(_token_view_from_record(record)) for record in records ]
+
+    @instrument_database_call_async
+    async def delete_api_token_async(self, token_id: int) -> None:
+        # The token does not receive the messages written after it is revoked. The channel is
+        # locked so that no message is written while the token is being revoked.
+        sql = """
+            UPDATE msg_box_api_token
+            SET validto = $1,
+                last_seq = COALESCE(last_seq, (SELECT COALESCE(MAX(seq), 0) FROM message
+                    WHERE message.msg_box_id = msg_box_api_token.msg_box_id))
+            WHERE id = $2
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("""
+                    SELECT 1 FROM msg_box
+                    WHERE id = (SELECT msg_box_id FROM msg_box_api_token WHERE id = $1)
+                    FOR UPDATE
+                """, token_id)
+                await conn.execute(sql, int(time.time()), token_id)
+
+    @instrument_database_call_async
+    async def get_api_token_authorization_data_for_msg_box_async(self, externalid: str,
+            token_id: int) -> Optional[int]:
+        """
+        If the given message box api token with id `token_id` is linked to the message box
+        with externalid `externalid` then we return the internal message box id `id`.
+        """
+        sql = """
+            SELECT msg_box.id
+            FROM msg_box_api_token
+            INNER JOIN msg_box ON msg_box_api_token.msg_box_id = msg_box.id
+            WHERE msg_box.externalid = $1 AND msg_box_api_token.id = $2
+        """
+        msg_box_id: Optional[int] = await self.pool.fetchval(sql, externalid, token_id)
+        return msg_box_id
+
+    @instrument_database_call_async
+    async def write_message_async(self, message: Message) -> MessageRow:
+        # There is no payload store for this backend, see `get_payload_blob_store`.
+        assert message.payload is not None
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # This lock is held until the transaction ends, and any other write to the same
+                # channel waits for it before it can allocate the next sequence number.
+                sql = "SELECT locked, sequenced FROM msg_box WHERE id = $1 FOR UPDATE"
+                record = await conn.fetchrow(sql, message.msg_box_id)
+                if record is not None:
+                    locked, sequenced = record
+                    if locked:
+                        raise PeerChannelMessageWriteError(code=APIErrors.CHANNEL_LOCKED)
+
+                    if sequenced:
+                        unread_count = await conn.fetchval(UNREAD_MESSAGE_COUNT_SQL,
+                            message.msg_box_api_token_id)
+                        if unread_count > 0:
+                            raise PeerChannelMessageWriteError(
+                                code=APIErrors.SEQUENCING_FAILURE)
+
+                sql = """
+                    INSERT INTO message (fromtoken, msg_box_id, seq, receivedts, contenttype,
+                        payload, payload_encoding)
+                    SELECT $1, $2, COALESCE(MAX(seq) + 1, 1), $3, $4, $5, $6
+                    FROM message
+                    WHERE msg_box_id = $2
+                    RETURNING id, fromtoken, msg_box_id, seq, receivedts, contenttype, payload,
+                        payload_encoding
+                """
+                record = await conn.fetchrow(sql, message.msg_box_api_token_id,
+                    message.msg_box_id, message.received_ts, message.content_type,
+                    message.payload, message.payload_encoding)
+                if record is None:
+                    raise PeerChannelMessageWriteError(code=APIErrors.DATABASE_WRITE_FAILURE)
+
+                message_row = _message_row_from_record(record)
+                self.logger.debug("Wrote message sequence: %s for msg_box_id: %s",
+                    message_row.sequence, message_row.message_box_id)
+
+                # Every other token has the message unread as it is after their read cursors.
+                # The writer has read it, which only needs an exception row if it has unread
+                # messages.
+                sql = """
+                    UPDATE msg_box_api_token SET read_seq = $1
+                    WHERE id = $2 AND msg_box_id = $3 AND read_seq = $1 - 1
+                """
+                result: str = await conn.execute(sql, message_row.sequence,
+                    message_row.from_token_id, message_row.message_box_id)
+                if result == "UPDATE 0":
+                    sql = """
+                        INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+                        SELECT id, $1, TRUE, FALSE
+                        FROM msg_box_api_token
+                        WHERE id = $2 AND msg_box_id = $3
+                    """
+                    await conn.execute(sql, message_row.sequence, message_row.from_token_id,
+                        message_row.message_box_id)
+        return message_row
+
+    @instrument_database_call_async
+    async def get_msg_box_head_async(self, external_id: str) -> Optional[MsgBoxHead]:
+        async with self.pool.acquire() as conn:
+            record = await conn.fetchrow("SELECT id, sequenced FROM msg_box "
+                "WHERE externalid = $1", external_id)
+            if record is None:
+                return None
+            msg_box_id, sequenced = record
+            if not sequenced:
+                return MsgBoxHead(False, 0, None, 0)
+            sql = f"""
+                SELECT message.seq, message.fromtoken
+                FROM message
+                WHERE message.msg_box_id = $1
+                    AND {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL}
+                ORDER BY message.seq DESC
+                LIMIT 1
+            """
+            record = await conn.fetchrow(sql, msg_box_id)
+            if record is None:
+                return MsgBoxHead(True, 0, None, 0)
+            sequence, from_token_id = record
+            sql = f"""
+                SELECT MAX(message.seq)
+                FROM message
+                WHERE message.msg_box_id = $1
+                    AND message.fromtoken != $2
+                    AND {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL}
+            """
+            other_writers_sequence: Optional[int] = await conn.fetchval(sql, msg_box_id,
+                from_token_id)
+            return MsgBoxHead(True, sequence, from_token_id, other_writers_sequence or 0)
+
+    @instrument_database_call_async
+    async def get_messages_async(self, api_token_id: int, onlyunread: bool,
+            after_sequence: int=0, limit: Optional[int]=None) \
+                -> tuple[list[MessageRow], int | None]:
+        async with self.pool.acquire() as conn:
+            sql = """
+                SELECT msg_box.sequenced, msg_box.id, msg_box_api_token.first_seq,
+                    COALESCE(msg_box_api_token.last_seq, $2), msg_box_api_token.read_seq,
+                    (SELECT MIN(seq) FROM message_status_exception
+                     WHERE token_id = msg_box_api_token.id
+                        AND seq <= msg_box_api_token.read_seq
+                        AND isread = FALSE AND isdeleted = FALSE)
+                FROM msg_box
+                INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = msg_box.id
+                WHERE msg_box_api_token.id = $1
+            """
+            record = await conn.fetchrow(sql, api_token_id, MAXIMUM_SEQUENCE)
+            if record is None:
+                return [], None
+
+            sequenced, msg_box_id, first_sequence, last_sequence, read_sequence, \
+                first_unread_exception_sequence = record
+            max_sequence: Optional[int] = None
+            if sequenced:
+                max_sequence = await conn.fetchval(MAX_SEQUENCE_SQL, api_token_id, msg_box_id,
+                    first_sequence, last_sequence)
+
+            # Unread messages are either after the read cursor or marked unread, so the messages
+            # before both of these do not need to be looked at.
+            from_sequence = first_sequence
+            if onlyunread:
+                from_sequence = read_sequence + 1
+                if first_unread_exception_sequence is not None:
+                    from_sequence = min(from_sequence, first_unread_exception_sequence)
+            from_sequence = max(from_sequence, after_sequence + 1)
+
+            sql = """
+                SELECT message.id, message.fromtoken, message.msg_box_id, message.seq,
+                    message.receivedts, message.contenttype, message.payload,
+                    message.payload_encoding
+                FROM message
+                LEFT JOIN message_status_exception
+                    ON message_status_exception.token_id = $1
+                    AND message_status_exception.seq = message.seq
+                WHERE message.msg_box_id = $2
+                    AND message.seq BETWEEN $3 AND $4
+                    AND message_status_exception.isdeleted IS NOT TRUE
+                    AND ($5::BOOLEAN = false
+                        OR (message.seq > $6 AND message_status_exception.isread IS NOT TRUE)
+                        OR message_status_exception.isread = false)
+                ORDER BY message.seq
+                LIMIT $7
+            """
+            messages = [ _message_row_from_record(record)
+                for record in await conn.fetch(sql, api_token_id, msg_box_id, from_sequence,
+                    last_sequence, onlyunread, read_sequence, limit) ]
+            return messages, max_sequence
+
+    @instrument_database_call_async
+    async def get_message_notifications_async(self, api_token_id: int, after_sequence: int,
+            limit: int) -> list[MessageNotificationRow]:
+        sql = """
+            SELECT message.seq, message.receivedts, message.contenttype
+            FROM msg_box_api_token
+            INNER JOIN message ON message.msg_box_id = msg_box_api_token.msg_box_id
+            LEFT JOIN message_status_exception
+                ON message_status_exception.token_id = msg_box_api_token.id
+                AND message_status_exception.seq = message.seq
+            WHERE msg_box_api_token.id = $1
+                AND message.seq BETWEEN GREATEST(msg_box_api_token.first_seq, $2 + 1)
+                    AND COALESCE(msg_box_api_token.last_seq, $3)
+                AND message_status_exception.isdeleted IS NOT TRUE
+            ORDER BY message.seq
+            LIMIT $4
+        """
+        async with self.pool.acquire() as conn:
+            return [ MessageNotificationRow(*record) for record in await conn.fetch(sql,
+                api_token_id, after_sequence, MAXIMUM_SEQUENCE, limit) ]
+
+    @instrument_database_call_async
+    async def get_messages_version_async(self, api_token_id: int) \
+            -> tuple[int | None, int] | None:
+        async with self.pool.acquire() as conn:
+            sql = """
+                SELECT msg_box.sequenced, msg_box.id, msg_box_api_token.first_seq,
+                    COALESCE(msg_box_api_token.last_seq, $2), msg_box_api_token.status_changes
+                FROM msg_box
+                INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = msg_box.id
+                WHERE msg_box_api_token.id = $1
+            """
+            record = await conn.fetchrow(sql, api_token_id, MAXIMUM_SEQUENCE)
+            if record is None:
+                return None
+            sequenced, msg_box_id, first_sequence, last_sequence, status_changes = record
+            max_sequence: Optional[int] = None
+            if sequenced:
+                max_sequence = await conn.fetchval(MAX_SEQUENCE_SQL, api_token_id, msg_box_id,
+                    first_sequence, last_sequence)
+            return max_sequence, status_changes
+
+    @instrument_database_call_async
+    async def sequence_exists_async(self, token_id: int, sequence: int) -> bool:
+        sql = """
+            SELECT COUNT(message.seq) AS seq_count
+            FROM message
+            INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = message.msg_box_id
+            WHERE msg_box_api_token.id = $1
+              AND message.seq = $2
+              AND message.seq >= msg_box_api_token.first_seq
+              AND (msg_box_api_token.last_seq IS NULL
+                OR message.seq <= msg_box_api_token.last_seq)
+        """
+        sequence_count: int = await self.pool.fetchval(sql, token_id, sequence)
+        return sequence_count == 1
+
+    @instrument_database_call_async
+    async def mark_messages_async(self, external_id: str, token_id: int, sequence: int,
+            mark_older: bool, set_read_to: bool) -> None:
+        # See `MsgBoxSQLiteRepository.mark_messages_async`. The token row is locked so that marks
+        # made at the same time for the same token are applied one after the other.
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                sql = """
+                    SELECT msg_box_api_token.msg_box_id, msg_box_api_token.first_seq,
+                        msg_box_api_token.read_seq
+                    FROM msg_box_api_token
+                    INNER JOIN msg_box ON msg_box.id = msg_box_api_token.msg_box_id
+                    WHERE msg_box_api_token.id = $1 AND msg_box.externalid = $2
+                    FOR UPDATE OF msg_box_api_token
+                """
+                record = await conn.fetchrow(sql, token_id, external_id)
+                if record is None:
+                    return
+                msg_box_id, first_sequence, read_sequence = record
+                await conn.execute("UPDATE msg_box_api_token "
+                    "SET status_changes = status_changes + 1 WHERE id = $1", token_id)
+
+                if mark_older and set_read_to:
+                    await conn.execute("UPDATE msg_box_api_token "
+                        "SET read_seq = GREATEST(read_seq, $1) WHERE id = $2", sequence, token_id)
+                    await conn.execute("UPDATE message_status_exception SET isread = NULL "
+                        "WHERE token_id = $1 AND seq <= $2", token_id, sequence)
+                elif mark_older:
+                    if sequence < read_sequence:
+                        await conn.execute("""
+                            INSERT INTO message_status_exception
+                                (token_id, seq, isread, isdeleted)
+                            SELECT $1, seq, TRUE, FALSE
+                            FROM message
+                            WHERE msg_box_id = $2 AND seq > $3 AND seq <= $4
+                            ON CONFLICT (token_id, seq) DO UPDATE
+                                SET isread = COALESCE(message_status_exception.isread, TRUE)
+                        """, token_id, msg_box_id, sequence, read_sequence)
+                    await conn.execute("UPDATE msg_box_api_token SET read_seq = $1 "
+                        "WHERE id = $2", first_sequence - 1, token_id)
+                    await conn.execute("UPDATE message_status_exception SET isread = NULL "
+                        "WHERE token_id = $1 AND seq <= $2", token_id, sequence)
+                elif set_read_to and sequence == read_sequence + 1:
+                    await conn.execute("UPDATE msg_box_api_token SET read_seq = $1 "
+                        "WHERE id = $2", sequence, token_id)
+                    await conn.execute("UPDATE message_status_exception SET isread = NULL "
+                        "WHERE token_id = $1 AND seq = $2", token_id, sequence)
+                else:
+                    isread = None if set_read_to == (sequence <= read_sequence) else set_read_to
+                    await conn.execute("""
+                        INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+                        VALUES ($1, $2, $3, FALSE)
+                        ON CONFLICT (token_id, seq) DO UPDATE SET isread = excluded.isread
+                    """, token_id, sequence, isread)
+
+                await conn.execute("DELETE FROM message_status_exception WHERE token_id = $1 "
+                    "AND isread IS NULL AND isdeleted = FALSE", token_id)
+
+    @instrument_database_call_async
+    async def get_message_metadata_async(self, external_id: str, sequence: int) \
+            -> Optional[MessageMetadata]:
+        sql = f"""
+            SELECT message.id, message.fromtoken, message.msg_box_id, message.receivedts,
+                message.contenttype
+            FROM message
+            INNER JOIN msg_box ON message.msg_box_id = msg_box.id
+            WHERE msg_box.externalid = $1
+              AND message.seq = $2
+              AND {MESSAGE_NOT_DELETED_BY_ALL_TOKENS_SQL}
+        """
+        record = await self.pool.fetchrow(sql, external_id, sequence)
+        if record is None:
+            return None
+        id, fromtoken, msg_box_id, receivedts, contenttype = record
+        return MessageMetadata(id=id, msg_box_id=msg_box_id, msg_box_api_token_id=fromtoken,
+            content_type=contenttype,
+            received_ts=datetime.fromtimestamp(receivedts, tz=timezone.utc))
+
+    @instrument_database_call_async
+    async def delete_message_async(self, message_id: int, token_id: int) -> int:
+        # Only tokens that received the message can delete it.
+        sql = """
+            INSERT INTO message_status_exception (token_id, seq, isread, isdeleted)
+            SELECT msg_box_api_token.id, message.seq, NULL, TRUE
+            FROM message
+            INNER JOIN msg_box_api_token ON msg_box_api_token.msg_box_id = message.msg_box_id
+            WHERE message.id = $1 AND msg_box_api_token.id = $2
+                AND message.seq >= msg_box_api_token.first_seq
+                AND (msg_box_api_token.last_seq IS NULL
+                    OR message.seq <= msg_box_api_token.last_seq)
+            ON CONFLICT (token_id, seq) DO UPDATE SET isdeleted = TRUE
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                result: str = await conn.execute(sql, message_id, token_id)
+                # The status is of the form "INSERT 0 <count>".
+                count = int(result.split()[-1])
+                if count > 0:
+                    await conn.execute("UPDATE msg_box_api_token "
+                        "SET status_changes = status_changes + 1 WHERE id = $1", token_id)
+        return count
@@ -0,0 +1,282 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# The peer channel storage split across several SQLite databases, selected with the
+# `PEER_CHANNELS_SQLITE_SHARDS` setting. Each shard is a complete set of the peer channel tables
+# in its own file with its own writer thread, so that writes to channels in different shards are
+# done concurrently. The accounts remain in the main database.
+#
+# A channel and everything related to it, its tokens, messages and message statuses, are in the
+# same shard. The shard is encoded in the high bits of every row id, by starting the
+# `AUTOINCREMENT` sequence of each table in shard `n` at `n << SHARD_ID_SHIFT`, so any id can be
+# routed directly. External ids and tokens are routed with an in-memory table that is filled
+# when channels and tokens are created, and on demand by looking in each shard when they are not
+# known, which is the case after a restart or if they were created by another worker process.
+#
+# Each shard has its own store for large payloads, if they are stored as files, as the references
+# to them are only checked in the shard's database.
+#
+# The number of shards can be increased but must not be decreased, as existing ids refer to the
+# shard they were created in.
+
+from __future__ import annotations
+import asyncio
+import itertools
+import logging
+from pathlib import Path
+from typing import Any, Optional
+
+try:
+    # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS has latest brew version of 3.35.5 (as of 2021-06-20).
+    # Windows builds use the official Python 3.10.0 builds and bundled version of 3.35.5.
+    import sqlite3
+
+from electrumsv_database.sqlite import replace_db_context_with_connection
+
+from ..constants import MessageBoxTokenFlag
+from ..metrics import instrument_database_call
+from ..request_timing import TimedDatabaseContext
+
+from . import view_models
+from .blob_store import create_payload_blob_store, PayloadBlobStore
+from .models import MsgBox, MsgBoxAPITokenRow, MsgBoxHead, MessageMetadata, Message
+from .repositories import MsgBoxRepository, MsgBoxSQLiteRepository
+from .types import MessageNotificationRow, MessageRow
+from .view_models import APITokenViewModelGet, MsgBoxViewModelAmend
+
+
+# This allows 2^40 rows of each table in each shard, and the ids of up to 2^13 shards are within
+# the range that JSON parsers using doubles can represent exactly.
+SHARD_ID_SHIFT = 40
+MAXIMUM_SHARD_COUNT = 1 << 13
+
+SHARDED_TABLE_NAMES = ("msg_box", "msg_box_api_token", "message")
+
+
+def get_shard_database_path(datastore_location: Path, shard_index: int) -> Path:
+    return datastore_location.with_name(f"{datastore_location.stem}_msg_box_{shard_index}"
+        f"{datastore_location.suffix}")
+
+
+def _seed_shard_id_sequences(shard_index: int, db: sqlite3.Connection) -> None:
+    # The `sqlite_sequence` table exists once the tables with `AUTOINCREMENT` are created, but
+    # a table's sequence row is not added until the first row is inserted into it.
+    sql = """
+        INSERT INTO sqlite_sequence (name, seq)
+        SELECT ?1, ?2
+        WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?1)
+    """
+    for table_name in SHARDED_TABLE_NAMES:
+        db.execute(sql, (table_name, shard_index << SHARD_ID_SHIFT))
+
+
+@replace_db_context_with_connection
+@instrument_database_call
+def _external_id_exists(db: sqlite3.Connection, external_id: str) -> bool:
+    sql = "SELECT 1 FROM msg_box WHERE externalid = ?"
+    return db.execute(sql, (external_id,)).fetchone() is not None
+
+
+@replace_db_context_with_connection
+@instrument_database_call
+def _token_exists(db: sqlite3.Connection, token: str) -> bool:
+    sql = "SELECT 1 FROM msg_box_api_token WHERE token = ?"
+    return db.execute(sql, (token,)).fetchone() is not None
+
+
+class MsgBoxShardedSQLiteRepository(MsgBoxRepository):
+
+    def __init__(self, datastore_location: Path, shard_count: int) -> None:
+        assert 1 <= shard_count <= MAXIMUM_SHARD_COUNT
+        self.logger = logging.getLogger("msg-box-sharded-db")
+        self._database_contexts = [ TimedDatabaseContext(
+                str(get_shard_database_path(datastore_location, shard_index)), write_warn_ms=10)
+            for shard_index in range(shard_count) ]
+        self._shards = [ MsgBoxSQLiteRepository(database_context, has_accounts_table=False,
+                blob_store=create_payload_blob_store(
+                    get_shard_database_path(datastore_location, shard_index)))
+            for shard_index, database_context in enumerate(self._database_contexts) ]
+        # New channels are spread evenly across the shards.
+        self._next_shard_indexes = itertools.cycle(range(shard_count))
+
+        # The routing table. Entries are not removed for the tokens of deleted channels, or for
+        # channels deleted by other worker processes, but looking in the shard an entry maps to
+        # finds nothing the same as any other shard would.
+        self._shard_index_by_external_id: dict[str, int] = {}
+        self._shard_index_by_token: dict[str, int] = {}
+
+    async def setup_async(self, create_tables: bool, reset_tables: bool) -> None:
+        def setup(shard_index: int, db: Optional[sqlite3.Connection]=None) -> None:
+            assert db is not None and isinstance(db, sqlite3.Connection)
+            shard = self._shards[shard_index]
+            if reset_tables:
+                # This also removes the sequences of the dropped tables.
+                shard.drop_tables(db)
+            if create_tables:
+                shard.create_tables(db)
+                _seed_shard_id_sequences(shard_index, db)
+
+        if reset_tables:
+            self.logger.info("Dropping peer channel database tables in %d shards",
+                len(self._shards))
+        if create_tables:
+            self.logger.info("Creating any missing peer channel database tables in %d shards",
+                len(self._shards))
+        if reset_tables or create_tables:
+            await asyncio.gather(*(database_context.run_in_thread_async(setup, shard_index)
+                for shard_index, database_context in enumerate(self._database_contexts)))
+        await asyncio.gather(*(shard.setup_async(create_tables, reset_tables)
+            for shard in self._shards))
+
+    async def close_async(self) -> None:
+        for database_context in self._database_contexts:
+            database_context.close()
+
+    def _get_shard_for_id(self, row_id: int) -> MsgBoxSQLiteRepository:
+        shard_index = row_id >> SHARD_ID_SHIFT
+        # Ids from requests are not necessarily valid, and any shard will not find those that
+        # are out of range.
+        if 0 <= shard_index < len(self._shards):
+            return self._shards[shard_index]
+        return self._shards[0]
+
+    def _get_shard_for_external_id(self, external_id: str) -> MsgBoxSQLiteRepository:
+        shard_index = self._shard_index_by_external_id.get(external_id)
+        if shard_index is None:
+            for shard_index, database_context in enumerate(self._database_contexts):
+                if _external_id_exists(database_context, external_id):
+                    self._shard_index_by_external_id[external_id] = shard_index
+                    break
+            else:
+                # There is no such channel, and any shard will not find it.
+                return self._shards[0]
+        return self._shards[shard_index]
+
+    def _get_shard_for_token(self, token: str) -> MsgBoxSQLiteRepository:
+        shard_index = self._shard_index_by_token.get(token)
+        if shard_index is None:
+            for shard_index, database_context in enumerate(self._database_contexts):
+                if _token_exists(database_context, token):
+                    self._shard_index_by_token[token] = shard_index
+                    break
+            else:
+                return self._shards[0]
+        return self._shards[shard_index]
+
+    async def update_msg_box_async(self, msg_box_view_amend: MsgBoxViewModelAmend,
+            external_id: str) -> Optional[view_models.MsgBoxViewModelAmend]:
+        return await self._get_shard_for_external_id(external_id).update_msg_box_async(
+            msg_box_view_amend, external_id)
+
+    async def create_message_box_async(self,
+            msg_box_view_create: view_models.MsgBoxViewModelCreate, account_id: int) -> MsgBox:
+        shard_index = next(self._next_shard_indexes)
+        msg_box = await self._shards[shard_index].create_message_box_async(msg_box_view_create,
+            account_id)
+        self._shard_index_by_external_id[msg_box.external_id] = shard_index
+        for token_row in msg_box.api_tokens:
+            self._shard_index_by_token[token_row.token] = shard_index
+        return msg_box
+
+    async def get_msgbox_tokens_async(self, msgbox_id: int) -> list[MsgBoxAPITokenRow]:
+        return await self._get_shard_for_id(msgbox_id).get_msgbox_tokens_async(msgbox_id)
+
+    async def get_message_box_by_id_async(self, message_box_id: int) -> Optional[MsgBox]:
+        return await self._get_shard_for_id(message_box_id).get_message_box_by_id_async(
+            message_box_id)
+
+    async def get_msg_box_async(self, account_id: int, externalid: str) -> Optional[MsgBox]:
+        return await self._get_shard_for_external_id(externalid).get_msg_box_async(account_id,
+            externalid)
+
+    async def get_msg_boxes_async(self, account_id: int, after_id: int=0,
+            limit: Optional[int]=None) -> list[MsgBox]:
+        # The ids in each shard are higher than those in the shards before it, so the shards are
+        # read in order starting with the one `after_id` is in, until there are enough channels.
+        msg_boxes: list[MsgBox] = []
+        for shard in self._shards[after_id >> SHARD_ID_SHIFT:]:
+            shard_limit = None if limit is None else limit - len(msg_boxes)
+            msg_boxes.extend(await shard.get_msg_boxes_async(account_id, after_id, shard_limit))
+            if limit is not None and len(msg_boxes) >= limit:
+                break
+        return msg_boxes
+
+    async def delete_msg_box_async(self, external_id: str) -> bool:
+        shard = self._get_shard_for_external_id(external_id)
+        if self._shard_index_by_external_id.pop(external_id, None) is None:
+            # The channel is not in any of the shards.
+            return False
+        return await shard.delete_msg_box_async(external_id)
+
+    async def create_api_token_async(self, description: str, flags: MessageBoxTokenFlag,
+            msg_box_id: int, account_id: int) -> APITokenViewModelGet|None:
+        token_view = await self._get_shard_for_id(msg_box_id).create_api_token_async(
+            description, flags, msg_box_id, account_id)
+        if token_view is not None:
+            self._shard_index_by_token[token_view.token] = token_view.id >> SHARD_ID_SHIFT
+        return token_view
+
+    async def get_api_token_by_id_async(self, token_id: int) -> APITokenViewModelGet|None:
+        return await self._get_shard_for_id(token_id).get_api_token_by_id_async(token_id)
+
+    async def get_api_token_async(self, token: str) -> MsgBoxAPITokenRow|None:
+        return await self._get_shard_for_token(token).get_api_token_async(token)
+
+    async def get_api_tokens_async(self, external_id: str, token: Optional[str]=None) \
+            -> Optional[list[dict[str, Any]]]:
+        return await self._get_shard_for_external_id(external_id).get_api_tokens_async(
+            external_id, token)
+
+    async def delete_api_token_async(self, token_id: int) -> None:
+        await self._get_shard_for_id(token_id).delete_api_token_async(token_id)
+
+    async def get_api_token_authorization_data_for_msg_box_async(self, externalid: str,
+            token_id: int) -> Optional[int]:
+        return await self._get_shard_for_id(token_id) \
+            .get_api_token_authorization_data_for_msg_box_async(externalid, token_id)
+
+    def get_payload_blob_store(self, msg_box_id: int) -> Optional[PayloadBlobStore]:
+        return self._get_shard_for_id(msg_box_id).get_payload_blob_store(msg_box_id)
+
+    async def write_message_async(self, message: Message) -> MessageRow:
+        return await self._get_shard_for_id(message.msg_box_id).write_message_async(message)
+
+    async def get_msg_box_head_async(self, external_id: str) -> Optional[MsgBoxHead]:
+        return await self._get_shard_for_external_id(external_id).get_msg_box_head_async(
+            external_id)
+
+    async def get_messages_async(self, api_token_id: int, onlyunread: bool,
+            after_sequence: int=0, limit: Optional[int]=None) \
+                -> tuple[list[MessageRow], int | None]:
+        return await self._get_shard_for_id(api_token_id).get_messages_async(api_token_id,
+            onlyunread, after_sequence, limit)
+
+    async def get_message_notifications_async(self, api_token_id: int, after_sequence: int,
+            limit: int) -> list[MessageNotificationRow]:
+        return await self._get_shard_for_id(api_token_id).get_message_notifications_async(
+            api_token_id, after_sequence, limit)
+
+    async def get_messages_version_async(self, api_token_id: int) \
+            -> tuple[int | None, int] | None:
+        return await self._get_shard_for_id(api_token_id).get_messages_version_async(
+            api_token_id)
+
+    async def sequence_exists_async(self, token_id: int, sequence: int) -> bool:
+        return await self._get_shard_for_id(token_id).sequence_exists_async(token_id, sequence)
+
+    async def mark_messages_async(self, external_id: str, token_id: int, sequence: int,
+            mark_older: bool, set_read_to: bool) -> None:
+        await self._get_shard_for_external_id(external_id).mark_messages_async(external_id,
+            token_id, sequence, mark_older, set_read_to)
+
+    async def get_message_metadata_async(self, external_id: str, sequence: int) \
+            -> Optional[MessageMetadata]:
+        return await self._get_shard_for_external_id(external_id).get_message_metadata_async(
+            external_id, sequence)
+
+    async def delete_message_async(self, message_id: int, token_id: int) -> int:
+        return await self._get_shard_for_id(token_id).delete_message_async(message_id,
+            token_id)
@@ -1,6 +1,9 @@
 import dataclasses
+import mmap
 from typing import TypedDict
 
+from ..constants import PayloadEncoding
+
 
 @dataclasses.dataclass
 class MessageRow:
@@ -10,10 +13,28 @@ class MessageRow:
     sequence: int
     date_received: int
     content_type: str
-    payload_bytes: bytes
+    # Large payloads may be memory-mapped from the payload file store, see `blob_store.py`.
+    payload_bytes: bytes|bytearray|mmap.mmap
+    # The payload bytes are compressed with this codec if it is not `NONE`.
+    payload_encoding: PayloadEncoding = PayloadEncoding.NONE
+
+
+@dataclasses.dataclass
+class MessageNotificationRow:
+    """
+    The metadata of a message that is sent in a notification, without the payload.
+    """
+    sequence: int
+    date_received: int
+    content_type: str
+
+
+class _MessageTextResponseOptional(TypedDict, total=False):
+    # This is only present if the payload is compressed, see `Accept-Payload-Encoding`.
+    content_encoding: str
 
 
-class MessageTextResponse(TypedDict):
+class MessageTextResponse(_MessageTextResponseOptional):
     sequence: int
     received: str
     content_type: str
@@ -0,0 +1,161 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# When the external server is run in multiple worker processes (see `WORKER_PROCESSES`) each of
+# them has its own websocket registries, and a message written to a peer channel through one
+# worker has to be delivered to websockets held by the other workers. The coordinator process
+# runs a relay on a Unix domain socket that every worker connects to, and any message a worker
+# publishes is passed on to all the other workers. The publishing worker delivers the message to
+# its own websockets directly.
+#
+# The framing is a four byte big-endian length followed by that many bytes, where the first byte
+# is the `NotificationBusMessageKind` and the rest is the JSON encoded message.
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+from pathlib import Path
+import struct
+from typing import Any, Callable, Optional
+
+from .constants import NotificationBusMessageKind
+from .utils import json_dumps_bytes
+
+
+logger = logging.getLogger("notification-bus")
+
+frame_length_struct = struct.Struct(">I")
+
+# A frame larger than this is a protocol error. Notifications are small.
+MAXIMUM_FRAME_SIZE = 1024 * 1024
+
+NotificationBusHandler = Callable[[NotificationBusMessageKind, Any], None]
+
+
+def pack_notification_bus_frame(kind: NotificationBusMessageKind, message: Any) -> bytes:
+    frame_bytes = bytes([ kind ]) + json_dumps_bytes(message)
+    return frame_length_struct.pack(len(frame_bytes)) + frame_bytes
+
+
+async def _read_frame_async(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """
+    Returns the frame bytes without the length prefix, or `None` if the connection was closed.
+    """
+    try:
+        length_bytes = await reader.readexactly(frame_length_struct.size)
+        frame_length = frame_length_struct.unpack(length_bytes)[0]
+        if frame_length == 0 or frame_length > MAXIMUM_FRAME_SIZE:
+            logger.error("Invalid notification bus frame length %d", frame_length)
+            return None
+        return await reader.readexactly(frame_length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+class NotificationBusServer:
+    """
+    The relay run by the coordinator process.
+    """
+
+    def __init__(self, socket_path: Path) -> None:
+        self._socket_path = socket_path
+        self._writers: set[asyncio.StreamWriter] = set()
+        self._connection_tasks: set[asyncio.Task[None]] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start_async(self) -> None:
+        if self._socket_path.exists():
+            self._socket_path.unlink()
+        self._server = await asyncio.start_unix_server(self._on_client_connected_async,
+            path=str(self._socket_path))
+        logger.debug("Notification bus listening on %s", self._socket_path)
+
+    async def stop_async(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # Closing the connections ends the connection tasks.
+        for writer in list(self._writers):
+            writer.close()
+        await asyncio.gather(*self._connection_tasks, return_exceptions=True)
+        if self._socket_path.exists():
+            self._socket_path.unlink()
+
+    async def _on_client_connected_async(self, reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter) -> None:
+        connection_task = asyncio.current_task()
+        assert connection_task is not None
+        self._connection_tasks.add(connection_task)
+        self._writers.add(writer)
+        try:
+            while True:
+                frame_bytes = await _read_frame_async(reader)
+                if frame_bytes is None:
+                    break
+                relayed_bytes = frame_length_struct.pack(len(frame_bytes)) + frame_bytes
+                other_writers = [ other_writer for other_writer in self._writers
+                    if other_writer is not writer ]
+                for other_writer in other_writers:
+                    other_writer.write(relayed_bytes)
+                # This stops the reading of further frames from this worker if any of the other
+                # workers are not keeping up.
+                for other_writer in other_writers:
+                    try:
+                        await other_writer.drain()
+                    except ConnectionError:
+                        pass
+        finally:
+            self._writers.discard(writer)
+            self._connection_tasks.discard(connection_task)
+            writer.close()
+
+
+class NotificationBusClient:
+    """
+    The connection a worker process has to the relay.
+    """
+
+    def __init__(self, socket_path: Path, handler: NotificationBusHandler) -> None:
+        self._socket_path = socket_path
+        self._handler = handler
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._read_task: Optional[asyncio.Task[None]] = None
+
+    async def connect_async(self) -> None:
+        reader, self._writer = await asyncio.open_unix_connection(path=str(self._socket_path))
+        self._read_task = asyncio.create_task(self._read_frames_async(reader))
+
+    async def close_async(self) -> None:
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def publish(self, kind: NotificationBusMessageKind, message: Any) -> None:
+        """
+        Pass on a message to all the other worker processes. This does not wait for it to be
+        sent, as the relay and the other workers are local.
+        """
+        assert self._writer is not None
+        if self._writer.is_closing():
+            logger.error("Notification bus is closed, dropped message kind=%s", kind)
+            return
+        self._writer.write(pack_notification_bus_frame(kind, message))
+
+    async def _read_frames_async(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            frame_bytes = await _read_frame_async(reader)
+            if frame_bytes is None:
+                logger.error("Notification bus connection closed")
+                break
+            try:
+                kind = NotificationBusMessageKind(frame_bytes[0])
+                message = json.loads(frame_bytes[1:])
+                self._handler(kind, message)
+            except Exception:
+                logger.exception("Failed processing notification bus message")
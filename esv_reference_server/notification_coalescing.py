@@ -0,0 +1,82 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+from __future__ import annotations
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+
+from .types import NotificationJsonData
+
+
+logger = logging.getLogger("notification-coalescing")
+
+# The longest a websocket client can ask for its notifications to be held for.
+MAXIMUM_COALESCING_WINDOW_SECONDS = 10.0
+
+
+def parse_coalescing_window(request: web.Request) -> Optional[float]:
+    """
+    The `coalesce` query parameter of a websocket request is the number of seconds its
+    notifications for a channel are held for, to be sent as one. Returns `None` if they are not
+    held and are sent as they happen.
+    """
+    window_text = request.query.get('coalesce')
+    if window_text is None:
+        return None
+    try:
+        window_seconds = float(window_text)
+    except ValueError:
+        window_seconds = -1.0
+    if not 0 <= window_seconds <= MAXIMUM_COALESCING_WINDOW_SECONDS:
+        raise web.HTTPBadRequest(reason="The 'coalesce' query parameter must be a number of "
+            f"seconds up to {MAXIMUM_COALESCING_WINDOW_SECONDS}")
+    return window_seconds if window_seconds > 0 else None
+
+
+class NotificationCoalescer:
+    """
+    The notifications for a websocket client are held from the first one that arrives until the
+    window has passed. Then the latest notification for each channel is sent with the number of
+    notifications for that channel it replaces (`count`), in the order the channels were first
+    notified. This is only used on the event loop thread.
+    """
+
+    def __init__(self, window_seconds: float,
+            send_async: Callable[[NotificationJsonData], Awaitable[None]]) -> None:
+        self._window_seconds = window_seconds
+        self._send_async = send_async
+        # Channel id: the latest notification for it, with the count so far.
+        self._notifications: dict[str, NotificationJsonData] = {}
+        self._send_task: Optional[asyncio.Task[None]] = None
+
+    def add(self, notification: NotificationJsonData) -> None:
+        channel_id = notification["channel_id"]
+        previous_notification = self._notifications.get(channel_id)
+        count = 1 if previous_notification is None else previous_notification["count"] + 1
+        self._notifications[channel_id] = { **notification, "count": count }
+        if self._send_task is None:
+            self._send_task = asyncio.create_task(self._send_after_window_async())
+
+    def close(self) -> None:
+        """
+        Any held notifications are discarded as the websocket has disconnected.
+        """
+        if self._send_task is not None:
+            self._send_task.cancel()
+            self._send_task = None
+        self._notifications.clear()
+
+    async def _send_after_window_async(self) -> None:
+        await asyncio.sleep(self._window_seconds)
+        notifications = list(self._notifications.values())
+        self._notifications.clear()
+        self._send_task = None
+        for notification in notifications:
+            try:
+                await self._send_async(notification)
+            except ConnectionResetError:
+                logger.debug("Dropped coalesced notification for disconnected websocket, "
+                    "channel_id=%s", notification["channel_id"])
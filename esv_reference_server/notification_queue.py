@@ -0,0 +1,124 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+
+from __future__ import annotations
+import asyncio
+from collections import deque
+import os
+from typing import Callable, cast, Generic, Hashable, Literal, Optional, TypeVar
+
+from . import metrics
+
+
+ItemType = TypeVar("ItemType")
+
+OverflowPolicy = Literal["drop_oldest", "block", "coalesce"]
+OVERFLOW_POLICIES: tuple[OverflowPolicy, ...] = ("drop_oldest", "block", "coalesce")
+
+
+class _QueueEntry(Generic[ItemType]):
+    __slots__ = ("key", "item")
+
+    def __init__(self, key: Optional[Hashable], item: ItemType) -> None:
+        self.key = key
+        self.item = item
+
+
+class NotificationQueue(Generic[ItemType]):
+    """
+    A queue of notifications waiting to be sent to websockets, with a maximum size so that
+    websockets that stall cannot make it grow until the process runs out of memory. When it is
+    full a new item is handled according to the overflow policy:
+
+    - `drop_oldest`: The oldest waiting item is dropped.
+    - `block`: Producers that can wait (`put_async`) wait until there is space. Those that
+      cannot (`put_nowait`) drop the oldest waiting item.
+    - `coalesce`: The new item replaces the waiting item with the same key if there is one,
+      keeping its place in the queue, and otherwise the oldest waiting item is dropped. Items
+      with a key of `None` are never replaced.
+
+    The most items that have been waiting at once and the number of items that have been
+    dropped or replaced are counted. This is only used on the event loop thread.
+    """
+
+    def __init__(self, name: str, max_size: int, overflow_policy: OverflowPolicy,
+            key_function: Optional[Callable[[ItemType], Optional[Hashable]]]=None) -> None:
+        if max_size < 1:
+            raise ValueError(f"The {name} queue size must be at least 1")
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"The {name} queue overflow policy must be one of "
+                f"{', '.join(OVERFLOW_POLICIES)}")
+        self.name = name
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self._key_function = key_function if overflow_policy == "coalesce" else None
+
+        self._entries: deque[_QueueEntry[ItemType]] = deque()
+        # The last waiting entry for each key, only for the `coalesce` policy.
+        self._entries_by_key: dict[Hashable, _QueueEntry[ItemType]] = {}
+        self._not_empty_event = asyncio.Event()
+        self._not_full_event = asyncio.Event()
+
+        self.high_water_mark = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+
+    @classmethod
+    def from_environment(cls, name: str, environment_prefix: str,
+            key_function: Optional[Callable[[ItemType], Optional[Hashable]]]=None) \
+                -> NotificationQueue[ItemType]:
+        return cls(name, int(os.getenv(f"{environment_prefix}_SIZE", "10000")),
+            cast(OverflowPolicy, os.getenv(f"{environment_prefix}_OVERFLOW_POLICY", "coalesce")),
+            key_function)
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def put_nowait(self, item: ItemType) -> None:
+        key = self._key_function(item) if self._key_function is not None else None
+        if len(self._entries) >= self.max_size:
+            if key is not None and key in self._entries_by_key:
+                self._entries_by_key[key].item = item
+                self.coalesced_count += 1
+                metrics.NOTIFICATION_QUEUE_OVERFLOWS.inc(self.name, "coalesced")
+                return
+            self._drop_oldest()
+
+        entry = _QueueEntry(key, item)
+        self._entries.append(entry)
+        if key is not None:
+            self._entries_by_key[key] = entry
+        if len(self._entries) > self.high_water_mark:
+            self.high_water_mark = len(self._entries)
+            metrics.NOTIFICATION_QUEUE_HIGH_WATER_MARK.set(self.high_water_mark, self.name)
+        self._not_empty_event.set()
+
+    async def put_async(self, item: ItemType) -> None:
+        """
+        With the `block` policy this waits until there is space for the item, otherwise it is
+        the same as `put_nowait`.
+        """
+        if self.overflow_policy == "block":
+            while len(self._entries) >= self.max_size:
+                self._not_full_event.clear()
+                await self._not_full_event.wait()
+        self.put_nowait(item)
+
+    async def get(self) -> ItemType:
+        while len(self._entries) == 0:
+            self._not_empty_event.clear()
+            await self._not_empty_event.wait()
+        entry = self._pop_oldest()
+        self._not_full_event.set()
+        return entry.item
+
+    def _pop_oldest(self) -> _QueueEntry[ItemType]:
+        entry = self._entries.popleft()
+        if entry.key is not None and self._entries_by_key.get(entry.key) is entry:
+            del self._entries_by_key[entry.key]
+        return entry
+
+    def _drop_oldest(self) -> None:
+        self._pop_oldest()
+        self.dropped_count += 1
+        metrics.NOTIFICATION_QUEUE_OVERFLOWS.inc(self.name, "dropped")
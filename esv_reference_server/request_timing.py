@@ -0,0 +1,218 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# Per-request timing breakdowns for slow requests. Every external request gets a `RequestTiming`
+# object in a context variable, and the places where a request spends time outside of the
+# handler's own code add to it: database calls, upstream HTTP requests made with the
+# application's client session and JSON encoding and decoding. If the request takes longer than
+# the `SLOW_REQUEST_THRESHOLD_MS` setting, a sample of these (at the `SLOW_REQUEST_SAMPLE_RATE`
+# setting) are logged and remembered in a fixed size buffer that can be fetched from the internal
+# server at `/slow-requests` if `EXPOSE_METRICS_API` is set.
+
+from __future__ import annotations
+from collections import deque
+import contextvars
+import dataclasses
+import json
+import logging
+import os
+import random
+import time
+from types import SimpleNamespace, TracebackType
+from typing import Any, Awaitable, Callable, Optional, ParamSpec, TypeVar
+
+import aiohttp
+from aiohttp import web
+from electrumsv_database.sqlite import DatabaseContext
+
+from .utils import get_route_name, json_dumps_bytes
+
+
+logger = logging.getLogger("request-timing")
+
+P1 = ParamSpec("P1")
+T1 = TypeVar("T1")
+
+
+@dataclasses.dataclass
+class RequestTiming:
+    database_seconds: float = 0.0
+    database_calls: int = 0
+    upstream_seconds: float = 0.0
+    upstream_calls: int = 0
+    json_seconds: float = 0.0
+    # Database calls can be nested, e.g. a repository method that does a write in the writer
+    # thread, and only the outermost should be counted.
+    database_depth: int = 0
+
+
+_current_request_timing: contextvars.ContextVar[Optional[RequestTiming]] = \
+    contextvars.ContextVar("current_request_timing", default=None)
+
+
+class _DatabaseCallTimer:
+    def __init__(self) -> None:
+        self._timing = _current_request_timing.get()
+        self._start_time = 0.0
+
+    def __enter__(self) -> None:
+        if self._timing is not None:
+            self._timing.database_depth += 1
+            self._start_time = time.perf_counter()
+
+    def __exit__(self, exc_type: Optional[type[BaseException]],
+            exc_value: Optional[BaseException], traceback: Optional[TracebackType]) -> None:
+        if self._timing is not None:
+            self._timing.database_depth -= 1
+            if self._timing.database_depth == 0:
+                self._timing.database_seconds += time.perf_counter() - self._start_time
+                self._timing.database_calls += 1
+
+
+def time_database_call() -> _DatabaseCallTimer:
+    """
+    Add the time taken by the enclosed database call to the current request's timing, if there
+    is one. Writes execute in the writer thread which does not have the request's context, so
+    they are timed by whatever is waiting for them on the event loop.
+    """
+    return _DatabaseCallTimer()
+
+
+class TimedDatabaseContext(DatabaseContext):
+    """
+    A database context where the time the current request waits for functions run in the
+    writer thread is counted towards its database time.
+    """
+
+    def run_in_thread(self, func: Callable[P1, T1], *args: P1.args, **kwargs: P1.kwargs) -> T1:
+        with time_database_call():
+            return super().run_in_thread(func, *args, **kwargs)
+
+    async def run_in_thread_async(self, func: Callable[P1, T1], *args: P1.args,
+            **kwargs: P1.kwargs) -> T1:
+        with time_database_call():
+            return await super().run_in_thread_async(func, *args, **kwargs)
+
+
+def timed_json_dumps(value: Any) -> str:
+    timing = _current_request_timing.get()
+    if timing is None:
+        return json.dumps(value)
+    start_time = time.perf_counter()
+    try:
+        return json.dumps(value)
+    finally:
+        timing.json_seconds += time.perf_counter() - start_time
+
+
+def timed_json_loads(text: str) -> Any:
+    timing = _current_request_timing.get()
+    if timing is None:
+        return json.loads(text)
+    start_time = time.perf_counter()
+    try:
+        return json.loads(text)
+    finally:
+        timing.json_seconds += time.perf_counter() - start_time
+
+
+def json_response(*args: Any, **kwargs: Any) -> web.Response:
+    """
+    This is `aiohttp.web.json_response` where the time taken to encode the data is counted
+    towards the JSON time for the current request. The data is only passed on if it is given,
+    as aiohttp does not allow it with an already encoded `body` or `text`.
+    """
+    return web.json_response(*args, dumps=timed_json_dumps, **kwargs)
+
+
+async def _on_upstream_request_start(session: aiohttp.ClientSession,
+        trace_config_ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams) -> None:
+    trace_config_ctx.request_timing = _current_request_timing.get()
+    trace_config_ctx.start_time = time.perf_counter()
+
+
+async def _on_upstream_request_end(session: aiohttp.ClientSession,
+        trace_config_ctx: SimpleNamespace,
+        params: aiohttp.TraceRequestEndParams|aiohttp.TraceRequestExceptionParams) -> None:
+    # This is the time until the response headers are received, or the request fails. Any time
+    # taken reading the response body is attributed to the handler.
+    timing: Optional[RequestTiming] = trace_config_ctx.request_timing
+    if timing is not None:
+        timing.upstream_seconds += time.perf_counter() - trace_config_ctx.start_time
+        timing.upstream_calls += 1
+
+
+def create_upstream_trace_config() -> aiohttp.TraceConfig:
+    # NOTE(typing) The aiohttp signal typing is incorrect, it wraps the callback type twice.
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_upstream_request_start) # type: ignore[arg-type]
+    trace_config.on_request_end.append(_on_upstream_request_end) # type: ignore[arg-type]
+    trace_config.on_request_exception.append(_on_upstream_request_end) # type: ignore[arg-type]
+    return trace_config
+
+
+class SlowRequestRecorder:
+    def __init__(self, threshold_seconds: float, sample_rate: float, maximum_entries: int) \
+            -> None:
+        self.threshold_seconds = threshold_seconds
+        self.sample_rate = sample_rate
+        self._entries: deque[dict[str, Any]] = deque(maxlen=maximum_entries)
+
+    @classmethod
+    def from_environment(cls) -> SlowRequestRecorder:
+        return cls(int(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "500")) / 1000,
+            float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", "1.0")),
+            int(os.getenv("SLOW_REQUEST_BUFFER_SIZE", "100")))
+
+    def get_entries(self) -> list[dict[str, Any]]:
+        return list(self._entries)
+
+    def record(self, request: web.Request, route_name: str, status: int, duration: float,
+            timing: RequestTiming) -> None:
+        if duration < self.threshold_seconds or random.random() >= self.sample_rate:
+            return
+
+        entry = {
+            "time": time.time(),
+            "route": route_name,
+            "method": request.method,
+            "status": status,
+            "duration_ms": round(duration * 1000, 3),
+            "database_ms": round(timing.database_seconds * 1000, 3),
+            "database_calls": timing.database_calls,
+            "upstream_ms": round(timing.upstream_seconds * 1000, 3),
+            "upstream_calls": timing.upstream_calls,
+            "json_ms": round(timing.json_seconds * 1000, 3),
+        }
+        self._entries.append(entry)
+        logger.warning("Slow request %s", json_dumps_bytes(entry).decode())
+
+
+@web.middleware
+async def request_timing_middleware(request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    recorder: SlowRequestRecorder = request.app["app_state"].slow_request_recorder
+    timing = RequestTiming()
+    context_token = _current_request_timing.set(timing)
+    start_time = time.perf_counter()
+    status = 500
+    is_websocket = False
+    try:
+        response = await handler(request)
+        status = response.status
+        # The duration for a websocket is how long it was connected and it is not a slow request.
+        is_websocket = isinstance(response, web.WebSocketResponse)
+        return response
+    except web.HTTPException as exc:
+        status = exc.status
+        raise
+    finally:
+        _current_request_timing.reset(context_token)
+        if not is_websocket:
+            recorder.record(request, get_route_name(request), status,
+                time.perf_counter() - start_time, timing)
+
+
+async def get_slow_requests(request: web.Request) -> web.Response:
+    recorder: SlowRequestRecorder = request.app["app_state"].slow_request_recorder
+    return web.json_response(recorder.get_entries())
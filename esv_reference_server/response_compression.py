@@ -0,0 +1,166 @@
+# Copyright(c) 2022 Bitcoin Association.
+# Distributed under the Open BSV software license, see the accompanying file LICENSE
+#
+# Compression of large text responses, using the best codec the client accepts in its
+# `Accept-Encoding` header. Brotli and zstd are only offered if the optional `brotli` and
+# `zstandard` packages are installed, and gzip always is. Small responses are not compressed,
+# as the saving does not justify the processor time, and large responses are compressed in a
+# worker thread so that the event loop is not blocked.
+#
+# The number of bytes saved is recorded for each route, see `metrics.py`.
+
+from __future__ import annotations
+import asyncio
+import gzip
+import os
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import hdrs, web
+
+try:
+    # Optional: Brotli response compression.
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+try:
+    # Optional: zstd response compression.
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+from .metrics import HTTP_RESPONSE_COMPRESSION_SAVED_BYTES, HTTP_RESPONSES_COMPRESSED
+from .utils import get_route_name
+
+
+# Only these content types are compressed. Binary responses are mostly hashes and other data
+# that does not compress.
+COMPRESSIBLE_CONTENT_TYPES = { "application/json", "text/plain", "text/html" }
+
+# The levels are chosen for speed over ratio, as the responses are compressed for every request.
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+
+
+def _compress_gzip(body: bytes|bytearray) -> bytes:
+    # The modification time is omitted so that the same body always compresses the same way.
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compress_brotli(body: bytes|bytearray) -> bytes:
+    return bytes(brotli.compress(bytes(body), quality=BROTLI_QUALITY))
+
+
+def _compress_zstd(body: bytes|bytearray) -> bytes:
+    return bytes(zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body))
+
+
+def get_available_codecs() -> dict[str, Callable[[bytes|bytearray], bytes]]:
+    """
+    The codecs in order of preference, where the client accepts several equally.
+    """
+    codecs: dict[str, Callable[[bytes|bytearray], bytes]] = {}
+    if zstandard is not None:
+        codecs["zstd"] = _compress_zstd
+    if brotli is not None:
+        codecs["br"] = _compress_brotli
+    codecs["gzip"] = _compress_gzip
+    return codecs
+
+
+def parse_accept_encoding(header_value: str) -> dict[str, float]:
+    """
+    The quality value of each codec listed in an `Accept-Encoding` header.
+    """
+    qualities: dict[str, float] = {}
+    for entry in header_value.split(","):
+        codec, _separator, parameters = entry.partition(";")
+        codec = codec.strip().lower()
+        if not codec:
+            continue
+        quality = 1.0
+        parameter_name, _separator, parameter_value = parameters.partition("=")
+        if parameter_name.strip().lower() == "q":
+            try:
+                quality = float(parameter_value)
+            except ValueError:
+                quality = 0.0
+        qualities[codec] = quality
+    return qualities
+
+
+class ResponseCompressor:
+    def __init__(self, minimum_size: int, executor_size: int, codec_names: list[str]) -> None:
+        """
+        Responses of at least `minimum_size` bytes are compressed if the client accepts one of
+        the codecs, and those of at least `executor_size` bytes are compressed in a worker
+        thread. A `minimum_size` of `0` disables compression.
+        """
+        self.minimum_size = minimum_size
+        self.executor_size = executor_size
+        available_codecs = get_available_codecs()
+        self._codecs = { codec_name: compress for codec_name, compress
+            in available_codecs.items() if codec_name in codec_names }
+
+    @classmethod
+    def from_environment(cls) -> ResponseCompressor:
+        return cls(int(os.getenv("RESPONSE_COMPRESSION_MINIMUM_SIZE", "1024")),
+            int(os.getenv("RESPONSE_COMPRESSION_EXECUTOR_SIZE", "65536")),
+            [ codec_name.strip() for codec_name in
+                os.getenv("RESPONSE_COMPRESSION_CODECS", "zstd,br,gzip").split(",") ])
+
+    def choose_codec(self, accept_encoding: str) -> Optional[str]:
+        qualities = parse_accept_encoding(accept_encoding)
+        default_quality = qualities.get("*", 0.0)
+        best_codec: Optional[str] = None
+        best_quality = 0.0
+        for codec_name in self._codecs:
+            quality = qualities.get(codec_name, default_quality)
+            if quality > best_quality:
+                best_codec = codec_name
+                best_quality = quality
+        return best_codec
+
+    async def compress_response_async(self, request: web.Request,
+            response: web.StreamResponse) -> None:
+        if self.minimum_size == 0 or type(response) is not web.Response or \
+                request.method == hdrs.METH_HEAD:
+            return
+        body = response.body
+        if not isinstance(body, (bytes, bytearray)) or len(body) < self.minimum_size:
+            return
+        if response.status != 200 or hdrs.CONTENT_ENCODING in response.headers or \
+                response.content_type not in COMPRESSIBLE_CONTENT_TYPES:
+            return
+
+        # Caches must not give this response to clients that accept different codecs.
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+        codec_name = self.choose_codec(request.headers.get(hdrs.ACCEPT_ENCODING, ""))
+        if codec_name is None:
+            return
+
+        compress = self._codecs[codec_name]
+        if len(body) >= self.executor_size:
+            compressed_body = await asyncio.get_running_loop().run_in_executor(None, compress,
+                body)
+        else:
+            compressed_body = compress(body)
+        if len(compressed_body) >= len(body):
+            return
+
+        response.body = compressed_body
+        response.headers[hdrs.CONTENT_ENCODING] = codec_name
+        route_name = get_route_name(request)
+        HTTP_RESPONSES_COMPRESSED.inc(route_name, codec_name)
+        HTTP_RESPONSE_COMPRESSION_SAVED_BYTES.inc(route_name, codec_name,
+            amount=len(body) - len(compressed_body))
+
+
+@web.middleware
+async def response_compression_middleware(request: web.Request,
+        handler: Callable[[web.Request], Awaitable[web.StreamResponse]]) -> web.StreamResponse:
+    compressor: ResponseCompressor = request.app["app_state"].response_compressor
+    response = await handler(request)
+    await compressor.compress_response_async(request, response)
+    return response
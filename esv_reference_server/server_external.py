@@ -10,8 +10,11 @@ from aiohttp import web
 
 from .application_state import ApplicationState
 from . import handlers, handlers_headers, handlers_indexer
+from .metrics import metrics_middleware
+from .request_timing import request_timing_middleware
+from .response_compression import response_compression_middleware
 from . import msg_box
-from .msg_box.controller import MsgBoxWebSocket
+from .msg_box.controller import MsgBoxMultiChannelWebSocket, MsgBoxWebSocket
 from .websock import GeneralWebSocket
 
 
@@ -23,7 +26,7 @@ logger = logging.getLogger("server")
 
 class ExternalServer:
     def __init__(self, app: web.Application, application_state: ApplicationState, host: str,
-            port: int) -> None:
+            port: int, reuse_port: bool=False) -> None:
         self.runner: Optional[web.AppRunner] = None
         self._app_state = application_state
         self._app = app
@@ -33,6 +36,9 @@ class ExternalServer:
 
         self._host = host
         self._port = port
+        # Multiple worker processes each bind to the same port and the kernel distributes the
+        # incoming connections between them.
+        self._reuse_port = reuse_port
         self._logger = logging.getLogger("aiohttp-rest-api")
 
     async def _on_startup(self, app: web.Application) -> None:
@@ -45,7 +51,8 @@ class ExternalServer:
         self._logger.info("Started external server on http://%s:%s", self._host, self._port)
         self.runner = web.AppRunner(self._app, access_log=None)
         await self.runner.setup()
-        site = web.TCPSite(self.runner, self._host, self._port, reuse_address=True)
+        site = web.TCPSite(self.runner, self._host, self._port, reuse_address=True,
+            reuse_port=self._reuse_port or None)
         await site.start()
         await self._app_state.wait_for_exit_async(external=True)
 
@@ -61,7 +68,8 @@ class ExternalServer:
 
 
 def get_external_server_application(app_state: ApplicationState) -> web.Application:
-    app = web.Application()
+    app = web.Application(middlewares=[ metrics_middleware, request_timing_middleware,
+        response_compression_middleware ])
 
     # This is the standard aiohttp way of managing state within the handlers
     app['app_state'] = app_state
@@ -95,6 +103,10 @@ def get_external_server_application(app_state: ApplicationState) -> web.Applicat
         web.post("/api/v1/channel/manage/{channelid}/api-token",
             msg_box.controller.create_new_token_for_channel),
 
+        # Message Box Websocket API for many channels. This is added before the routes that take
+        # a channel id, which would otherwise match it.
+        web.view("/api/v1/channel/notify", MsgBoxMultiChannelWebSocket),
+
         # Message Box Push / Pull API
         web.post("/api/v1/channel/{channelid}", msg_box.controller.write_message),
         # web.head is added automatically by web.get in aiohttp
@@ -8,7 +8,7 @@ from typing import Optional
 from aiohttp import web
 
 from .application_state import ApplicationState
-from . import handlers, handlers_indexer_internal
+from . import handlers, handlers_indexer_internal, metrics, request_timing
 
 
 class InternalServer:
@@ -68,4 +68,10 @@ def get_internal_server_application(app_state: ApplicationState) -> web.Applicat
                 handlers_indexer_internal.indexer_post_tip_filter_matches),
         ])
 
+    if os.getenv("EXPOSE_METRICS_API") == "1":
+        app.add_routes([
+            web.get("/metrics", metrics.get_metrics),
+            web.get("/slow-requests", request_timing.get_slow_requests),
+        ])
+
     return app
@@ -34,12 +34,12 @@ except ModuleNotFoundError:
 import time
 from typing import Any, cast, NamedTuple, Optional, Sequence
 
-from electrumsv_database.sqlite import bulk_insert_returning, read_rows_by_id, \
-    replace_db_context_with_connection
+from electrumsv_database.sqlite import read_rows_by_id, replace_db_context_with_connection
 
 from .constants import AccountFlag, IndexerPushdataRegistrationFlag, OutboundDataFlag
-from .types import AccountIndexerMetadata, OutboundDataLogRow, OutboundDataCreatedRow, \
-    OutboundDataPendingRow, OutboundDataRow, TipFilterListEntry, TipFilterRegistrationEntry
+from .types import AccountIndexerMetadata, OutboundDataLogRow, OutboundDataPendingRow, \
+    OutboundDataRow, TipFilterListEntry, TipFilterRegistrationEntry
+from .metrics import instrument_database_call
 from .utils import create_account_api_token
 
 # Useful regexes for searching codebase:
@@ -49,7 +49,7 @@ logger = logging.getLogger("app-database")
 
 
 APPLICATION_ID = int.from_bytes(b"ESVR", "big", signed=True)
-LATEST_MIGRATION = 2
+LATEST_MIGRATION = 3
 
 
 class AccountMetadata(NamedTuple):
@@ -76,6 +76,7 @@ def create_tables(db: sqlite3.Connection) -> None:
     create_indexer_filtering_registrations_pushdata_table(db)
     create_outbound_data_table(db)
     create_outbound_data_logs_table(db)
+    create_account_outbox_tables(db)
 
     db.execute(f"PRAGMA user_version={LATEST_MIGRATION}")
 
@@ -104,8 +105,18 @@ def initialise_database(db: sqlite3.Connection) -> None:
         db.execute("DROP TABLE account_payment_channels")
         db.execute("ALTER TABLE accounts DROP COLUMN active_channel_id")
         db.execute("ALTER TABLE accounts DROP COLUMN last_payment_key_index")
+        current_migration = 2
+
+    if current_migration == 2:
+        # Motivation: Outbound data ids are now allocated in the writer thread and matched to
+        #     their log rows by position, so the content hash is no longer needed.
+        column_names = { row[1] for row in db.execute("PRAGMA table_info(outbound_data)") }
+        if "outbound_data_hash" in column_names:
+            db.execute("ALTER TABLE outbound_data DROP COLUMN outbound_data_hash")
 
 def delete_all_tables(db: sqlite3.Connection) -> None:
+    db.execute("DROP TABLE IF EXISTS account_outbox_state")
+    db.execute("DROP TABLE IF EXISTS account_outbox")
     db.execute("DROP TABLE IF EXISTS outbound_data_logs")
     db.execute("DROP TABLE IF EXISTS outbound_data")
     db.execute("DROP TABLE IF EXISTS indexer_filtering_registrations_pushdata")
@@ -152,6 +163,7 @@ def create_account_table(db: sqlite3.Connection) -> None:
     """
     db.execute(sql)
 
+@instrument_database_call
 def create_account(public_key_bytes: bytes, db: Optional[sqlite3.Connection]=None) \
         -> tuple[int, str]:
     assert db is not None and isinstance(db, sqlite3.Connection)
@@ -165,16 +177,23 @@ def create_account(public_key_bytes: bytes, db: Optional[sqlite3.Connection]=Non
     account_id: int = cursor.lastrowid
     return account_id, api_key
 
+@instrument_database_call
 def deactivate_account(account_id: int, flags: AccountFlag,
-        db: Optional[sqlite3.Connection]=None) -> None:
+        db: Optional[sqlite3.Connection]=None) -> Optional[str]:
+    """
+    Returns the API key of the deactivated account, or `None` if the account does not exist.
+    Any cached authorisation for this API key should be discarded after this commits.
+    """
     assert db is not None and isinstance(db, sqlite3.Connection)
     sql = """
-    UPDATE accounts SET flags=flags|? WHERE account_id=?
+    UPDATE accounts SET flags=flags|? WHERE account_id=? RETURNING api_key
     """
     assert flags & AccountFlag.DISABLED_MASK != 0
-    db.execute(sql, (flags, account_id))
+    row = db.execute(sql, (flags, account_id)).fetchone()
+    return cast(Optional[str], row[0]) if row is not None else None
 
 @replace_db_context_with_connection
+@instrument_database_call
 def get_account_id_for_api_key(db: sqlite3.Connection, api_key: str) \
         -> tuple[Optional[int], AccountFlag]:
     """
@@ -192,6 +211,7 @@ def get_account_id_for_api_key(db: sqlite3.Connection, api_key: str) \
     return account_id, account_flags
 
 @replace_db_context_with_connection
+@instrument_database_call
 def get_account_id_for_public_key_bytes(db: sqlite3.Connection, public_key_bytes: bytes) \
         -> tuple[Optional[int], AccountFlag]:
     """
@@ -209,6 +229,7 @@ def get_account_id_for_public_key_bytes(db: sqlite3.Connection, public_key_bytes
     return account_id, account_flags
 
 @replace_db_context_with_connection
+@instrument_database_call
 def get_account_metadata_for_account_id(db: sqlite3.Connection, account_id: int) -> AccountMetadata:
     sql = "SELECT public_key_bytes, api_key, flags FROM accounts WHERE account_id = ?1"
     row = db.execute(sql, (account_id,)).fetchone()
@@ -238,6 +259,7 @@ def create_indexer_filtering_registrations_pushdata_table(db: sqlite3.Connection
     """
     db.execute(sql)
 
+@instrument_database_call
 def create_indexer_filtering_registrations_pushdatas(account_id: int,
         registration_entries: list[TipFilterRegistrationEntry],
         db: Optional[sqlite3.Connection]=None) -> Optional[int]:
@@ -263,6 +285,7 @@ def create_indexer_filtering_registrations_pushdatas(account_id: int,
         return date_created
 
 @replace_db_context_with_connection
+@instrument_database_call
 def read_indexer_filtering_registrations_pushdatas(db: sqlite3.Connection, account_id: int,
         # These defaults include all rows no matter the flag value.
         expected_flags: IndexerPushdataRegistrationFlag=IndexerPushdataRegistrationFlag.NONE,
@@ -277,6 +300,7 @@ def read_indexer_filtering_registrations_pushdatas(db: sqlite3.Connection, accou
         entries.append(TipFilterListEntry(row[0], row[1], row[2] - row[1]))
     return entries
 
+@instrument_database_call
 def update_indexer_filtering_registrations_pushdatas_flags(
         account_id: int,
         pushdata_hashes: list[bytes],
@@ -304,6 +328,7 @@ def update_indexer_filtering_registrations_pushdatas_flags(
     if require_all and cursor.rowcount != len(pushdata_hashes):
         raise DatabaseStateModifiedError
 
+@instrument_database_call
 def delete_indexer_filtering_registrations_pushdatas(account_id: int,
         pushdata_hashes: list[bytes],
         # These defaults include all rows no matter the flag value.
@@ -320,6 +345,7 @@ def delete_indexer_filtering_registrations_pushdatas(account_id: int,
         update_rows.append((account_id, pushdata_hash, mask, expected_flags))
     db.executemany(sql, update_rows)
 
+@instrument_database_call
 def prune_indexer_filtering(expected_flags: IndexerPushdataRegistrationFlag,
         mask: IndexerPushdataRegistrationFlag, date_expires: Optional[int]=None,
         db: Optional[sqlite3.Connection]=None) -> int:
@@ -334,12 +360,14 @@ def prune_indexer_filtering(expected_flags: IndexerPushdataRegistrationFlag,
     return deletion_count
 
 @replace_db_context_with_connection
+@instrument_database_call
 def read_account_indexer_metadata(db: sqlite3.Connection, account_ids: list[int]) \
         -> list[AccountIndexerMetadata]:
     sql = "SELECT account_id, tip_filter_callback_url, tip_filter_callback_token " \
         "FROM accounts WHERE account_id IN ({})"
     return read_rows_by_id(AccountIndexerMetadata, db, sql, [], account_ids)
 
+@instrument_database_call
 def update_account_indexer_settings_write(account_id: int, settings: dict[str, Any],
         db: Optional[sqlite3.Connection]=None) -> dict[str, Any]:
     """
@@ -374,7 +402,6 @@ def create_outbound_data_table(db: sqlite3.Connection) -> None:
         outbound_data_id        INTEGER     PRIMARY KEY,
         account_id              INTEGER     NOT NULL,
         outbound_data           BLOB        NOT NULL,
-        outbound_data_hash      BLOB        NOT NULL,
         outbound_data_flags     INTEGER     NOT NULL,
         content_type            TEXT        NOT NULL,
         date_created            INTEGER     NOT NULL,
@@ -398,38 +425,41 @@ def create_outbound_data_logs_table(db: sqlite3.Connection) -> None:
     """)
 
 
+@instrument_database_call
 def create_outbound_datas_write(data_creation_rows: list[OutboundDataRow],
-        log_creation_rows_by_key: dict[tuple[int, bytes], OutboundDataLogRow],
+        log_creation_rows: list[OutboundDataLogRow],
         db: Optional[sqlite3.Connection]=None) -> None:
+    """
+    Insert the outbound data rows and a log row for each. The log row for a given data row is
+    expected to be at the same index in `log_creation_rows`.
+    """
     assert db is not None
-    sql_prefix = "INSERT INTO outbound_data (outbound_data_id, account_id, outbound_data, " \
-        "outbound_data_hash, outbound_data_flags, content_type, date_created) VALUES"
-    sql_suffix = "RETURNING outbound_data_id, account_id, outbound_data_hash"
-    # Remember that SQLite does not guarantee that the returned row order matches the insert order
-    # so we need something to match the id to the inserted row, and the hash aids in this.
-    datas_created = bulk_insert_returning(OutboundDataCreatedRow, db, sql_prefix, sql_suffix,
-        data_creation_rows)
-    if len(datas_created) != len(data_creation_rows):
+    assert len(data_creation_rows) == len(log_creation_rows)
+    # All writes are serialised through the writer thread, so nothing else can insert outbound
+    # data between allocating the ids here and inserting the rows that use them. SQLite does not
+    # guarantee the order of rows returned from an `INSERT .. RETURNING` statement, so we give
+    # each row a known id rather than matching allocated ids back to rows afterwards.
+    next_outbound_data_id: int = db.execute(
+        "SELECT COALESCE(MAX(outbound_data_id), 0) + 1 FROM outbound_data").fetchone()[0]
+    outbound_data_ids = range(next_outbound_data_id,
+        next_outbound_data_id + len(data_creation_rows))
+
+    sql = "INSERT INTO outbound_data (outbound_data_id, account_id, outbound_data, " \
+        "outbound_data_flags, content_type, date_created) VALUES (?, ?, ?, ?, ?, ?)"
+    cursor = db.executemany(sql, (data_row._replace(outbound_data_id=outbound_data_id)
+        for outbound_data_id, data_row in zip(outbound_data_ids, data_creation_rows)))
+    if cursor.rowcount != len(data_creation_rows):
         raise DatabaseStateModifiedError()
 
-    # Insert all the created ids into the log rows.
-    for data_created in datas_created:
-        log_row_key = (data_created.account_id, data_created.outbound_data_hash)
-        log_creation_rows_by_key[log_row_key] = log_creation_rows_by_key[log_row_key] \
-            ._replace(outbound_data_id=data_created.outbound_data_id)
-
-    log_creation_rows = list(log_creation_rows_by_key.values())
-    # Verify that every log row got a created id for the outbound data row.
-    assert all(log_row.outbound_data_id is not None for log_row in log_creation_rows)
-
     sql = "INSERT INTO outbound_data_logs (account_id, outbound_data_id, outbound_data_flags, " \
         "response_status_code, response_reason, date_created) VALUES (?, ?, ?, ?, ?, ?)"
-    cursor = db.executemany(sql, log_creation_rows)
+    cursor = db.executemany(sql, (log_row._replace(outbound_data_id=outbound_data_id)
+        for outbound_data_id, log_row in zip(outbound_data_ids, log_creation_rows)))
     if cursor.rowcount != len(log_creation_rows):
         raise DatabaseStateModifiedError()
 
 
-
+@instrument_database_call
 def create_outbound_data_logs_write(creation_rows: list[OutboundDataLogRow],
         db: Optional[sqlite3.Connection]=None) -> None:
     assert db is not None
@@ -441,6 +471,7 @@ def create_outbound_data_logs_write(creation_rows: list[OutboundDataLogRow],
 
 
 @replace_db_context_with_connection
+@instrument_database_call
 def read_pending_outbound_datas(db: sqlite3.Connection, flags: OutboundDataFlag,
         mask: OutboundDataFlag) -> list[OutboundDataPendingRow]:
     sql = """
@@ -463,6 +494,7 @@ def read_pending_outbound_datas(db: sqlite3.Connection, flags: OutboundDataFlag,
         row[5], row[6], row[7]) for row in db.execute(sql, sql_values) ]
 
 
+@instrument_database_call
 def update_outbound_data_flags_write(entries: list[tuple[OutboundDataFlag, int]],
         db: Optional[sqlite3.Connection]=None) -> None:
     assert db is not None
@@ -472,9 +504,182 @@ def update_outbound_data_flags_write(entries: list[tuple[OutboundDataFlag, int]]
 
 
 @replace_db_context_with_connection
+@instrument_database_call
 def read_outbound_data_logs(db: sqlite3.Connection, outbound_data_ids: Sequence[int]) \
         -> list[OutboundDataLogRow]:
     sql = "SELECT account_id, outbound_data_id, outbound_data_flags, response_status_code, " \
         "response_reason, date_created FROM outbound_Data_logs WHERE outbound_data_id IN ({}) " \
         "ORDER BY date_created"
     return read_rows_by_id(OutboundDataLogRow, db, sql, [], outbound_data_ids)
+
+
+# SECTION: Account outbox.
+
+def create_account_outbox_tables(db: sqlite3.Connection) -> None:
+    """
+    The account messages that did not fit in the in-memory outbox of a worker process, see
+    `account_outbox.py`. The message ids are only unique for the worker process and account.
+    """
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS account_outbox (
+        worker_index            INTEGER     NOT NULL,
+        account_id              INTEGER     NOT NULL,
+        message_id              INTEGER     NOT NULL,
+        message_kind            INTEGER     NOT NULL,
+        message_data            BLOB        NOT NULL,
+        PRIMARY KEY (worker_index, account_id, message_id)
+    )
+    """)
+    db.execute("""
+    CREATE TABLE IF NOT EXISTS account_outbox_state (
+        worker_index            INTEGER     NOT NULL,
+        account_id              INTEGER     NOT NULL,
+        acknowledged_id         INTEGER     NOT NULL DEFAULT 0,
+        dropped_id              INTEGER     NOT NULL DEFAULT 0,
+        reserved_count          INTEGER     NOT NULL DEFAULT 0,
+        PRIMARY KEY (worker_index, account_id)
+    )
+    """)
+
+
+class AccountOutboxStateRow(NamedTuple):
+    # The client has all the messages up to and including this one.
+    acknowledged_id: int
+    # The messages up to and including this one were dropped as the outbox was full.
+    dropped_id: int
+    # The message counter values up to and including this one may have been used for ids.
+    reserved_count: int
+    # The last message id that was spilled, or zero.
+    last_message_id: int
+    # The number of spilled messages.
+    message_count: int
+
+
+@replace_db_context_with_connection
+@instrument_database_call
+def read_account_outbox_account_ids(db: sqlite3.Connection, worker_index: int) -> list[int]:
+    sql = "SELECT account_id FROM account_outbox_state WHERE worker_index=?"
+    return [ row[0] for row in db.execute(sql, (worker_index,)).fetchall() ]
+
+
+@instrument_database_call
+def create_account_outbox_state_write(worker_index: int, account_id: int,
+        db: Optional[sqlite3.Connection]=None) -> None:
+    assert db is not None and isinstance(db, sqlite3.Connection)
+    db.execute("INSERT OR IGNORE INTO account_outbox_state (worker_index, account_id) "
+        "VALUES (?, ?)", (worker_index, account_id))
+
+
+@replace_db_context_with_connection
+@instrument_database_call
+def read_account_outbox_state(db: sqlite3.Connection, worker_index: int, account_id: int) \
+        -> AccountOutboxStateRow:
+    sql = """
+        SELECT COALESCE((SELECT acknowledged_id FROM account_outbox_state
+                WHERE worker_index=?1 AND account_id=?2), 0),
+            COALESCE((SELECT dropped_id FROM account_outbox_state
+                WHERE worker_index=?1 AND account_id=?2), 0),
+            COALESCE((SELECT reserved_count FROM account_outbox_state
+                WHERE worker_index=?1 AND account_id=?2), 0),
+            COALESCE(MAX(message_id), 0), COUNT(*)
+        FROM account_outbox
+        WHERE worker_index=?1 AND account_id=?2
+    """
+    return AccountOutboxStateRow(*db.execute(sql, (worker_index, account_id)).fetchone())
+
+
+@instrument_database_call
+def reserve_account_outbox_message_ids_write(worker_index: int, account_id: int,
+        reserved_count: int, db: Optional[sqlite3.Connection]=None) -> None:
+    """
+    Record that the message counter values up to and including the given one may be used for
+    message ids, so that they are not used again after a restart.
+    """
+    assert db is not None and isinstance(db, sqlite3.Connection)
+    db.execute("""
+        INSERT INTO account_outbox_state (worker_index, account_id, reserved_count)
+        VALUES (?1, ?2, ?3)
+        ON CONFLICT (worker_index, account_id)
+            DO UPDATE SET reserved_count=MAX(reserved_count, ?3)
+    """, (worker_index, account_id, reserved_count))
+
+
+@replace_db_context_with_connection
+@instrument_database_call
+def read_account_outbox_messages(db: sqlite3.Connection, worker_index: int, account_id: int,
+        after_message_id: int, limit: int) -> list[tuple[int, int, bytes]]:
+    """
+    Returns the message id, kind and data of the spilled messages after the given message id, in
+    order. This is a range scan of the primary key.
+    """
+    sql = "SELECT message_id, message_kind, message_data FROM account_outbox " \
+        "WHERE worker_index=? AND account_id=? AND message_id>? ORDER BY message_id LIMIT ?"
+    return cast(list[tuple[int, int, bytes]],
+        db.execute(sql, (worker_index, account_id, after_message_id, limit)).fetchall())
+
+
+def _trim_account_outbox(db: sqlite3.Connection, worker_index: int, account_id: int,
+        maximum_count: int) -> tuple[int, int]:
+    """
+    Delete the acknowledged messages and then the oldest messages past the maximum, remembering
+    the last of the latter so that the client can be told. Returns the number of messages left
+    and the last dropped message id.
+    """
+    db.execute("""
+        DELETE FROM account_outbox
+        WHERE worker_index=?1 AND account_id=?2 AND message_id <= COALESCE(
+            (SELECT acknowledged_id FROM account_outbox_state
+             WHERE worker_index=?1 AND account_id=?2), 0)
+    """, (worker_index, account_id))
+    row = db.execute("SELECT message_id FROM account_outbox WHERE worker_index=? "
+        "AND account_id=? ORDER BY message_id DESC LIMIT 1 OFFSET ?",
+        (worker_index, account_id, maximum_count)).fetchone()
+    if row is not None:
+        dropped_id: int = row[0]
+        db.execute("DELETE FROM account_outbox WHERE worker_index=? AND account_id=? "
+            "AND message_id <= ?", (worker_index, account_id, dropped_id))
+        db.execute("""
+            INSERT INTO account_outbox_state (worker_index, account_id, dropped_id)
+            VALUES (?1, ?2, ?3)
+            ON CONFLICT (worker_index, account_id) DO UPDATE SET dropped_id=?3
+        """, (worker_index, account_id, dropped_id))
+    message_count, dropped_id = db.execute("""
+        SELECT COUNT(*), COALESCE((SELECT dropped_id FROM account_outbox_state
+            WHERE worker_index=?1 AND account_id=?2), 0)
+        FROM account_outbox
+        WHERE worker_index=?1 AND account_id=?2
+    """, (worker_index, account_id)).fetchone()
+    return message_count, dropped_id
+
+
+@instrument_database_call
+def create_account_outbox_messages_write(worker_index: int, account_id: int,
+        rows: list[tuple[int, int, bytes]], maximum_count: int,
+        db: Optional[sqlite3.Connection]=None) -> tuple[int, int]:
+    """
+    Spill the given message id, kind and data rows, keeping at most `maximum_count` messages
+    for the account. Returns the number of messages kept and the last dropped message id.
+    """
+    assert db is not None and isinstance(db, sqlite3.Connection)
+    db.executemany("INSERT INTO account_outbox (worker_index, account_id, message_id, "
+        "message_kind, message_data) VALUES (?, ?, ?, ?, ?)",
+        [ (worker_index, account_id, *row) for row in rows ])
+    return _trim_account_outbox(db, worker_index, account_id, maximum_count)
+
+
+@instrument_database_call
+def acknowledge_account_outbox_messages_write(worker_index: int, account_id: int,
+        message_id: int, maximum_count: int, db: Optional[sqlite3.Connection]=None) \
+            -> tuple[int, int]:
+    """
+    Delete the spilled messages up to and including the given message id. Returns the number
+    of messages kept and the last dropped message id.
+    """
+    assert db is not None and isinstance(db, sqlite3.Connection)
+    db.execute("""
+        INSERT INTO account_outbox_state (worker_index, account_id, acknowledged_id)
+        VALUES (?1, ?2, ?3)
+        ON CONFLICT (worker_index, account_id)
+            DO UPDATE SET acknowledged_id=MAX(acknowledged_id, ?3)
+    """, (worker_index, account_id, message_id))
+    return _trim_account_outbox(db, worker_index, account_id, maximum_count)
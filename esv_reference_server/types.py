@@ -12,6 +12,7 @@ from .constants import AccountMessageKind, OutboundDataFlag
 if typing.TYPE_CHECKING:
     from .msg_box.models import MsgBox
     from .msg_box.types import MessageRow
+    from .notification_coalescing import NotificationCoalescer
 
 
 # TODO Ideally these media types would be constants from some standard library.
@@ -25,6 +26,13 @@ class AccountWebsocketState:
     accept_type: AccountWebsocketMediaType
 
     spent_output_registrations: set[Outpoint] = dataclasses.field(default_factory=set)
+    # Peer channel notifications are held and sent together if the client asked for this.
+    coalescer: Optional[NotificationCoalescer] = None
+    # Messages are sent with their account outbox id if the client asked for this. New messages
+    # are not sent while the messages it missed are being sent, and are sent with them instead.
+    uses_outbox: bool = False
+    is_replaying: bool = False
+    last_message_id: int = 0
 
 
 class HeadersWSClient(NamedTuple):
@@ -35,7 +43,11 @@ class HeadersWSClient(NamedTuple):
 class MsgBoxWSClient(NamedTuple):
     ws_id: str
     websocket: web.WebSocketResponse
-    messagebox_id: int
+    # The channels the websocket is subscribed to. This is only changed by the application state
+    # methods that also update the index of websockets by channel.
+    messagebox_ids: set[int]
+    # Notifications are held and sent together if the client asked for this.
+    coalescer: Optional[NotificationCoalescer] = None
 
 
 class Route(NamedTuple):
@@ -66,7 +78,13 @@ class Header(TypedDict):
     work: int
 
 
-class NotificationJsonData(TypedDict):
+class _NotificationJsonDataOptional(TypedDict, total=False):
+    # This is only present for websocket clients that have their notifications coalesced, and is
+    # the number of notifications for the channel that this one replaces.
+    count: int
+
+
+class NotificationJsonData(_NotificationJsonDataOptional):
     sequence: int
     received: str
     content_type: str
@@ -79,9 +97,14 @@ class HeaderSVTip(TypedDict):
     height: int
 
 
-class GeneralNotification(TypedDict):
+class _GeneralNotificationOptional(TypedDict, total=False):
+    # The account outbox id, if the client asked for the outbox to be used.
+    id: int
+
+
+class GeneralNotification(_GeneralNotificationOptional):
     message_type: str
-    result: Union[NotificationJsonData, str]
+    result: Union[NotificationJsonData, str, dict[str, int]]
 
 
 class AccountMessage(NamedTuple):
@@ -159,18 +182,11 @@ class OutboundDataRow(NamedTuple):
     outbound_data_id: Optional[int]
     account_id: int
     outbound_data: bytes
-    outbound_data_hash: bytes
     outbound_data_flags: OutboundDataFlag
     content_type: str
     date_created: int
 
 
-class OutboundDataCreatedRow(NamedTuple):
-    outbound_data_id: int
-    account_id: int
-    outbound_data_hash: bytes
-
-
 class OutboundDataPendingRow(NamedTuple):
     outbound_data_id: int
     account_id: int
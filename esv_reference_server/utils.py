@@ -8,6 +8,12 @@ from typing import Any, Optional
 
 from aiohttp import web
 
+try:
+    # Optional faster JSON encoder that produces bytes directly.
+    import orjson
+except ModuleNotFoundError:
+    orjson = None # type: ignore[assignment]
+
 from .constants import AccountMessageKind
 
 
@@ -36,15 +42,37 @@ def _try_read_bearer_token_from_query(request: web.Request) -> Optional[str]:
     return auth_string
 
 
+def get_route_name(request: web.Request) -> str:
+    # The resource template is used rather than the path so that the number of distinct values
+    # is bounded, e.g. "/api/v1/channel/{channelid}".
+    resource = request.match_info.route.resource
+    if resource is None:
+        return "unmatched"
+    return resource.canonical
+
+
+def json_dumps_bytes(value: Any) -> bytes:
+    """
+    Serialise a JSON-compatible value directly to UTF-8 encoded bytes.
+
+    If `orjson` is installed it is used, otherwise we fall back to the standard library encoder
+    using the same compact separators so that the output is the same either way.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+
+
 def pack_account_message_bytes(message_kind: AccountMessageKind, message_data: Any) -> bytes:
     """
     Serialise an outgoing account message as bytes.
     """
     message_bytes = struct.pack(">I", message_kind)
-    if message_kind == AccountMessageKind.PEER_CHANNEL_MESSAGE:
+    if message_kind in (AccountMessageKind.PEER_CHANNEL_MESSAGE,
+            AccountMessageKind.OUTBOX_TRUNCATED):
         # Just use the same JSON format for now.
         assert isinstance(message_data, dict)
-        message_bytes += json.dumps(message_data).encode()
+        message_bytes += json_dumps_bytes(message_data)
     elif message_kind == AccountMessageKind.SPENT_OUTPUT_EVENT:
         assert isinstance(message_data, bytes)
         message_bytes += message_data
@@ -2,6 +2,7 @@
 # TODO(1.4.0) Rename this file to `websocket_account.py`.
 
 from __future__ import annotations
+import json
 import logging
 from typing import cast, TYPE_CHECKING
 import uuid
@@ -10,14 +11,19 @@ import aiohttp
 from aiohttp import web
 from aiohttp.web_ws import WebSocketResponse
 
-from . import sqlite_db
+from .constants import AccountMessageKind
 from .errors import APIErrors
-from .types import AccountWebsocketState, AccountWebsocketMediaType
+from .notification_coalescing import NotificationCoalescer, parse_coalescing_window
+from .types import AccountWebsocketState, AccountWebsocketMediaType, NotificationJsonData
 
 if TYPE_CHECKING:
     from esv_reference_server.application_state import ApplicationState
 
 
+# The number of account outbox messages read at a time when sending a client those it missed.
+OUTBOX_REPLAY_PAGE_SIZE = 100
+
+
 class GeneralWebSocket(web.View):
     """
     Each connected client receives account-related notifications on this websocket.
@@ -30,7 +36,8 @@ class GeneralWebSocket(web.View):
 
     async def get(self) -> WebSocketResponse:
         """The communication for this is one-way - for message box notifications only.
-        Client messages will be ignored"""
+        Client messages will be ignored, except for acknowledgements of account outbox messages
+        if the client asked for the outbox to be used with `outbox=true`."""
         app_state: ApplicationState = self.request.app['app_state']
 
         # Note this bearer token is the account-specific one
@@ -39,8 +46,7 @@ class GeneralWebSocket(web.View):
             raise web.HTTPBadRequest(reason=f"{APIErrors.MISSING_QUERY_PARAM}: Missing "
                 "'token' query parameter (requires master bearer token).")
 
-        account_id, _account_flags = sqlite_db.get_account_id_for_api_key(
-            app_state.database_context, api_key)
+        account_id, _account_flags = app_state.get_account_id_for_api_key(api_key)
         if account_id is None:
             raise web.HTTPUnauthorized()
 
@@ -49,6 +55,23 @@ class GeneralWebSocket(web.View):
         if accept_type_text == "*/*":
             accept_type_text = 'application/json'
         accept_type = cast(AccountWebsocketMediaType, accept_type_text)
+        coalescing_window_seconds = parse_coalescing_window(self.request)
+        uses_outbox = self.request.query.get('outbox') == "true"
+        last_message_id_text = self.request.query.get('last_id')
+        if uses_outbox:
+            if coalescing_window_seconds is not None:
+                raise web.HTTPBadRequest(reason="The 'outbox' and 'coalesce' query parameters "
+                    "cannot be used together")
+            if last_message_id_text is not None and not last_message_id_text.isdigit():
+                raise web.HTTPBadRequest(reason="The 'last_id' query parameter must be an "
+                    "account outbox message id")
+            # Each worker process has its own outbox, and the client has to resynchronise if it
+            # is connected to another one.
+            if last_message_id_text is not None and \
+                    not app_state.account_outbox.is_own_message_id(int(last_message_id_text)):
+                raise web.HTTPBadRequest(reason="The 'last_id' query parameter is the id of a "
+                    "message from another server worker")
+            await app_state.account_outbox.enable_async(account_id)
         websocket_response = web.WebSocketResponse(heartbeat=30)
         await websocket_response.prepare(self.request)
         websocket_state = AccountWebsocketState(
@@ -57,14 +80,33 @@ class GeneralWebSocket(web.View):
             account_id=account_id,
             accept_type=accept_type
         )
+        if coalescing_window_seconds is not None:
+            async def send_peer_channel_message_async(notification: NotificationJsonData) \
+                    -> None:
+                await app_state.send_account_message_async(websocket_state,
+                    AccountMessageKind.PEER_CHANNEL_MESSAGE, notification)
+            websocket_state.coalescer = NotificationCoalescer(coalescing_window_seconds,
+                send_peer_channel_message_async)
+        if uses_outbox:
+            # Without a message id the client is sent the messages after the last one it
+            # acknowledged.
+            websocket_state.uses_outbox = True
+            websocket_state.is_replaying = True
+            websocket_state.last_message_id = int(last_message_id_text) \
+                if last_message_id_text is not None else \
+                app_state.account_outbox.get_acknowledged_id(account_id)
         # TODO(1.4.0) If there is an existing connection for this account close it.
         app_state.setup_account_websocket(websocket_state)
         self.logger.debug(
             'Account websocket connected, host=%s, accept_type=%s, websocket_id=%s, account_id=%d',
             self.request.host, accept_type, websocket_state.ws_id, account_id)
         try:
-            await self._websocket_message_loop(websocket_state)
+            if uses_outbox:
+                await self._send_outbox_messages_async(app_state, websocket_state)
+            await self._websocket_message_loop(app_state, websocket_state)
         finally:
+            if websocket_state.coalescer is not None:
+                websocket_state.coalescer.close()
             if not websocket_response.closed:
                 await websocket_response.close()
             self.logger.debug("Account websocket disconnected, websocket_id=%s", ws_id)
@@ -72,11 +114,51 @@ class GeneralWebSocket(web.View):
 
         return websocket_response
 
-    async def _websocket_message_loop(self, websocket_state: AccountWebsocketState) -> None:
+    async def _send_outbox_messages_async(self, app_state: ApplicationState,
+            websocket_state: AccountWebsocketState) -> None:
+        """
+        Send the client the messages it missed. New messages are added to the account outbox
+        while this happens and are sent with them. If some of them were dropped because the
+        outbox was full the client is told first, and should resynchronise.
+        """
+        account_outbox = app_state.account_outbox
+        account_id = websocket_state.account_id
+        dropped_message_id = account_outbox.get_dropped_id(account_id)
+        if dropped_message_id > websocket_state.last_message_id:
+            await app_state.send_account_message_async(websocket_state,
+                AccountMessageKind.OUTBOX_TRUNCATED, { "dropped_id": dropped_message_id },
+                dropped_message_id)
+
+        while True:
+            entries = account_outbox.read(account_id, websocket_state.last_message_id,
+                OUTBOX_REPLAY_PAGE_SIZE)
+            if not entries:
+                break
+            for entry in entries:
+                await app_state.send_account_message_async(websocket_state, entry.message_kind,
+                    entry.message, entry.message_id)
+        websocket_state.is_replaying = False
+
+    async def _websocket_message_loop(self, app_state: ApplicationState,
+            websocket_state: AccountWebsocketState) -> None:
         # Loop until the connection is closed. This is a broken usage of the `for` loop by
         # aiohttp, where the number of iterations is not bounded.
         async for message in websocket_state.websocket:
-            if message.type in (aiohttp.WSMsgType.text, aiohttp.WSMsgType.binary):
+            if websocket_state.uses_outbox and message.type == aiohttp.WSMsgType.text:
+                # The only incoming messages accepted are acknowledgements of outbox messages,
+                # `{"ack": <message id>}`, for messages sent by this worker process.
+                try:
+                    message_id = json.loads(message.data)["ack"]
+                except (ValueError, KeyError, TypeError):
+                    message_id = None
+                if type(message_id) is int and \
+                        app_state.account_outbox.is_own_message_id(message_id):
+                    await app_state.account_outbox.acknowledge_async(websocket_state.account_id,
+                        message_id)
+                else:
+                    await websocket_state.websocket.close()
+
+            elif message.type in (aiohttp.WSMsgType.text, aiohttp.WSMsgType.binary):
                 # We do not accept incoming messages. To ignore them would be to encourage badly
                 # implemented clients.
                 await websocket_state.websocket.close()
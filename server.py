@@ -8,15 +8,21 @@ from pathlib import Path
 import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
+import multiprocessing
+from multiprocessing.synchronize import Event as EventType
+import shutil
+import tempfile
 from typing import cast, Optional
 
 from aiohttp import web
 
+from esv_reference_server.account_outbox import MAXIMUM_WORKER_PROCESSES
 from esv_reference_server.application_state import ApplicationState
 from esv_reference_server.server_external import ExternalServer, get_external_server_application
 from esv_reference_server.server_internal import InternalServer, get_internal_server_application
 from esv_reference_server.constants import DEFAULT_DATABASE_NAME, EXTERNAL_SERVER_HOST, \
     EXTERNAL_SERVER_PORT, HREF_HOST, HREF_PORT, INTERNAL_SERVER_HOST, INTERNAL_SERVER_PORT, Network
+from esv_reference_server.notification_bus import NotificationBusServer
 
 MODULE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 LOG_PATH = Path('logs') / 'esv_reference_server.log'
@@ -29,8 +35,11 @@ requests_logger = logging.getLogger("urllib3")
 requests_logger.setLevel(logging.WARNING)
 
 
-def create_log_file_if_not_exist(data_path: Path) -> Path:
+def create_log_file_if_not_exist(data_path: Path, worker_index: Optional[int]=None) -> Path:
     full_log_path = data_path / LOG_PATH
+    if worker_index is not None:
+        # Each worker process gets its own log file as the file is recreated on startup.
+        full_log_path = full_log_path.with_stem(f"{full_log_path.stem}-worker{worker_index}")
     if not full_log_path.exists():
         full_log_path.parent.mkdir(exist_ok=True)
         with open(full_log_path, 'w') as f:
@@ -38,8 +47,8 @@ def create_log_file_if_not_exist(data_path: Path) -> Path:
     return full_log_path
 
 
-def setup_logging(data_path: Path) -> None:
-    full_log_path = create_log_file_if_not_exist(data_path)
+def setup_logging(data_path: Path, worker_index: Optional[int]=None) -> None:
+    full_log_path = create_log_file_if_not_exist(data_path, worker_index)
     logging.basicConfig(format='%(asctime)s %(levelname)-8s %(name)-24s %(message)s',
         level=logging.DEBUG, datefmt='%Y-%m-%d %H:%M:%S')
     file_handler = RotatingFileHandler(full_log_path, mode='w', backupCount=1, encoding='utf-8')
@@ -65,7 +74,7 @@ def load_dotenv(dotenv_path: Path) -> None:
             os.environ[key] = val
 
 
-def setup_application() -> tuple[Network, Path]:
+def load_environment() -> Path:
     # Used for unit testing to override usual configuration
     if not os.getenv("SKIP_DOTENV_FILE") == '1':
         dotenv_path = MODULE_DIR.joinpath('.env')
@@ -75,8 +84,12 @@ def setup_application() -> tuple[Network, Path]:
     data_path = Path(os.getenv('REFERENCE_SERVER_DATA_PATH', DEFAULT_DATA_PATH))
     if not data_path.exists():
         data_path.mkdir(parents=True)
+    return data_path
 
-    setup_logging(data_path)
+
+def setup_application(worker_index: Optional[int]=None) -> tuple[Network, Path]:
+    data_path = load_environment()
+    setup_logging(data_path, worker_index)
 
     human_readable_network = os.getenv('NETWORK', 'regtest')
     which_network: Network
@@ -100,8 +113,14 @@ def setup_application() -> tuple[Network, Path]:
     return which_network, datastore_location
 
 
-async def main() -> None:
-    which_network, datastore_location = setup_application()
+async def main(worker_index: Optional[int]=None, notification_bus_path: Optional[Path]=None,
+        database_ready_event: Optional[EventType]=None) -> None:
+    """
+    The worker arguments are only provided if this is one of several worker processes. The first
+    worker sets up the database and is the only worker to run the internal server.
+    """
+    which_network, datastore_location = setup_application(worker_index)
+    is_primary_worker = worker_index is None or worker_index == 0
     external_host = cast(str, os.getenv("EXTERNAL_HOST", EXTERNAL_SERVER_HOST))
     external_port_text = os.getenv("EXTERNAL_PORT", EXTERNAL_SERVER_PORT)
     try:
@@ -121,16 +140,24 @@ async def main() -> None:
         sys.exit(1)
 
     application_state = ApplicationState(which_network, datastore_location, internal_host,
-        internal_port, external_host, external_port, href_host, href_port)
+        internal_port, external_host, external_port, href_host, href_port,
+        setup_database=is_primary_worker, worker_index=worker_index or 0)
 
-    use_internal_server = os.getenv("EXPOSE_INDEXER_APIS") == "1"
+    use_indexer_apis = os.getenv("EXPOSE_INDEXER_APIS") == "1"
+    use_internal_server = is_primary_worker and \
+        (use_indexer_apis or os.getenv("EXPOSE_METRICS_API") == "1")
     internal_application: Optional[web.Application] = None
     if use_internal_server:
-        assert application_state.indexer_url is not None
+        if use_indexer_apis:
+            assert application_state.indexer_url is not None
         internal_application = get_internal_server_application(application_state)
     external_application = get_external_server_application(application_state)
 
-    await application_state.setup_async(internal_application, external_application)
+    await application_state.setup_async(internal_application, external_application,
+        notification_bus_path, is_primary_worker)
+    # The peer channel tables are created here if they are in a PostgreSQL database.
+    if database_ready_event is not None:
+        database_ready_event.set()
 
     internal_server: Optional[InternalServer] = None
     tasks = list[asyncio.Task[None]]()
@@ -142,7 +169,7 @@ async def main() -> None:
         tasks.append(run_internal_server_task)
 
     external_server = ExternalServer(external_application, application_state, external_host,
-        external_port)
+        external_port, reuse_port=worker_index is not None)
     run_external_server_task = asyncio.create_task(external_server.run_async())
     tasks.append(run_external_server_task)
     try:
@@ -156,9 +183,92 @@ async def main() -> None:
         await application_state.teardown_async()
 
 
+def run_worker_process(worker_index: int, notification_bus_path: Path,
+        database_ready_event: EventType) -> None:
+    try:
+        asyncio.run(main(worker_index, notification_bus_path, database_ready_event))
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.exception("unexpected exception in worker %d", worker_index)
+    finally:
+        logger.info("Exiting reference server worker %d", worker_index)
+
+
+async def run_workers_async(worker_count: int) -> None:
+    """
+    Run the external server in `worker_count` processes that all accept connections on the
+    same port, and relay notifications between them so that websockets connected to any worker
+    receive them.
+    """
+    data_path = load_environment()
+    setup_logging(data_path)
+
+    # Unix domain socket paths have a short maximum length, so the data path is not used.
+    notification_bus_directory = Path(tempfile.mkdtemp(prefix="esv-reference-server-"))
+    notification_bus_path = notification_bus_directory / "notification-bus.sock"
+    notification_bus = NotificationBusServer(notification_bus_path)
+    await notification_bus.start_async()
+
+    # Workers do not inherit the state of this process, and start by loading the environment.
+    context = multiprocessing.get_context("spawn")
+    processes: list[multiprocessing.process.BaseProcess] = []
+    database_ready_event = context.Event()
+    try:
+        for worker_index in range(worker_count):
+            worker_process = context.Process(target=run_worker_process,
+                name=f"worker-{worker_index}",
+                args=(worker_index, notification_bus_path, database_ready_event))
+            worker_process.start()
+            processes.append(worker_process)
+            logger.info("Started worker %d, pid=%d", worker_index, worker_process.pid)
+            # The first worker sets up the database, and the others wait for that to be done.
+            if worker_index == 0:
+                while not database_ready_event.is_set():
+                    if not worker_process.is_alive():
+                        raise Exception("The first worker exited during startup")
+                    await asyncio.sleep(0.1)
+
+        # If any worker exits the server is no longer working as expected and is stopped.
+        while all(process.is_alive() for process in processes):
+            await asyncio.sleep(1.0)
+        for process in processes:
+            if not process.is_alive():
+                logger.error("Worker %s exited with code %s", process.name, process.exitcode)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(10.0)
+        await notification_bus.stop_async()
+        shutil.rmtree(notification_bus_directory, ignore_errors=True)
+
+
+def get_worker_process_count() -> int:
+    load_environment()
+    worker_count_text = os.getenv("WORKER_PROCESSES", "1")
+    try:
+        worker_count = int(worker_count_text)
+    except ValueError:
+        print(f"Invalid `WORKER_PROCESSES` value '{worker_count_text}'")
+        sys.exit(1)
+    if worker_count > 1 and sys.platform == "win32":
+        print("Multiple `WORKER_PROCESSES` are not supported on Windows")
+        sys.exit(1)
+    if worker_count > MAXIMUM_WORKER_PROCESSES:
+        print(f"At most {MAXIMUM_WORKER_PROCESSES} `WORKER_PROCESSES` are supported")
+        sys.exit(1)
+    return worker_count
+
+
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        worker_count = get_worker_process_count()
+        if worker_count > 1:
+            asyncio.run(run_workers_async(worker_count))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         pass
     except Exception:
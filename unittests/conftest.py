@@ -241,6 +241,7 @@ def run_server() -> Generator[ApplicationState, None, None]:
     os.environ['EXPOSE_INDEXER_APIS'] = '0'
     os.environ['INDEXER_URL'] = 'http://127.0.0.1:49241'
     os.environ['ENABLE_OUTBOUND_DATA_DELIVERY'] = '0'
+    os.environ['EXPOSE_METRICS_API'] = '1'
     os.environ['SKIP_DOTENV_FILE'] = '1'
     os.environ['REFERENCE_SERVER_RESET'] = '0'
     os.environ['REFERENCE_SERVER_DATA_PATH'] = str(data_path)
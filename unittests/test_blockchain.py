@@ -36,12 +36,20 @@
 
 
 from __future__ import annotations
+import asyncio
 import os
+import threading
+import unittest.mock
 
-from bitcoinx import Bitcoin, Ops, P2MultiSig_Output, P2PK_Output, pack_byte, PrivateKey, Script, \
-    SigHash, Tx, TxInput, TxOutput
+from bitcoinx import Bitcoin, InterpreterError, Ops, P2MultiSig_Output, P2PK_Output, pack_byte, \
+    PrivateKey, Script, SigHash, Tx, TxInput, TxOutput
 
-from esv_reference_server.blockchain import verify_utxo_spend
+import pytest
+
+from esv_reference_server import blockchain
+from esv_reference_server.blockchain import get_script_verification_key, \
+    ScriptVerificationCache, ScriptVerificationPool, ScriptVerificationQueueFullError, \
+    verify_utxo_spend
 
 
 PRIVATE_KEY_1 = PrivateKey.from_hex(
@@ -58,12 +66,13 @@ PUBLIC_KEY_3 = PRIVATE_KEY_3.public_key
 
 
 def _sign_contract_transaction_input(contract_transaction: Tx, funding_output_script_bytes: bytes,
-        funding_value: int, private_key: PrivateKey, sig_hash: SigHash|None=None) -> bytes:
+        funding_value: int, private_key: PrivateKey, sig_hash: SigHash|None=None,
+        input_index: int=0) -> bytes:
     if sig_hash is None:
         sig_hash = SigHash(SigHash.ALL | SigHash.FORKID)
     # At this point we want to know that the signable parts of the transaction are complete and
     # we can calculate and inject the signature of those.
-    signature_hash = contract_transaction.signature_hash(0, funding_value,
+    signature_hash = contract_transaction.signature_hash(input_index, funding_value,
         funding_output_script_bytes, sig_hash)
     signature_bytes = private_key.sign(signature_hash, None)
     sig: bytes = signature_bytes + pack_byte(sig_hash)
@@ -105,3 +114,129 @@ def test_verify_utxo_spend_p2ms() -> None:
 
     assert verify_utxo_spend(spending_tx, 0, incoming_output)
 
+
+
+async def test_verify_transaction_inputs_async() -> None:
+    incoming_p2pk = P2PK_Output(PUBLIC_KEY_1, Bitcoin)
+    incoming_p2pk_output = TxOutput(1000, incoming_p2pk.to_script())
+    incoming_p2ms = P2MultiSig_Output([ PUBLIC_KEY_1, PUBLIC_KEY_2 ], 2)
+    incoming_p2ms_output = TxOutput(2000, incoming_p2ms.to_script())
+
+    outgoing_input_1 = TxInput(os.urandom(32), 0, Script(), 0xFFFFFFFF)
+    outgoing_input_2 = TxInput(os.urandom(32), 1, Script(), 0xFFFFFFFF)
+    outgoing_p2pk = P2PK_Output(PUBLIC_KEY_3, Bitcoin)
+    outgoing_output = TxOutput(2900, outgoing_p2pk.to_script())
+
+    spending_tx = Tx(2, [outgoing_input_1, outgoing_input_2], [outgoing_output], 0)
+    signature_bytes = _sign_contract_transaction_input(spending_tx,
+        incoming_p2pk.to_script_bytes(), 1000, PRIVATE_KEY_1, input_index=0)
+    outgoing_input_1.script_sig = Script() << signature_bytes
+    signature_bytes_1 = _sign_contract_transaction_input(spending_tx,
+        incoming_p2ms.to_script_bytes(), 2000, PRIVATE_KEY_1, input_index=1)
+    signature_bytes_2 = _sign_contract_transaction_input(spending_tx,
+        incoming_p2ms.to_script_bytes(), 2000, PRIVATE_KEY_2, input_index=1)
+    outgoing_input_2.script_sig = Script() << Ops.OP_0 << signature_bytes_1 << signature_bytes_2
+
+    pool = ScriptVerificationPool(2, 10.0, 4)
+    try:
+        assert await pool.verify_utxo_spend_async(spending_tx, 1, incoming_p2ms_output)
+        assert await pool.verify_transaction_inputs_async(spending_tx,
+            [ incoming_p2pk_output, incoming_p2ms_output ]) == [ True, True ]
+        # The wrong spent output for the first input, the script evaluation errors are raised.
+        with pytest.raises(InterpreterError):
+            await pool.verify_transaction_inputs_async(spending_tx,
+                [ incoming_p2ms_output, incoming_p2ms_output ])
+        assert pool.pending_count == 0
+    finally:
+        pool.shutdown()
+
+
+async def test_script_verification_pool_timeout_and_limit() -> None:
+    release_event = threading.Event()
+    def slow_verify_utxo_spend(transaction: Tx, input_index: int, utxo: TxOutput) -> bool:
+        release_event.wait()
+        return True
+
+    spending_tx = Tx(2, [ TxInput(os.urandom(32), 0, Script(), 0xFFFFFFFF),
+        TxInput(os.urandom(32), 0, Script(), 0xFFFFFFFF) ], [], 0)
+    utxo = TxOutput(1000, Script())
+    pool = ScriptVerificationPool(1, 0.05, 2)
+    try:
+        with unittest.mock.patch("esv_reference_server.blockchain._evaluate_utxo_spend",
+                slow_verify_utxo_spend):
+            # A timed out evaluation is considered to have failed.
+            assert not await pool.verify_utxo_spend_async(spending_tx, 0, utxo)
+            # It is still running in the worker thread and still counts towards the limit.
+            assert pool.pending_count == 1
+            with pytest.raises(ScriptVerificationQueueFullError):
+                await pool.verify_transaction_inputs_async(spending_tx, [ utxo, utxo ])
+            assert pool.pending_count == 1
+
+            release_event.set()
+            for i in range(100):
+                if pool.pending_count == 0:
+                    break
+                await asyncio.sleep(0.01)
+            assert pool.pending_count == 0
+    finally:
+        # Ensure the worker thread is not left blocked, or the test process will not exit.
+        release_event.set()
+        pool.shutdown()
+
+
+def test_script_verification_key() -> None:
+    utxo_1 = TxOutput(1000, P2PK_Output(PUBLIC_KEY_1, Bitcoin).to_script())
+    utxo_2 = TxOutput(1000, P2PK_Output(PUBLIC_KEY_2, Bitcoin).to_script())
+    input_1 = TxInput(os.urandom(32), 0, Script() << b"signature 1", 0xFFFFFFFF)
+    input_2 = TxInput(os.urandom(32), 0, Script(), 0xFFFFFFFF)
+    output = TxOutput(1900, P2PK_Output(PUBLIC_KEY_3, Bitcoin).to_script())
+    transaction = Tx(2, [ input_1, input_2 ], [ output ], 0)
+
+    key = get_script_verification_key(transaction, 0, utxo_1)
+    assert key != get_script_verification_key(transaction, 1, utxo_1)
+    assert key != get_script_verification_key(transaction, 0, utxo_2)
+    # Signing another input does not affect whether this input is valid.
+    input_2.script_sig = Script() << b"signature 2"
+    assert key == get_script_verification_key(transaction, 0, utxo_1)
+    # Changes to anything this input signs or provides do.
+    input_1.script_sig = Script() << b"signature 3"
+    assert key != get_script_verification_key(transaction, 0, utxo_1)
+    input_1.script_sig = Script() << b"signature 1"
+    transaction.locktime = 100
+    assert key != get_script_verification_key(transaction, 0, utxo_1)
+
+
+def test_script_verification_cache_eviction() -> None:
+    cache = ScriptVerificationCache(2)
+    cache.add(b"1")
+    cache.add(b"2")
+    # Using the oldest entry makes the other entry the least recently used.
+    assert cache.contains(b"1")
+    cache.add(b"3")
+    assert len(cache) == 2
+    assert cache.contains(b"1")
+    assert not cache.contains(b"2")
+    assert cache.contains(b"3")
+
+
+def test_verify_utxo_spend_cached() -> None:
+    incoming_p2pk = P2PK_Output(PUBLIC_KEY_1, Bitcoin)
+    incoming_output = TxOutput(1000, incoming_p2pk.to_script())
+    outgoing_input = TxInput(os.urandom(32), 0, Script(), 0xFFFFFFFF)
+    outgoing_output = TxOutput(900, P2PK_Output(PUBLIC_KEY_2, Bitcoin).to_script())
+    spending_tx = Tx(2, [outgoing_input], [outgoing_output], 0)
+    signature_bytes = _sign_contract_transaction_input(spending_tx, incoming_p2pk.to_script_bytes(),
+        1000, PRIVATE_KEY_1)
+
+    with unittest.mock.patch("esv_reference_server.blockchain._evaluate_utxo_spend",
+            wraps=blockchain._evaluate_utxo_spend) as evaluate_mock:
+        # Failed evaluations are not cached.
+        for i in range(2):
+            with pytest.raises(InterpreterError):
+                verify_utxo_spend(spending_tx, 0, incoming_output)
+        assert evaluate_mock.call_count == 2
+
+        outgoing_input.script_sig = Script() << signature_bytes
+        assert verify_utxo_spend(spending_tx, 0, incoming_output)
+        assert verify_utxo_spend(spending_tx, 0, incoming_output)
+        assert evaluate_mock.call_count == 3
@@ -1,5 +1,4 @@
 import asyncio
-import hashlib
 from http import HTTPStatus
 import os
 import random
@@ -10,7 +9,9 @@ import aiohttp
 from bitcoinx import PrivateKey, PublicKey
 import pytest
 
-from esv_reference_server.constants import IndexerPushdataRegistrationFlag, OutboundDataFlag
+from esv_reference_server.account_outbox import AccountOutbox, MAXIMUM_WORKER_PROCESSES
+from esv_reference_server.constants import AccountFlag, AccountMessageKind, \
+    IndexerPushdataRegistrationFlag, OutboundDataFlag
 from esv_reference_server.application_state import ApplicationState
 from esv_reference_server import sqlite_db
 from esv_reference_server.sqlite_db import create_account, \
@@ -163,29 +164,24 @@ async def test_outbound_data_and_logs(request_mock: unittest.mock.Mock,
     time_mock.side_effect = lambda *args: current_time
 
     data_creation_rows = list[OutboundDataRow]()
-    log_creation_rows_by_key = dict[tuple[int, bytes], OutboundDataLogRow]()
+    log_creation_rows = list[OutboundDataLogRow]()
 
     for row_index in range(30):
         outbound_data_bytes = "".join(chr(random.randrange(32, 90)) for i in range(2048)).encode()
 
-        hasher = hashlib.blake2b(digest_size=20)
-        hasher.update(outbound_data_bytes)
-        outbound_data_hash = hasher.digest()
-
         account_id = account_ids[row_index % len(account_ids)]
         content_type = random.choice([ "application/json", "application/octet-stream" ])
         current_time += 1.0
         data_creation_row = OutboundDataRow(None, account_id, outbound_data_bytes,
-            outbound_data_hash, OutboundDataFlag.TIP_FILTER_NOTIFICATIONS,
-            content_type, int(current_time))
+            OutboundDataFlag.TIP_FILTER_NOTIFICATIONS, content_type, int(current_time))
         data_creation_rows.append(data_creation_row)
 
-        log_creation_rows_by_key[(account_id, outbound_data_hash)] = \
-            OutboundDataLogRow(account_id, None, data_creation_row.outbound_data_flags,
-                HTTPStatus.BAD_REQUEST, "Fake reason", int(current_time))
+        log_creation_rows.append(OutboundDataLogRow(account_id, None,
+            data_creation_row.outbound_data_flags, HTTPStatus.BAD_REQUEST, "Fake reason",
+            int(current_time)))
 
     await application_state.database_context.run_in_thread_async(
-        sqlite_db.create_outbound_datas_write, data_creation_rows, log_creation_rows_by_key)
+        sqlite_db.create_outbound_datas_write, data_creation_rows, log_creation_rows)
 
     # Find all the rows that have zeroed flags, there are none, we always set flags above.
     pending_rows_1 = sqlite_db.read_pending_outbound_datas(application_state.database_context,
@@ -198,11 +194,16 @@ async def test_outbound_data_and_logs(request_mock: unittest.mock.Mock,
     assert len(pending_rows_2) == len(data_creation_rows)
 
     # Check that the created log rows get the correct outbound data table foreign key value.
-    # These are assigned by matching the hash (which is necessary because SQLite does not return
-    # ids in the order the insertion rows were passed in).
+    # These are assigned by position, and the pending rows are only found by joining on the logs.
     pending_ids_2 = set(row.outbound_data_id for row in pending_rows_2
         if row.outbound_data_id is not None)
     assert len(pending_ids_2) == len(data_creation_rows)
+    data_creation_rows_by_data = { row.outbound_data: row for row in data_creation_rows }
+    for pending_row in pending_rows_2:
+        data_creation_row = data_creation_rows_by_data[pending_row.outbound_data]
+        assert pending_row.account_id == data_creation_row.account_id
+        assert pending_row.content_type == data_creation_row.content_type
+        assert pending_row.date_created == data_creation_row.date_created
 
     update_rows = list[tuple[OutboundDataFlag, int]]()
     non_updated_ids = pending_ids_2.copy()
@@ -410,3 +411,102 @@ async def test_outbound_data_and_logs(request_mock: unittest.mock.Mock,
         if data_row.outbound_data_id == new_log_rows[0].outbound_data_id ]
     assert len(final_rows) == 1
 
+
+async def test_account_api_key_cache() -> None:
+    assert ApplicationState.singleton_reference is not None
+    application_state = ApplicationState.singleton_reference()
+    assert application_state is not None
+
+    account_id, api_key = await application_state.database_context.run_in_thread_async(
+        create_account, PUBLIC_KEY_1.to_bytes(compressed=True))
+    assert application_state.get_account_id_for_api_key(api_key) == (account_id, AccountFlag.NONE)
+
+    # Cached lookups do not touch the database.
+    with unittest.mock.patch("esv_reference_server.sqlite_db.get_account_id_for_api_key") \
+            as get_mock:
+        assert application_state.get_account_id_for_api_key(api_key) == \
+            (account_id, AccountFlag.NONE)
+        assert get_mock.call_count == 0
+
+    # Deactivating the account invalidates the cached key.
+    await application_state.deactivate_account_async(account_id, AccountFlag.DISABLED_FLAGGED)
+    assert application_state.get_account_id_for_api_key(api_key) == (None, AccountFlag.NONE)
+
+
+async def test_account_outbox_spill() -> None:
+    assert ApplicationState.singleton_reference is not None
+    application_state = ApplicationState.singleton_reference()
+    assert application_state is not None
+
+    # A worker index that the server does not use.
+    account_outbox = AccountOutbox(application_state.database_context, 99, 4, 10)
+    account_id = 1
+    assert await account_outbox.add_async(account_id, AccountMessageKind.SPENT_OUTPUT_EVENT,
+        b"ignored") is None
+    await account_outbox.enable_async(account_id)
+
+    message_ids: list[int] = []
+    for i in range(20):
+        message_id = await account_outbox.add_async(account_id,
+            AccountMessageKind.SPENT_OUTPUT_EVENT, bytes([ i ]))
+        assert message_id is not None
+        message_ids.append(message_id)
+        if i == 4:
+            # Adding a message does not wait for the oldest ones to be written to the database,
+            # and they can still be read while they are.
+            assert account_outbox._accounts[account_id].spill_count == 1
+            assert [ entry.message for entry in account_outbox.read(account_id, 0, 100) ] == \
+                [ bytes([ i ]) for i in range(5) ]
+        await account_outbox.wait_for_writes_async()
+    assert message_ids == sorted(set(message_ids))
+    # The ids are exact for clients that read JSON numbers as doubles.
+    assert all(message_id < 2 ** 53 for message_id in message_ids)
+    # The message ids are those of this worker process, and not those of another one.
+    assert all(account_outbox.is_own_message_id(message_id) for message_id in message_ids)
+    assert account_outbox.is_own_message_id(0)
+    assert not AccountOutbox(application_state.database_context, 98, 4, 10) \
+        .is_own_message_id(message_ids[0])
+    with pytest.raises(ValueError):
+        AccountOutbox(application_state.database_context, MAXIMUM_WORKER_PROCESSES, 4, 10)
+
+    # The oldest messages were spilled to the database and then dropped as it was full.
+    entries = account_outbox.read(account_id, 0, 100)
+    assert [ entry.message for entry in entries ] == [ bytes([ i ]) for i in range(10, 20) ]
+    assert [ entry.message_id for entry in entries ] == message_ids[10:]
+    assert account_outbox.get_dropped_id(account_id) == message_ids[9]
+    # The spilled messages are read before the ones in memory a page at a time.
+    assert account_outbox.read(account_id, message_ids[10], 3) == entries[1:4]
+
+    await account_outbox.acknowledge_async(account_id, message_ids[14])
+    assert account_outbox.read(account_id, 0, 100) == entries[5:]
+
+    # Peer channel notifications are compacted to the last one for each channel.
+    for channel_id, sequence in (("a", 1), ("b", 1), ("a", 2)):
+        await account_outbox.add_async(account_id, AccountMessageKind.PEER_CHANNEL_MESSAGE,
+            { "channel_id": channel_id, "sequence": sequence })
+    await account_outbox.wait_for_writes_async()
+    assert [ entry.message for entry in account_outbox.read(account_id, message_ids[-1], 100) ] \
+        == [ { "channel_id": "b", "sequence": 1 }, { "channel_id": "a", "sequence": 2 } ]
+
+    # The messages in memory are kept when the server exits.
+    entries = account_outbox.read(account_id, 0, 100)
+    await account_outbox.flush_async()
+    account_outbox = AccountOutbox(application_state.database_context, 99, 4, 10)
+    account_outbox.load()
+    assert account_outbox.read(account_id, 0, 100) == entries
+    assert account_outbox.get_acknowledged_id(account_id) == message_ids[14]
+    assert account_outbox.get_last_id(account_id) == entries[-1].message_id
+
+    # The ids of messages that were lost when the server exited uncleanly are not used again.
+    lost_message_id = await account_outbox.add_async(account_id,
+        AccountMessageKind.SPENT_OUTPUT_EVENT, b"lost")
+    assert lost_message_id is not None and lost_message_id > entries[-1].message_id
+    await account_outbox.wait_for_writes_async()
+    account_outbox = AccountOutbox(application_state.database_context, 99, 4, 10)
+    account_outbox.load()
+    assert account_outbox.read(account_id, 0, 100) == entries
+    message_id = await account_outbox.add_async(account_id,
+        AccountMessageKind.SPENT_OUTPUT_EVENT, b"kept")
+    assert message_id is not None and message_id > lost_message_id
+    assert account_outbox.is_own_message_id(message_id)
+    await account_outbox.wait_for_writes_async()
@@ -0,0 +1,34 @@
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request, TestServer
+
+from esv_reference_server.handlers_indexer import mirrored_indexer_call_async
+
+
+async def test_mirrored_indexer_call_json() -> None:
+    indexer_requests: list[bytes] = []
+
+    async def indexer_post_transaction_filter(request: web.Request) -> web.Response:
+        indexer_requests.append(await request.read())
+        return web.json_response({ "dateCreated": "2022-01-01T00:00:00Z" })
+
+    indexer_application = web.Application()
+    indexer_application.router.add_post("/api/v1/transaction/filter",
+        indexer_post_transaction_filter)
+    async with TestServer(indexer_application) as indexer_server, \
+            aiohttp.ClientSession() as client_session:
+        app_state = SimpleNamespace(indexer_is_connected=True,
+            indexer_url=str(indexer_server.make_url("")).rstrip("/"),
+            get_aiohttp_session=lambda: client_session)
+        request = make_mocked_request("POST", "/api/v1/transaction/filter",
+            headers={ "Accept": "application/json", "Content-Type": "application/json" },
+            app={ "app_state": app_state })
+
+        # The already encoded indexer response is passed through as JSON.
+        response = await mirrored_indexer_call_async(request, body=b'{"key": "value"}')
+        assert response.status == 200
+        assert response.content_type == "application/json"
+        assert response.body == b'{"dateCreated": "2022-01-01T00:00:00Z"}'
+        assert indexer_requests == [ b'{"key": "value"}' ]
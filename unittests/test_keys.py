@@ -37,10 +37,13 @@
 
 from datetime import datetime
 import os
+import unittest.mock
 
 from bitcoinx import PrivateKey
 
-from esv_reference_server.keys import VerifiableKeyDataDict, verify_key_data
+from esv_reference_server import keys
+from esv_reference_server.keys import VerifiableKeyDataDict, verify_key_data, \
+    verify_key_data_async
 
 
 CLIENT_IDENTITY_PRIVATE_KEY_HEX = "d468816bc0f78465d4833426c280166c3810ecc9c0350c5232b0c417687fbde6"
@@ -78,3 +81,18 @@ def test_verify_key_data_incorrect_message() -> None:
     key_data["message_hex"] = os.urandom(32).hex()
     assert not verify_key_data(key_data)
 
+async def test_verify_key_data_async_cached() -> None:
+    # Check that repeated verification of the same key data only verifies the signature once.
+    key_data = _generate_client_key_data()
+    with unittest.mock.patch("esv_reference_server.keys._verify_and_cache_key_data",
+            wraps=keys._verify_and_cache_key_data) as verify_mock:
+        assert await verify_key_data_async(key_data)
+        assert await verify_key_data_async(key_data)
+        assert verify_key_data(key_data)
+        assert verify_mock.call_count == 1
+
+        # Failed verifications are not cached.
+        key_data["message_hex"] = os.urandom(32).hex()
+        assert not await verify_key_data_async(key_data)
+        assert not await verify_key_data_async(key_data)
+        assert verify_mock.call_count == 3
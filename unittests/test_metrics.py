@@ -0,0 +1,80 @@
+import os
+
+import requests
+
+from esv_reference_server.application_state import ApplicationState
+from esv_reference_server import sqlite_db
+from esv_reference_server.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+from unittests.conftest import TEST_EXTERNAL_HOST, TEST_EXTERNAL_PORT, TEST_INTERNAL_HOST, \
+    TEST_INTERNAL_PORT
+
+
+def test_metrics_rendering() -> None:
+    registry = MetricsRegistry()
+    counter = Counter("test_events_total", "Events", ("kind",))
+    gauge = Gauge("test_queue_length", "Queue length")
+    histogram = Histogram("test_duration_seconds", "Duration", ("name",), buckets=(0.1, 1.0))
+    for metric in (counter, gauge, histogram):
+        registry.register(metric)
+
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    counter.inc("b\"")
+    gauge.set_function(lambda: 7)
+    histogram.observe(0.05, "x")
+    histogram.observe(0.5, "x")
+    histogram.observe(5.0, "x")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_events_total counter" in lines
+    assert 'test_events_total{kind="a"} 3' in lines
+    assert 'test_events_total{kind="b\\""} 1' in lines
+    assert "test_queue_length 7" in lines
+    assert "# TYPE test_duration_seconds histogram" in lines
+    assert 'test_duration_seconds_bucket{name="x",le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{name="x",le="1.0"} 2' in lines
+    assert 'test_duration_seconds_bucket{name="x",le="+Inf"} 3' in lines
+    assert 'test_duration_seconds_count{name="x"} 3' in lines
+    assert 'test_duration_seconds_sum{name="x"} 5.55' in lines
+
+
+def test_metrics_endpoint() -> None:
+    result = requests.get(f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/")
+    assert result.status_code == 200
+
+    result = requests.get(f"http://{TEST_INTERNAL_HOST}:{TEST_INTERNAL_PORT}/metrics")
+    assert result.status_code == 200
+    assert result.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    assert 'esv_http_request_duration_seconds_count{route="/",method="GET",status="200"}' \
+        in result.text
+    assert "esv_msgbox_notification_queue_length 0" in result.text
+    assert "esv_database_call_duration_seconds_count" in result.text
+
+
+def test_slow_request_breakdown(run_server: ApplicationState) -> None:
+    _account_id, api_key = run_server.database_context.run_in_thread(sqlite_db.create_account,
+        os.urandom(33))
+    recorder = run_server.slow_request_recorder
+    threshold_seconds = recorder.threshold_seconds
+    recorder.threshold_seconds = 0
+    try:
+        result = requests.get(f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}"
+            "/api/v1/channel/manage/list", headers={ "Authorization": f"Bearer {api_key}" })
+        assert result.status_code == 200
+    finally:
+        recorder.threshold_seconds = threshold_seconds
+
+    result = requests.get(f"http://{TEST_INTERNAL_HOST}:{TEST_INTERNAL_PORT}/slow-requests")
+    assert result.status_code == 200
+    entries = [ entry for entry in result.json()
+        if entry["route"] == "/api/v1/channel/manage/list" ]
+    assert len(entries) == 1
+    entry = entries[0]
+    assert entry["method"] == "GET"
+    assert entry["status"] == 200
+    # The account lookup and the channel list.
+    assert entry["database_calls"] == 2
+    assert 0 < entry["database_ms"] <= entry["duration_ms"]
+    assert entry["upstream_calls"] == 0
+    assert entry["json_ms"] > 0
@@ -0,0 +1,418 @@
+import asyncio
+import os
+from pathlib import Path
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, NamedTuple, Optional
+import unittest.mock
+
+from electrumsv_database.sqlite import DatabaseContext
+import pytest
+
+try:
+    # Linux expects the latest package version of 3.35.4 (as of pysqlite-binary 0.4.6)
+    import pysqlite3 as sqlite3
+except ModuleNotFoundError:
+    # MacOS has latest brew version of 3.35.5 (as of 2021-06-20).
+    # Windows builds use the official Python 3.10.0 builds and bundled version of 3.35.5.
+    import sqlite3
+
+from esv_reference_server.constants import DEFAULT_DATABASE_NAME, MessageBoxTokenFlag
+from esv_reference_server.errors import APIErrors
+from esv_reference_server.msg_box.blob_store import get_payload_blob_store_path, \
+    PayloadBlobStore
+from esv_reference_server.msg_box.models import Message, MsgBox, MsgBoxHead
+from esv_reference_server.msg_box.repositories import MsgBoxRepository, MsgBoxSQLiteRepository, \
+    PeerChannelMessageWriteError
+from esv_reference_server.msg_box.repositories_sharded import MsgBoxShardedSQLiteRepository, \
+    SHARD_ID_SHIFT
+from esv_reference_server.msg_box.view_models import MsgBoxViewModelAmend, \
+    MsgBoxViewModelCreate, RetentionViewModel
+from esv_reference_server import sqlite_db
+
+
+# The PostgreSQL tests are only run if a database is provided for them, see
+# `contrib/docker-compose-postgres.yml`. Tables are created in it if they do not exist, but it
+# is never reset.
+POSTGRES_TEST_DATABASE_URL = os.getenv("PEER_CHANNELS_TEST_DATABASE_URL")
+
+MESSAGE_COUNT = 20
+
+
+class SQLiteRepositoryState(NamedTuple):
+    database_context: DatabaseContext
+    repository: MsgBoxSQLiteRepository
+    blob_store: Optional[PayloadBlobStore]
+    account_id: int
+
+
+CreateSQLiteRepository = Callable[[Optional[int]], Awaitable[SQLiteRepositoryState]]
+
+
+@pytest.fixture
+async def create_sqlite_repository(tmp_path: Path) -> AsyncIterator[CreateSQLiteRepository]:
+    """
+    Create a repository with an account in a new database, storing payloads larger than the
+    given size in files if one is given. This is not the database used by the server, as other
+    tests expect the row ids there.
+    """
+    database_contexts: list[DatabaseContext] = []
+
+    async def create_async(payload_file_threshold: Optional[int]=None) \
+            -> SQLiteRepositoryState:
+        datastore_location = tmp_path / DEFAULT_DATABASE_NAME
+        database_context = DatabaseContext(str(datastore_location))
+        database_contexts.append(database_context)
+        blob_store = PayloadBlobStore(get_payload_blob_store_path(datastore_location),
+            payload_file_threshold) if payload_file_threshold is not None else None
+        repository = MsgBoxSQLiteRepository(database_context, blob_store=blob_store)
+        def setup(db: Optional[sqlite3.Connection]=None) -> tuple[int, str]:
+            sqlite_db.setup(db)
+            repository.create_tables(db)
+            return sqlite_db.create_account(os.urandom(33), db)
+        account_id, _api_key = await database_context.run_in_thread_async(setup)
+        return SQLiteRepositoryState(database_context, repository, blob_store, account_id)
+
+    yield create_async
+    for database_context in database_contexts:
+        database_context.close()
+
+
+async def _check_concurrent_writes_async(repository: MsgBoxRepository, account_id: int) -> None:
+    msg_box = await repository.create_message_box_async(MsgBoxViewModelCreate(public_read=True,
+        public_write=True, sequenced=False, retention=RetentionViewModel(min_age_days=0,
+            max_age_days=0, auto_prune=True)), account_id)
+    token_row = msg_box.api_tokens[0]
+
+    def create_message(index: int) -> Message:
+        return Message(msg_box_id=msg_box.id, msg_box_api_token_id=token_row.id,
+            content_type="application/octet-stream", payload=index.to_bytes(4, "big"),
+            received_ts=int(time.time()))
+
+    message_rows = await asyncio.gather(*(repository.write_message_async(create_message(i))
+        for i in range(MESSAGE_COUNT)))
+    # Each write is given the next sequence number, without gaps or duplicates.
+    assert sorted(row.sequence for row in message_rows) == list(range(1, MESSAGE_COUNT+1))
+
+    stored_rows, _max_sequence = await repository.get_messages_async(token_row.id, False)
+    assert [ row.sequence for row in stored_rows ] == list(range(1, MESSAGE_COUNT+1))
+    assert { row.payload_bytes for row in stored_rows } == \
+        { i.to_bytes(4, "big") for i in range(MESSAGE_COUNT) }
+
+    msg_box2 = await repository.get_msg_box_async(account_id, msg_box.external_id)
+    assert msg_box2 is not None
+    assert msg_box2.head_message_sequence == MESSAGE_COUNT
+
+    await repository.update_msg_box_async(MsgBoxViewModelAmend(public_read=True,
+        public_write=True, locked=True), msg_box.external_id)
+    with pytest.raises(PeerChannelMessageWriteError) as exc_info:
+        await repository.write_message_async(create_message(MESSAGE_COUNT))
+    assert exc_info.value.code == APIErrors.CHANNEL_LOCKED
+
+    assert await repository.delete_msg_box_async(msg_box.external_id)
+    assert await repository.get_msg_box_async(account_id, msg_box.external_id) is None
+
+
+async def _check_read_cursors_async(repository: MsgBoxRepository, account_id: int) -> None:
+    msg_box = await repository.create_message_box_async(MsgBoxViewModelCreate(public_read=True,
+        public_write=True, sequenced=False, retention=RetentionViewModel(min_age_days=0,
+            max_age_days=0, auto_prune=True)), account_id)
+    owner_token_id = msg_box.api_tokens[0].id
+
+    async def write_message(token_id: int) -> int:
+        message_row = await repository.write_message_async(Message(msg_box_id=msg_box.id,
+            msg_box_api_token_id=token_id, content_type="application/octet-stream",
+            payload=b"", received_ts=int(time.time())))
+        return message_row.sequence
+
+    async def get_sequences(token_id: int, onlyunread: bool) -> list[int]:
+        message_rows, _max_sequence = await repository.get_messages_async(token_id, onlyunread)
+        return [ message_row.sequence for message_row in message_rows ]
+
+    for i in range(3):
+        await write_message(owner_token_id)
+    # A token only receives the messages written after it is created.
+    token_view = await repository.create_api_token_async("reader",
+        MessageBoxTokenFlag.READ_ACCESS | MessageBoxTokenFlag.WRITE_ACCESS, msg_box.id,
+        account_id)
+    assert token_view is not None
+    token_id = token_view.id
+    assert await get_sequences(token_id, False) == []
+    assert not await repository.sequence_exists_async(token_id, 3)
+    for i in range(3):
+        await write_message(owner_token_id)
+    assert await get_sequences(token_id, True) == [ 4, 5, 6 ]
+    # The writer has read the messages it wrote.
+    assert await get_sequences(owner_token_id, True) == []
+
+    await repository.mark_messages_async(msg_box.external_id, token_id, 5, False, True)
+    assert await get_sequences(token_id, True) == [ 4, 6 ]
+    await repository.mark_messages_async(msg_box.external_id, token_id, 4, False, True)
+    assert await get_sequences(token_id, True) == [ 6 ]
+    await repository.mark_messages_async(msg_box.external_id, token_id, 6, True, True)
+    assert await get_sequences(token_id, True) == []
+    await repository.mark_messages_async(msg_box.external_id, token_id, 5, True, False)
+    assert await get_sequences(token_id, True) == [ 4, 5 ]
+    await repository.mark_messages_async(msg_box.external_id, token_id, 4, False, True)
+    assert await get_sequences(token_id, True) == [ 5 ]
+    await repository.mark_messages_async(msg_box.external_id, token_id, 6, False, False)
+    assert await get_sequences(token_id, True) == [ 5, 6 ]
+    assert await get_sequences(token_id, False) == [ 4, 5, 6 ]
+    # Websockets that reconnect read the messages after the last one they were notified of.
+    message_rows, _max_sequence = await repository.get_messages_async(token_id, False, 4)
+    assert [ message_row.sequence for message_row in message_rows ] == [ 5, 6 ]
+    message_rows, _max_sequence = await repository.get_messages_async(token_id, True, 5)
+    assert [ message_row.sequence for message_row in message_rows ] == [ 6 ]
+    message_rows, _max_sequence = await repository.get_messages_async(token_id, False, 0, 2)
+    assert [ message_row.sequence for message_row in message_rows ] == [ 4, 5 ]
+    # They are only notified of the messages, without reading the payloads.
+    notification_rows = await repository.get_message_notifications_async(token_id, 0, 2)
+    assert [ row.sequence for row in notification_rows ] == [ 4, 5 ]
+    assert notification_rows[0].content_type == "application/octet-stream"
+    notification_rows = await repository.get_message_notifications_async(token_id, 5, 2)
+    assert [ row.sequence for row in notification_rows ] == [ 6 ]
+    # Unsequenced channels do not give the latest sequence.
+    assert await repository.get_messages_version_async(token_id) == (None, 6)
+
+    # A message is kept until every token that received it has deleted it.
+    metadata = await repository.get_message_metadata_async(msg_box.external_id, 5)
+    assert metadata is not None
+    assert await repository.delete_message_async(metadata.id, token_id) == 1
+    assert await get_sequences(token_id, True) == [ 6 ]
+    assert await get_sequences(owner_token_id, False) == [ 1, 2, 3, 4, 5, 6 ]
+    assert await repository.get_message_metadata_async(msg_box.external_id, 5) is not None
+    assert await repository.delete_message_async(metadata.id, owner_token_id) == 1
+    assert await repository.get_message_metadata_async(msg_box.external_id, 5) is None
+    # Messages written before the token was created are not the token's to delete.
+    metadata = await repository.get_message_metadata_async(msg_box.external_id, 1)
+    assert metadata is not None
+    assert await repository.delete_message_async(metadata.id, token_id) == 0
+
+    # A revoked token does not receive the messages written after it.
+    await repository.delete_api_token_async(token_id)
+    assert await write_message(owner_token_id) == 7
+    assert await repository.sequence_exists_async(token_id, 6)
+    assert not await repository.sequence_exists_async(token_id, 7)
+    assert await get_sequences(token_id, False) == [ 4, 6 ]
+    notification_rows = await repository.get_message_notifications_async(token_id, 0, 10)
+    assert [ row.sequence for row in notification_rows ] == [ 4, 6 ]
+
+    # In a sequenced channel a token can only write when it has read every message.
+    sequenced_msg_box = await repository.create_message_box_async(MsgBoxViewModelCreate(
+        public_read=True, public_write=True, sequenced=True, retention=RetentionViewModel(
+            min_age_days=0, max_age_days=0, auto_prune=True)), account_id)
+    token_view = await repository.create_api_token_async("writer",
+        MessageBoxTokenFlag.READ_ACCESS | MessageBoxTokenFlag.WRITE_ACCESS,
+        sequenced_msg_box.id, account_id)
+    assert token_view is not None
+
+    def create_message(token_id: int) -> Message:
+        return Message(msg_box_id=sequenced_msg_box.id, msg_box_api_token_id=token_id,
+            content_type="application/octet-stream", payload=b"",
+            received_ts=int(time.time()))
+
+    await repository.write_message_async(create_message(sequenced_msg_box.api_tokens[0].id))
+    with pytest.raises(PeerChannelMessageWriteError) as exc_info:
+        await repository.write_message_async(create_message(token_view.id))
+    assert exc_info.value.code == APIErrors.SEQUENCING_FAILURE
+    await repository.mark_messages_async(sequenced_msg_box.external_id, token_view.id, 1,
+        True, True)
+    message_row = await repository.write_message_async(create_message(token_view.id))
+    assert message_row.sequence == 2
+    assert await repository.get_messages_version_async(token_view.id) == (2, 1)
+    assert await repository.get_msg_box_head_async(sequenced_msg_box.external_id) == \
+        MsgBoxHead(True, 2, token_view.id, 1)
+    assert await repository.get_msg_box_head_async(msg_box.external_id) == \
+        MsgBoxHead(False, 0, None, 0)
+    assert await repository.get_msg_box_head_async("unknown") is None
+
+    assert await repository.delete_msg_box_async(msg_box.external_id)
+    assert await repository.delete_msg_box_async(sequenced_msg_box.external_id)
+
+
+async def test_sqlite_repository_concurrent_writes(
+        create_sqlite_repository: CreateSQLiteRepository) -> None:
+    state = await create_sqlite_repository(None)
+    await _check_concurrent_writes_async(state.repository, state.account_id)
+
+
+async def test_sqlite_repository_read_cursors(
+        create_sqlite_repository: CreateSQLiteRepository) -> None:
+    state = await create_sqlite_repository(None)
+    await _check_read_cursors_async(state.repository, state.account_id)
+
+
+async def test_sqlite_repository_message_status_migration(
+        create_sqlite_repository: CreateSQLiteRepository) -> None:
+    database_context, repository, _blob_store, account_id = \
+        await create_sqlite_repository(None)
+
+    # Channel 1 has messages 1-6. The owner token 1 wrote them all. Token 2 was created after
+    # message 2, has read 3 and 5 and deleted 4. Token 3 received 1-4 before it was revoked and
+    # has read them all.
+    def create_legacy_rows(db: Optional[sqlite3.Connection]=None) -> None:
+        assert db is not None
+        db.execute("INSERT INTO msg_box (id, account_id, externalid, publicread, publicwrite, "
+            "locked, sequenced, minagedays, maxagedays, autoprune) "
+            "VALUES (1, ?, 'channel', 1, 1, 0, 0, 0, 0, 1)", (account_id,))
+        flags = MessageBoxTokenFlag.READ_ACCESS | MessageBoxTokenFlag.WRITE_ACCESS
+        db.executemany("INSERT INTO msg_box_api_token (id, account_id, msg_box_id, token, "
+            "description, flags, validfrom, validto) VALUES (?, ?, 1, ?, '', ?, 0, ?)",
+            [ (1, account_id, "token1", flags, None), (2, account_id, "token2", flags, None),
+              (3, account_id, "token3", flags, 1) ])
+        db.executemany("INSERT INTO message (id, fromtoken, msg_box_id, seq, receivedts, "
+            "contenttype, payload) VALUES (?, 1, 1, ?, 0, 'text/plain', x'')",
+            [ (seq, seq) for seq in range(1, 7) ])
+        db.execute("""
+            CREATE TABLE message_status (
+                id            INTEGER            PRIMARY KEY,
+                message_id    BIGINT             NOT NULL,
+                token_id      BIGINT             NOT NULL,
+                isread        INTEGER            NOT NULL,
+                isdeleted     INTEGER            NOT NULL
+            )""")
+        db.executemany("INSERT INTO message_status (message_id, token_id, isread, isdeleted) "
+            "VALUES (?, ?, ?, ?)",
+            [ (seq, 1, 1, 0) for seq in range(1, 7) ] +
+            [ (3, 2, 1, 0), (4, 2, 0, 1), (5, 2, 1, 0), (6, 2, 0, 0) ] +
+            [ (seq, 3, 1, 0) for seq in range(1, 5) ])
+        # The next startup finds the legacy table and migrates it.
+        repository.create_tables(db)
+
+    async def get_sequences(token_id: int, onlyunread: bool) -> list[int]:
+        message_rows, _max_sequence = await repository.get_messages_async(token_id, onlyunread)
+        return [ message_row.sequence for message_row in message_rows ]
+
+    await database_context.run_in_thread_async(create_legacy_rows)
+    assert await get_sequences(1, False) == [ 1, 2, 3, 4, 5, 6 ]
+    assert await get_sequences(1, True) == []
+    assert await get_sequences(2, False) == [ 3, 5, 6 ]
+    assert await get_sequences(2, True) == [ 6 ]
+    assert await get_sequences(3, False) == [ 1, 2, 3, 4 ]
+    assert await get_sequences(3, True) == []
+
+
+async def test_sqlite_repository_payload_files(
+        create_sqlite_repository: CreateSQLiteRepository) -> None:
+    database_context, repository, blob_store, account_id = \
+        await create_sqlite_repository(100)
+    assert blob_store is not None
+
+    def get_stored_hashes() -> set[str]:
+        return set(blob_store.iter_hashes(0))
+
+    view = MsgBoxViewModelCreate(public_read=True, public_write=True, sequenced=False,
+        retention=RetentionViewModel(min_age_days=0, max_age_days=0, auto_prune=True))
+    msg_box1 = await repository.create_message_box_async(view, account_id)
+    msg_box2 = await repository.create_message_box_async(view, account_id)
+    small_payload = os.urandom(100)
+    large_payload = os.urandom(101)
+
+    def create_message(msg_box: MsgBox, payload: bytes) -> Message:
+        return Message(msg_box_id=msg_box.id, msg_box_api_token_id=msg_box.api_tokens[0].id,
+            content_type="application/octet-stream", payload=payload,
+            received_ts=int(time.time()))
+
+    message_row = await repository.write_message_async(create_message(msg_box1,
+        large_payload))
+    assert bytes(message_row.payload_bytes) == large_payload
+    await repository.write_message_async(create_message(msg_box1, small_payload))
+    # The same payload written to another channel is stored once.
+    await repository.write_message_async(create_message(msg_box2, large_payload))
+    assert len(get_stored_hashes()) == 1
+
+    stored_rows, _max_sequence = await repository.get_messages_async(
+        msg_box1.api_tokens[0].id, False)
+    assert [ bytes(row.payload_bytes) for row in stored_rows ] == \
+        [ large_payload, small_payload ]
+
+    # The file is still used by the other channel.
+    assert await repository.delete_msg_box_async(msg_box1.external_id)
+    assert len(get_stored_hashes()) == 1
+
+    # The file is not deleted if the transaction that removes the last reference to it is rolled
+    # back, so that the message can still be read.
+    run_in_thread_async = database_context.run_in_thread_async
+    async def run_in_thread_and_roll_back_async(func: Callable[..., Any], *args: Any) -> Any:
+        def write_and_fail(*args: Any, db: Optional[sqlite3.Connection]=None) -> None:
+            func(*args, db=db)
+            raise sqlite3.OperationalError("database is locked")
+        return await run_in_thread_async(write_and_fail, *args)
+    with unittest.mock.patch.object(database_context, "run_in_thread_async",
+            run_in_thread_and_roll_back_async):
+        with pytest.raises(sqlite3.OperationalError):
+            await repository.delete_message_async(message_row.message_id + 2,
+                msg_box2.api_tokens[0].id)
+    assert len(get_stored_hashes()) == 1
+    stored_rows, _max_sequence = await repository.get_messages_async(
+        msg_box2.api_tokens[0].id, False)
+    assert [ bytes(row.payload_bytes) for row in stored_rows ] == [ large_payload ]
+
+    assert await repository.delete_message_async(message_row.message_id + 2,
+        msg_box2.api_tokens[0].id) == 1
+    assert get_stored_hashes() == set()
+    stored_rows, _max_sequence = await repository.get_messages_async(
+        msg_box2.api_tokens[0].id, False)
+    assert stored_rows == []
+
+
+async def test_sharded_sqlite_repository(tmp_path: Path) -> None:
+    datastore_location = tmp_path / DEFAULT_DATABASE_NAME
+    repository = MsgBoxShardedSQLiteRepository(datastore_location, 3)
+    await repository.setup_async(create_tables=True, reset_tables=False)
+    try:
+        # The accounts are not in the shard databases, so any account id can be used.
+        await _check_concurrent_writes_async(repository, 1)
+
+        view = MsgBoxViewModelCreate(public_read=True, public_write=True, sequenced=False,
+            retention=RetentionViewModel(min_age_days=0, max_age_days=0, auto_prune=True))
+        msg_boxes = [ await repository.create_message_box_async(view, 1) for i in range(3) ]
+        # The shard is in the high bits of the ids of all the rows for the channel.
+        assert { msg_box.id >> SHARD_ID_SHIFT for msg_box in msg_boxes } == { 0, 1, 2 }
+        for msg_box in msg_boxes:
+            assert msg_box.api_tokens[0].id >> SHARD_ID_SHIFT == msg_box.id >> SHARD_ID_SHIFT
+    finally:
+        await repository.close_async()
+
+    # A restarted server does not know which shards the external ids and tokens are in.
+    repository = MsgBoxShardedSQLiteRepository(datastore_location, 3)
+    await repository.setup_async(create_tables=True, reset_tables=False)
+    try:
+        for msg_box in msg_boxes:
+            msg_box2 = await repository.get_msg_box_async(1, msg_box.external_id)
+            assert msg_box2 is not None and msg_box2.id == msg_box.id
+            token_row = await repository.get_api_token_async(msg_box.api_tokens[0].token)
+            assert token_row is not None and token_row.msg_box_id == msg_box.id
+        assert len(await repository.get_msg_boxes_async(1)) == 3
+        # The pages continue across the shards in id order.
+        msg_boxes.sort(key=lambda msg_box: msg_box.id)
+        page = await repository.get_msg_boxes_async(1, msg_boxes[0].id, 1)
+        assert [ msg_box.id for msg_box in page ] == [ msg_boxes[1].id ]
+        page = await repository.get_msg_boxes_async(1, msg_boxes[0].id, 5)
+        assert [ msg_box.id for msg_box in page ] == [ msg_boxes[1].id, msg_boxes[2].id ]
+        assert page[0].api_tokens == msg_boxes[1].api_tokens
+        assert await repository.get_msg_box_async(1, "unknown") is None
+    finally:
+        await repository.close_async()
+
+
+@pytest.fixture
+async def postgres_repository() -> AsyncIterator[MsgBoxRepository]:
+    """
+    The accounts are not in the PostgreSQL database, so any account id can be used with this.
+    """
+    if POSTGRES_TEST_DATABASE_URL is None:
+        pytest.skip("PEER_CHANNELS_TEST_DATABASE_URL is not set")
+    from esv_reference_server.msg_box.repositories_postgres import MsgBoxPostgresRepository
+    repository = MsgBoxPostgresRepository(POSTGRES_TEST_DATABASE_URL, MESSAGE_COUNT)
+    await repository.setup_async(create_tables=True, reset_tables=False)
+    yield repository
+    await repository.close_async()
+
+
+async def test_postgres_repository_concurrent_writes(
+        postgres_repository: MsgBoxRepository) -> None:
+    await _check_concurrent_writes_async(postgres_repository, 1)
+
+
+async def test_postgres_repository_read_cursors(postgres_repository: MsgBoxRepository) -> None:
+    await _check_read_cursors_async(postgres_repository, 1)
@@ -0,0 +1,44 @@
+import asyncio
+from pathlib import Path
+from typing import Any
+
+from esv_reference_server.constants import NotificationBusMessageKind
+from esv_reference_server.notification_bus import NotificationBusClient, \
+    NotificationBusHandler, NotificationBusServer
+
+
+async def test_notification_bus_relays_to_other_workers(tmp_path: Path) -> None:
+    socket_path = tmp_path / "bus.sock"
+    server = NotificationBusServer(socket_path)
+    await server.start_async()
+
+    received: list[list[tuple[NotificationBusMessageKind, Any]]] = [ [], [], [] ]
+    def create_handler(index: int) -> NotificationBusHandler:
+        return lambda kind, message: received[index].append((kind, message))
+    clients = [ NotificationBusClient(socket_path, create_handler(index)) for index in range(3) ]
+    try:
+        for client in clients:
+            await client.connect_async()
+        # Allow the relay to accept all the connections.
+        await asyncio.sleep(0.1)
+
+        notification = { "sequence": 1, "channel_id": "abc" }
+        clients[0].publish(NotificationBusMessageKind.MESSAGE_BOX_NOTIFICATION, [ 5, notification ])
+        clients[2].publish(NotificationBusMessageKind.ACCOUNT_API_KEY_INVALIDATED, "key")
+        for i in range(50):
+            if len(received[1]) == 2:
+                break
+            await asyncio.sleep(0.02)
+
+        assert received[0] == [ (NotificationBusMessageKind.ACCOUNT_API_KEY_INVALIDATED, "key") ]
+        assert received[1] == [
+            (NotificationBusMessageKind.MESSAGE_BOX_NOTIFICATION, [ 5, notification ]),
+            (NotificationBusMessageKind.ACCOUNT_API_KEY_INVALIDATED, "key"),
+        ]
+        assert received[2] == [
+            (NotificationBusMessageKind.MESSAGE_BOX_NOTIFICATION, [ 5, notification ]) ]
+    finally:
+        for client in clients:
+            await client.close_async()
+        await server.stop_async()
+    assert not socket_path.exists()
@@ -0,0 +1,138 @@
+import asyncio
+import tracemalloc
+from typing import Optional
+
+import pytest
+
+from esv_reference_server import metrics
+from esv_reference_server.notification_queue import NotificationQueue, OverflowPolicy
+
+
+def create_notification(channel_index: int, sequence: int) -> tuple[int, dict[str, object]]:
+    return channel_index, { "sequence": sequence, "channel_id": f"channel{channel_index}",
+        "content_type": "application/json", "received": "2022-01-01T00:00:00Z" }
+
+
+async def drain(queue: NotificationQueue[tuple[int, dict[str, object]]]) \
+        -> list[tuple[int, dict[str, object]]]:
+    return [ await queue.get() for i in range(queue.qsize()) ]
+
+
+@pytest.mark.parametrize("overflow_policy", [ "drop_oldest", "block", "coalesce" ])
+async def test_notification_queue_memory_flat_when_consumer_stalls(
+        overflow_policy: OverflowPolicy) -> None:
+    queue = NotificationQueue[tuple[int, dict[str, object]]](f"stress_{overflow_policy}", 100,
+        overflow_policy, lambda entry: entry[0])
+
+    # Nothing is read from the queue while a burst of notifications for many channels is
+    # written to it by producers that cannot wait.
+    tracemalloc.start()
+    try:
+        allocated_sizes: list[int] = []
+        for burst_index in range(5):
+            for sequence in range(burst_index * 20000, (burst_index + 1) * 20000):
+                queue.put_nowait(create_notification(sequence % 500, sequence))
+            allocated_sizes.append(tracemalloc.get_traced_memory()[0])
+    finally:
+        tracemalloc.stop()
+
+    assert queue.qsize() == 100
+    assert queue.high_water_mark == 100
+    assert queue.dropped_count + queue.coalesced_count == 5 * 20000 - 100
+    assert max(allocated_sizes) - min(allocated_sizes) < 100 * 1024
+    assert metrics.NOTIFICATION_QUEUE_HIGH_WATER_MARK.get(queue.name) == 100
+    assert metrics.NOTIFICATION_QUEUE_OVERFLOWS.get(queue.name, "dropped") == \
+        queue.dropped_count
+    # The newest notifications are kept.
+    notifications = await drain(queue)
+    assert [ notification["sequence"] for _index, notification in notifications ] == \
+        list(range(5 * 20000 - 100, 5 * 20000))
+
+
+async def test_notification_queue_coalesce() -> None:
+    queue = NotificationQueue[tuple[int, dict[str, object]]]("coalesce", 3, "coalesce",
+        lambda entry: entry[0] if entry[0] > 0 else None)
+    for channel_index, sequence in ((1, 1), (2, 1), (1, 2), (1, 3), (2, 2), (3, 1)):
+        queue.put_nowait(create_notification(channel_index, sequence))
+    # Once the queue is full the last waiting notification for a channel is replaced by a later
+    # one, and when there is no waiting notification for a channel the oldest is dropped.
+    notifications = await drain(queue)
+    assert [ (index, notification["sequence"]) for index, notification in notifications ] == \
+        [ (2, 2), (1, 3), (3, 1) ]
+    assert queue.coalesced_count == 2
+    assert queue.dropped_count == 1
+
+    # Notifications without a key are never replaced.
+    for sequence in range(4):
+        queue.put_nowait(create_notification(0, sequence))
+    notifications = await drain(queue)
+    assert [ notification["sequence"] for _index, notification in notifications ] == [ 1, 2, 3 ]
+    assert queue.dropped_count == 2
+
+
+async def test_notification_queue_block() -> None:
+    queue = NotificationQueue[tuple[int, dict[str, object]]]("block", 10, "block")
+
+    async def produce() -> None:
+        for sequence in range(50):
+            await queue.put_async(create_notification(1, sequence))
+
+    producer_task = asyncio.create_task(produce())
+    await asyncio.sleep(0.05)
+    # The producer waits for the stalled consumer rather than dropping notifications.
+    assert not producer_task.done()
+    assert queue.qsize() == 10
+
+    received: list[Optional[object]] = []
+    while len(received) < 50:
+        _index, notification = await asyncio.wait_for(queue.get(), 5)
+        received.append(notification["sequence"])
+    await producer_task
+    assert received == list(range(50))
+    assert queue.dropped_count == 0
+    assert queue.high_water_mark == 10
+
+
+async def test_notification_queue_block_memory_flat_when_consumer_stalls() -> None:
+    queue = NotificationQueue[tuple[int, dict[str, object]]]("stress_block_async", 100, "block",
+        lambda entry: entry[0])
+    notification_count = 20000
+
+    async def produce() -> None:
+        for sequence in range(notification_count):
+            await queue.put_async(create_notification(sequence % 500, sequence))
+
+    # Nothing is read from the queue while a producer that waits for space writes a burst of
+    # notifications for many channels to it.
+    tracemalloc.start()
+    try:
+        producer_task = asyncio.create_task(produce())
+        allocated_sizes: list[int] = []
+        for i in range(5):
+            await asyncio.sleep(0.02)
+            allocated_sizes.append(tracemalloc.get_traced_memory()[0])
+            assert not producer_task.done()
+            assert queue.qsize() == 100
+
+        # Once the consumer reads again every notification is received, and the queue never
+        # holds more than its size.
+        for sequence in range(notification_count):
+            _index, notification = await asyncio.wait_for(queue.get(), 5)
+            assert notification["sequence"] == sequence
+            if sequence % 2000 == 0:
+                allocated_sizes.append(tracemalloc.get_traced_memory()[0])
+        await producer_task
+    finally:
+        tracemalloc.stop()
+
+    assert max(allocated_sizes) - min(allocated_sizes) < 100 * 1024
+    assert queue.high_water_mark == 100
+    assert queue.dropped_count == 0
+    assert queue.coalesced_count == 0
+
+
+def test_notification_queue_invalid_configuration() -> None:
+    with pytest.raises(ValueError):
+        NotificationQueue[int]("invalid", 0, "block")
+    with pytest.raises(ValueError):
+        NotificationQueue[int]("invalid", 10, "drop_newest")   # type: ignore[arg-type]
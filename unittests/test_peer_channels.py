@@ -7,6 +7,9 @@ import json
 import logging
 import os
 from pathlib import Path
+import time
+import unittest.mock
+import zlib
 
 from esv_reference_server.utils import from_isoformat
 
@@ -26,8 +29,15 @@ import pytest
 import requests
 
 from esv_reference_server.application_state import ApplicationState
+from esv_reference_server.constants import PayloadEncoding
 from esv_reference_server.errors import WebsocketUnauthorizedException
+from esv_reference_server.msg_box.compression import PayloadCompressor
+from esv_reference_server.msg_box.models import Message
+from esv_reference_server.msg_box.types import MessageRow
+from esv_reference_server import metrics
+from esv_reference_server.response_compression import ResponseCompressor
 from esv_reference_server import sqlite_db
+from esv_reference_server.types import NotificationJsonData
 
 from .conftest import _wrong_auth_type, _bad_token, _successful_call, _no_auth, \
     _subscribe_to_general_notifications_peer_channels, TEST_EXTERNAL_HOST, TEST_HREF_HOST, \
@@ -35,6 +45,8 @@ from .conftest import _wrong_auth_type, _bad_token, _successful_call, _no_auth,
 
 WS_URL_TEMPLATE_MSG_BOX = "ws://"+ TEST_EXTERNAL_HOST +":"+ str(TEST_EXTERNAL_PORT) + \
     "/api/v1/channel/{channelid}/notify"
+WS_URL_MSG_BOXES = "ws://"+ TEST_EXTERNAL_HOST +":"+ str(TEST_EXTERNAL_PORT) + \
+    "/api/v1/channel/notify"
 
 PRIVATE_KEY_1 = PrivateKey.from_hex(
     "720f1987db69efa562b3dabd78e51f19bd8da76c70ad839b72b939f4071b144b")
@@ -487,6 +499,140 @@ class TestAiohttpRESTAPI:
         assert response_body['content_type'] == 'application/json'
         assert response_body['payload'] == expected_response_body
 
+    @pytest.mark.asyncio
+    async def test_write_message_chunked_upload(self) -> None:
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        URL = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/api/v1/channel/{CHANNEL_ID}"
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "Authorization": f"Bearer {CHANNEL_BEARER_TOKEN}",
+        }
+
+        # A generator body is sent with chunked encoding, without a `Content-Length` header.
+        payload = os.urandom(40000)
+        result = requests.post(URL, data=(payload[i:i+10000] for i in range(0, 40000, 10000)),
+            headers=headers)
+        assert result.status_code == 200, result.reason
+        assert base64.b64decode(result.json()['payload']) == payload
+
+        # The limit is 65536 bytes, see `conftest.py`.
+        result = requests.post(URL, data=(payload for i in range(2)), headers=headers)
+        assert result.status_code == HTTPStatus.REQUEST_ENTITY_TOO_LARGE, result.reason
+
+        result = requests.post(URL, data=(b"" for i in range(1)), headers=headers)
+        assert result.status_code == HTTPStatus.BAD_REQUEST, result.reason
+
+    @pytest.mark.asyncio
+    async def test_write_message_compressed_payload(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        URL = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/api/v1/channel/{CHANNEL_ID}"
+        headers = { "Authorization": f"Bearer {CHANNEL_BEARER_TOKEN}" }
+        json_payload = json.dumps([ {"key": "value"} ] * 100).encode()
+        binary_payload = os.urandom(1000)
+
+        payload_compressor = application_state.payload_compressor
+        application_state.payload_compressor = PayloadCompressor(PayloadEncoding.DEFLATE, 100)
+        try:
+            for content_type, payload in (("application/json", json_payload),
+                    ("application/octet-stream", binary_payload)):
+                result = requests.post(URL, data=payload,
+                    headers=headers | { "Content-Type": content_type })
+                assert result.status_code == 200, result.reason
+                assert base64.b64decode(result.json()['payload']) == payload
+        finally:
+            application_state.payload_compressor = payload_compressor
+
+        # Payloads are decompressed for clients that do not accept the codec.
+        result = requests.get(URL, headers=headers)
+        assert result.status_code == 200, result.reason
+        response_body = result.json()
+        assert [ base64.b64decode(entry['payload']) for entry in response_body ] == \
+            [ json_payload, binary_payload ]
+        assert all('content_encoding' not in entry for entry in response_body)
+
+        # Only the JSON payload is compressed.
+        result = requests.get(URL, headers=headers | { "Accept-Payload-Encoding": "deflate" })
+        assert result.status_code == 200, result.reason
+        response_body = result.json()
+        assert response_body[0]['content_encoding'] == 'deflate'
+        assert zlib.decompress(base64.b64decode(response_body[0]['payload'])) == json_payload
+        assert 'content_encoding' not in response_body[1]
+        assert base64.b64decode(response_body[1]['payload']) == binary_payload
+
+    @pytest.mark.asyncio
+    async def test_get_messages_compressed_response(self) -> None:
+        response_compressor = ResponseCompressor(1024, 65536, [ "gzip" ])
+        assert response_compressor.choose_codec("gzip, deflate") == "gzip"
+        assert response_compressor.choose_codec("br;q=1.0, gzip;q=0.5") == "gzip"
+        assert response_compressor.choose_codec("gzip;q=0") is None
+        assert response_compressor.choose_codec("*") == "gzip"
+        assert response_compressor.choose_codec("identity") is None
+
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        URL = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/api/v1/channel/{CHANNEL_ID}"
+        headers = { "Authorization": f"Bearer {CHANNEL_BEARER_TOKEN}" }
+        payload = json.dumps([ {"key": "value"} ] * 200).encode()
+        result = requests.post(URL, data=payload,
+            headers=headers | { "Content-Type": "application/json" })
+        assert result.status_code == 200, result.reason
+
+        ROUTE_NAME = "/api/v1/channel/{channelid}"
+        saved_bytes = metrics.HTTP_RESPONSE_COMPRESSION_SAVED_BYTES.get(ROUTE_NAME, "gzip")
+        result = requests.get(URL, headers=headers | { "Accept-Encoding": "gzip" })
+        assert result.status_code == 200, result.reason
+        assert result.headers['Content-Encoding'] == "gzip"
+        assert result.headers['Vary'] == "Accept-Encoding"
+        assert int(result.headers['Content-Length']) < len(result.content)
+        assert base64.b64decode(result.json()[0]['payload']) == payload
+        assert metrics.HTTP_RESPONSE_COMPRESSION_SAVED_BYTES.get(ROUTE_NAME, "gzip") > \
+            saved_bytes
+
+        result = requests.get(URL, headers=headers | { "Accept-Encoding": "identity" })
+        assert result.status_code == 200, result.reason
+        assert 'Content-Encoding' not in result.headers
+        assert base64.b64decode(result.json()[0]['payload']) == payload
+
+    @pytest.mark.asyncio
+    async def test_list_channels_paginated(self) -> None:
+        for i in range(3):
+            await self._create_new_channel()
+
+        URL = "http://"+ TEST_EXTERNAL_HOST +":"+ str(TEST_EXTERNAL_PORT) + \
+            "/api/v1/channel/manage/list"
+        headers = { "Authorization": f"Bearer {self._api_key}" }
+        result = requests.get(URL, headers=headers)
+        assert result.status_code == 200, result.reason
+        all_channels = result.json()
+        assert 'Link' not in result.headers
+
+        # The pages follow the `Link` header until a page is not full.
+        paged_channels: list[dict[str, object]] = []
+        next_url: str|None = URL +"?limit=2"
+        while next_url is not None:
+            result = requests.get(next_url, headers=headers)
+            assert result.status_code == 200, result.reason
+            page = result.json()
+            assert len(page) <= 2
+            paged_channels.extend(page)
+            next_url = result.links['next']['url'] if 'next' in result.links else None
+            if next_url is not None:
+                assert len(page) == 2
+                next_url = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}{next_url}"
+        assert paged_channels == all_channels
+
+        result = requests.get(URL, headers=headers,
+            params={ "after": all_channels[0]['id'], "limit": 1 })
+        assert result.status_code == 200, result.reason
+        assert result.json() == all_channels[1:2]
+
+        for params in ({ "limit": "0" }, { "limit": "x" }, { "after": "unknown" }):
+            result = requests.get(URL, headers=headers, params=params)
+            assert result.status_code == HTTPStatus.BAD_REQUEST, result.reason
+
     @pytest.mark.asyncio
     async def test_get_messages_head(self) -> None:
         CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
@@ -507,6 +653,139 @@ class TestAiohttpRESTAPI:
         assert result.headers['ETag'] == "1"
         assert result.content == b''
 
+    @pytest.mark.asyncio
+    async def test_get_messages_head_cached(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+        repository = application_state.msg_box_repository
+
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        CHANNEL_READ_ONLY_TOKEN_ID, CHANNEL_READ_ONLY_TOKEN = \
+            await self._create_channel_read_token(CHANNEL_ID)
+        URL = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/api/v1/channel/{CHANNEL_ID}"
+        reader_headers = {"Authorization": f"Bearer {CHANNEL_READ_ONLY_TOKEN}"}
+        writer_headers = {"Authorization": f"Bearer {CHANNEL_BEARER_TOKEN}"}
+        assert requests.head(URL, headers=reader_headers).headers['ETag'] == "0"
+        self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+
+        # The cached latest message is updated by the write, and the tokens are cached.
+        with unittest.mock.patch.object(repository, "get_api_token_async") as token_mock, \
+                unittest.mock.patch.object(repository, "get_msg_box_head_async") as head_mock:
+            assert requests.head(URL, headers=reader_headers).headers['ETag'] == "1"
+            # A token is not given the sequence of the messages it wrote itself.
+            assert requests.head(URL, headers=writer_headers).headers['ETag'] == "0"
+            assert token_mock.call_count == 0
+            assert head_mock.call_count == 0
+
+        # A revoked token is no longer cached.
+        self._revoke_token(CHANNEL_ID, CHANNEL_READ_ONLY_TOKEN_ID)
+        with unittest.mock.patch.object(repository, "get_api_token_async",
+                return_value=None) as token_mock:
+            result = requests.head(URL, headers=reader_headers)
+            assert result.status_code == HTTPStatus.UNAUTHORIZED
+            assert token_mock.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_get_messages_not_modified(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+        repository = application_state.msg_box_repository
+
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        CHANNEL_READ_ONLY_TOKEN_ID, CHANNEL_READ_ONLY_TOKEN = \
+            await self._create_channel_read_token(CHANNEL_ID)
+        self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+        URL = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/api/v1/channel/{CHANNEL_ID}"
+        headers = {"Authorization": f"Bearer {CHANNEL_READ_ONLY_TOKEN}"}
+        result = requests.get(URL, headers=headers, params={"unread": "true"})
+        assert result.status_code == HTTPStatus.OK
+        assert result.headers['ETag'] == 'W/"1-0"'
+
+        # The messages are not read if the client already has them.
+        not_modified_count = metrics.MESSAGE_BOX_MESSAGE_LIST_READS.get("not_modified")
+        with unittest.mock.patch.object(repository, "get_messages_async") as get_mock:
+            for if_none_match in ('W/"1-0"', '"1-0"', "1-0", 'W/"0-0", W/"1-0"'):
+                result = requests.get(URL, params={"unread": "true"},
+                    headers={**headers, "If-None-Match": if_none_match})
+                assert result.status_code == HTTPStatus.NOT_MODIFIED
+                assert result.headers['ETag'] == 'W/"1-0"'
+                assert result.content == b""
+            assert get_mock.call_count == 0
+        assert metrics.MESSAGE_BOX_MESSAGE_LIST_READS.get("not_modified") == \
+            not_modified_count + 4
+
+        # Marking the message as read changes the unread messages, but not the latest sequence.
+        result = requests.post(f"{URL}/1", headers=headers, json={"read": True})
+        assert result.status_code == HTTPStatus.OK
+        result = requests.get(URL, params={"unread": "true"},
+            headers={**headers, "If-None-Match": 'W/"1-0"'})
+        assert result.status_code == HTTPStatus.OK
+        assert result.headers['ETag'] == 'W/"1-1"'
+        assert result.json() == []
+        result = requests.get(URL, params={"unread": "true"},
+            headers={**headers, "If-None-Match": result.headers['ETag']})
+        assert result.status_code == HTTPStatus.NOT_MODIFIED
+        # The latest sequence that HEAD gives does not describe the marked messages, and the
+        # messages are always returned for it.
+        result = requests.head(URL, headers=headers)
+        assert result.headers['ETag'] == "1"
+        result = requests.get(URL, params={"unread": "true"},
+            headers={**headers, "If-None-Match": result.headers['ETag']})
+        assert result.status_code == HTTPStatus.OK
+        assert result.json() == []
+
+        self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+        result = requests.get(URL, params={"unread": "true"},
+            headers={**headers, "If-None-Match": 'W/"1-1"'})
+        assert result.status_code == HTTPStatus.OK
+        assert result.headers['ETag'] == 'W/"2-1"'
+        assert [ message['sequence'] for message in result.json() ] == [ 2 ]
+
+    @pytest.mark.asyncio
+    async def test_get_messages_long_poll(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        CHANNEL_READ_ONLY_TOKEN_ID, CHANNEL_READ_ONLY_TOKEN = \
+            await self._create_channel_read_token(CHANNEL_ID)
+        self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+        URL = f"http://{TEST_EXTERNAL_HOST}:{TEST_EXTERNAL_PORT}/api/v1/channel/{CHANNEL_ID}"
+        headers = {"Authorization": f"Bearer {CHANNEL_READ_ONLY_TOKEN}",
+            "If-None-Match": 'W/"1-0"'}
+
+        for wait in ("-1", "soon", "nan"):
+            result = requests.get(URL, headers=headers, params={"wait": wait})
+            assert result.status_code == HTTPStatus.BAD_REQUEST
+
+        # Nothing is written, so the client still has the latest messages when the time is up.
+        result = requests.get(URL, headers=headers, params={"wait": "0.2"})
+        assert result.status_code == HTTPStatus.NOT_MODIFIED
+        assert result.headers['ETag'] == 'W/"1-0"'
+
+        # The waiting request is answered as soon as a message is written.
+        get_task = asyncio.create_task(asyncio.to_thread(requests.get, URL, headers=headers,
+            params={"wait": "30", "unread": "true"}))
+        while not application_state._msg_box_message_waiters:
+            await asyncio.sleep(0.01)
+        self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+        result = await asyncio.wait_for(get_task, 10)
+        assert result.status_code == HTTPStatus.OK
+        assert result.headers['ETag'] == 'W/"2-0"'
+        assert [ message['sequence'] for message in result.json() ] == [ 1, 2 ]
+        assert application_state._msg_box_message_waiters == {}
+        assert application_state._msg_box_long_poll_counts == {}
+
+        with unittest.mock.patch.object(application_state, "_msg_box_long_poll_account_limit", 0):
+            result = requests.get(URL, headers=headers, params={"wait": "1"})
+            assert result.status_code == HTTPStatus.TOO_MANY_REQUESTS
+            # Requests that do not wait are not limited.
+            result = requests.get(URL, headers={**headers, "If-None-Match": 'W/"2-0"'})
+            assert result.status_code == HTTPStatus.NOT_MODIFIED
+
     @pytest.mark.asyncio
     async def test_get_messages_unread_should_get_one(self) -> None:
         CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
@@ -529,7 +808,7 @@ class TestAiohttpRESTAPI:
         self.logger.debug("test_get_messages_head url: %s", URL)
         result = _successful_call(URL, HTTP_METHOD, None, None,
             CHANNEL_READ_ONLY_TOKEN)
-        assert result.headers['ETag'] == "1"
+        assert result.headers['ETag'] == 'W/"1-0"'
         response_body = result.json()
         assert isinstance(response_body, list)
         assert response_body[0]['sequence'] == 1
@@ -740,6 +1019,251 @@ class TestAiohttpRESTAPI:
 
         asyncio.run(main())
 
+    @pytest.mark.asyncio
+    async def test_channels_websocket_since(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+        repository = application_state.msg_box_repository
+
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        for i in range(3):
+            self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+        url = WS_URL_TEMPLATE_MSG_BOX.format(channelid=CHANNEL_ID)
+
+        async with aiohttp.ClientSession() as session:
+            with pytest.raises(WSServerHandshakeError):
+                await session.ws_connect(url, params={"token": CHANNEL_BEARER_TOKEN,
+                    "since": "-1"})
+
+        # A message is written after the last page of missed messages is read, and the
+        # notifications for it and for the last missed message are both held until the missed
+        # messages are sent.
+        get_messages_async = repository.get_messages_async
+        message_box_ids: list[int] = []
+        message_rows_written: list[MessageRow] = []
+        async def get_messages_and_write_async(api_token_id: int, onlyunread: bool,
+                after_sequence: int=0, limit: int | None=None) \
+                    -> tuple[list[MessageRow], int | None]:
+            result = await get_messages_async(api_token_id, onlyunread, after_sequence, limit)
+            message_box_ids.extend(message_row.message_box_id for message_row in result[0])
+            if len(result[0]) > 0 or len(message_rows_written) > 0:
+                return result
+            message_row = await repository.write_message_async(Message(
+                msg_box_id=message_box_ids[0], msg_box_api_token_id=api_token_id,
+                content_type="application/json", payload=b"{}", received_ts=int(time.time())))
+            message_rows_written.append(message_row)
+            for sequence in (3, message_row.sequence):
+                await application_state.publish_message_box_notification_async(
+                    message_row.message_box_id,
+                    NotificationJsonData(sequence=sequence, received="", content_type="",
+                        channel_id=CHANNEL_ID))
+            await asyncio.sleep(0.1)
+            return result
+
+        async with aiohttp.ClientSession() as session:
+            with unittest.mock.patch.object(repository, "get_messages_async",
+                    get_messages_and_write_async):
+                ws = await session.ws_connect(url, params={"token": CHANNEL_BEARER_TOKEN,
+                    "since": "1", "payloads": "true"}, timeout=5.0)
+                notifications = [ await ws.receive_json(timeout=5.0) for i in range(3) ]
+            assert [ notification["sequence"] for notification in notifications ] == [ 2, 3, 4 ]
+            assert [ "payload" in notification for notification in notifications ] == \
+                [ True, True, False ]
+            assert notifications[0]["channel_id"] == CHANNEL_ID
+            # The server thread stops holding notifications after it sends the last held one.
+            for i in range(50):
+                if application_state._msg_box_ws_catch_up_notifications == {}:
+                    break
+                await asyncio.sleep(0.02)
+            assert application_state._msg_box_ws_catch_up_notifications == {}
+
+            # Once caught up the websocket is notified of new messages as usual.
+            self._write_message(CHANNEL_ID, CHANNEL_BEARER_TOKEN)
+            notification = await ws.receive_json(timeout=5.0)
+            assert notification["sequence"] == 5
+            await ws.close()
+
+    @pytest.mark.asyncio
+    async def test_channels_multi_channel_websocket(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+
+        channels = [ await self._create_new_channel() for i in range(3) ]
+        async with aiohttp.ClientSession() as session:
+            ws = await session.ws_connect(WS_URL_MSG_BOXES, timeout=5.0)
+            for channel_id, token, _token_id in channels:
+                await ws.send_json({ "action": "subscribe", "channel_id": channel_id,
+                    "token": token })
+                assert await ws.receive_json(timeout=5.0) == { "action": "subscribed",
+                    "channel_id": channel_id }
+            await ws.send_json({ "action": "subscribe", "channel_id": channels[0][0],
+                "token": channels[1][1] })
+            response = await ws.receive_json(timeout=5.0)
+            assert response["action"] == "error"
+            assert response["channel_id"] == channels[0][0]
+            # The websocket shares the index used to notify the websockets for one channel.
+            ws_ids = application_state.ws_clients_by_messagebox_id.values()
+            assert sum(len(ws_ids_) for ws_ids_ in ws_ids) == 3
+
+            # A websocket can only be subscribed to so many channels, and this is checked before
+            # the token.
+            extra_channel_id, _extra_token, _extra_token_id = await self._create_new_channel()
+            with unittest.mock.patch.object(application_state,
+                    "msg_box_websocket_subscription_limit", 3):
+                await ws.send_json({ "action": "subscribe", "channel_id": extra_channel_id,
+                    "token": "invalid" })
+                assert await ws.receive_json(timeout=5.0) == { "action": "error",
+                    "channel_id": extra_channel_id,
+                    "reason": "Too many channel subscriptions for this websocket" }
+                # Subscribing again to a subscribed channel does not count towards the limit.
+                await ws.send_json({ "action": "subscribe", "channel_id": channels[2][0],
+                    "token": channels[2][1] })
+                assert await ws.receive_json(timeout=5.0) == { "action": "subscribed",
+                    "channel_id": channels[2][0] }
+            assert sum(len(ws_ids_) for ws_ids_ in ws_ids) == 3
+
+            for channel_id, token, _token_id in reversed(channels):
+                self._write_message(channel_id, token)
+                notification = await ws.receive_json(timeout=5.0)
+                assert notification["channel_id"] == channel_id
+                assert notification["sequence"] == 1
+
+            await ws.send_json({ "action": "unsubscribe", "channel_id": channels[0][0] })
+            assert await ws.receive_json(timeout=5.0) == { "action": "unsubscribed",
+                "channel_id": channels[0][0] }
+            self._write_message(channels[0][0], channels[0][1])
+            self._write_message(channels[1][0], channels[1][1])
+            notification = await ws.receive_json(timeout=5.0)
+            assert notification["channel_id"] == channels[1][0]
+            await ws.close()
+        while application_state.ws_clients_by_messagebox_id:
+            await asyncio.sleep(0.01)
+
+    @pytest.mark.asyncio
+    async def test_websocket_notifications_coalesced(self) -> None:
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        CHANNEL_RW_TOKEN_ID, CHANNEL_RW_TOKEN = \
+            await self._create_channel_read_token(CHANNEL_ID, can_write=True)
+        url = WS_URL_TEMPLATE_MSG_BOX.format(channelid=CHANNEL_ID)
+
+        async with aiohttp.ClientSession() as session:
+            for coalesce in ("-1", "soon", "60"):
+                with pytest.raises(WSServerHandshakeError):
+                    await session.ws_connect(url, params={"token": CHANNEL_BEARER_TOKEN,
+                        "coalesce": coalesce})
+
+            channel_ws = await session.ws_connect(url, params={"token": CHANNEL_BEARER_TOKEN,
+                "coalesce": "0.5"}, timeout=5.0)
+            account_ws = await session.ws_connect(WS_URL_GENERAL, params={"token": self._api_key,
+                "coalesce": "0.5"}, timeout=5.0)
+            # The burst of messages is sent as one notification on each websocket.
+            for i in range(3):
+                self._write_message(CHANNEL_ID, CHANNEL_RW_TOKEN)
+            notification = await channel_ws.receive_json(timeout=5.0)
+            assert notification["channel_id"] == CHANNEL_ID
+            assert notification["sequence"] == 3
+            assert notification["count"] == 3
+            account_message = await account_ws.receive_json(timeout=5.0)
+            assert account_message["message_type"] == "bsvapi.channels.notification"
+            assert account_message["result"]["sequence"] == 3
+            assert account_message["result"]["count"] == 3
+            with pytest.raises(asyncio.TimeoutError):
+                await channel_ws.receive_json(timeout=0.6)
+
+            self._write_message(CHANNEL_ID, CHANNEL_RW_TOKEN)
+            notification = await channel_ws.receive_json(timeout=5.0)
+            assert notification["sequence"] == 4
+            assert notification["count"] == 1
+            await channel_ws.close()
+            await account_ws.close()
+
+    @pytest.mark.asyncio
+    async def test_websocket_account_outbox(self) -> None:
+        assert ApplicationState.singleton_reference is not None
+        application_state = ApplicationState.singleton_reference()
+        assert application_state is not None
+        account_id, _account_flags = application_state.get_account_id_for_api_key(self._api_key)
+        assert account_id is not None
+        CHANNEL_ID, CHANNEL_BEARER_TOKEN, CHANNEL_BEARER_TOKEN_ID = await self._create_new_channel()
+        CHANNEL_RW_TOKEN_ID, CHANNEL_RW_TOKEN = \
+            await self._create_channel_read_token(CHANNEL_ID, can_write=True)
+
+        async with aiohttp.ClientSession() as session:
+            for params in ({ "outbox": "true", "coalesce": "0.5" },
+                    { "outbox": "true", "last_id": "soon" }):
+                with pytest.raises(WSServerHandshakeError):
+                    await session.ws_connect(WS_URL_GENERAL,
+                        params={ "token": self._api_key, **params })
+
+            params = { "token": self._api_key, "outbox": "true" }
+            account_ws = await session.ws_connect(WS_URL_GENERAL, params=params, timeout=5.0)
+            self._write_message(CHANNEL_ID, CHANNEL_RW_TOKEN)
+            account_message = await account_ws.receive_json(timeout=5.0)
+            assert account_message["message_type"] == "bsvapi.channels.notification"
+            first_message_id = account_message["id"]
+            await account_ws.send_json({ "ack": first_message_id })
+            await account_ws.close()
+
+            # The notifications written while disconnected are kept, compacted to the last one
+            # for the channel, and sent on reconnection.
+            for i in range(2):
+                self._write_message(CHANNEL_ID, CHANNEL_RW_TOKEN)
+            await asyncio.sleep(0.2)
+            account_ws = await session.ws_connect(WS_URL_GENERAL, params=params, timeout=5.0)
+            account_message = await account_ws.receive_json(timeout=5.0)
+            assert account_message["result"]["channel_id"] == CHANNEL_ID
+            assert account_message["result"]["sequence"] == 3
+            assert account_message["id"] > first_message_id
+            assert account_message["id"] < 2 ** 53
+            with pytest.raises(asyncio.TimeoutError):
+                await account_ws.receive_json(timeout=0.5)
+            await account_ws.send_json({ "ack": account_message["id"] })
+            await account_ws.close()
+
+            # Nothing is sent after the last acknowledged message, unless the client asks.
+            account_ws = await session.ws_connect(WS_URL_GENERAL, params=params, timeout=5.0)
+            with pytest.raises(asyncio.TimeoutError):
+                await account_ws.receive_json(timeout=0.5)
+            self._write_message(CHANNEL_ID, CHANNEL_RW_TOKEN)
+            live_message = await account_ws.receive_json(timeout=5.0)
+            assert live_message["result"]["sequence"] == 4
+            assert live_message["id"] > account_message["id"]
+            await account_ws.close()
+
+            account_ws = await session.ws_connect(WS_URL_GENERAL,
+                params={ **params, "last_id": str(account_message["id"]) }, timeout=5.0)
+            replayed_message = await account_ws.receive_json(timeout=5.0)
+            assert replayed_message == live_message
+            # The ids of the messages of another worker process are not acknowledged.
+            await account_ws.send_json({ "ack": live_message["id"] + 1 })
+            assert (await account_ws.receive(timeout=5.0)).type == aiohttp.WSMsgType.CLOSE
+            await account_ws.close()
+            assert application_state.account_outbox.get_acknowledged_id(account_id) == \
+                account_message["id"]
+
+            # A client that was connected to another worker process has to resynchronise.
+            with pytest.raises(WSServerHandshakeError):
+                await session.ws_connect(WS_URL_GENERAL,
+                    params={ **params, "last_id": str(live_message["id"] + 1) })
+
+            # The messages sent to a client that does not use the outbox are not kept, as it
+            # cannot acknowledge them.
+            account_ws = await session.ws_connect(WS_URL_GENERAL,
+                params={ "token": self._api_key }, timeout=5.0)
+            self._write_message(CHANNEL_ID, CHANNEL_RW_TOKEN)
+            account_message = await account_ws.receive_json(timeout=5.0)
+            assert account_message["result"]["sequence"] == 5
+            assert "id" not in account_message
+            await account_ws.close()
+            await asyncio.sleep(0.2)
+            account_ws = await session.ws_connect(WS_URL_GENERAL, params={ **params,
+                "last_id": str(live_message["id"]) }, timeout=5.0)
+            with pytest.raises(asyncio.TimeoutError):
+                await account_ws.receive_json(timeout=0.5)
+            await account_ws.close()
+
     def test_general_purpose_websocket_bad_auth_should_fail(self) -> None:
         async def wait_on_sub(url: str, api_token: str,
                               expected_count: int, completion_event: asyncio.Event) -> None: